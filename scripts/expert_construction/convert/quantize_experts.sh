@@ -0,0 +1,31 @@
+#!/usr/bin/bash
+
+#SBATCH --job-name=quantize-experts
+#SBATCH --output=logs_split/%x-%j.log
+#SBATCH --error=logs_split/%x-%j.log
+
+#SBATCH --partition=MoE
+#SBATCH --ntasks-per-node=1
+#SBATCH --cpus-per-task=16
+#SBATCH --mem=0
+
+#SBATCH --nodes=1
+#SBATCH --gres=gpu:0
+#SBATCH --quotatype=auto
+
+
+{
+  folder_name="split-gradient-max-ShareFalse-8MoE-Top2-Scale1.0-Dense0"  # an existing MoE model
+
+  model_path="/mnt/petrelfs/share_data/quxiaoye/llama_moe_v2/converted_models/${folder_name}"
+
+  bits=4
+  group_size=128
+  save_path="/mnt/petrelfs/share_data/quxiaoye/llama_moe_v2/converted_models/${folder_name}-Int${bits}-Group${group_size}"
+
+  srun python smoe/entrypoint/expert_construction/convert/quantize_experts.py \
+    --model_path ${model_path} \
+    --save_path ${save_path} \
+    --bits ${bits} \
+    --group_size ${group_size}
+}
@@ -0,0 +1,37 @@
+#!/usr/bin/bash
+
+#SBATCH --job-name=split-coact
+#SBATCH --output=logs_split/%x-%j.log
+#SBATCH --error=logs_split/%x-%j.log
+
+#SBATCH --partition=MoE
+#SBATCH --ntasks-per-node=1
+#SBATCH --cpus-per-task=16
+#SBATCH --mem=0
+
+#SBATCH --nodes=1
+#SBATCH --gres=gpu:1
+#SBATCH --quotatype=auto
+
+# reserved spot auto
+
+{
+  model_path="/mnt/petrelfs/share_data/quxiaoye/models/ReluLLaMA-7B"
+  data_path="/mnt/petrelfs/share_data/quxiaoye/data/llama1_7B_val_set_tokenized/mixed.jsonl"
+
+  num_experts=8
+  use_relu="True"
+  num_neighbors=64
+  normalize="jaccard"
+
+  save_path="/mnt/petrelfs/huxuyang/push/LLaMA-MoE-v2/resources/llama_moe_v2/split-coactivation-${normalize}-${num_experts}MoE"
+
+  srun python smoe/entrypoint/expert_construction/split/split_coactivation.py \
+    --model_path ${model_path} \
+    --data_path ${data_path} \
+    --save_path ${save_path} \
+    --num_experts ${num_experts} \
+    --use_relu ${use_relu} \
+    --num_neighbors ${num_neighbors} \
+    --normalize ${normalize}
+}
@@ -8,6 +8,13 @@ from transformers.integrations import TensorBoardCallback, rewrite_logs
 from smoe.utils.visualization.visualize import get_heatmap_img_grid_for_tb
 
 
+def _consumed_tokens(args: TrainingArguments, state: TrainerState) -> int:
+    """Counted non-padding tokens of `EnhancedTrainerState`, nominal tokens of other states."""
+    if hasattr(state, "tot_consumed_tokens"):
+        return state.tot_consumed_tokens
+    return state.global_step * args.num_tokens_per_batch
+
+
 class EnhancedTensorboardCallback(TensorBoardCallback):
     def __init__(self, tb_writer=None):
         super().__init__(tb_writer)
@@ -28,27 +35,31 @@ class EnhancedTensorboardCallback(TensorBoardCallback):
 
         if self.tb_writer is not None:
             logs.update({"Buggy_Estimated_Total_FLOPs": state.total_flos})
-            free_mem, tot_mem = torch.cuda.mem_get_info()
-            used_mem = (tot_mem - free_mem) / 1024**3
-            gpu_util = torch.cuda.utilization()
-            logs.update({"GPU_Mem_GB": used_mem, "GPU_Util": gpu_util})
+            if torch.cuda.is_available():
+                # allocator counters are host-side, no driver query or device sync
+                logs["GPU_Mem_GB"] = torch.cuda.memory_reserved() / 1024**3
+                logs["GPU_Max_Mem_GB"] = torch.cuda.max_memory_reserved() / 1024**3
+                if control.should_evaluate:
+                    # NVML query, only on evaluation steps
+                    try:
+                        logs["GPU_Util"] = torch.cuda.utilization()
+                    except Exception:
+                        pass
             logs = rewrite_logs(logs)
             for k, v in logs.items():
                 if isinstance(v, (int, float)):
                     self.tb_writer.add_scalar(k, v, state.global_step)
                     if k == "train/loss":
-                        tokens = state.global_step * args.num_tokens_per_batch
+                        tokens = _consumed_tokens(args, state)
                         token_loss_key = "train/loss_on_tokens"
                         self.tb_writer.add_scalar(token_loss_key, v, tokens)
                     elif k == "train/Buggy_Estimated_Total_FLOPs":
                         # write tokens per GPU per second (TGS) and Model FLOPs Utilization (MFU)
                         seconds = time.time() - state.start_timestamp
-                        tgs = (
-                            state.global_step
-                            * args.num_tokens_per_batch
-                            / args.world_size
-                            / seconds
+                        tokens = _consumed_tokens(args, state) - getattr(
+                            state, "start_consumed_tokens", 0
                         )
+                        tgs = tokens / args.world_size / seconds
                         self.tb_writer.add_scalar(
                             "train/Avg_TGS", tgs, state.global_step
                         )
@@ -66,11 +77,22 @@ class EnhancedTensorboardCallback(TensorBoardCallback):
                     self.tb_writer.add_scalar(k, _v, state.global_step)
                 elif k == "train/num_dropped_tokens" and isinstance(v, Iterable):
                     # (tensor(1.0), tensor(2.3)) -> [1.0, 2.3]
+                    if control.should_evaluate:
+                        self.tb_writer.add_image(
+                            k,
+                            get_heatmap_img_grid_for_tb(
+                                [
+                                    (
+                                        n
+                                        if isinstance(n, torch.Tensor)
+                                        else torch.tensor(n)
+                                    )
+                                    for n in v
+                                ]
+                            ),
+                            state.global_step,
+                        )
                     if all(isinstance(n, torch.Tensor) for n in v):
-                        if control.should_evaluate:
-                            self.tb_writer.add_image(
-                                k, get_heatmap_img_grid_for_tb(v), state.global_step
-                            )
                         v = [n.item() for n in v]
                     # self.tb_writer.add_scalars(
                     #     f"{k}/layer",
@@ -81,15 +103,16 @@ class EnhancedTensorboardCallback(TensorBoardCallback):
                 elif (
                     k == "train/gate_load" or k == "train/gate_importance"
                 ) and isinstance(v, Iterable):
-                    if not all(isinstance(n, torch.Tensor) for n in v):
-                        v = [torch.tensor(n) for n in v]
-                    # v: (tensor([1.0, 2.3, ... num_experts]), tensor([3.0, 4.5, ... num_experts]), ... num_layers)
+                    # v: [[1.0, 2.3, ... num_experts], [3.0, 4.5, ... num_experts], ... num_layers]
                     # self.tb_writer.add_scalars(
                     #     f"{k}/std/layer",
                     #     {str(i): n.std().item() for i, n in enumerate(v)},
                     #     state.global_step,
                     # )
+                    # heatmaps are rendered on evaluation steps only
                     if control.should_evaluate:
+                        if not all(isinstance(n, torch.Tensor) for n in v):
+                            v = [torch.tensor(n) for n in v]
                         self.tb_writer.add_image(
                             k, get_heatmap_img_grid_for_tb(v), state.global_step
                         )
@@ -98,11 +121,17 @@ class EnhancedTensorboardCallback(TensorBoardCallback):
                         self.tb_writer.add_scalar(
                             f"prob_map/{name}", val, state.global_step
                         )
-
-                # elif k == "train/consumed_tokens":
-                #     v.update({"total_tokens": sum(v.values())})
-                #     for name, val in v.items():
-                #         self.tb_writer.add_scalar(
-                #             f"consumed_tokens/{name}", val, state.global_step
-                #         )
+                elif k == "train/consumed_tokens" and isinstance(v, dict):
+                    # the real data mixture, to be compared with `prob_map`
+                    total_tokens = sum(v.values())
+                    for name, val in v.items():
+                        self.tb_writer.add_scalar(
+                            f"consumed_tokens/{name}", val, state.global_step
+                        )
+                        if total_tokens > 0:
+                            self.tb_writer.add_scalar(
+                                f"consumed_tokens_portion/{name}",
+                                val / total_tokens,
+                                state.global_step,
+                            )
             self.tb_writer.flush()
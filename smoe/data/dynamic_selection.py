@@ -1,5 +1,15 @@
+import math
+import random
+
 import numpy as np
 import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+
+from smoe.utils.io import load_json
+from smoe.utils.logging import get_logger
+
+logger = get_logger(__file__)
 
 LLAMA_DATA_PORTION = {
     "en_cc": 0.67,
@@ -122,6 +132,344 @@ def update_weight_sheared_llama(
     return {k: v for k, v in zip(task_types, updated_domain_weights)}
 
 
+DOMAIN_WEIGHT_UPDATE_FUNCS = {
+    "sheared_llama": update_weight_sheared_llama,
+    "sheared_llama_paper": update_weight_sheared_llama_paper,
+}
+
+
+def load_reference_loss(filepath: str = None) -> dict[str, float]:
+    """Reference losses from a json file (domain name -> loss), defaults to llama2-7B on SlimPajama"""
+    if filepath is None:
+        return dict(LLAMA2_7B_SLIMPAJAMA_VAL_REF_LOSS)
+    return {str(k): float(v) for k, v in load_json(filepath).items()}
+
+
+@torch.no_grad()
+def causal_lm_loss_per_sample(
+    logits: torch.Tensor,
+    labels: torch.Tensor,
+    ignore_index: int = -100,
+    chunk_size: int = 2048,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Token-level CE summed per sample, computed in chunks of tokens to bound the fp32 copy of logits.
+
+    Args:
+        logits: (bsz, seq_len, vocab_size)
+        labels: (bsz, seq_len), not shifted
+
+    Returns:
+        loss_sum: (bsz,) float32
+        num_tokens: (bsz,) float32
+    """
+    bsz = logits.shape[0]
+    shift_logits = logits[:, :-1].reshape(-1, logits.shape[-1])
+    shift_labels = labels[:, 1:].reshape(-1).to(logits.device)
+    token_losses = []
+    for start in range(0, shift_labels.shape[0], chunk_size):
+        token_losses.append(
+            F.cross_entropy(
+                shift_logits[start : start + chunk_size].float(),
+                shift_labels[start : start + chunk_size],
+                ignore_index=ignore_index,
+                reduction="none",
+            )
+        )
+    token_losses = torch.cat(token_losses).view(bsz, -1)
+    num_tokens = (labels[:, 1:] != ignore_index).to(token_losses.device).float()
+    return token_losses.sum(dim=1), num_tokens.sum(dim=1)
+
+
+class DomainProbeSet:
+    """
+    A small fixed token sample of each domain, cached once and re-scored at every probe.
+
+    Args:
+        datasets: domain name -> map-style dataset of `{"input_ids": [...]}` blocks,
+            e.g. the per-domain `CachedJsonlDataset` eval sets
+        num_blocks: number of blocks sampled from each domain
+    """
+
+    def __init__(
+        self,
+        datasets: dict[str, torch.utils.data.Dataset],
+        num_blocks: int = 8,
+        seed: int = 1227,
+    ):
+        rng = random.Random(seed)
+        self.domains = []
+        self.blocks = []
+        for domain, dataset in datasets.items():
+            indices = sorted(
+                rng.sample(range(len(dataset)), min(num_blocks, len(dataset)))
+            )
+            for idx in indices:
+                ins = dataset[idx]
+                input_ids = torch.tensor(ins["input_ids"], dtype=torch.long)
+                labels = torch.tensor(
+                    ins.get("labels", ins["input_ids"]), dtype=torch.long
+                )
+                self.domains.append(domain)
+                self.blocks.append((input_ids, labels))
+        logger.info(
+            f"Domain probe set: {len(self.blocks)} blocks from {len(datasets)} domains"
+        )
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def _get_block(self, idx: int = None) -> tuple[torch.Tensor, torch.Tensor]:
+        """The block at `idx`, or a dummy block with masked-out labels if `idx` is None"""
+        if idx is not None:
+            return self.blocks[idx]
+        input_ids = self.blocks[0][0]
+        return input_ids, torch.full_like(input_ids, -100)
+
+    @torch.no_grad()
+    def evaluate(
+        self, model, batch_size: int = 4, device: torch.device = None
+    ) -> dict[str, float]:
+        """Mean token loss of each domain. Blocks are sharded evenly over ranks and reduced."""
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        else:
+            rank, world_size = 0, 1
+        if device is None:
+            device = next(model.parameters()).device
+
+        names = sorted(set(self.domains))
+        name2idx = {name: i for i, name in enumerate(names)}
+        loss_sum = torch.zeros(len(names), device=device)
+        num_tokens = torch.zeros(len(names), device=device)
+        local = list(range(rank, len(self.blocks), world_size))
+        # every rank runs the same number of forwards (collectives inside the model, e.g. ZeRO-3),
+        # the missing blocks are filled with dummy ones whose labels are all masked out
+        num_local = math.ceil(len(self.blocks) / world_size)
+        local += [None] * (num_local - len(local))
+        for start in range(0, len(local), batch_size):
+            batch_ids = local[start : start + batch_size]
+            blocks = [self._get_block(i) for i in batch_ids]
+            input_ids = torch.nn.utils.rnn.pad_sequence(
+                [block[0] for block in blocks], batch_first=True
+            ).to(device)
+            labels = torch.nn.utils.rnn.pad_sequence(
+                [block[1] for block in blocks],
+                batch_first=True,
+                padding_value=-100,
+            ).to(device)
+            attention_mask = torch.nn.utils.rnn.pad_sequence(
+                [torch.ones_like(block[0]) for block in blocks],
+                batch_first=True,
+            ).to(device)
+            outputs = model(input_ids=input_ids, attention_mask=attention_mask)
+            _loss_sum, _num_tokens = causal_lm_loss_per_sample(outputs.logits, labels)
+            domain_ids = torch.tensor(
+                [0 if i is None else name2idx[self.domains[i]] for i in batch_ids],
+                device=device,
+            )
+            loss_sum.index_add_(0, domain_ids, _loss_sum.to(device))
+            num_tokens.index_add_(0, domain_ids, _num_tokens.to(device))
+
+        if world_size > 1:
+            dist.all_reduce(loss_sum)
+            dist.all_reduce(num_tokens)
+        loss_sum, num_tokens = loss_sum.tolist(), num_tokens.tolist()
+        return {
+            name: loss_sum[i] / num_tokens[i]
+            for i, name in enumerate(names)
+            if num_tokens[i] > 0
+        }
+
+
+class DomainReweightingEngine:
+    """
+    Domain reweighting for dynamic data selection.
+
+    Per-domain losses are estimated from the training batches themselves (tagged with
+    their source domain), so no eval pass is needed between reweighting steps.
+    The running training loss of a domain is shrunk towards its loss on the cached probe set
+    (`DomainProbeSet`) when the domain has only been seen a few times,
+    which also covers domains that are rarely sampled.
+
+    Args:
+        domains: domain names in the order of the `domain_id` tags (`source2idx`)
+        prob_map: initial sampling weights
+        ref_loss: domain name -> reference loss
+        method: key of `DOMAIN_WEIGHT_UPDATE_FUNCS`
+        ema_decay: decay of the running losses between two reweighting steps
+        probe_shrinkage: number of observed tokens (or samples if per-sample losses are unavailable)
+            at which training and probe losses weigh the same
+        probe_interval: re-score the probe set every `probe_interval` reweighting steps
+    """
+
+    def __init__(
+        self,
+        domains: list[str],
+        prob_map: dict[str, float],
+        ref_loss: dict[str, float],
+        method: str = "sheared_llama",
+        ema_decay: float = 0.9,
+        probe_shrinkage: float = 65536.0,
+        probe_interval: int = 4,
+    ):
+        if method not in DOMAIN_WEIGHT_UPDATE_FUNCS:
+            raise ValueError(
+                f"Unknown reweighting method: {method}, choices: {list(DOMAIN_WEIGHT_UPDATE_FUNCS)}"
+            )
+        self.domains = list(domains)
+        self.domain2idx = {name: i for i, name in enumerate(self.domains)}
+        self.prob_map = {name: prob_map[name] for name in self.domains}
+        self.ref_loss = dict(ref_loss)
+        self.method = method
+        self.ema_decay = ema_decay
+        self.probe_shrinkage = probe_shrinkage
+        self.probe_interval = probe_interval
+
+        # device-side sums of the current window, no host sync while training
+        self._loss_sum: torch.Tensor = None
+        self._num_tokens: torch.Tensor = None
+
+        num_domains = len(self.domains)
+        self.running_loss = np.full(num_domains, np.nan)
+        self.running_count = np.zeros(num_domains)
+        self.probe_loss = np.full(num_domains, np.nan)
+        self.num_steps = 0
+
+    def _init_window(self, device):
+        self._loss_sum = torch.zeros(len(self.domains), device=device)
+        self._num_tokens = torch.zeros(len(self.domains), device=device)
+
+    @torch.no_grad()
+    def observe(
+        self,
+        domain_ids: torch.Tensor,
+        labels: torch.Tensor = None,
+        loss_per_sample: torch.Tensor = None,
+        logits: torch.Tensor = None,
+        loss: torch.Tensor = None,
+    ):
+        """
+        Record the training losses of a batch.
+
+        Per-sample losses are taken from `loss_per_sample` (token losses summed per sample,
+        returned by the training forward) when available, otherwise computed from `logits`
+        and `labels`. If neither is available, the batch `loss` is assigned to every sample.
+        """
+        domain_ids = domain_ids.view(-1).long()
+        if self._loss_sum is None or self._loss_sum.device != domain_ids.device:
+            self._init_window(domain_ids.device)
+        if loss_per_sample is not None and labels is not None:
+            loss_sum = loss_per_sample.float()
+            num_tokens = (labels[:, 1:] != -100).sum(dim=1).float()
+        elif logits is not None and labels is not None:
+            loss_sum, num_tokens = causal_lm_loss_per_sample(logits, labels)
+        elif loss is not None:
+            num_tokens = torch.ones(domain_ids.shape[0], device=domain_ids.device)
+            loss_sum = loss.detach().float().expand_as(num_tokens)
+        else:
+            return
+        self._loss_sum.index_add_(0, domain_ids, loss_sum.to(domain_ids.device))
+        self._num_tokens.index_add_(0, domain_ids, num_tokens.to(domain_ids.device))
+
+    def should_probe(self) -> bool:
+        return self.probe_interval > 0 and self.num_steps % self.probe_interval == 0
+
+    def set_probe_losses(self, probe_losses: dict[str, float]):
+        for name, loss in probe_losses.items():
+            if name in self.domain2idx:
+                self.probe_loss[self.domain2idx[name]] = loss
+
+    def estimate_losses(self) -> dict[str, float]:
+        """Current loss estimate of each domain, `nan` if the domain has not been seen"""
+        has_probe = ~np.isnan(self.probe_loss)
+        has_train = ~np.isnan(self.running_loss)
+        weight = self.running_count / (self.running_count + self.probe_shrinkage)
+        estimate = np.where(
+            has_probe & has_train,
+            weight * np.nan_to_num(self.running_loss)
+            + (1.0 - weight) * np.nan_to_num(self.probe_loss),
+            np.where(has_train, self.running_loss, self.probe_loss),
+        )
+        return {name: float(estimate[i]) for i, name in enumerate(self.domains)}
+
+    def step(self) -> dict[str, float]:
+        """Fold the current window into the running losses and return the new prob_map"""
+        if self._loss_sum is not None:
+            loss_sum, num_tokens = self._loss_sum, self._num_tokens
+            if dist.is_available() and dist.is_initialized():
+                loss_sum, num_tokens = loss_sum.clone(), num_tokens.clone()
+                dist.all_reduce(loss_sum)
+                dist.all_reduce(num_tokens)
+            loss_sum = loss_sum.cpu().numpy().astype(np.float64)
+            num_tokens = num_tokens.cpu().numpy().astype(np.float64)
+            self._loss_sum.zero_()
+            self._num_tokens.zero_()
+
+            seen = num_tokens > 0
+            window_loss = np.divide(
+                loss_sum, num_tokens, out=np.full_like(loss_sum, np.nan), where=seen
+            )
+            first = seen & np.isnan(self.running_loss)
+            self.running_loss[first] = window_loss[first]
+            update = seen & ~first
+            self.running_loss[update] = (
+                self.ema_decay * self.running_loss[update]
+                + (1.0 - self.ema_decay) * window_loss[update]
+            )
+            self.running_count = self.ema_decay * self.running_count + num_tokens
+
+        curr_loss = self.estimate_losses()
+        ref_loss = {}
+        for name in self.domains:
+            if np.isnan(curr_loss[name]):
+                # unseen domains keep their weights (zero loss delta)
+                curr_loss[name] = ref_loss[name] = 0.0
+            else:
+                ref_loss[name] = self.ref_loss.get(name, curr_loss[name])
+        self.prob_map = DOMAIN_WEIGHT_UPDATE_FUNCS[self.method](
+            self.prob_map, ref_loss, curr_loss
+        )
+        self.prob_map = {k: float(v) for k, v in self.prob_map.items()}
+        self.num_steps += 1
+        return dict(self.prob_map)
+
+    def state_dict(self) -> dict:
+        def _to_list(arr):
+            return [None if np.isnan(x) else float(x) for x in arr]
+
+        return {
+            "domains": self.domains,
+            "prob_map": self.prob_map,
+            "running_loss": _to_list(self.running_loss),
+            "running_count": self.running_count.tolist(),
+            "probe_loss": _to_list(self.probe_loss),
+            "num_steps": self.num_steps,
+        }
+
+    def load_state_dict(self, state_dict: dict):
+        def _from_list(values):
+            return np.array(
+                [np.nan if x is None else x for x in values], dtype=np.float64
+            )
+
+        name2idx = {name: i for i, name in enumerate(state_dict["domains"])}
+        idx = [name2idx.get(name) for name in self.domains]
+        running_loss = _from_list(state_dict["running_loss"])
+        running_count = np.array(state_dict["running_count"], dtype=np.float64)
+        probe_loss = _from_list(state_dict["probe_loss"])
+        for i, j in enumerate(idx):
+            if j is None:
+                continue
+            self.running_loss[i] = running_loss[j]
+            self.running_count[i] = running_count[j]
+            self.probe_loss[i] = probe_loss[j]
+        self.prob_map.update(
+            {k: v for k, v in state_dict["prob_map"].items() if k in self.domain2idx}
+        )
+        self.num_steps = state_dict["num_steps"]
+
+
 if __name__ == "__main__":
     # new_weight = update_weight_sheared_llama_paper(
     new_weight = update_weight_sheared_llama(
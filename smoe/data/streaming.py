@@ -280,6 +280,78 @@ class PackedJsonlDataset(IterableDataset):
         }
 
 
+class WeightedDomainSampler:
+    """
+    Draws domain indices from a categorical distribution with Walker's alias method.
+
+    Indices are drawn in vectorized blocks of `block_size`, so a single draw is O(1)
+    and the alias table is only rebuilt when the weights change.
+
+    Args:
+        weights: non-negative sampling weight of each domain, zero weights are never drawn
+    """
+
+    def __init__(self, weights: list[float], seed: int = 1227, block_size: int = 1024):
+        self.rng = np.random.default_rng(seed)
+        self.block_size = block_size
+        self._block = np.empty(0, dtype=np.int64)
+        self._pos = 0
+        self.set_weights(weights)
+
+    def set_weights(self, weights: list[float]):
+        weights = np.asarray(weights, dtype=np.float64)
+        if weights.ndim != 1 or len(weights) == 0:
+            raise ValueError("weights must be a non-empty 1-d sequence")
+        if (weights < 0).any() or not np.isfinite(weights).all():
+            raise ValueError(f"Invalid sampling weights: {weights.tolist()}")
+        total = weights.sum()
+        if total <= 0:
+            raise ValueError("At least one sampling weight must be positive")
+
+        num = len(weights)
+        prob = weights * num / total
+        alias = np.arange(num, dtype=np.int64)
+        small = [i for i in range(num) if prob[i] < 1.0]
+        large = [i for i in range(num) if prob[i] >= 1.0]
+        while small and large:
+            small_idx, large_idx = small.pop(), large.pop()
+            alias[small_idx] = large_idx
+            prob[large_idx] -= 1.0 - prob[small_idx]
+            if prob[large_idx] < 1.0:
+                small.append(large_idx)
+            else:
+                large.append(large_idx)
+        # leftovers are 1.0 up to floating point errors
+        for i in small + large:
+            prob[i] = 1.0
+        self.weights = weights / total
+        self.prob = prob
+        self.alias = alias
+        # drop the pre-drawn block, it was drawn with the old weights
+        self._block = np.empty(0, dtype=np.int64)
+        self._pos = 0
+
+    @property
+    def num_remaining(self) -> int:
+        return len(self._block) - self._pos
+
+    def sample_block(self, size: int) -> np.ndarray:
+        cols = self.rng.integers(0, len(self.prob), size=size)
+        coins = self.rng.random(size)
+        return np.where(coins < self.prob[cols], cols, self.alias[cols])
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> int:
+        if self._pos >= len(self._block):
+            self._block = self.sample_block(self.block_size)
+            self._pos = 0
+        idx = self._block[self._pos]
+        self._pos += 1
+        return int(idx)
+
+
 class SubDirWeightedPackedJsonlDataset(IterableDataset):
     """
     Example:
@@ -304,8 +376,18 @@ class SubDirWeightedPackedJsonlDataset(IterableDataset):
             task2 dir: 1.jsonl, ...
         weights: dirname to sampling weight.
             e.g. {"task1 dir": 0.3, "task2 dir": 0.7}
+        return_domain_id: add `domain_id` (index in `source2idx`) to each instance,
+            used by the trainer to track per-domain losses.
+        exhaustion_policy: what to do when a domain runs out of data.
+            stop: end the whole stream
+            recycle: iterate over the domain again
+            drop: drop the domain and renormalize the weights of the others,
+                the stream ends when all domains are exhausted
+        sampling_block_size: number of domain indices drawn at a time
     """
 
+    EXHAUSTION_POLICIES = ("stop", "recycle", "drop")
+
     def __init__(
         self,
         dataset_dir: str,
@@ -313,11 +395,21 @@ class SubDirWeightedPackedJsonlDataset(IterableDataset):
         seed: int = 1227,
         buffer_size: int = 200,
         block_size: int = 2048,
+        return_domain_id: bool = False,
+        exhaustion_policy: str = "stop",
+        sampling_block_size: int = 1024,
     ) -> None:
+        if exhaustion_policy not in self.EXHAUSTION_POLICIES:
+            raise ValueError(
+                f"Unknown exhaustion_policy: {exhaustion_policy}, choices: {self.EXHAUSTION_POLICIES}"
+            )
         self.rng = random.Random(seed)
         self.seed = seed
         self.buffer_size = buffer_size
         self.block_size = block_size
+        self.return_domain_id = return_domain_id
+        self.exhaustion_policy = exhaustion_policy
+        self.sampling_block_size = sampling_block_size
         self.dataset_dir_path = Path(dataset_dir)
 
         task_types = [p.stem for p in self.dataset_dir_path.glob("*") if p.is_dir()]
@@ -343,37 +435,115 @@ class SubDirWeightedPackedJsonlDataset(IterableDataset):
             self.source2idx[task_type] = len(self.source2idx)
             self.prob_map[task_type] = sampling_weight
 
+        # weights are mirrored in shared memory (the last slot is a version counter),
+        # so that updates from the main process reach the dataloader workers.
+        self._shared_weights = torch.zeros(
+            len(self.source2idx) + 1, dtype=torch.float64
+        ).share_memory_()
+        self._weights_version = 0
+        self._sync_shared_weights()
+
         self.task_type_to_dataset = {}
+        # number of finished passes over each domain
+        self.task_type_to_num_epochs = {}
         for task_type in task_types:
-            # zhutong: use iter to support next() calling, since the dataset itself
-            #          does not implement __next__().
-            ds = iter(
-                PackedJsonlDataset(
-                    str(self.dataset_dir_path.joinpath(task_type)),
-                    seed=seed,
-                    buffer_size=buffer_size,
-                    block_size=block_size,
-                )
+            self.task_type_to_dataset[task_type] = self._build_task_iterator(task_type)
+            self.task_type_to_num_epochs[task_type] = 0
+
+    def _build_task_iterator(self, task_type: str, epoch: int = 0) -> Iterator:
+        # zhutong: use iter to support next() calling, since the dataset itself
+        #          does not implement __next__().
+        return iter(
+            PackedJsonlDataset(
+                str(self.dataset_dir_path.joinpath(task_type)),
+                seed=self.seed + epoch,
+                buffer_size=self.buffer_size,
+                block_size=self.block_size,
             )
-            self.task_type_to_dataset[task_type] = ds
+        )
+
+    def _sync_shared_weights(self):
+        for task_type, idx in self.source2idx.items():
+            self._shared_weights[idx] = self.prob_map[task_type]
+        self._shared_weights[-1] += 1
+        self._weights_version = int(self._shared_weights[-1].item())
+
+    def _maybe_reload_shared_weights(self):
+        version = int(self._shared_weights[-1].item())
+        if version != self._weights_version:
+            weights = self._shared_weights.tolist()
+            for task_type, idx in self.source2idx.items():
+                self.prob_map[task_type] = weights[idx]
+            self._weights_version = version
 
     def update_prob_map(self, new_prob_map: dict):
         self.prob_map.update(new_prob_map)
+        self._sync_shared_weights()
 
     def update_existed_prob_map(self, new_prob_map: dict):
         for name in self.prob_map:
             if name in new_prob_map:
                 self.prob_map[name] = new_prob_map[name]
+        self._sync_shared_weights()
+
+    def _get_sampling_weights(self, idx2task_type: list[str]) -> list[float]:
+        return [
+            self.prob_map[task_type] if task_type in self.task_type_to_dataset else 0.0
+            for task_type in idx2task_type
+        ]
 
     def __iter__(self) -> Iterator:
+        idx2task_type = list(self.source2idx.keys())
+        if len(self.task_type_to_dataset) == 0:
+            return
+        self._maybe_reload_shared_weights()
+        # a new seed for every iteration, different across dataloader workers
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        sampler = WeightedDomainSampler(
+            self._get_sampling_weights(idx2task_type),
+            seed=self.rng.randrange(2**32) + worker_id,
+            block_size=self.sampling_block_size,
+        )
+        sampler_version = self._weights_version
+        num_yield_in_epoch = defaultdict(lambda: 0)
         while len(self.task_type_to_dataset) > 0:
-            candidate_task_types = list(self.task_type_to_dataset.keys())
-            weights = [self.prob_map[task_type] for task_type in candidate_task_types]
-            choice = self.rng.choices(candidate_task_types, weights=weights, k=1)[0]
+            # weights from `update_prob_map` are picked up before drawing a new block
+            if sampler.num_remaining == 0:
+                self._maybe_reload_shared_weights()
+                if sampler_version != self._weights_version:
+                    sampler.set_weights(self._get_sampling_weights(idx2task_type))
+                    sampler_version = self._weights_version
+            choice = idx2task_type[next(sampler)]
             try:
-                yield next(self.task_type_to_dataset[choice])
+                ins = next(self.task_type_to_dataset[choice])
             except StopIteration:
-                # self.task_type_to_dataset.pop(choice)
-                # logger.debug(f"Task type {choice} finished, drop it")
-                # yield from self
-                return
+                if self.exhaustion_policy == "stop":
+                    return
+                self.task_type_to_num_epochs[choice] += 1
+                if (
+                    self.exhaustion_policy == "recycle"
+                    and num_yield_in_epoch[choice] > 0
+                ):
+                    num_yield_in_epoch[choice] = 0
+                    logger.debug(f"Task type {choice} finished, iterate over it again")
+                    self.task_type_to_dataset[choice] = self._build_task_iterator(
+                        choice, epoch=self.task_type_to_num_epochs[choice]
+                    )
+                else:
+                    logger.debug(f"Task type {choice} finished, drop it")
+                    self.task_type_to_dataset.pop(choice)
+                    if len(self.task_type_to_dataset) == 0:
+                        return
+                    weights = self._get_sampling_weights(idx2task_type)
+                    if sum(weights) <= 0:
+                        logger.warning(
+                            "All remaining task types have zero sampling weights, stop iteration"
+                        )
+                        return
+                    sampler.set_weights(weights)
+                continue
+            num_yield_in_epoch[choice] += 1
+            if self.return_domain_id:
+                ins["domain_id"] = self.source2idx[choice]
+            yield ins
@@ -9,14 +9,71 @@ from transformers import LlamaForCausalLM, LlamaTokenizer
 from smoe.data.collate_fn import tensor_dict_cat_collator
 from smoe.data.datasets_moe import LineByLineJsonlTextDataset
 from smoe.models.llama_moe import LlamaMoEForCausalLM
-from smoe.utils.model_operation.modify_llama_model import (
-    llama_with_hidden_states_scale_recording,
-)
-from smoe.utils.model_operation.modify_llama_moe_model import (
-    llama_moe_with_hidden_states_scale_recording_early_stop,
+from smoe.utils.calibration import (
+    CalibrationCallback,
+    LayerwiseCalibrator,
+    get_mlp,
+    output_hidden_states,
 )
 
+
 # fmt: off
+class ScoreScaleFactorCallback(CalibrationCallback):
+    """
+    Measures the average L1 norms of the MLP outputs and of their residuals in the first pass of every layer,
+    sets the score scale factor of LLaMA-MoE layers so that their ratio matches `target_scale_gaps`,
+    and runs the layer again with the new factor to advance to the next layer.
+    """
+
+    def __init__(self, target_scale_gaps):
+        self.target_scale_gaps = target_scale_gaps
+        self.score_scale_factors = []
+        self.mlp_outputs = []
+        self.mlp_residuals = []
+        self._state = None
+        self._hooks = []
+
+    @torch.no_grad()
+    def _record_residual(self, module, args):
+        if self._state.pass_idx == 0:
+            self.mlp_residuals.append(torch.abs(args[0].detach().float()).sum(2).flatten())
+
+    @torch.no_grad()
+    def _record_output(self, module, args, output):
+        if self._state.pass_idx == 0:
+            self.mlp_outputs.append(torch.abs(output_hidden_states(output).detach().float()).sum(2).flatten())
+
+    def on_layer_begin(self, state, layer):
+        self._state = state
+        self.mlp_outputs, self.mlp_residuals = [], []
+        self._hooks = [
+            layer.post_attention_layernorm.register_forward_pre_hook(self._record_residual),
+            get_mlp(layer).register_forward_hook(self._record_output),
+        ]
+
+    def on_pass_end(self, state, layer):
+        if state.pass_idx > 0:
+            return False
+        layer_index = state.layer_idx
+        avg_mlp_output = torch.mean(torch.cat(self.mlp_outputs), dim=0).item()
+        avg_mlp_residual = torch.mean(torch.cat(self.mlp_residuals), dim=0).item()
+        this_layer_scale_gap = avg_mlp_residual / avg_mlp_output
+
+        this_layer_score_scale_factor = this_layer_scale_gap / self.target_scale_gaps[layer_index]
+        print(f"Layer {layer_index}: target_scale_gap={format(self.target_scale_gaps[layer_index], '.2f')}, layer_scale_gap={format(this_layer_scale_gap, '.2f')}, score_scale_factor={format(this_layer_score_scale_factor, '.2f')}, avg_mlp_output={format(avg_mlp_output, '.2f')}, avg_mlp_residual={format(avg_mlp_residual, '.2f')}\n", flush=True)
+        self.score_scale_factors.append(this_layer_score_scale_factor)
+        if not hasattr(layer.mlp, "calculator"):
+            return False
+        # the following layers are calibrated on the outputs with the new factor
+        layer.mlp.calculator.score_scale_factor = this_layer_score_scale_factor
+        return True
+
+    def on_layer_end(self, state, layer):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--tokenizer_path', type=str)
@@ -62,45 +119,22 @@ if __name__ == "__main__":
 
     """load model"""
     print("Loading llama model...", flush=True)
-    new_forward = None
     if args.model_type == "llama_moe":
         model = LlamaMoEForCausalLM.from_pretrained(args.model_path).model
-        new_forward = llama_moe_with_hidden_states_scale_recording_early_stop
         model.set_moe_calculator_score_scale_factor(1.0)
     elif args.model_type == "llama":
         model = LlamaForCausalLM.from_pretrained(args.model_path).model
-        new_forward = llama_with_hidden_states_scale_recording
     else:
         raise ValueError("Unknown model type: " + args.model_type)
 
     """calculate scale factor layer by layer"""
     print("Start evaluation...", flush=True)
-    score_scale_factors = []
-
-    model.to(device)
     model.half()
     model.eval()
-    for layer_index in tqdm(range(model.config.num_hidden_layers), desc="forward by layer", leave=True):
-        # model = llama_moe_with_hidden_states_scale_recording_early_stop(model, early_stop_layer=layer_index)
-        model = new_forward(model)
-
-        iter_train = iter(data_loader)
-        for step in tqdm(range(len(data_loader)), desc="forward step", leave=False):
-            batch = next(iter_train)
-            for key in batch.keys():
-                batch[key] = batch[key].to(device)
-            with torch.no_grad():
-                model(**batch)
-
-        avg_mlp_output = torch.mean(torch.cat(model.layers[layer_index].mlp_outputs), dim=0).item()
-        avg_mlp_residual = torch.mean(torch.cat(model.layers[layer_index].mlp_residuals), dim=0).item()
-        this_layer_scale_gap = avg_mlp_residual / avg_mlp_output
-
-        this_layer_score_scale_factor = this_layer_scale_gap / target_scale_gaps[layer_index]
-        print(f"Layer {layer_index}: target_scale_gap={format(target_scale_gaps[layer_index], '.2f')}, layer_scale_gap={format(this_layer_scale_gap, '.2f')}, score_scale_factor={format(this_layer_score_scale_factor, '.2f')}, avg_mlp_output={format(avg_mlp_output, '.2f')}, avg_mlp_residual={format(avg_mlp_residual, '.2f')}\n", flush=True)
-        # print(score_scale_factors, flush=True)
-        model.layers[layer_index].mlp.calculator.score_scale_factor = this_layer_score_scale_factor
-        score_scale_factors.append(this_layer_score_scale_factor)
+    # only the running layer is moved to the device, the hidden states of all batches are kept between layers
+    callback = ScoreScaleFactorCallback(target_scale_gaps)
+    LayerwiseCalibrator(model, device=device).run(tqdm(data_loader, desc="forward for embeddings"), [callback])
+    score_scale_factors = callback.score_scale_factors
 
     """save"""
     if not os.path.exists(args.save_path):
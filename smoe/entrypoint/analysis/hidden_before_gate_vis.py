@@ -1,3 +1,4 @@
+import tempfile
 import warnings
 from pathlib import Path
 from types import MethodType
@@ -7,7 +8,6 @@ import numpy as np
 import torch
 from accelerate import Accelerator
 from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
 from torch.utils.data import DataLoader
 from tqdm import tqdm, trange
 
@@ -16,6 +16,7 @@ from smoe.data.streaming import CachedJsonlDataset
 from smoe.models.llama_moe import LlamaMoEForCausalLM
 from smoe.models.llama_moe.modeling_llama_moe import LlamaMoEDecoderLayer, MoEMlpOutput
 from smoe.modules.moe.moe_gates import TopKBalancedNoisyGate
+from smoe.utils.visualization.tsne_torch_model import TorchTSNE
 
 eval_path_map = {
     "en_wikipedia": "/mnt/petrelfs/share_data/quxiaoye/data/llama1_7B_val_set_tokenized/en_wikipedia.jsonl",
@@ -140,19 +141,33 @@ def plot_2d_distribution(embs, labels, save_path, title: str = None):
     plt.savefig(save_path)
 
 
-def tsne_for_one_layer(data_list, save_path, labels, title: str = None):
-    # data_list: (num datasets, num tokens, hidden dim)
-    tsne = TSNE(n_components=2, verbose=1)
+def tsne_for_one_layer(
+    data_list, save_path, labels, title: str = None, max_num_tokens: int = None
+):
+    # data_list: (num datasets, num tokens, hidden dim), arrays or memmaps
+    # all datasets are embedded together, with kNN P-values and FFT-interpolated forces
+    tsne = TorchTSNE(n_components=2, verbose=True, method="fft")
     min_num = min([len(data) for data in data_list])
-
-    embs = []
-    for data in data_list:
-        emb = tsne.fit_transform(data[:min_num])
-        embs.append(emb)
+    if max_num_tokens is not None:
+        min_num = min(min_num, max_num_tokens)
+
+    # the datasets are copied into one memmap, which is read in chunks
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tokens = np.lib.format.open_memmap(
+            f"{tmp_dir}/tokens.npy",
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(data_list) * min_num, data_list[0].shape[-1]),
+        )
+        for idx, data in enumerate(data_list):
+            tokens[idx * min_num : (idx + 1) * min_num] = data[:min_num]
+        emb = tsne.fit_transform(tokens)
+        del tokens
+    embs = emb.cpu().numpy().reshape(len(data_list), min_num, 2)
     plot_2d_distribution(embs, labels, save_path, title=title)
 
 
-def tsne_for_layers(data_list, save_dir, labels):
+def tsne_for_layers(data_list, save_dir, labels, max_num_tokens: int = None):
     num_layers = len(data_list[0])
     for layer_idx in trange(num_layers, desc="Making scatter plots"):
         tsne_for_one_layer(
@@ -160,6 +175,7 @@ def tsne_for_layers(data_list, save_dir, labels):
             f"{save_dir}/tsne_L{layer_idx}.png",
             labels,
             title=f"t-SNE Layer {layer_idx}",
+            max_num_tokens=max_num_tokens,
         )
 
 
@@ -194,7 +210,10 @@ def main(
     name2softmax = {}
     if load_cache:
         for name in eval_datanames:
-            name2hidden[name] = np.load(f"{result_dir}/{name}_hidden.npy")
+            # (num layers, num tokens, hidden dim), only the plotted tokens are read
+            name2hidden[name] = np.load(
+                f"{result_dir}/{name}_hidden.npy", mmap_mode="r"
+            )
             name2softmax[name] = np.load(f"{result_dir}/{name}_softmax.npy")
     else:
         global hidden_list
@@ -0,0 +1,417 @@
+"""
+End-to-end benchmark of the dense-to-MoE expert construction pipeline on a tiny random Llama (CPU).
+
+    python -m smoe.entrypoint.benchmark.expert_construction --output_json results.json
+    python -m smoe.entrypoint.benchmark.expert_construction --baseline_json smoe/entrypoint/benchmark/expert_construction_baseline.json
+    python -m smoe.entrypoint.benchmark.expert_construction --baseline_json baseline.json --update_baseline True
+
+The stages call the library code of `smoe/entrypoint/expert_construction` and hand over their results as files:
+    dense           random `LlamaForCausalLM` saved as sharded safetensors, and the token batches
+    features        MLP input features of every layer (get_gates/*)
+    gates           gate weights by random selection or balanced k-means (get_gates/*)
+    scores          gradient importance scores of the neurons for each gate (split/split_gradient_get_grads_v2.py)
+    split           neuron indices of the experts (split/split_gradient_v2.py)
+    distribution    attention / MLP output distributions of the dense model (align/get_hidden_distribution.py)
+    convert         Mixtral checkpoint (convert/convert_mixtral_v2.py)
+    align           experts rescaled to the dense distributions (align/align_converted_model.py)
+
+Every stage runs in a fresh process and records its wall time, peak RSS and a checksum of its outputs.
+With `--baseline_json`, stages that are slower or larger than the baseline by more than the tolerance,
+or whose checksums changed, are reported as regressions and the exit code is 1.
+Wall times and peak RSS are only compared on the machine that recorded the baseline (same `environment`),
+checksums whenever the pipeline arguments and the torch version match.
+`expert_construction_baseline.json` is the baseline of the default arguments.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+from smoe.utils.io import create_dir, dump_json, load_json
+from smoe.utils.operations.operation_string import str2bool
+
+STAGES = (
+    "dense",
+    "features",
+    "gates",
+    "scores",
+    "split",
+    "distribution",
+    "convert",
+    "align",
+)
+# pipeline arguments that change the outputs, baselines with other values are not comparable
+PIPELINE_ARGS = (
+    "vocab_size",
+    "hidden_size",
+    "intermediate_size",
+    "num_layers",
+    "num_heads",
+    "num_experts",
+    "top_k",
+    "scale_factor",
+    "gate_method",
+    "num_batches",
+    "batch_size",
+    "seq_len",
+    "seed",
+)
+REPO_ROOT = Path(__file__).resolve().parents[3]
+
+
+def get_environment(args) -> dict:
+    """The machine and software the timings are measured on."""
+    return {
+        "hostname": platform.node(),
+        "machine": platform.machine(),
+        "num_cpus": os.cpu_count(),
+        "num_threads": args.num_threads,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+    }
+
+
+def tensor_checksum(obj) -> str:
+    """sha256 of the tensors in (nested) dicts / lists / tuples, in sorted key order."""
+    sha = hashlib.sha256()
+
+    def _update(value):
+        if isinstance(value, torch.Tensor):
+            value = value.detach().cpu().contiguous()
+            sha.update(f"{value.dtype}{tuple(value.shape)}".encode())
+            sha.update(value.view(-1).view(torch.uint8).numpy().tobytes())
+        elif isinstance(value, dict):
+            for key in sorted(value, key=str):
+                sha.update(str(key).encode())
+                _update(value[key])
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                _update(item)
+        else:
+            sha.update(repr(value).encode())
+
+    _update(obj)
+    return sha.hexdigest()
+
+
+def safetensors_checksum(folder: Path) -> str:
+    from safetensors.torch import load_file
+
+    state_dict = {}
+    for filepath in sorted(folder.glob("*.safetensors")):
+        state_dict.update(load_file(filepath))
+    return tensor_checksum(state_dict)
+
+
+def load_batches(work_dir: Path) -> list[dict]:
+    return torch.load(work_dir / "batches.pt")
+
+
+# fmt: off
+def stage_dense(args, work_dir: Path) -> str:
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    config = LlamaConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.intermediate_size,
+        num_hidden_layers=args.num_layers,
+        num_attention_heads=args.num_heads,
+        num_key_value_heads=args.num_heads,
+        max_position_embeddings=args.seq_len,
+    )
+    torch.manual_seed(args.seed)
+    model = LlamaForCausalLM(config)
+    # sharded, `convert_safetensors` checks the total size in the index
+    model.save_pretrained(work_dir / "dense", safe_serialization=True, max_shard_size="500KB")
+
+    batches = []
+    for _ in range(args.num_batches):
+        input_ids = torch.randint(0, args.vocab_size, (args.batch_size, args.seq_len))
+        batches.append({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)})
+    torch.save(batches, work_dir / "batches.pt")
+    return tensor_checksum([model.state_dict(), batches])
+
+
+def stage_features(args, work_dir: Path) -> str:
+    from transformers import LlamaForCausalLM
+
+    from smoe.utils.calibration import FeatureCaptureCallback, LayerwiseCalibrator
+
+    model = LlamaForCausalLM.from_pretrained(work_dir / "dense").eval()
+    features = {}
+
+    def _capture(layer_idx, layer_features):
+        features[layer_idx] = layer_features.float()
+
+    LayerwiseCalibrator(model).run(load_batches(work_dir), [FeatureCaptureCallback(_capture)])
+    torch.save(features, work_dir / "features.pt")
+    return tensor_checksum(features)
+
+
+def stage_gates(args, work_dir: Path) -> str:
+    from smoe.utils.expert_construction.hidden_feature_gates import (
+        cluster_gate_weights,
+        select_gate_weights,
+    )
+
+    features = torch.load(work_dir / "features.pt")
+    gate_weights = {}
+    for layer_idx, layer_features in features.items():
+        if args.gate_method == "random":
+            generator = torch.Generator().manual_seed(args.seed + layer_idx)
+            gate_weights[layer_idx] = select_gate_weights(layer_features, args.num_experts, generator=generator)
+        else:
+            gate_weights[layer_idx] = cluster_gate_weights(
+                layer_features.numpy(),
+                args.num_experts,
+                balance_jitter_factor=args.balance_jitter_factor,
+                max_iter=args.kmeans_max_iter,
+                random_state=args.seed,
+                n_init=1,
+                n_jobs=1,
+            )
+    torch.save(gate_weights, work_dir / "gate_weights.pt")
+    return tensor_checksum(gate_weights)
+
+
+def stage_scores(args, work_dir: Path) -> str:
+    from transformers import LlamaForCausalLM
+
+    from smoe.utils.expert_construction.gradient_importance import (
+        GradientImportanceScorer,
+    )
+
+    model = LlamaForCausalLM.from_pretrained(work_dir / "dense")
+    scorer = GradientImportanceScorer(model, torch.load(work_dir / "gate_weights.pt"))
+    for batch in load_batches(work_dir):
+        scorer.set_attention_mask(batch["attention_mask"])
+        outputs = model(**batch, labels=batch["input_ids"])
+        outputs.loss.backward()
+        model.zero_grad()
+    scorer.remove()
+
+    final_scores = scorer.get_scores()
+    torch.save(final_scores, work_dir / "importance_scores.pt")
+    return tensor_checksum(final_scores)
+
+
+def stage_split(args, work_dir: Path) -> str:
+    from smoe.entrypoint.expert_construction.split.split_gradient_v2 import (
+        GradientSplitV2,
+    )
+
+    all_importance_scores = torch.load(work_dir / "importance_scores.pt")
+    split_args = argparse.Namespace(num_experts=args.num_experts)
+    neuron_indices = {}
+    for layer_idx in range(args.num_layers):
+        score_list = [all_importance_scores[layer_idx][j] for j in range(args.num_experts)]
+        split = GradientSplitV2(split_args, layer_idx, score_list)
+        with contextlib.redirect_stdout(io.StringIO()):
+            split.split(args.num_experts, args.intermediate_size // args.num_experts, criterion="max", share_neurons=False)
+        neuron_indices[layer_idx] = split.labels
+    torch.save(neuron_indices, work_dir / "neuron_indices.pt")
+    return tensor_checksum(neuron_indices)
+
+
+def stage_distribution(args, work_dir: Path) -> str:
+    from transformers import LlamaForCausalLM
+
+    from smoe.utils.calibration import HiddenDistributionCallback, LayerwiseCalibrator
+
+    model = LlamaForCausalLM.from_pretrained(work_dir / "dense", attn_implementation="eager").eval()
+    callback = HiddenDistributionCallback(args.hidden_size)
+    LayerwiseCalibrator(model).run(load_batches(work_dir), [callback])
+    distribution = callback.gather()
+    torch.save(distribution, work_dir / "distribution.pt")
+    return tensor_checksum(distribution)
+
+
+def stage_convert(args, work_dir: Path) -> str:
+    from smoe.utils.expert_construction.convert_llama_to_mixtral import (
+        convert_safetensors,
+    )
+
+    # the modeling files are copied with paths relative to the repository root
+    os.chdir(REPO_ROOT)
+    with contextlib.redirect_stdout(io.StringIO()):
+        convert_safetensors(
+            work_dir / "dense",
+            work_dir / "moe",
+            num_experts=args.num_experts,
+            top_k=args.top_k,
+            scale_factor=args.scale_factor,
+            neuron_indices=torch.load(work_dir / "neuron_indices.pt"),
+            gate_weights=torch.load(work_dir / "gate_weights.pt"),
+        )
+    return safetensors_checksum(work_dir / "moe")
+
+
+def stage_align(args, work_dir: Path) -> str:
+    from smoe.models.mixtral import MixtralConfig, MixtralForCausalLM
+    from smoe.utils.expert_construction.align_layerwise import align_model_layerwise
+
+    config = MixtralConfig.from_pretrained(work_dir / "moe")
+    config._attn_implementation = "eager"
+    model = MixtralForCausalLM.from_pretrained(work_dir / "moe", config=config).eval()
+    model.config.use_cache = False
+    ref_distribution = torch.load(work_dir / "distribution.pt")
+    batches = load_batches(work_dir)
+
+    scale_factors = align_model_layerwise(model, batches, ref_distribution)
+
+    torch.save(scale_factors, work_dir / "scale_factors.pt")
+    return tensor_checksum([scale_factors, model.state_dict()])
+# fmt: on
+
+
+def _run_stage(stage: str, args, work_dir: str) -> dict:
+    torch.set_num_threads(args.num_threads)
+    start = time.perf_counter()
+    checksum = globals()[f"stage_{stage}"](args, Path(work_dir))
+    wall_time = time.perf_counter() - start
+    # kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {"wall_time": wall_time, "peak_rss_mb": peak_rss_mb, "checksum": checksum}
+
+
+def run_pipeline(args, work_dir: str) -> dict:
+    """Runs every stage in a fresh process, so the peak RSS is per stage."""
+    # stages may change the working directory
+    work_dir = os.path.abspath(work_dir)
+    create_dir(work_dir)
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for stage in STAGES:
+        with context.Pool(1) as pool:
+            results[stage] = pool.apply(_run_stage, (stage, args, work_dir))
+        print(
+            f"{stage:>12} wall time: {results[stage]['wall_time']:.3f} s"
+            f" peak RSS: {results[stage]['peak_rss_mb']:.1f} MB"
+            f" checksum: {results[stage]['checksum'][:12]}"
+        )
+    return results
+
+
+def compare_with_baseline(
+    results: dict,
+    baseline: dict,
+    time_tolerance: float = 0.5,
+    rss_tolerance: float = 0.2,
+    check_checksums: bool = True,
+    check_resources: bool = True,
+) -> list[str]:
+    """Regression messages of `results` against the `baseline` stages."""
+    regressions = []
+    for stage, result in results.items():
+        ref = baseline.get(stage)
+        if ref is None:
+            continue
+        if check_resources:
+            if result["wall_time"] > ref["wall_time"] * (1 + time_tolerance):
+                regressions.append(
+                    f"{stage}: wall time {result['wall_time']:.3f} s > baseline {ref['wall_time']:.3f} s"
+                )
+            if result["peak_rss_mb"] > ref["peak_rss_mb"] * (1 + rss_tolerance):
+                regressions.append(
+                    f"{stage}: peak RSS {result['peak_rss_mb']:.1f} MB > baseline {ref['peak_rss_mb']:.1f} MB"
+                )
+        if check_checksums and result["checksum"] != ref["checksum"]:
+            regressions.append(
+                f"{stage}: checksum {result['checksum'][:12]} != baseline {ref['checksum'][:12]}"
+            )
+    return regressions
+
+
+def main(args) -> int:
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = run_pipeline(args, args.work_dir or tmp_dir)
+    pipeline_args = {key: getattr(args, key) for key in PIPELINE_ARGS}
+    environment = get_environment(args)
+    report = {
+        "pipeline_args": pipeline_args,
+        "environment": environment,
+        "stages": results,
+    }
+    if args.output_json:
+        dump_json(report, args.output_json, indent=2)
+
+    if args.baseline_json is None:
+        return 0
+    if args.update_baseline or not os.path.exists(args.baseline_json):
+        dump_json(report, args.baseline_json, indent=2)
+        print(f"Baseline saved to {args.baseline_json}")
+        return 0
+
+    baseline = load_json(args.baseline_json)
+    baseline_environment = baseline.get("environment", {})
+    # random initialization and kernels may change with the torch version
+    check_checksums = (
+        baseline["pipeline_args"] == pipeline_args
+        and baseline_environment.get("torch") == environment["torch"]
+    )
+    if not check_checksums:
+        print(
+            "Pipeline arguments or torch version differ from the baseline, checksums are not compared"
+        )
+    check_resources = baseline_environment == environment
+    if not check_resources:
+        print(
+            "The baseline was recorded on another machine, wall times and peak RSS are not compared"
+        )
+    regressions = compare_with_baseline(
+        results,
+        baseline["stages"],
+        time_tolerance=args.time_tolerance,
+        rss_tolerance=args.rss_tolerance,
+        check_checksums=check_checksums,
+        check_resources=check_resources,
+    )
+    for regression in regressions:
+        print(f"[REGRESSION] {regression}")
+    if len(regressions) == 0:
+        print("No regression against the baseline")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_size", type=int, default=512)
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument("--intermediate_size", type=int, default=256)
+    parser.add_argument("--num_layers", type=int, default=4)
+    parser.add_argument("--num_heads", type=int, default=4)
+    parser.add_argument("--num_experts", type=int, default=4)
+    parser.add_argument("--top_k", type=int, default=2)
+    parser.add_argument("--scale_factor", type=float, default=1.0)
+    parser.add_argument(
+        "--gate_method", type=str, default="random", choices=("random", "clustering")
+    )
+    parser.add_argument("--balance_jitter_factor", type=float, default=0.1)
+    parser.add_argument("--kmeans_max_iter", type=int, default=20)
+    parser.add_argument("--num_batches", type=int, default=4)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--seq_len", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=1227)
+    parser.add_argument("--num_threads", type=int, default=1)
+    parser.add_argument("--work_dir", type=str, default=None)
+    parser.add_argument("--output_json", type=str, default=None)
+    parser.add_argument("--baseline_json", type=str, default=None)
+    parser.add_argument("--update_baseline", type=str, default="False")
+    parser.add_argument("--time_tolerance", type=float, default=0.5)
+    parser.add_argument("--rss_tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    args.update_baseline = str2bool(args.update_baseline)
+    sys.exit(main(args))
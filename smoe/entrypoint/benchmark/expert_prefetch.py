@@ -0,0 +1,171 @@
+"""
+Batch-1 decoding benchmark of offloaded Mixtral experts with different prefetching strategies.
+
+    python -m smoe.entrypoint.benchmark.expert_prefetch --capacity 16 --max_new_tokens 64
+    python -m smoe.entrypoint.benchmark.expert_prefetch --model_path /path/to/mixtral --capacity 64
+
+Without `--model_path`, a randomly initialized Mixtral is saved to a temporary folder.
+Each strategy reports the decoding latency per token, the expert cache statistics
+and, for the predictors, the prediction hits / misses.
+"""
+
+import argparse
+import json
+import tempfile
+import time
+
+import torch
+
+from smoe.models.mixtral.configuration_mixtral import MixtralConfig
+from smoe.models.mixtral.modeling_mixtral import MixtralForCausalLM
+from smoe.modules.expert_offload import ExpertOffloadEngine
+from smoe.modules.expert_prefetch import (
+    ExpertPrefetcher,
+    RouterLookaheadPredictor,
+    TransitionPredictor,
+)
+from smoe.utils.routing_trace import RoutingTrace, RoutingTraceRecorder
+
+STRATEGIES = ("on_demand", "next_layer", "lookahead", "transition")
+
+
+def save_random_model(args, folder: str):
+    config = MixtralConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.intermediate_size,
+        num_hidden_layers=args.num_layers,
+        num_attention_heads=8,
+        num_key_value_heads=8,
+        num_local_experts=args.num_experts,
+        num_experts_per_tok=args.num_selects,
+    )
+    config._attn_implementation = "eager"
+    torch.manual_seed(args.seed)
+    model = MixtralForCausalLM(config)
+    for layer in model.model.layers:
+        # the routers are zero-initialized, which routes every token to the same experts
+        torch.nn.init.normal_(layer.block_sparse_moe.gate.weight, std=0.02)
+    model.save_pretrained(folder, safe_serialization=True)
+
+
+def load_engine(args, folder: str, prefetch) -> ExpertOffloadEngine:
+    config = MixtralConfig.from_pretrained(folder)
+    config._attn_implementation = "eager"
+    return ExpertOffloadEngine.from_pretrained(
+        MixtralForCausalLM,
+        folder,
+        capacity=args.capacity,
+        config=config,
+        prefetch=prefetch,
+    )
+
+
+@torch.no_grad()
+def record_transitions(engine, input_ids, folder: str) -> TransitionPredictor:
+    with RoutingTraceRecorder(engine.model, folder):
+        engine.model(input_ids)
+    return TransitionPredictor.from_routing_trace(RoutingTrace(folder))
+
+
+@torch.no_grad()
+def run_strategy(args, folder: str, strategy: str, input_ids) -> dict:
+    engine = load_engine(
+        args, folder, "next_layer" if strategy == "next_layer" else None
+    )
+    prefetcher = None
+    if strategy == "lookahead":
+        predictor = RouterLookaheadPredictor.from_model(
+            engine.model, depth=args.depth, num_candidates=args.num_candidates
+        )
+        prefetcher = ExpertPrefetcher(engine.model, predictor, engine=engine)
+    elif strategy == "transition":
+        with tempfile.TemporaryDirectory() as trace_folder:
+            predictor = record_transitions(
+                engine,
+                torch.randint(0, engine.model.config.vocab_size, (4, 256)),
+                trace_folder,
+            )
+        predictor.num_candidates = args.num_candidates or predictor.num_candidates
+        prefetcher = ExpertPrefetcher(engine.model, predictor, engine=engine)
+
+    generate_kwargs = dict(
+        max_new_tokens=args.max_new_tokens,
+        min_new_tokens=args.max_new_tokens,
+        do_sample=False,
+        pad_token_id=0,
+    )
+    # warmup, then start from a cold cache
+    engine.model.generate(input_ids, max_new_tokens=2, pad_token_id=0)
+    engine.cache.clear()
+    engine.cache.reset_stats()
+    if prefetcher is not None:
+        prefetcher.reset_stats()
+
+    start = time.perf_counter()
+    engine.model.generate(input_ids, **generate_kwargs)
+    latency = (time.perf_counter() - start) / args.max_new_tokens * 1000
+
+    result = {"strategy": strategy, "latency_ms_per_token": latency}
+    if prefetcher is not None:
+        result.update(prefetcher.stats())
+        prefetcher.close()
+    else:
+        result["cache"] = engine.stats()
+    engine.close()
+    return result
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        folder = args.model_path
+        if folder is None:
+            folder = tmp_dir
+            save_random_model(args, folder)
+        vocab_size = MixtralConfig.from_pretrained(folder).vocab_size
+        torch.manual_seed(args.seed)
+        input_ids = torch.randint(0, vocab_size, (1, args.prompt_len))
+
+        results = []
+        for strategy in args.strategies:
+            result = run_strategy(args, folder, strategy, input_ids)
+            results.append(result)
+            cache = result["cache"]
+            line = f"{strategy:>12} latency: {result['latency_ms_per_token']:.3f} ms/token cache hits: {cache['hits']} prefetch hits: {cache['prefetch_hits']} misses: {cache['misses']}"
+            if "hit_rate" in result:
+                line += f" prediction hit rate: {result['hit_rate']:.3f} precision: {result['precision']:.3f}"
+            print(line)
+
+    if args.output_json:
+        with open(args.output_json, "w", encoding="utf8") as fout:
+            json.dump({"args": vars(args), "results": results}, fout, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", type=str, default=None)
+    parser.add_argument("--vocab_size", type=int, default=1024)
+    parser.add_argument("--hidden_size", type=int, default=512)
+    parser.add_argument("--intermediate_size", type=int, default=1024)
+    parser.add_argument("--num_layers", type=int, default=8)
+    parser.add_argument("--num_experts", type=int, default=8)
+    parser.add_argument("--num_selects", type=int, default=2)
+    parser.add_argument("--capacity", type=int, default=16)
+    parser.add_argument("--depth", type=int, default=1)
+    parser.add_argument("--num_candidates", type=int, default=None)
+    parser.add_argument("--prompt_len", type=int, default=32)
+    parser.add_argument("--max_new_tokens", type=int, default=32)
+    parser.add_argument(
+        "--strategies",
+        type=str,
+        nargs="+",
+        default=list(STRATEGIES),
+        choices=STRATEGIES,
+    )
+    parser.add_argument("--num_threads", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1227)
+    parser.add_argument("--output_json", type=str, default=None)
+    args = parser.parse_args()
+    main(args)
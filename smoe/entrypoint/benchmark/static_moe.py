@@ -0,0 +1,130 @@
+"""
+Compiled-vs-eager benchmark of the static-shape MoE calculator.
+
+    python -m smoe.entrypoint.benchmark.static_moe --num_tokens 512 --capacity_factor 1.25
+
+Each variant reports the number of `torch.compile` graphs (and graph breaks) of one MoE layer
+and the mean forward latency after warmup.
+"""
+
+import argparse
+import json
+import time
+
+import torch
+import torch._dynamo
+
+from smoe.modules.moe.moe_layers import LinearGLUMoELayer
+from smoe.utils.operations.operation_string import str2bool
+
+
+def build_moe_layer(args, calculator_type: str) -> LinearGLUMoELayer:
+    torch.manual_seed(args.seed)
+    layer = LinearGLUMoELayer(
+        input_size=args.hidden_size,
+        hidden_size=args.intermediate_size,
+        output_size=args.hidden_size,
+        hidden_act="silu",
+        num_experts=args.num_experts,
+        num_selects=args.num_selects,
+        bias=False,
+        gate_type="TopKBalancedNoisyGate",
+        gate_network="linear",
+        gate_add_noise=False,
+        calculator_type=calculator_type,
+        capacity_factor=args.capacity_factor,
+    )
+    # the linear gate is zero-initialized, which routes every token to the same experts
+    torch.nn.init.normal_(layer.gate.gate_network.weight, std=0.02)
+    return layer.eval()
+
+
+def count_graphs(layer, x) -> tuple[int, int]:
+    torch._dynamo.reset()
+    explanation = torch._dynamo.explain(layer)(x)
+    return explanation.graph_count, explanation.graph_break_count
+
+
+@torch.no_grad()
+def measure_latency(fn, x, warmup: int, iters: int) -> float:
+    for _ in range(warmup):
+        fn(x)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn(x)
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    compile_options = None
+    if args.backend == "inductor":
+        # batch fusion stacks the expert weights into a bmm at every call,
+        # freezing lets inductor pre-pack the (inference-only) weights
+        compile_options = {
+            "freezing": args.inductor_freezing,
+            "batch_fusion": args.inductor_batch_fusion,
+        }
+    x = torch.randn(args.num_tokens, args.hidden_size)
+    variants = [
+        ("UniversalCalculator", False),
+        ("StaticCapacityCalculator", False),
+        ("UniversalCalculator", True),
+        ("StaticCapacityCalculator", True),
+    ]
+
+    results = []
+    for calculator_type, compiled in variants:
+        layer = build_moe_layer(args, calculator_type)
+        num_graphs, num_breaks = count_graphs(layer, x)
+        fn = layer
+        if compiled:
+            torch._dynamo.reset()
+            fn = torch.compile(
+                layer,
+                backend=args.backend,
+                fullgraph=calculator_type == "StaticCapacityCalculator",
+                options=compile_options,
+            )
+        latency = measure_latency(fn, x, args.warmup, args.iters)
+        result = {
+            "calculator_type": calculator_type,
+            "mode": f"compiled({args.backend})" if compiled else "eager",
+            "graphs": num_graphs,
+            "graph_breaks": num_breaks,
+            "latency_ms": latency,
+        }
+        if calculator_type == "StaticCapacityCalculator":
+            with torch.no_grad():
+                result["num_dropped_tokens"] = fn(x).num_dropped_tokens.item()
+        results.append(result)
+        print(
+            f"{calculator_type:>26} {result['mode']:>18} graphs: {num_graphs} breaks: {num_breaks} latency: {latency:.3f} ms"
+        )
+
+    if args.output_json:
+        with open(args.output_json, "w", encoding="utf8") as fout:
+            json.dump({"args": vars(args), "results": results}, fout, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_tokens", type=int, default=512)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--intermediate_size", type=int, default=512)
+    parser.add_argument("--num_experts", type=int, default=8)
+    parser.add_argument("--num_selects", type=int, default=2)
+    parser.add_argument("--capacity_factor", type=float, default=1.25)
+    parser.add_argument("--backend", type=str, default="inductor")
+    parser.add_argument("--inductor_freezing", type=str, default="True")
+    parser.add_argument("--inductor_batch_fusion", type=str, default="False")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--iters", type=int, default=50)
+    parser.add_argument("--num_threads", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1227)
+    parser.add_argument("--output_json", type=str, default=None)
+    args = parser.parse_args()
+    args.inductor_freezing = str2bool(args.inductor_freezing)
+    args.inductor_batch_fusion = str2bool(args.inductor_batch_fusion)
+    main(args)
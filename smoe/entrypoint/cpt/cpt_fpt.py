@@ -239,6 +239,8 @@ def main():
             prob_map=prob_map,
             seed=training_args.seed,
             block_size=data_args.block_size,
+            return_domain_id=True,
+            exhaustion_policy=data_args.domain_exhaustion_policy,
         )
         # lm_datasets = load_streaming_datasets(
         #     data_args.dataset_dir,
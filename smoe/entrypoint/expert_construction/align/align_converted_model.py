@@ -10,18 +10,14 @@ from typing import Dict, Optional
 
 import accelerate
 import torch
-from torch.nn.parameter import Parameter
-from tqdm import tqdm
 
 from smoe.entrypoint.expert_construction.get_gates.hidden_feature_clustering import (
     prepare_model_and_data,
 )
 from smoe.models.mixtral import MixtralForCausalLM
 from smoe.utils.config import EnhancedTrainingArguments, ModelArguments, parse_args
-from smoe.utils.io import create_dir
-from smoe.utils.model_operation.modify_llama_moe_v2_model import (
-    llama_moe_v2_with_hidden_distribution_recording_for_alignment,
-)
+from smoe.utils.expert_construction.align_layerwise import align_model_layerwise
+from smoe.utils.io import create_dir, load_artifacts
 
 logger = logging.getLogger(__name__)
 
@@ -41,6 +37,18 @@ class DataArguments:
 class AnalysisArguments:
     reference_distribution_file: Optional[str] = field(default=None)
     save_path: Optional[str] = field(default=None)
+    max_memory_bytes: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Memory budget of the cached hidden states, the batches beyond it are spilled to disk"
+        },
+    )
+    spill_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Folder of the spilled hidden states, defaults to a temporary folder"
+        },
+    )
 
 
 # fmt: off
@@ -53,7 +61,6 @@ def main():
 
     # 🔍 model check & prepare configs
     if isinstance(model, MixtralForCausalLM):
-        model.model = llama_moe_v2_with_hidden_distribution_recording_for_alignment(model.model)  # 🔍 change the forward function
         model.config.use_cache = False  # 🔍 set configuration
         model.config.add_rescale_bias = True  # 🔍 set configuration
     else:
@@ -62,10 +69,6 @@ def main():
     if model.config.moe_type != "modulelist":
         raise ValueError("For now the only supported MoE type is modulelist!")
 
-    num_hidden_layers = model.config.num_hidden_layers
-    hidden_size = model.config.hidden_size
-    use_attn_moe = model.config.use_attn_moe
-
     # 🔍 load distribution information from file
     # Example Format:
     # {
@@ -83,99 +86,29 @@ def main():
     #     },
     #     ......
     # }
-    ref_distribution: Dict = torch.load(analysis_args.reference_distribution_file)
+    ref_distribution: Dict = load_artifacts(analysis_args.reference_distribution_file)
 
-    # 🔍 prepare accelerator
+    # 🔍 prepare accelerator (the model stays on CPU, only the running layer is moved to the device)
     accelerator = accelerate.Accelerator()
-    model, dataloader = accelerator.prepare(model, dataloader)
+    dataloader = accelerator.prepare(dataloader)
 
     # 🔍 start aligning
-    scale_factors = {}
-
-    with torch.no_grad():
-        for target_layer in range(num_hidden_layers):
-            # check if is MoE
-            if not accelerator.unwrap_model(model).model.layers[target_layer].is_moe:
-                continue
-
-            for target_module in ["attn", "mlp"] if use_attn_moe else ["mlp"]:
-                print(f"layer {target_layer} {target_module}")
-
-                # set the target module to align & initialize the statistics
-                for layer_idx, layer in enumerate(accelerator.unwrap_model(model).model.layers):
-                    if layer_idx == target_layer:
-                        layer.align_module = target_module
-                        layer.distribution = {
-                            "number": torch.zeros((1,)),
-                            "mean": torch.zeros((hidden_size,)),
-                            "variance": torch.zeros((hidden_size,)),
-                        }
-                    else:
-                        layer.align_module = None
-                        layer.distribution = None
-
-                accelerator.unwrap_model(model).model.early_stopping_layer = target_layer
-
-                # forward for distribution of the target module
-                for i, batch in tqdm(enumerate(iter(dataloader))):  # each time we create a new iter, i.e., the dataloader is reset
-                    if i >= training_args.max_steps:
-                        break
-                    model(**batch)
-
-                # gather results
-                distribution = accelerator.unwrap_model(model).model.layers[target_layer].distribution
-                print("distribution\n", distribution)
-
-                all_num = accelerator.gather(distribution["number"])
-                all_mean = accelerator.gather(distribution["mean"]).reshape(-1, hidden_size)
-                all_var = accelerator.gather(distribution["variance"]).reshape(-1, hidden_size)
-                final_num = all_num.sum()
-                final_mean = (all_num[:, None] * all_mean).sum(0) / final_num
-                final_var = (all_num[:, None] * (all_var + all_mean ** 2)).sum(0) / final_num - final_mean ** 2
-
-                # calculate the scale factor for the current module
-                ref_mean = ref_distribution[target_layer][target_module]["mean"].to(accelerator.device)
-                ref_var = ref_distribution[target_layer][target_module]["variance"].to(accelerator.device)
-
-                scale_magnitude = torch.sqrt(ref_var / final_var)
-                scale_bias = ref_mean - final_mean * scale_magnitude
-
-                if target_layer not in scale_factors:
-                    scale_factors[target_layer] = {}
-                scale_factors[target_layer][target_module] = {
-                    "scale_bias": scale_bias.clone().cpu(),
-                    "scale_magnitude": scale_magnitude.clone().cpu(),
-                }
-
-                print(f"final_num {final_num}")
-                print(f"mean: {final_mean} -> {ref_mean}")
-                print(f"variance: {final_var} -> {ref_var}")
-                print(f"scale bias: {scale_bias}")
-                print(f"scale magnitude: {scale_magnitude}")
-
-                # perform weight rescaling
-                layer = accelerator.unwrap_model(model).model.layers[target_layer]
-
-                if target_module == "attn":
-                    for expert_idx, attention_expert in enumerate(layer.self_attn.o_proj):
-                        old_bias = None if attention_expert.bias is None else attention_expert.bias.data.clone()
-                        old_weight = attention_expert.weight.data.clone()
-                        attention_expert.bias = Parameter(scale_bias.clone())
-                        attention_expert.weight *= scale_magnitude.unsqueeze(1)
-                        print(f"attn expert {expert_idx} o_proj bias: {old_bias} -> {attention_expert.bias.data}")
-                        print(f"attn expert {expert_idx} o_proj weight: {old_weight} -> {attention_expert.weight.data}")
-
-                elif target_module == "mlp":
-                    for expert_idx, mlp_expert in enumerate(layer.block_sparse_moe.experts):
-                        old_bias = None if mlp_expert.w2.bias is None else mlp_expert.w2.bias.data.clone()
-                        old_weight = mlp_expert.w2.weight.data.clone()
-                        mlp_expert.w2.bias = Parameter(scale_bias.clone())
-                        mlp_expert.w2.weight *= scale_magnitude.unsqueeze(1)
-                        print(f"MLP expert {expert_idx} down_proj bias: {old_bias} -> {mlp_expert.w2.bias.data}")
-                        print(f"MLP expert {expert_idx} down_proj weight: {old_weight} -> {mlp_expert.w2.weight.data}")
-
-                else:
-                    raise NotImplementedError
+    # the batches are streamed through one layer at a time, so each layer is forwarded once more per module to align
+    batches = []
+    for i, batch in enumerate(dataloader):
+        if i >= training_args.max_steps:
+            break
+        batches.append(batch)
+
+    scale_factors = align_model_layerwise(
+        model,
+        batches,
+        ref_distribution,
+        gather_fn=accelerator.gather,
+        max_memory_bytes=analysis_args.max_memory_bytes,
+        spill_dir=analysis_args.spill_dir,
+        device=accelerator.device,
+    )
 
     # 🔍 save the aligned model
     if accelerator.is_main_process:
@@ -185,7 +118,7 @@ def main():
         torch.save(scale_factors, os.path.join(analysis_args.save_path, "scale_factors.pt"))
 
         # model
-        accelerator.unwrap_model(model).save_pretrained(analysis_args.save_path)
+        model.save_pretrained(analysis_args.save_path)
 
         # tokenizer
         tokenizer = dataloader.dataset.tokenizer
@@ -193,11 +126,11 @@ def main():
 
         # code
         current_path = os.path.dirname(__file__)
-        if isinstance(accelerator.unwrap_model(model), MixtralForCausalLM):
+        if isinstance(model, MixtralForCausalLM):
             shutil.copy(os.path.join(current_path, "../../../models/mixtral/configuration_mixtral.py"), analysis_args.save_path)
             shutil.copy(os.path.join(current_path, "../../../models/mixtral/modeling_mixtral.py"), analysis_args.save_path)
         else:
-            warnings.warn(f"[WARN] unknown model type {type(accelerator.unwrap_model(model))}")
+            warnings.warn(f"[WARN] unknown model type {type(model)}")
 
     accelerator.wait_for_everyone()
     accelerator.print("All done!")
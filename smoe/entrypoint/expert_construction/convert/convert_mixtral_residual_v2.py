@@ -1,10 +1,9 @@
 import argparse
 
-import torch
-
 from smoe.utils.expert_construction.convert_llama_to_mixtral_residual import (
     convert_residual_safetensors,
 )
+from smoe.utils.io import load_artifacts
 
 # fmt: off
 if __name__ == "__main__":
@@ -23,7 +22,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
     print(args, "\n")
 
-    neuron_indices = torch.load(args.neuron_indices_file)
+    neuron_indices = load_artifacts(args.neuron_indices_file)
     intermediate_size = len(neuron_indices[0][0])
     intermediate_size_residual = len(neuron_indices[0]["residual"])
 
@@ -38,7 +37,7 @@ if __name__ == "__main__":
         num_moe_contract_layers=args.num_moe_contract_layers,
         moe_type=args.moe_implementation_type,
         neuron_indices=neuron_indices,
-        gate_weights=None if args.gate_weights_file is None else torch.load(args.gate_weights_file),
+        gate_weights=None if args.gate_weights_file is None else load_artifacts(args.gate_weights_file),
     )
     print("Done!")
 # fmt: on
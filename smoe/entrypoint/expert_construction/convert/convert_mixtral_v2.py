@@ -1,8 +1,7 @@
 import argparse
 
-import torch
-
 from smoe.utils.expert_construction.convert_llama_to_mixtral import convert_safetensors
+from smoe.utils.io import load_artifacts
 
 # fmt: off
 if __name__ == "__main__":
@@ -29,8 +28,8 @@ if __name__ == "__main__":
         scale_factor=args.scale_factor,
         num_moe_contract_layers=args.num_moe_contract_layers,
         moe_type=args.moe_implementation_type,
-        neuron_indices=None if args.neuron_indices_file is None else torch.load(args.neuron_indices_file),
-        gate_weights=None if args.gate_weights_file is None else torch.load(args.gate_weights_file),
+        neuron_indices=None if args.neuron_indices_file is None else load_artifacts(args.neuron_indices_file),
+        gate_weights=None if args.gate_weights_file is None else load_artifacts(args.gate_weights_file),
     )
     print("Done!")
 # fmt: on
@@ -0,0 +1,23 @@
+"""
+Quantize the expert weights of a saved (LLaMA-MoE / Mixtral) safetensors checkpoint to int8 / int4 for
+inference, see `smoe.modules.expert_quant`. Load the results with `load_quantized_model`.
+"""
+
+import argparse
+
+from smoe.modules.expert_quant import SUPPORTED_BITS, quantize_safetensors_experts
+
+# fmt: off
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str)
+    parser.add_argument('--save_path', type=str)
+    parser.add_argument('--bits', type=int, default=8, choices=SUPPORTED_BITS)
+    parser.add_argument('--group_size', type=int, default=None, help="input channels sharing a scale, None for per output channel scales")
+
+    args = parser.parse_args()
+    print(args, "\n")
+
+    quantize_safetensors_experts(args.model_path, args.save_path, bits=args.bits, group_size=args.group_size)
+    print("Done.")
+# fmt: on
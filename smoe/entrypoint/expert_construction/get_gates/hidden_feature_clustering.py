@@ -3,7 +3,6 @@ Modified from smoe/entrypoint/cpt/cpt_fpt.py
 """
 import gc
 import logging
-import math
 import os
 import pathlib
 import socket
@@ -15,19 +14,15 @@ import accelerate
 import datasets
 import torch
 import transformers
-from k_means_constrained import KMeansConstrained
 from torch.utils.data import DataLoader, RandomSampler
-from tqdm import tqdm
 from transformers import (
     CONFIG_MAPPING,
     AutoConfig,
     AutoModelForCausalLM,
     AutoTokenizer,
-    DynamicCache,
     LlamaForCausalLM,
     set_seed,
 )
-from transformers.models.llama.modeling_llama import LlamaMLP
 from transformers.trainer_utils import seed_worker
 
 from smoe.entrypoint.cpt.cpt_fpt import MODEL_MAP
@@ -38,8 +33,9 @@ from smoe.entrypoint.sft.train_sft_llama3 import (
 from smoe.models.llama_moe.modeling_llama_moe import LlamaMoEForCausalLM
 from smoe.models.llama_moe_residual import LlamaMoEResidualForCausalLM
 from smoe.models.mixtral.modeling_mixtral import MixtralForCausalLM
+from smoe.utils.calibration import FeatureCaptureCallback, LayerwiseCalibrator
 from smoe.utils.config import EnhancedTrainingArguments, ModelArguments, parse_args
-from smoe.utils.expert_construction.k_means_constrained_cos import KMeansConstrainedCos
+from smoe.utils.expert_construction.hidden_feature_gates import cluster_gate_weights
 from smoe.utils.gpu_mem_track import print_gpu_memory
 from smoe.utils.io import create_dir
 from smoe.utils.param import get_trainable_parameters
@@ -89,6 +85,18 @@ class ClusteringArguments:
             "help": "Number of runs for K-Means to run in parallel. Should be over 0."
         },
     )
+    max_memory_bytes: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Memory budget of the cached hidden states and features, the batches beyond it are spilled to disk"
+        },
+    )
+    spill_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Folder of the spilled hidden states, defaults to a temporary folder"
+        },
+    )
 
 
 # fmt: off
@@ -273,185 +281,83 @@ def main():
     if not isinstance(model, LlamaForCausalLM):
         raise ValueError("For now the only supported model is LLaMA!")
 
-    num_hidden_layers = model.config.num_hidden_layers
     hidden_size = model.config.hidden_size
 
     # assert hidden_size % clustering_args.num_experts == 0
     balance_jitter_factor = max(0.0, clustering_args.balance_jitter_factor)
 
-    # 🔍 prepare accelerator
+    # 🔍 prepare accelerator (the model stays on CPU, only the running layer is moved to the device)
     accelerator = accelerate.Accelerator()
-    model, dataloader = accelerator.prepare(model, dataloader)
+    dataloader = accelerator.prepare(dataloader)
+    if accelerator.num_processes > 1:
+        # pad to make the tensors share the same shape
+        raise NotImplementedError("Please use 1 GPU to run.")
 
     # 🔍 begin layer-wise clustering
     all_gate_weights = {}
 
-    with torch.no_grad():
-        # 🔍 prepare forward kwargs (copied from LlamaModel)
-        ## initialize temp vars
-        all_hidden_states = []
-        all_attn_kwargs = []
-        all_padding_masks = []
-
-        ## prepare inputs
-        accelerator.print(f"Forward for embedding outputs!")
-
-        for i, batch in tqdm(enumerate(dataloader)):
-            if i >= training_args.max_steps:
-                break
-
-            ## get embedded hidden states
-            hidden_states = accelerator.unwrap_model(model).model.embed_tokens(batch["input_ids"])
-
-            ## get attention kwargs
-            output_attentions = False
-            use_cache = False
-
-            past_key_values = DynamicCache.from_legacy_cache(None)
-            past_seen_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
-            cache_position = torch.arange(
-                past_seen_tokens,
-                past_seen_tokens + hidden_states.shape[1],
-                device=accelerator.device,
-            )
-            position_ids = cache_position.unsqueeze(0)
-
-            attention_mask = batch.get("attention_mask")
-            causal_mask = accelerator.unwrap_model(model).model._update_causal_mask(
-                attention_mask,
-                hidden_states,
-                cache_position,
-                past_key_values,
-                output_attentions,
-            )
+    def _cluster(i, all_clustering_hidden_states):
+        """Clusters the MLP input features of layer `i`, called by the calibrator after the layer forward"""
+        accelerator.print(f"Forward for layer {i} outputs done!")
+        print_gpu_memory(accelerator)
+        all_clustering_hidden_states = all_clustering_hidden_states.float().reshape(-1, hidden_size).numpy()
+
+        ## perform clustering
+        accelerator.print(f"Clustering for layer {i} outputs!")
+
+        gate_weights = cluster_gate_weights(
+            all_clustering_hidden_states,
+            clustering_args.num_experts,
+            balance_jitter_factor=balance_jitter_factor,
+            distance_metric=clustering_args.distance_metric,
+            max_iter=clustering_args.max_iter,
+            random_state=clustering_args.random_state,
+            n_init=clustering_args.n_jobs,
+            n_jobs=clustering_args.n_jobs,
+            verbose=True,
+        )
 
-            input_kwargs = {
-                "attention_mask": causal_mask,
-                "position_ids": position_ids,
-                "past_key_value": past_key_values,
-                "output_attentions": output_attentions,
-                "use_cache": use_cache,
-                "cache_position": cache_position,
-            }
-
-            ## add to all
-            all_hidden_states.append(hidden_states.cpu())
-            all_attn_kwargs.append(input_kwargs)
-            all_padding_masks.append(attention_mask.bool() if attention_mask is not None else None)
-
-        accelerator.print(f"Forward for embedding outputs done!")
-
-        # 🔍 perform clustering for layers
-        for i in range(num_hidden_layers):
-            ## initialize temp vars
-            global this_padding_mask
-            this_padding_mask = None
-            all_clustering_hidden_states = []
-
-            ## hook
-            @torch.no_grad()
-            def _forward_hook_mlp(module, input, output):
-                """This hook captures the input features to the MLP layers"""
-                # WARNING: Each run here causes the GPU memory to leak!!!!!!!!!
-                if this_padding_mask is None:
-                    clustering_hidden_state = input[0].detach()
-                else:
-                    clustering_hidden_state = input[0].detach()[this_padding_mask]
-                all_clustering_hidden_states.append(clustering_hidden_state)
-
-            ## prepare layer
-            layer = accelerator.unwrap_model(model).model.layers[i]
-            assert isinstance(layer.mlp, LlamaMLP)
-            hook = layer.mlp.up_proj.register_forward_hook(_forward_hook_mlp)
-
-            ## get hidden states
-            accelerator.print(f"Forward for layer {i} outputs!")
-            print_gpu_memory(accelerator)
-            for batch_id, hidden_states in tqdm(enumerate(all_hidden_states)):
-                this_padding_mask = all_padding_masks[batch_id]
-                all_hidden_states[batch_id] = layer(hidden_states.to(accelerator.device), **all_attn_kwargs[batch_id])[0].cpu()
-            accelerator.print(f"Forward for layer {i} outputs done!")
-            print_gpu_memory(accelerator)
-
-            ## 🔍 all gather across devices
-            all_clustering_hidden_states = torch.cat(all_clustering_hidden_states, dim=0)
-            if accelerator.num_processes > 1:
-                # pad to make the tensors share the same shape
-                raise NotImplementedError("Please use 1 GPU to run.")
-            all_clustering_hidden_states = accelerator.gather(all_clustering_hidden_states).cpu().float().reshape(-1, hidden_size)
-            all_clustering_hidden_states = all_clustering_hidden_states.numpy()
-
-            ## free memory
-            hook.remove()
-            layer.to("cpu")
-            del layer
-            del hidden_states
-            gc.collect()
-            torch.cuda.empty_cache()
-            accelerator.print(f"Clear cache done!")
-            print_gpu_memory(accelerator)
-
-            ## perform clustering
-            if accelerator.is_main_process:
-                accelerator.print(f"Clustering for layer {i} outputs!")
-
-                num_features = all_clustering_hidden_states.shape[0]
-                balanced_num_features = num_features / clustering_args.num_experts
-                min_cluster_size = max(0, math.floor(balanced_num_features * (1 - balance_jitter_factor)))
-                max_cluster_size = min(num_features, math.ceil(balanced_num_features * (1 + balance_jitter_factor)))
-
-                print("total number of features:", num_features)
-                print("ideally balanced cluster size:", balanced_num_features)
-                print("min cluster size:", min_cluster_size)
-                print("max cluster size:", max_cluster_size)
-
-                if clustering_args.distance_metric == "l2":
-                    kmeans = KMeansConstrained(
-                        n_clusters=clustering_args.num_experts,
-                        size_min=min_cluster_size,
-                        size_max=max_cluster_size,
-                        tol=1e-3,
-                        n_init=clustering_args.n_jobs,
-                        max_iter=clustering_args.max_iter,
-                        random_state=clustering_args.random_state,
-                        n_jobs=clustering_args.n_jobs,
-                        verbose=True,
-                    ).fit(all_clustering_hidden_states, None)
-                elif clustering_args.distance_metric == "cos":
-                    kmeans = KMeansConstrainedCos(
-                        n_clusters=clustering_args.num_experts,
-                        size_min=min_cluster_size,
-                        size_max=max_cluster_size,
-                        tol=1e-3,
-                        n_init=clustering_args.n_jobs,
-                        max_iter=clustering_args.max_iter,
-                        random_state=clustering_args.random_state,
-                        n_jobs=clustering_args.n_jobs,
-                        verbose=True,
-                    ).fit(all_clustering_hidden_states, None)
-                gate_weights = torch.from_numpy(kmeans.cluster_centers_)
-
-                # gate_weights = all_clustering_hidden_states[torch.randperm(num_features)[:clustering_args.num_experts]]
-
-                all_gate_weights[i] = gate_weights  # add to all weights
-                accelerator.print(f"{gate_weights.shape}, {gate_weights}")
-                accelerator.print(f"Clustering for layer {i} outputs done!")
-
-                ## check the classification results
-                all_logits = torch.from_numpy(all_clustering_hidden_states).to(accelerator.device) @ gate_weights.clone().to(accelerator.device).t()
-                all_classes = torch.argmax(all_logits, dim=-1)
-                class_counts = torch.bincount(all_classes, minlength=clustering_args.num_experts)
-                accelerator.print(f"Classification counts for layer {i}: {class_counts}")
-
-                ## free memory
-                gc.collect()
-                torch.cuda.empty_cache()
-                print_gpu_memory(accelerator)
-
-            else:
-                del all_clustering_hidden_states  # only store the hidden states on the main process
-
-            accelerator.wait_for_everyone()
+        # gate_weights = all_clustering_hidden_states[torch.randperm(num_features)[:clustering_args.num_experts]]
+
+        all_gate_weights[i] = gate_weights  # add to all weights
+        accelerator.print(f"{gate_weights.shape}, {gate_weights}")
+        accelerator.print(f"Clustering for layer {i} outputs done!")
+
+        ## check the classification results
+        all_logits = torch.from_numpy(all_clustering_hidden_states).to(accelerator.device) @ gate_weights.clone().to(accelerator.device).t()
+        all_classes = torch.argmax(all_logits, dim=-1)
+        class_counts = torch.bincount(all_classes, minlength=clustering_args.num_experts)
+        accelerator.print(f"Classification counts for layer {i}: {class_counts}")
+
+        ## free memory
+        del all_logits
+        gc.collect()
+        torch.cuda.empty_cache()
+        print_gpu_memory(accelerator)
+
+    batches = []
+    for i, batch in enumerate(dataloader):
+        if i >= training_args.max_steps:
+            break
+        batches.append(batch)
+
+    # 🔍 the MLP inputs (non-padding tokens) of each layer are captured and clustered layer by layer
+    calibrator = LayerwiseCalibrator(
+        model,
+        device=accelerator.device,
+        max_memory_bytes=clustering_args.max_memory_bytes,
+        spill_dir=clustering_args.spill_dir,
+    )
+    calibrator.run(
+        batches,
+        [
+            FeatureCaptureCallback(
+                _cluster,
+                max_memory_bytes=clustering_args.max_memory_bytes,
+                spill_dir=None if clustering_args.spill_dir is None else os.path.join(clustering_args.spill_dir, "features"),
+            )
+        ],
+    )
 
     # 🔍 save clustering results (gate weights)
     if accelerator.is_main_process:
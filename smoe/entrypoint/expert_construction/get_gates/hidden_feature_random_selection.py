@@ -17,6 +17,7 @@ from smoe.entrypoint.expert_construction.get_gates.hidden_feature_clustering imp
     prepare_model_and_data,
 )
 from smoe.utils.config import EnhancedTrainingArguments, ModelArguments, parse_args
+from smoe.utils.expert_construction.hidden_feature_gates import select_gate_weights
 from smoe.utils.gpu_mem_track import print_gpu_memory
 from smoe.utils.io import create_dir
 
@@ -178,7 +179,7 @@ def main():
                 num_features = all_selection_hidden_states.shape[0]
                 print("total number of features:", num_features)
 
-                gate_weights = all_selection_hidden_states[torch.randperm(num_features)[:selection_args.num_experts]]
+                gate_weights = select_gate_weights(all_selection_hidden_states, selection_args.num_experts)
 
                 all_gate_weights[i] = gate_weights  # add to all weights
                 accelerator.print(f"{gate_weights.shape}, {gate_weights}")
@@ -0,0 +1,34 @@
+"""
+Pack expert construction artifacts (split scores, neuron indices, gate weights, ...) into a single
+memory-mapped artifact store, see `smoe.utils.io.ArtifactStore`.
+
+`--src` is a `torch.save` file (e.g. `importance_scores.pt`) or a folder of per-layer / per-expert files.
+The store is a drop-in replacement of `--src` for the split / convert / visualization entrypoints.
+"""
+
+import argparse
+
+from transformers import AutoConfig
+
+from smoe.utils.io import ArtifactStore, pack_artifacts
+
+# fmt: off
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--src', type=str)
+    parser.add_argument('--dst', type=str, help="path of the store, ends with `.safetensors`")
+    parser.add_argument('--model_path', type=str, default=None, help="the config hash of this model is recorded in the manifest")
+    parser.add_argument('--kind', type=str, default=None, help="e.g. `importance_scores`, `neuron_indices`, `gate_weights`")
+
+    args = parser.parse_args()
+    print(args, "\n")
+
+    if not args.dst.endswith(".safetensors"):
+        raise ValueError("The artifact store path must end with `.safetensors`!")
+
+    config = None if args.model_path is None else AutoConfig.from_pretrained(args.model_path)
+    pack_artifacts(args.src, args.dst, config=config, kind=args.kind)
+
+    store = ArtifactStore(args.dst)
+    print(f"Packed {len(store)} top-level entries to \"{args.dst}\", manifest: {store.manifest}")
+# fmt: on
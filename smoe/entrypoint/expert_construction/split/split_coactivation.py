@@ -0,0 +1,102 @@
+"""
+Split the FFN neurons of (ReLU-)LLaMA into experts by their co-activations on calibration data.
+
+The calibration batches are streamed through the model layer by layer, the top-k co-activation sketch of
+every layer is partitioned into equally sized experts right after the layer, and the expert neuron indices
+are saved as `neuron_indices.pt` for `convert_safetensors`.
+"""
+
+import argparse
+import os
+
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from transformers import AutoTokenizer, LlamaForCausalLM
+
+from smoe.data.collate_fn import tensor_dict_cat_collator
+from smoe.data.datasets_moe import LineByLineJsonlTextDataset
+from smoe.utils.calibration import LayerwiseCalibrator
+from smoe.utils.expert_construction.coactivation import (
+    CoActivationCallback,
+    balanced_graph_partition,
+    labels_to_neuron_indices,
+    partition_cut,
+)
+from smoe.utils.io import create_dir
+from smoe.utils.model_operation.modify_llama_model import llama_with_relu_activation
+from smoe.utils.operations.operation_string import str2bool
+
+# fmt: off
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str)
+    parser.add_argument('--tokenizer_path', type=str, default=None)
+    parser.add_argument('--data_path', type=str)
+    parser.add_argument('--save_path', type=str)
+    parser.add_argument('--num_experts', type=int, default=8)
+    parser.add_argument('--use_relu', type=str, default="False", help="replace the activation with ReLU, for ReLU-LLaMA checkpoints with SiLU configs")
+    parser.add_argument('--activation_threshold', type=float, default=0.0, help="a neuron fires when its activation is above the threshold")
+    parser.add_argument('--num_neighbors', type=int, default=64, help="co-activated neighbors kept for every neuron")
+    parser.add_argument('--flush_tokens', type=int, default=8192)
+    parser.add_argument('--normalize', type=str, default="jaccard", choices=("jaccard", "count"))
+    parser.add_argument('--max_iter', type=int, default=20, help="iterations of the partition refinement")
+    parser.add_argument('--data_begin_index', type=int, default=0)
+    parser.add_argument('--data_end_index', type=int, default=500)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--block_size', type=int, default=2048)
+    parser.add_argument('--max_memory_bytes', type=int, default=None, help="memory budget of the cached hidden states")
+    parser.add_argument('--spill_dir', type=str, default=None)
+    parser.add_argument('--save_sketches', type=str, default="False")
+
+    args = parser.parse_args()
+    args.use_relu = str2bool(args.use_relu)
+    args.save_sketches = str2bool(args.save_sketches)
+    print(args, "\n")
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    """load tokenizer & data"""
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path or args.model_path)
+    tokenizer.pad_token = tokenizer.eos_token
+    data_index_range = (args.data_begin_index, args.data_end_index)
+    dataset = LineByLineJsonlTextDataset(tokenizer, file_path=args.data_path, block_size=args.block_size, data_index_range=data_index_range)
+    data_loader = DataLoader(dataset, batch_size=args.batch_size, collate_fn=tensor_dict_cat_collator)
+
+    """load model (kept on CPU, only the running layer is moved to the device)"""
+    print("Loading llama model...", flush=True)
+    model = LlamaForCausalLM.from_pretrained(args.model_path, torch_dtype=torch.float16 if device == "cuda" else torch.float32).model
+    if args.use_relu:
+        model = llama_with_relu_activation(model)
+    model.eval()
+
+    """collect co-activations & split layer by layer"""
+    neuron_indices = {}
+    sketches = {}
+
+    def _split(layer_idx, sketch):
+        graph = sketch.to_graph(normalize=args.normalize)
+        labels = balanced_graph_partition(graph, args.num_experts, max_iter=args.max_iter)
+        neuron_indices[layer_idx] = labels_to_neuron_indices(labels, args.num_experts)
+        firing_rate = sketch.firing_counts.float().mean().item() / max(sketch.num_tokens, 1)
+        print(f"Layer {layer_idx}: tokens {sketch.num_tokens}, firing rate {firing_rate:.4f}, edges {graph.nnz}, cut {partition_cut(graph, labels):.4f}", flush=True)
+        if args.save_sketches:
+            sketches[layer_idx] = sketch.state_dict()
+
+    callback = CoActivationCallback(
+        _split,
+        threshold=args.activation_threshold,
+        num_neighbors=args.num_neighbors,
+        flush_tokens=args.flush_tokens,
+    )
+    calibrator = LayerwiseCalibrator(model, device=device, max_memory_bytes=args.max_memory_bytes, spill_dir=args.spill_dir)
+    calibrator.run(tqdm(data_loader, desc="forward for embeddings"), [callback])
+
+    """save"""
+    create_dir(args.save_path)
+    torch.save(neuron_indices, os.path.join(args.save_path, "neuron_indices.pt"))
+    if args.save_sketches:
+        torch.save(sketches, os.path.join(args.save_path, "coactivation_sketches.pt"))
+    print("Done.")
+
+# fmt: on
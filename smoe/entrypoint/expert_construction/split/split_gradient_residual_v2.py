@@ -2,11 +2,11 @@ import argparse
 import os
 
 import torch
-from tqdm import tqdm
 from transformers import LlamaConfig
 
 from smoe.utils.expert_construction.expert_split_residual import GradientSplitResidual
-from smoe.utils.io import create_dir
+from smoe.utils.expert_construction.parallel_split import ParallelLayerSplitter
+from smoe.utils.io import create_dir, load_artifacts
 from smoe.utils.operations.operation_string import str2bool
 
 
@@ -42,6 +42,13 @@ class GradientSplitResidualV2(GradientSplitResidual):
         print(self.labels)
 
 
+def split_layer(layer, shared, args):
+    score_list = [shared[f"{layer}.{j}"] for j in range(args.num_experts_moe)]
+    split = GradientSplitResidualV2(args, layer, score_list)
+    split.split(args.num_experts_moe, args.num_experts_residual, args.expert_size, criterion=args.criterion, share_neurons=args.share_neurons)
+    return split.labels
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--model_path', type=str)
@@ -54,6 +61,8 @@ if __name__ == "__main__":
 
     parser.add_argument('--criterion', type=str, default="max", choices=("min", "max"))
     parser.add_argument('--share_neurons', type=str, default="False")
+    parser.add_argument('--num_workers', type=int, default=1, help="processes splitting the layers in parallel")
+    parser.add_argument('--checkpoint_dir', type=str, default=None, help="finished layers are saved here and skipped when resuming")
 
     args = parser.parse_args()
     args.share_neurons = str2bool(args.share_neurons)
@@ -63,25 +72,28 @@ if __name__ == "__main__":
     config = LlamaConfig.from_pretrained(args.model_path)
 
     print("Loading importance scores...")
-    all_importance_scores = torch.load(args.score_file)
+    all_importance_scores = load_artifacts(args.score_file)  # `.pt` or artifact store
 
     # START
-    neuron_indices = {}
-    for i in tqdm(range(config.num_hidden_layers)):
-        # get scores
+    shared_scores = {}
+    for i in range(config.num_hidden_layers):
         this_layer_scores = all_importance_scores[i]
-        score_list = [this_layer_scores[j] for j in range(len(this_layer_scores))]
 
         # check configs
-        assert args.num_experts_moe == len(score_list)
-
-        if args.expert_size is None:
-            args.expert_size = score_list[0].numel() // (args.num_experts_moe + args.num_experts_residual)
-
-        # start split
-        split = GradientSplitResidualV2(args, i, score_list)
-        split.split(args.num_experts_moe, args.num_experts_residual, args.expert_size, criterion=args.criterion, share_neurons=args.share_neurons)
-        neuron_indices[i] = split.labels
+        assert args.num_experts_moe == len(this_layer_scores)
+        for j in range(args.num_experts_moe):
+            shared_scores[f"{i}.{j}"] = this_layer_scores[j]
+
+    if args.expert_size is None:
+        args.expert_size = shared_scores["0.0"].numel() // (args.num_experts_moe + args.num_experts_residual)
+
+    # start split
+    splitter = ParallelLayerSplitter(num_workers=args.num_workers, checkpoint_dir=args.checkpoint_dir)
+    neuron_indices = splitter.run(
+        split_layer,
+        {i: dict(args=args) for i in range(config.num_hidden_layers)},
+        shared=shared_scores,
+    )
 
     # SAVE
     create_dir(args.save_path)
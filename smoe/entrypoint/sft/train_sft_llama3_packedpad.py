@@ -16,6 +16,10 @@ from transformers.trainer_pt_utils import LabelSmoother
 
 import smoe.models.mixtral.modeling_mixtral as ModelingMixtralResidual
 from smoe.models.mixtral import MixtralConfig, MixtralForCausalLM
+from smoe.utils.async_checkpoint import (
+    AsyncShardedCheckpointWriter,
+    merge_sharded_checkpoint,
+)
 from smoe.utils.conversation import Llama3ConversationTemplate
 from smoe.utils.io import get_pathname_from_name_or_path, load_json, load_jsonlines
 
@@ -101,9 +105,28 @@ class TrainingArguments(transformers.TrainingArguments):
         default=False,
         metadata={"help": "Whether to save optimizer."},
     )
+    async_checkpoint: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to write the final checkpoint as per-rank shards (merged into HF format on rank 0 afterwards) instead of gathering the full state dict to rank 0."
+        },
+    )
 
 
 def trainer_save_model_safe(trainer):
+    if getattr(trainer.args, "async_checkpoint", False):
+        # every rank writes its own FSDP shard, then rank 0 merges them from disk
+        writer = AsyncShardedCheckpointWriter()
+        writer.save(trainer.model, trainer.args.output_dir)
+        writer.close()
+        trainer.accelerator.wait_for_everyone()
+        if trainer.args.should_save:
+            merge_sharded_checkpoint(trainer.args.output_dir, remove_shards=True)
+            trainer.model.config.save_pretrained(trainer.args.output_dir)
+            if trainer.tokenizer is not None:
+                trainer.tokenizer.save_pretrained(trainer.args.output_dir)
+        return
+
     from torch.distributed.fsdp import FullStateDictConfig
     from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
     from torch.distributed.fsdp import StateDictType
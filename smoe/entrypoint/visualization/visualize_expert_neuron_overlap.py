@@ -9,6 +9,12 @@ import torch
 from tqdm import tqdm
 from transformers import LlamaConfig
 
+from smoe.utils.expert_construction.neuron_overlap import (
+    load_or_compute_overlap,
+    neuron_overlap_stats,
+    overlap_cache_file,
+    selected_masks_from_scores,
+)
 from smoe.utils.io import delete_file_or_dir, torch_load_template_score_file
 from smoe.utils.visualization.visualize import visualize_expert_neuron_overlap
 
@@ -21,6 +27,7 @@ if __name__ == "__main__":
     parser.add_argument('--expert_size', type=int)
     parser.add_argument('--score_file_template', type=str, default="layers.{}.mlp.up_proj.weight.change")
     parser.add_argument('--criterion', type=str, default="max", choices=("min", "max"))
+    parser.add_argument('--cache_file', type=str, default=None, help="overlap statistics cache, next to the score files by default")
 
     args = parser.parse_args()
     print("\n", args)
@@ -30,27 +37,29 @@ if __name__ == "__main__":
 
     delete_file_or_dir(os.path.join(args.save_path, "total_neurons.txt"))
 
-    for layer_id in tqdm(range(config.num_hidden_layers)):
-        """read scores from files"""
-        score_list = torch_load_template_score_file(args.score_file_path, args.score_file_template, layer_id)
-        num_experts = len(score_list)
-        scores = torch.stack(score_list, dim=0)
-
-        """get selected mask"""
-        selected_mask_list = []
-        for j, score in enumerate(score_list):
-            if args.criterion == "min":
-                sorted_score, index = torch.sort(score)
-            elif args.criterion == "max":
-                sorted_score, index = torch.sort(score, descending=True)
-            else:
-                raise NotImplementedError
-            selected_mask = torch.zeros_like(score, dtype=torch.int)
-            selected_mask[index[:args.expert_size]] += 1
-            selected_mask_list.append(selected_mask)
-        selected_masks = torch.stack(selected_mask_list, dim=0)  # shape(num_experts, intermediate_size)
+    def compute_overlap():
+        """read scores from files & get selected masks"""
+        scores = torch.stack([
+            torch.stack(torch_load_template_score_file(args.score_file_path, args.score_file_template, layer_id), dim=0)
+            for layer_id in tqdm(range(config.num_hidden_layers), desc="loading scores")
+        ], dim=0)  # shape(num_layers, num_experts, intermediate_size)
+        selected_masks = selected_masks_from_scores(scores, args.expert_size, criterion=args.criterion)
+        return neuron_overlap_stats(selected_masks)
+
+    cache_file = args.cache_file or overlap_cache_file(args.score_file_path, f"overlap-{args.criterion}-{args.expert_size}")
+    overlap_stats = load_or_compute_overlap(
+        cache_file,
+        args.score_file_path,
+        compute_overlap,
+        template=args.score_file_template,
+        criterion=args.criterion,
+        expert_size=args.expert_size,
+    )
+    num_experts = overlap_stats["overlap_rate"].shape[-1]
 
+    for layer_id in tqdm(range(config.num_hidden_layers)):
         """visualize"""
-        visualize_expert_neuron_overlap(selected_masks, num_experts, config.intermediate_size, args.expert_size, layer_id, save_dir=args.save_path)
+        this_layer_stats = {key: value[layer_id] for key, value in overlap_stats.items()}
+        visualize_expert_neuron_overlap(None, num_experts, config.intermediate_size, args.expert_size, layer_id, save_dir=args.save_path, overlap_stats=this_layer_stats)
 
     print("done.")
@@ -6,10 +6,16 @@ import argparse
 import math
 import os
 
+import numpy as np
 import torch
 from tqdm import tqdm
 from transformers import LlamaConfig
 
+from smoe.utils.expert_construction.neuron_overlap import (
+    load_or_compute_overlap,
+    overlap_cache_file,
+    selection_overlap_sweep,
+)
 from smoe.utils.io import torch_load_template_score_file
 from smoe.utils.visualization.line import line_plot_with_highlight
 
@@ -21,6 +27,7 @@ if __name__ == "__main__":
     parser.add_argument('--save_path', type=str)
     parser.add_argument('--score_file_template', type=str, default="layers.{}.mlp.up_proj.weight.change")
     parser.add_argument('--criterion', type=str, default="max", choices=("min", "max"))
+    parser.add_argument('--cache_file', type=str, default=None, help="overlap statistics cache, next to the score files by default")
 
     args = parser.parse_args()
     print("\n", args)
@@ -38,67 +45,43 @@ if __name__ == "__main__":
     print(len(expert_size_list))
     print(expert_size_list)
 
+    def compute_overlap():
+        """read scores from files"""
+        scores = torch.stack([
+            torch.stack(torch_load_template_score_file(args.score_file_path, args.score_file_template, layer_id), dim=0)
+            for layer_id in tqdm(range(config.num_hidden_layers), desc="loading scores")
+        ], dim=0)  # shape(num_layers, num_experts, intermediate_size)
+        return selection_overlap_sweep(scores, expert_size_list, criterion=args.criterion)
+
+    cache_file = args.cache_file or overlap_cache_file(args.score_file_path, f"overlap-sweep-{args.criterion}")
+    sweep = load_or_compute_overlap(
+        cache_file,
+        args.score_file_path,
+        compute_overlap,
+        template=args.score_file_template,
+        criterion=args.criterion,
+        expert_sizes=expert_size_list,
+    )
+    overlap_neurons = sweep["overlap_neurons"]  # shape(num_layers, num_sizes, num_experts)
+    independent_neurons = sweep["independent_neurons"]  # shape(num_layers, num_sizes)
+
+    """summarize results"""
     independent_neuron_count = {}
-    overlap_percent = {}
+    overlap_percent = {overlap_num: {} for overlap_num in range(1, num_experts + 1)}
     overlap_repeated_rate = {}
+    total_neuron_num = np.array(expert_size_list) * num_experts
+    repeated_times = np.arange(num_experts)  # (overlap_num - 1)
 
-    for layer_id in tqdm(range(config.num_hidden_layers)):
-        # print(f"Layer {layer_id}:")
+    for layer_id in range(config.num_hidden_layers):
+        """independent neuron count"""
+        independent_neuron_count[f"layer{layer_id}"] = independent_neurons[layer_id].tolist()
 
-        """read scores from files"""
-        score_list = torch_load_template_score_file(args.score_file_path, args.score_file_template, layer_id)
-        scores = torch.stack(score_list, dim=0)
-        scores_sum = scores.sum(0)
-
-        """sort scores"""
-        sort_index_list = []
-        for score in score_list:
-            if args.criterion == "min":
-                sorted_score, index = torch.sort(score)
-            elif args.criterion == "max":
-                sorted_score, index = torch.sort(score, descending=True)
-            else:
-                raise NotImplementedError
-            sort_index_list.append(index)
-
-        # for i in range(len(sort_index_list)):
-        #     print(f"Expert {i} index: {sort_index_list[i][:5]}")
-
-        """initialize dict"""
-        for expert_id in range(num_experts):
-            if (expert_id + 1) not in overlap_percent:
-                overlap_percent[expert_id + 1] = {}
-            overlap_percent[expert_id + 1][f"layer{layer_id}"] = []
-        overlap_repeated_rate[f"layer{layer_id}"] = []
-        independent_neuron_count[f"layer{layer_id}"] = []
-
-        """summarize results"""
-        for expert_size in expert_size_list:
-
-            """get selected mask"""
-            selected_mask_list = []
-            for index in sort_index_list:
-                selected_mask = torch.zeros((config.intermediate_size,), dtype=torch.int)
-                selected_mask[index[:expert_size]] += 1
-                selected_mask_list.append(selected_mask)
-            selected_masks = torch.stack(selected_mask_list, dim=0)  # shape(num_experts, intermediate_size)
-            sum_count = selected_masks.sum(0)  # shape(intermediate_size,)
-
-            """independent neuron count"""
-            this_size_independent_neuron_count = (sum_count > 0).sum().item()
-            independent_neuron_count[f"layer{layer_id}"].append(this_size_independent_neuron_count)
-
-            """overlap percent"""
-            for overlap_num in range(1, num_experts + 1):
-                this_num_overlap_percent = (sum_count == overlap_num).sum().item() / this_size_independent_neuron_count
-                overlap_percent[overlap_num][f"layer{layer_id}"].append(this_num_overlap_percent)
-
-            """overlap repeated rate"""
-            this_size_total_neuron_num = expert_size * num_experts
-            this_size_total_overlap_repeated_neuron_num = 0
-            for overlap_num in range(2, num_experts + 1):
-                this_size_total_overlap_repeated_neuron_num += (overlap_num - 1) * (sum_count == overlap_num).sum().item()
-            overlap_repeated_rate[f"layer{layer_id}"].append(this_size_total_overlap_repeated_neuron_num / this_size_total_neuron_num)
+        """overlap percent"""
+        for overlap_num in range(1, num_experts + 1):
+            overlap_percent[overlap_num][f"layer{layer_id}"] = (overlap_neurons[layer_id, :, overlap_num - 1] / independent_neurons[layer_id]).tolist()
+
+        """overlap repeated rate"""
+        overlap_repeated_rate[f"layer{layer_id}"] = ((overlap_neurons[layer_id] * repeated_times).sum(-1) / total_neuron_num).tolist()
 
     """visualization"""
     if not os.path.exists(args.save_path):
@@ -49,6 +49,8 @@ class LlamaMoEConfig(PretrainedConfig):
         drop_tokens=True,
         dropped_padding="zero",
         capacity_factor=1.25,
+        # -------- training configs --------
+        lm_loss_chunk_size=0,
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -88,6 +90,8 @@ class LlamaMoEConfig(PretrainedConfig):
         self.dropped_padding = dropped_padding
         self.capacity_factor = capacity_factor
 
+        self.lm_loss_chunk_size = lm_loss_chunk_size
+
         # for backward compatibility
         if num_key_value_heads is None:
             num_key_value_heads = num_attention_heads
@@ -20,6 +20,11 @@ from transformers.models.llama.modeling_llama import (
 from transformers.utils import ModelOutput, logging
 
 from smoe.models.llama_moe.configuration_llama_moe import LlamaMoEConfig
+from smoe.modules.chunked_ce import (
+    causal_lm_loss,
+    is_partitioned,
+    should_return_logits,
+)
 from smoe.modules.moe.moe_layers import LinearGLUMoELayer, MoEMlpOutput
 from smoe.modules.norm import WeightNorm
 
@@ -51,6 +56,7 @@ class MoECausalLMOutputWithPast(CausalLMOutputWithPast):
     num_dropped_tokens: Optional[Tuple[int]] = None
     gate_load: Optional[Tuple[list[torch.Tensor]]] = None
     gate_importance: Optional[Tuple[list[torch.Tensor]]] = None
+    loss_per_sample: Optional[torch.FloatTensor] = None
 
 
 class LlamaMoEDecoderLayer(LlamaDecoderLayer):
@@ -521,6 +527,8 @@ class LlamaMoEForCausalLM(LlamaForCausalLM, LlamaMoEPreTrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
+        return_logits=None,
+        return_loss_per_sample=None,
         **kwargs,
     ):
         output_attentions = (
@@ -551,10 +559,35 @@ class LlamaMoEForCausalLM(LlamaForCausalLM, LlamaMoEPreTrainedModel):
         )
 
         hidden_states = outputs.last_hidden_state
-        logits = self.lm_head(hidden_states)
+        # 🔍 the chunked loss reads `lm_head.weight` outside its forward, not gathered under ZeRO-3
+        lm_loss_chunk_size = (
+            getattr(self.config, "lm_loss_chunk_size", 0)
+            if self.training and not is_partitioned(self.lm_head.weight)
+            else 0
+        )
+        return_logits = should_return_logits(return_logits, labels, lm_loss_chunk_size)
+        logits = None
+        if return_logits:
+            logits = self.lm_head(hidden_states)
 
         loss = None
-        if labels is not None:
+        loss_per_sample = None
+        if labels is not None and (lm_loss_chunk_size > 0 or return_loss_per_sample):
+            # 🔍 fused lm_head + CE over token chunks in training, full logits are not materialized
+            # the per-sample losses (for domain reweighting) come from the same CE pass
+            loss = causal_lm_loss(
+                hidden_states,
+                self.lm_head,
+                labels,
+                chunk_size=lm_loss_chunk_size,
+                logits=logits,
+                return_per_sample=bool(return_loss_per_sample),
+            )
+            if return_loss_per_sample:
+                loss, loss_per_sample = loss
+        elif labels is not None:
+            if logits is None:
+                logits = self.lm_head(hidden_states)
             # Shift so that tokens < n predict n
             shift_logits = logits[..., :-1, :].contiguous()
             shift_labels = labels[..., 1:].contiguous()
@@ -565,8 +598,12 @@ class LlamaMoEForCausalLM(LlamaForCausalLM, LlamaMoEPreTrainedModel):
             # Enable model parallelism
             shift_labels = shift_labels.to(shift_logits.device)
             loss = loss_fct(shift_logits, shift_labels)
-            if outputs.balance_loss is not None and outputs.balance_loss > 0:
-                loss += outputs.balance_loss
+        if (
+            loss is not None
+            and outputs.balance_loss is not None
+            and outputs.balance_loss > 0
+        ):
+            loss += outputs.balance_loss
 
         if not return_dict:
             output = (logits,) + outputs[1:]
@@ -582,6 +619,7 @@ class LlamaMoEForCausalLM(LlamaForCausalLM, LlamaMoEPreTrainedModel):
             balance_loss=outputs.balance_loss,
             gate_load=outputs.gate_load,
             gate_importance=outputs.gate_importance,
+            loss_per_sample=loss_per_sample,
         )
 
     def update_config(self):
@@ -158,6 +158,11 @@ class LlamaRMSNorm(nn.Module):
         return self.weight * hidden_states.to(input_dtype)
 
 
+# cos/sin tables shared by the rotary embeddings of all layers,
+# {(class, dim, base, max_position_embeddings, scaling_factor, device, dtype): (cos, sin)}
+_ROTARY_TABLES = {}
+
+
 class LlamaRotaryEmbedding(torch.nn.Module):
     def __init__(self, dim, max_position_embeddings=2048, base=10000, device=None):
         super().__init__()
@@ -170,37 +175,51 @@ class LlamaRotaryEmbedding(torch.nn.Module):
         )
         self.register_buffer("inv_freq", inv_freq)
 
-        # Build here to make `torch.jit.trace` work.
-        self._set_cos_sin_cache(
-            seq_len=max_position_embeddings,
-            device=self.inv_freq.device,
-            dtype=torch.get_default_dtype(),
+    def _compute_inv_freq(self, base, device):
+        return 1.0 / (
+            base ** (torch.arange(0, self.dim, 2, device=device).float() / self.dim)
         )
 
-    def _set_cos_sin_cache(self, seq_len, device, dtype):
-        self.max_seq_len_cached = seq_len
-        t = torch.arange(
-            self.max_seq_len_cached, device=device, dtype=self.inv_freq.dtype
-        )
+    def _compute_cos_sin(self, seq_len, device):
+        inv_freq = self._compute_inv_freq(self.base, device)
+        t = torch.arange(seq_len, device=device, dtype=inv_freq.dtype)
 
-        freqs = torch.einsum("i,j->ij", t, self.inv_freq)
+        freqs = torch.einsum("i,j->ij", t, inv_freq)
         # Different from paper, but it uses a different permutation in order to obtain the same calculation
         emb = torch.cat((freqs, freqs), dim=-1)
-        self.register_buffer(
-            "cos_cached", emb.cos()[None, None, :, :].to(dtype), persistent=False
-        )
-        self.register_buffer(
-            "sin_cached", emb.sin()[None, None, :, :].to(dtype), persistent=False
-        )
+        return emb.cos(), emb.sin()
+
+    def _next_table_length(self, seq_len, cached_len):
+        # grow geometrically
+        return max(seq_len, 2 * cached_len)
 
     def forward(self, x, seq_len=None):
         # x: [bs, num_attention_heads, seq_len, head_size]
-        if seq_len > self.max_seq_len_cached:
-            self._set_cos_sin_cache(seq_len=seq_len, device=x.device, dtype=x.dtype)
+        key = (
+            type(self),
+            self.dim,
+            self.base,
+            self.max_position_embeddings,
+            getattr(self, "scaling_factor", 1.0),
+            x.device,
+            x.dtype,
+        )
+        table = _ROTARY_TABLES.get(key)
+        if table is None or table[0].shape[2] < seq_len:
+            if table is None:
+                length = max(seq_len, self.max_position_embeddings)
+            else:
+                length = self._next_table_length(seq_len, table[0].shape[2])
+            cos, sin = self._compute_cos_sin(length, x.device)
+            table = (
+                cos[None, None, :, :].to(x.dtype),
+                sin[None, None, :, :].to(x.dtype),
+            )
+            _ROTARY_TABLES[key] = table
 
         return (
-            self.cos_cached[:, :, :seq_len, ...].to(dtype=x.dtype),
-            self.sin_cached[:, :, :seq_len, ...].to(dtype=x.dtype),
+            table[0][:, :, :seq_len, ...],
+            table[1][:, :, :seq_len, ...],
         )
 
 
@@ -218,22 +237,15 @@ class LlamaLinearScalingRotaryEmbedding(LlamaRotaryEmbedding):
         self.scaling_factor = scaling_factor
         super().__init__(dim, max_position_embeddings, base, device)
 
-    def _set_cos_sin_cache(self, seq_len, device, dtype):
-        self.max_seq_len_cached = seq_len
-        t = torch.arange(
-            self.max_seq_len_cached, device=device, dtype=self.inv_freq.dtype
-        )
+    def _compute_cos_sin(self, seq_len, device):
+        inv_freq = self._compute_inv_freq(self.base, device)
+        t = torch.arange(seq_len, device=device, dtype=inv_freq.dtype)
         t = t / self.scaling_factor
 
-        freqs = torch.einsum("i,j->ij", t, self.inv_freq)
+        freqs = torch.einsum("i,j->ij", t, inv_freq)
         # Different from paper, but it uses a different permutation in order to obtain the same calculation
         emb = torch.cat((freqs, freqs), dim=-1)
-        self.register_buffer(
-            "cos_cached", emb.cos()[None, None, :, :].to(dtype), persistent=False
-        )
-        self.register_buffer(
-            "sin_cached", emb.sin()[None, None, :, :].to(dtype), persistent=False
-        )
+        return emb.cos(), emb.sin()
 
 
 class LlamaDynamicNTKScalingRotaryEmbedding(LlamaRotaryEmbedding):
@@ -250,32 +262,25 @@ class LlamaDynamicNTKScalingRotaryEmbedding(LlamaRotaryEmbedding):
         self.scaling_factor = scaling_factor
         super().__init__(dim, max_position_embeddings, base, device)
 
-    def _set_cos_sin_cache(self, seq_len, device, dtype):
-        self.max_seq_len_cached = seq_len
-
+    def _compute_cos_sin(self, seq_len, device):
+        base = self.base
         if seq_len > self.max_position_embeddings:
             base = self.base * (
                 (self.scaling_factor * seq_len / self.max_position_embeddings)
                 - (self.scaling_factor - 1)
             ) ** (self.dim / (self.dim - 2))
-            inv_freq = 1.0 / (
-                base ** (torch.arange(0, self.dim, 2).float().to(device) / self.dim)
-            )
-            self.register_buffer("inv_freq", inv_freq)
+        inv_freq = self._compute_inv_freq(base, device)
 
-        t = torch.arange(
-            self.max_seq_len_cached, device=device, dtype=self.inv_freq.dtype
-        )
+        t = torch.arange(seq_len, device=device, dtype=inv_freq.dtype)
 
-        freqs = torch.einsum("i,j->ij", t, self.inv_freq)
+        freqs = torch.einsum("i,j->ij", t, inv_freq)
         # Different from paper, but it uses a different permutation in order to obtain the same calculation
         emb = torch.cat((freqs, freqs), dim=-1)
-        self.register_buffer(
-            "cos_cached", emb.cos()[None, None, :, :].to(dtype), persistent=False
-        )
-        self.register_buffer(
-            "sin_cached", emb.sin()[None, None, :, :].to(dtype), persistent=False
-        )
+        return emb.cos(), emb.sin()
+
+    def _next_table_length(self, seq_len, cached_len):
+        # the frequencies depend on the length, build for exactly `seq_len`
+        return seq_len
 
 
 def rotate_half(x):
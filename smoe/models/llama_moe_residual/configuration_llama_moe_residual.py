@@ -56,6 +56,8 @@ class LlamaMoEResidualConfig(PretrainedConfig):
         drop_tokens=True,
         dropped_padding="zero",
         capacity_factor=1.25,
+        # -------- training configs --------
+        lm_loss_chunk_size=0,
         #### -------- moe residual block configs -------- ####
         # ↓↓↓↓ different here ↓↓↓↓ #
         num_experts_residual=2,
@@ -104,6 +106,8 @@ class LlamaMoEResidualConfig(PretrainedConfig):
         self.dropped_padding = dropped_padding
         self.capacity_factor = capacity_factor
 
+        self.lm_loss_chunk_size = lm_loss_chunk_size
+
         # ↓↓↓↓ different here ↓↓↓↓ #
         self.num_experts_residual = num_experts_residual
         self.size_experts_residual = size_experts_residual
@@ -104,6 +104,9 @@ class LlamaMoEResidualDecoderLayer(LlamaMoEDecoderLayer):
     def reset_residual_experts(self):
         self.mlp.reset_residual_experts()
 
+    def set_moe_residual_fuse(self, fuse_residual):
+        self.mlp.set_fuse_residual(fuse_residual)
+
 
 class LlamaMoEResidualPreTrainedModel(LlamaMoEPreTrainedModel):
     config_class = LlamaMoEResidualConfig
@@ -242,6 +245,10 @@ class LlamaMoEResidualModel(LlamaMoEModel, LlamaMoEResidualPreTrainedModel):
         for idx, decoder_layer in enumerate(self.layers):
             decoder_layer.reset_residual_experts()
 
+    def set_moe_residual_fuse(self, fuse_residual):
+        for idx, decoder_layer in enumerate(self.layers):
+            decoder_layer.set_moe_residual_fuse(fuse_residual)
+
 
 class LlamaMoEResidualForCausalLM(LlamaMoEForCausalLM, LlamaMoEResidualPreTrainedModel):
     def __init__(self, config):
@@ -269,6 +276,9 @@ class LlamaMoEResidualForCausalLM(LlamaMoEForCausalLM, LlamaMoEResidualPreTraine
     def reset_residual_experts(self):
         self.model.reset_residual_experts()
 
+    def set_moe_residual_fuse(self, fuse_residual):
+        self.model.set_moe_residual_fuse(fuse_residual)
+
 
 class LlamaMoEResidualForSequenceClassification(
     LlamaMoEForSequenceClassification, LlamaMoEResidualPreTrainedModel
@@ -297,3 +307,6 @@ class LlamaMoEResidualForSequenceClassification(
 
     def reset_residual_experts(self):
         self.model.reset_residual_experts()
+
+    def set_moe_residual_fuse(self, fuse_residual):
+        self.model.set_moe_residual_fuse(fuse_residual)
@@ -114,6 +114,10 @@ class MistralConfig(PretrainedConfig):
             Sliding window attention window size. If not specified, will default to `4096`.
         attention_dropout (`float`, *optional*, defaults to 0.0):
             The dropout ratio for the attention probabilities.
+        lm_loss_chunk_size (`int`, *optional*, defaults to 0):
+            Number of tokens per chunk of the fused lm_head + cross-entropy loss in training. The full logits are
+            not materialized when it is > 0 and `labels` are given. 0 disables chunking. Chunking is skipped
+            if the lm_head weight is partitioned by DeepSpeed ZeRO-3.
 
     ```python
     >>> from transformers import MistralModel, MistralConfig
@@ -151,6 +155,7 @@ class MistralConfig(PretrainedConfig):
         rope_theta=10000.0,
         sliding_window=4096,
         attention_dropout=0.0,
+        lm_loss_chunk_size=0,
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -172,6 +177,7 @@ class MistralConfig(PretrainedConfig):
         self.use_cache = use_cache
         self.rope_theta = rope_theta
         self.attention_dropout = attention_dropout
+        self.lm_loss_chunk_size = lm_loss_chunk_size
         # Attention implementation to use, if relevant.
         self._attn_implementation_internal = kwargs.pop("attn_implementation", None)
 
@@ -45,6 +45,12 @@ from transformers.utils import (
     replace_return_docstrings,
 )
 
+from smoe.modules.chunked_ce import (
+    causal_lm_loss,
+    is_partitioned,
+    should_return_logits,
+)
+from smoe.modules.rotary import get_rotary_table
 from smoe.utils.cache_utils import Cache, DynamicCache
 from smoe.utils.modeling_attn_mask_utils import _prepare_4d_causal_attention_mask
 
@@ -159,39 +165,19 @@ class MistralRotaryEmbedding(nn.Module):
         self.dim = dim
         self.max_position_embeddings = max_position_embeddings
         self.base = base
-        inv_freq = 1.0 / (
-            self.base ** (torch.arange(0, self.dim, 2).float().to(device) / self.dim)
-        )
-        self.register_buffer("inv_freq", inv_freq, persistent=False)
-
-        # Build here to make `torch.jit.trace` work.
-        self._set_cos_sin_cache(
-            seq_len=max_position_embeddings,
-            device=self.inv_freq.device,
-            dtype=torch.get_default_dtype(),
-        )
-
-    def _set_cos_sin_cache(self, seq_len, device, dtype):
-        self.max_seq_len_cached = seq_len
-        t = torch.arange(
-            self.max_seq_len_cached, device=device, dtype=self.inv_freq.dtype
-        )
-
-        freqs = torch.outer(t, self.inv_freq)
-        # Different from paper, but it uses a different permutation in order to obtain the same calculation
-        emb = torch.cat((freqs, freqs), dim=-1)
-        self.register_buffer("cos_cached", emb.cos().to(dtype), persistent=False)
-        self.register_buffer("sin_cached", emb.sin().to(dtype), persistent=False)
 
     def forward(self, x, seq_len=None):
         # x: [bs, num_attention_heads, seq_len, head_size]
-        if seq_len > self.max_seq_len_cached:
-            self._set_cos_sin_cache(seq_len=seq_len, device=x.device, dtype=x.dtype)
-
-        return (
-            self.cos_cached[:seq_len].to(dtype=x.dtype),
-            self.sin_cached[:seq_len].to(dtype=x.dtype),
+        # 🔍 cos/sin tables are shared by all layers
+        cos, sin = get_rotary_table(
+            self.dim,
+            seq_len,
+            x.device,
+            x.dtype,
+            base=self.base,
+            max_position_embeddings=self.max_position_embeddings,
         )
+        return cos[:seq_len], sin[:seq_len]
 
 
 # Copied from transformers.models.llama.modeling_llama.rotate_half
@@ -1194,6 +1180,7 @@ class MistralForCausalLM(MistralPreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        return_logits: Optional[bool] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         r"""
         Args:
@@ -1201,6 +1188,9 @@ class MistralForCausalLM(MistralPreTrainedModel):
                 Labels for computing the masked language modeling loss. Indices should either be in `[0, ...,
                 config.vocab_size]` or -100 (see `input_ids` docstring). Tokens with indices set to `-100` are ignored
                 (masked), the loss is only computed for the tokens with labels in `[0, ..., config.vocab_size]`.
+            return_logits (`bool`, *optional*):
+                Whether to return the logits. Defaults to `False` only when the chunked loss is used
+                (`config.lm_loss_chunk_size > 0` in training with `labels`), otherwise `True`.
 
         Returns:
 
@@ -1249,11 +1239,28 @@ class MistralForCausalLM(MistralPreTrainedModel):
         )
 
         hidden_states = outputs[0]
-        logits = self.lm_head(hidden_states)
-        logits = logits.float()
+        # the chunked loss reads `lm_head.weight` outside its forward, not gathered under ZeRO-3
+        lm_loss_chunk_size = (
+            getattr(self.config, "lm_loss_chunk_size", 0)
+            if self.training and not is_partitioned(self.lm_head.weight)
+            else 0
+        )
+        return_logits = should_return_logits(return_logits, labels, lm_loss_chunk_size)
+        logits = None
+        if return_logits:
+            logits = self.lm_head(hidden_states)
+            logits = logits.float()
 
         loss = None
-        if labels is not None:
+        if labels is not None and lm_loss_chunk_size > 0:
+            # fused lm_head + CE over token chunks in training, full logits are not materialized
+            loss = causal_lm_loss(
+                hidden_states, self.lm_head, labels, chunk_size=lm_loss_chunk_size
+            )
+        elif labels is not None:
+            if logits is None:
+                logits = self.lm_head(hidden_states)
+                logits = logits.float()
             # Shift so that tokens < n predict n
             shift_logits = logits[..., :-1, :].contiguous()
             shift_labels = labels[..., 1:].contiguous()
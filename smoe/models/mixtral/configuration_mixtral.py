@@ -167,13 +167,18 @@ class MixtralConfig(PretrainedConfig):
         output_router_logits=False,
         router_aux_loss_coef=0.001,
         moe_type: str = "modulelist",  # 🔍
+        static_moe: bool = False,  # 🔍 capacity-padded static-shape experts for torch.compile / CUDA graphs (modulelist only)
+        static_moe_capacity_factor: float = 1.25,  # 🔍 expert slots relative to the balanced load, None to never drop tokens (every expert computes all tokens)
         num_moe_contract_layers: int = 0,  # 🔍 the number of layers that are not converted into MoE at each side of the model
         use_attn_moe: bool = False,  # 🔍
         top_k_attn: int = None,  # 🔍
         attn_experts: int = None, 
         scale_factor_attn: float = None,  # 🔍
+        batched_attn_moe: bool = True,  # 🔍 compute all attention experts at once when there is no cache
         use_layer_wise_balance: bool = False,  # ✨ whether to fix the balance loss bug for Mixtral
+        use_router_prob_balance: bool = False,  # ✨ whether to weight the balance loss with the full router probabilities (Switch Transformer) instead of the top-k weights
         add_rescale_bias: bool = False,  # 🔍 whether to add bias to the AttentionMoE `o_proj` & MoE `down_proj` for distribution alignment
+        lm_loss_chunk_size: int = 0,  # 🔍 tokens per chunk of the fused lm_head + CE loss in training, 0 to disable
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -203,6 +208,8 @@ class MixtralConfig(PretrainedConfig):
         self.output_router_logits = output_router_logits
         self.router_aux_loss_coef = router_aux_loss_coef
         self.moe_type = moe_type  # 🔍
+        self.static_moe = static_moe  # 🔍
+        self.static_moe_capacity_factor = static_moe_capacity_factor  # 🔍
         self.num_moe_contract_layers = num_moe_contract_layers  # 🔍
 
         # 🔍 for Attention MoE
@@ -210,13 +217,18 @@ class MixtralConfig(PretrainedConfig):
         self.top_k_attn = top_k_attn
         self.scale_factor_attn = scale_factor_attn
         self.attn_experts = attn_experts
+        self.batched_attn_moe = batched_attn_moe
 
         # ✨ For balance loss bugfix
         self.use_layer_wise_balance = use_layer_wise_balance
+        self.use_router_prob_balance = use_router_prob_balance
 
         # 🔍 for distribution alignment
         self.add_rescale_bias = add_rescale_bias
 
+        # 🔍 for memory-efficient lm loss
+        self.lm_loss_chunk_size = lm_loss_chunk_size
+
         # Attention implementation to use, if relevant.
         self._attn_implementation_internal = kwargs.pop("attn_implementation", None)
 
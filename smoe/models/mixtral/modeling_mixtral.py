@@ -43,6 +43,17 @@ from transformers.utils.import_utils import (
     is_torchdynamo_compiling,
 )
 
+from smoe.modules.chunked_ce import (
+    causal_lm_loss,
+    is_partitioned,
+    should_return_logits,
+)
+from smoe.modules.rotary import get_rotary_table
+from smoe.modules.static_moe import (
+    capacity_dispatch,
+    compute_expert_capacity,
+    static_moe_forward,
+)
 from smoe.utils.modeling_attn_mask_utils import _prepare_4d_causal_attention_mask
 
 from .configuration_mixtral import MixtralConfig
@@ -132,11 +143,18 @@ class MoeCausalLMOutputWithPast(ModelOutput):
         aux_loss (`torch.FloatTensor`, *optional*, returned when `labels` is provided):
             aux_loss for the sparse modules.
 
-        router_logits (`tuple(torch.FloatTensor)`, *optional*, returned when `output_router_probs=True` and `config.add_router_probs=True` is passed or when `config.output_router_probs=True`):
-            Tuple of `torch.FloatTensor` (one for each layer) of shape `(batch_size, sequence_length, num_experts)`.
+        router_logits (`tuple(torch.FloatTensor)`, *optional*, returned when `output_router_logits=True` is passed or when `config.output_router_logits=True`):
+            Tuple of `torch.FloatTensor` (one for each MoE layer) of shape `(batch_size * sequence_length, num_experts)`.
+
+            Raw router logits (pre-softmax) that are computed by MoE routers.
+        routing_stats (`tuple(torch.FloatTensor)`, *optional*, returned when `output_router_logits=True` is passed or when `config.output_router_logits=True`):
+            Tuple of `torch.FloatTensor` (one for each MoE layer) of shape `(2, num_experts)`, see `compute_routing_stats`.
+
+            Expert counts and router probability sums over non-padding tokens, these terms are used to compute the
+            auxiliary loss for Mixture of Experts models.
 
-            Raw router logtis (post-softmax) that are computed by MoE routers, these terms are used to compute the auxiliary
-            loss for Mixture of Experts models.
+        loss_per_sample (`torch.FloatTensor` of shape `(batch_size,)`, *optional*, returned when `labels` and `return_loss_per_sample=True` are passed):
+            Detached language modeling loss summed over the tokens of each sample, from the same pass as `loss`.
 
         past_key_values (`tuple(tuple(torch.FloatTensor))`, *optional*, returned when `use_cache=True` is passed or when `config.use_cache=True`):
             Tuple of `tuple(torch.FloatTensor)` of length `config.n_layers`, with each tuple having 2 tensors of shape
@@ -164,6 +182,8 @@ class MoeCausalLMOutputWithPast(ModelOutput):
     hidden_states: Optional[Tuple[torch.FloatTensor]] = None
     attentions: Optional[Tuple[torch.FloatTensor]] = None
     router_logits: Optional[Tuple[torch.FloatTensor]] = None
+    routing_stats: Optional[Tuple[torch.FloatTensor]] = None  # 🔍
+    loss_per_sample: Optional[torch.FloatTensor] = None  # 🔍
 
     @property
     def balance_loss(self):
@@ -210,11 +230,15 @@ class MoeModelOutputWithPast(ModelOutput):
 
             Attentions weights after the attention softmax, used to compute the weighted average in the self-attention
             heads.
-        router_logits (`tuple(torch.FloatTensor)`, *optional*, returned when `output_router_probs=True` and `config.add_router_probs=True` is passed or when `config.output_router_probs=True`):
-            Tuple of `torch.FloatTensor` (one for each layer) of shape `(batch_size, sequence_length, num_experts)`.
+        router_logits (`tuple(torch.FloatTensor)`, *optional*, returned when `output_router_logits=True` is passed or when `config.output_router_logits=True`):
+            Tuple of `torch.FloatTensor` (one for each MoE layer) of shape `(batch_size * sequence_length, num_experts)`.
 
-            Raw router logtis (post-softmax) that are computed by MoE routers, these terms are used to compute the auxiliary
-            loss for Mixture of Experts models.
+            Raw router logits (pre-softmax) that are computed by MoE routers.
+        routing_stats (`tuple(torch.FloatTensor)`, *optional*, returned when `output_router_logits=True` is passed or when `config.output_router_logits=True`):
+            Tuple of `torch.FloatTensor` (one for each MoE layer) of shape `(2, num_experts)`, see `compute_routing_stats`.
+
+            Expert counts and router probability sums over non-padding tokens, these terms are used to compute the
+            auxiliary loss for Mixture of Experts models.
     """
 
     last_hidden_state: torch.FloatTensor = None
@@ -222,6 +246,7 @@ class MoeModelOutputWithPast(ModelOutput):
     hidden_states: Optional[Tuple[torch.FloatTensor]] = None
     attentions: Optional[Tuple[torch.FloatTensor]] = None
     router_logits: Optional[Tuple[torch.FloatTensor]] = None
+    routing_stats: Optional[Tuple[torch.FloatTensor]] = None  # 🔍
     attn_router_logits: Optional[Tuple[torch.FloatTensor]] = None  # 🔍
 
 
@@ -242,77 +267,145 @@ if is_torch_fx_available():
     _prepare_4d_causal_attention_mask = torch.fx.wrap(_prepare_4d_causal_attention_mask)
 
 
-def load_balancing_loss_func(
-    gate_logits: Union[torch.Tensor, Tuple],
-    num_experts: torch.Tensor = None,
+def compute_routing_stats(
+    scores: torch.Tensor,
+    selected_experts: torch.Tensor,
+    num_experts: int,
+    token_mask: Optional[torch.Tensor] = None,
+) -> torch.FloatTensor:
+    r"""
+    Compact routing statistics of a MoE layer for the balance loss.
+
+    Args:
+        scores (`torch.Tensor`):
+            Router probabilities (post-softmax). Shape: [num_tokens, num_experts].
+        selected_experts (`torch.Tensor`):
+            Indices of the selected experts. Shape: [num_tokens, top_k].
+        token_mask (`torch.Tensor`, *optional*):
+            Non-padding tokens, padding tokens are excluded from the statistics. Shape: [num_tokens] or [batch_size, sequence_length].
+
+    Returns:
+        `torch.FloatTensor` of shape [2, num_experts], the number of tokens routed to each expert (no gradient)
+        and the sum of router probabilities of each expert.
+    """
+    scores = scores.float()
+    if token_mask is not None:
+        token_mask = token_mask.reshape(-1, 1).to(scores.dtype)
+        scores = scores * token_mask
+        token_weights = token_mask.expand(selected_experts.shape)
+    else:
+        token_weights = torch.ones_like(selected_experts, dtype=scores.dtype)
+    expert_counts = scores.new_zeros(num_experts).index_add_(
+        0, selected_experts.reshape(-1), token_weights.reshape(-1)
+    )
+    return torch.stack((expert_counts, scores.sum(0)))
+
+
+def load_balancing_loss_from_stats(
+    routing_stats: Union[torch.Tensor, Tuple],
     top_k=2,
     use_layer_wise_balance=False,
+    use_router_prob_balance=False,
 ) -> torch.FloatTensor:
     r"""
-    Computes auxiliary load balancing loss as in Switch Transformer - implemented in Pytorch.
+    Computes auxiliary load balancing loss as in Switch Transformer from the routing statistics of `compute_routing_stats`.
 
     See Switch Transformer (https://arxiv.org/abs/2101.03961) for more details. This function implements the loss
     function presented in equations (4) - (6) of the paper. It aims at penalizing cases where the routing between
     experts is too unbalanced.
 
     Args:
-        gate_logits (Union[`torch.Tensor`, Tuple[torch.Tensor]):
-            Logits from the `gate`, should be a tuple of tensors. Shape: [batch_size, seqeunce_length, num_experts].
-        num_experts (`int`, *optional*):
-            Number of experts
+        routing_stats (Union[`torch.Tensor`, Tuple[torch.Tensor]):
+            Routing statistics of each layer. Shape: [2, num_experts].
+        use_router_prob_balance (`bool`, *optional*, defaults to `False`):
+            Whether to weight the expert loads with the full router probabilities as in Switch Transformer.
+            Otherwise the legacy Mixtral formula is used, which takes the mean of the renormalized top-k weights
+            instead (always `1 / top_k`, so the loss is a constant without gradients).
 
     Returns:
         The auxiliary loss.
     """
-    if gate_logits is None or (
-        isinstance(gate_logits, Iterable) and len(gate_logits) == 0
+    if routing_stats is None or (
+        isinstance(routing_stats, Iterable) and len(routing_stats) == 0
     ):
         return 0
+    if isinstance(routing_stats, torch.Tensor):
+        routing_stats = (routing_stats,)
+
+    device = routing_stats[0].device
+    routing_stats = torch.stack([stats.to(device) for stats in routing_stats])  # (num_layers, 2, num_experts)
 
     # ✨ Here is the fix for balance loss in Mixtral.
     # We should calculate the balance loss in a layer-wise manner otherwise it may lead to degenerated solutions.
-    if use_layer_wise_balance:
-        if not isinstance(gate_logits, Iterable):
-            gate_logits = (gate_logits,)
+    if not use_layer_wise_balance:
+        # equals to concatenating the tokens of all layers
+        routing_stats = routing_stats.sum(0, keepdim=True)
+
+    expert_counts, prob_sums = routing_stats.unbind(1)
+    num_experts = expert_counts.shape[-1]
+    # each token is routed to `top_k` experts
+    num_tokens = (expert_counts.sum(-1, keepdim=True) / top_k).clamp(min=1)
+
+    tokens_per_expert = expert_counts / num_tokens
+    if use_router_prob_balance:
+        router_prob_per_expert = prob_sums / num_tokens
     else:
-        if isinstance(gate_logits, Iterable):
-            gate_logits = (torch.cat(gate_logits, dim=0),)
-        else:
-            gate_logits = (gate_logits,)
-
-    all_balance_losses = []
-
-    for logits in gate_logits:
-        routing_weights, selected_experts = torch.topk(logits, top_k, dim=-1)
-        routing_weights = routing_weights.softmax(dim=-1)
-
-        # cast the expert indices to int64, otherwise one-hot encoding will fail
-        if selected_experts.dtype != torch.int64:
-            selected_experts = selected_experts.to(torch.int64)
-
-        if len(selected_experts.shape) == 2:
-            selected_experts = selected_experts.unsqueeze(2)
+        # legacy formula: the routed tokens are averaged over the `top_k` slots of each token,
+        # and weighted by the mean of the renormalized top-k weights, both are `1 / top_k`
+        router_prob_per_expert = expert_counts.new_full(
+            expert_counts.shape, 1.0 / top_k**2
+        )
+    # ✨ balance loss for each layer
+    all_balance_losses = (tokens_per_expert * router_prob_per_expert).sum(-1) * num_experts
 
-        expert_mask = torch.nn.functional.one_hot(selected_experts, num_experts)
+    return all_balance_losses.mean()  # ✨
 
-        # For a given token, determine if it was routed to a given expert.
-        expert_mask = torch.max(expert_mask, axis=-2).values
 
-        # cast to float32 otherwise mean will fail
-        expert_mask = expert_mask.to(torch.float32)
-        tokens_per_group_and_expert = torch.mean(expert_mask, axis=-2)
+def load_balancing_loss_func(
+    gate_logits: Union[torch.Tensor, Tuple],
+    num_experts: torch.Tensor = None,
+    top_k=2,
+    use_layer_wise_balance=False,
+    attention_mask: Optional[torch.Tensor] = None,
+    use_router_prob_balance=False,
+) -> torch.FloatTensor:
+    r"""
+    Computes auxiliary load balancing loss from router logits, see `load_balancing_loss_from_stats`.
 
-        router_prob_per_group_and_expert = torch.mean(routing_weights, axis=-1)
+    Args:
+        gate_logits (Union[`torch.Tensor`, Tuple[torch.Tensor]):
+            Logits from the `gate`, should be a tuple of tensors. Shape: [batch_size * seqeunce_length, num_experts].
+        num_experts (`int`, *optional*):
+            Number of experts
+        attention_mask (`torch.Tensor`, *optional*):
+            Padding mask, padding tokens are not counted. Shape: [batch_size, sequence_length].
 
-        # ✨ balance loss for this layer
-        balance_loss = torch.mean(
-            tokens_per_group_and_expert * router_prob_per_group_and_expert.unsqueeze(-1)
-        ) * (num_experts**2)
-        all_balance_losses.append(balance_loss.reshape(1))
+    Returns:
+        The auxiliary loss.
+    """
+    if gate_logits is None or (
+        isinstance(gate_logits, Iterable) and len(gate_logits) == 0
+    ):
+        return 0
+    if isinstance(gate_logits, torch.Tensor):
+        gate_logits = (gate_logits,)
+    if attention_mask is not None and attention_mask.dim() != 2:
+        raise ValueError(
+            f"Expected a 2D padding mask of shape (batch_size, sequence_length), got {tuple(attention_mask.shape)}"
+        )
 
-    all_balance_losses = torch.cat(all_balance_losses).mean()  # ✨
+    routing_stats = []
+    for logits in gate_logits:
+        scores = F.softmax(logits.reshape(-1, num_experts), dim=-1, dtype=torch.float)
+        _, selected_experts = torch.topk(scores, top_k, dim=-1)
+        token_mask = None
+        if attention_mask is not None:
+            token_mask = attention_mask[:, -(scores.shape[0] // attention_mask.shape[0]):].to(scores.device)
+        routing_stats.append(compute_routing_stats(scores, selected_experts, num_experts, token_mask))
 
-    return all_balance_losses
+    return load_balancing_loss_from_stats(
+        routing_stats, top_k, use_layer_wise_balance, use_router_prob_balance
+    )
 
 
 # Copied from transformers.models.llama.modeling_llama._get_unpad_data
@@ -356,39 +449,19 @@ class MixtralRotaryEmbedding(nn.Module):
         self.dim = dim
         self.max_position_embeddings = max_position_embeddings
         self.base = base
-        inv_freq = 1.0 / (
-            self.base ** (torch.arange(0, self.dim, 2).float().to(device) / self.dim)
-        )
-        self.register_buffer("inv_freq", inv_freq, persistent=False)
-
-        # Build here to make `torch.jit.trace` work.
-        self._set_cos_sin_cache(
-            seq_len=max_position_embeddings,
-            device=self.inv_freq.device,
-            dtype=torch.get_default_dtype(),
-        )
-
-    def _set_cos_sin_cache(self, seq_len, device, dtype):
-        self.max_seq_len_cached = seq_len
-        t = torch.arange(
-            self.max_seq_len_cached, device=device, dtype=self.inv_freq.dtype
-        )
-
-        freqs = torch.outer(t, self.inv_freq)
-        # Different from paper, but it uses a different permutation in order to obtain the same calculation
-        emb = torch.cat((freqs, freqs), dim=-1)
-        self.register_buffer("cos_cached", emb.cos().to(dtype), persistent=False)
-        self.register_buffer("sin_cached", emb.sin().to(dtype), persistent=False)
 
     def forward(self, x, seq_len=None):
         # x: [bs, num_attention_heads, seq_len, head_size]
-        if seq_len > self.max_seq_len_cached:
-            self._set_cos_sin_cache(seq_len=seq_len, device=x.device, dtype=x.dtype)
-
-        return (
-            self.cos_cached[:seq_len].to(dtype=x.dtype),
-            self.sin_cached[:seq_len].to(dtype=x.dtype),
+        # 🔍 cos/sin tables are shared by all layers and attention experts
+        cos, sin = get_rotary_table(
+            self.dim,
+            seq_len,
+            x.device,
+            x.dtype,
+            base=self.base,
+            max_position_embeddings=self.max_position_embeddings,
         )
+        return cos[:seq_len], sin[:seq_len]
 
 
 # Copied from transformers.models.llama.modeling_llama.rotate_half
@@ -861,6 +934,11 @@ class MixtralAttentionMoE(MixtralAttention):
         routing_weights /= routing_weights.sum(dim=-1, keepdim=True)
         routing_weights = routing_weights.to(dtype)  # we cast back to the input dtype
 
+        # 🔍 all experts at once when there is no cache to update
+        if past_key_value is None and not output_attentions and getattr(self.config, "batched_attn_moe", True):
+            final_attn_output = self._batched_forward(hidden_states.reshape(bsz, q_len, hidden_dim), attention_mask, position_ids, routing_weights, selected_experts)
+            return final_attn_output.reshape(bsz, q_len, hidden_dim), None, past_key_value, router_logits
+
         # 🔍 moe selection
         final_attn_output = torch.zeros_like(hidden_states).reshape(-1, hidden_dim)
 
@@ -869,6 +947,9 @@ class MixtralAttentionMoE(MixtralAttention):
         expert_mask = torch.nn.functional.one_hot(selected_experts, num_classes=self.attn_experts)  # (bsz * q_len, top_k_attn, num_key_value_heads)
         expert_mask = expert_mask.permute(2, 1, 0)  # (num_key_value_heads, top_k_attn, bsz * q_len)
 
+        # 🔍 upper bound of the positions that is known on host
+        rotary_seq_len = max(self.max_position_embeddings, q_len if past_key_value is None else past_key_value._seen_tokens_total)
+
         # Loop over all available experts in the model and perform the computation on each expert
         all_attn_weights = [] if output_attentions else None
         for expert_idx in range(self.attn_experts):
@@ -933,7 +1014,7 @@ class MixtralAttentionMoE(MixtralAttention):
             current_position_ids[current_batch_ids, current_seq_ids] = position_ids.expand(bsz, q_len).flatten()[top_x]
 
             if top_x.shape[0] > 0:  # apply only when there are tokens
-                cos, sin = self.rotary_emb(value_states, seq_len=current_position_ids.max().item() + 1)  # 🔍 adjust the seq_len to the maximum possible value
+                cos, sin = self.rotary_emb(value_states, seq_len=rotary_seq_len)  # 🔍 shared table, no host sync for the maximum position
                 query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, current_position_ids)
 
             if past_key_value is not None:
@@ -1017,6 +1098,107 @@ class MixtralAttentionMoE(MixtralAttention):
 
         return final_attn_output, all_attn_weights, past_key_value, router_logits  # 🔍 return an extra `router_logits`
 
+    def _batched_forward(
+            self,
+            hidden_states: torch.Tensor,
+            attention_mask: Optional[torch.Tensor],
+            position_ids: torch.LongTensor,
+            routing_weights: torch.Tensor,
+            selected_experts: torch.LongTensor,
+    ) -> torch.Tensor:
+        """
+        🔍 Computes all attention experts at once, equivalent to the expert loop in `forward` without cache.
+
+        The tokens routed to an expert in a sample form a segment. Segments are packed in (expert, sample, position) order,
+        so the projections are one matmul per expert over contiguous rows, and the attention runs through SDPA over the
+        zero-padded segments with a block-causal mask. The segment sizes are the only values copied back to host.
+
+        Queries without any key to attend to (e.g. left padding) get zero attention outputs, while the expert loop
+        averages over all values for them. Outputs only differ at such padding positions.
+
+        Args:
+            hidden_states: (bsz, q_len, hidden_size)
+            attention_mask: padding mask of shape (bsz, q_len), or None
+            routing_weights, selected_experts: (bsz * q_len, top_k_attn)
+
+        Returns:
+            (bsz * q_len, hidden_size)
+        """
+        device = hidden_states.device
+        bsz, q_len, hidden_dim = hidden_states.size()
+        num_tokens = bsz * q_len
+        num_segments = self.attn_experts * bsz
+        num_heads = self.num_key_value_groups // self.split_ratio
+        hidden_states = hidden_states.reshape(num_tokens, hidden_dim)
+
+        # 🔍 sort the routed (token, expert) pairs by expert, then by token
+        flat_experts = selected_experts.reshape(-1)
+        flat_tokens = torch.arange(num_tokens, device=device).repeat_interleave(self.top_k_attn)
+        order = torch.argsort(flat_experts * num_tokens + flat_tokens)
+        token_ids = flat_tokens[order]
+        segment_ids = flat_experts[order] * bsz + token_ids // q_len
+        segment_lens = torch.bincount(segment_ids, minlength=num_segments)
+        segment_starts = torch.cumsum(segment_lens, dim=0) - segment_lens
+        slot_ids = torch.arange(token_ids.shape[0], device=device) - segment_starts[segment_ids]  # position in the segment
+        token_position_ids = position_ids.expand(bsz, q_len).reshape(-1)[token_ids]
+
+        # 🔍 the only device-to-host sync
+        max_segment_len, *expert_sizes = torch.cat((
+            segment_lens.max().view(1),
+            segment_lens.view(self.attn_experts, bsz).sum(1),
+        )).tolist()
+
+        # 🔍 per-expert projections over contiguous rows of the packed tokens
+        packed_states = hidden_states[token_ids].split(expert_sizes)
+        query_states = torch.cat([self.q_proj[i](x) for i, x in enumerate(packed_states)])
+        key_states = torch.cat([self.k_proj[i](x) for i, x in enumerate(packed_states)])
+        value_states = torch.cat([self.v_proj[i](x) for i, x in enumerate(packed_states)])
+
+        query_states = query_states.view(-1, num_heads, 1, self.head_dim)
+        key_states = key_states.view(-1, 1, 1, self.head_dim)
+        cos, sin = self.rotary_emb(value_states, seq_len=max(self.max_position_embeddings, q_len))
+        query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, token_position_ids[:, None])
+
+        def _to_segments(states):  # (selected_num, heads, head_dim) -> (num_segments, heads, max_segment_len, head_dim)
+            padded = states.new_zeros((num_segments, max_segment_len) + states.shape[1:])
+            padded[segment_ids, slot_ids] = states
+            return padded.transpose(1, 2)
+
+        query_states = _to_segments(query_states.squeeze(2))
+        key_states = _to_segments(key_states.squeeze(2)).expand(-1, num_heads, -1, -1)
+        value_states = _to_segments(value_states.view(-1, 1, self.head_dim)).expand(-1, num_heads, -1, -1)
+
+        # 🔍 block-causal mask over the segments, sliding window counts in positions of the segment as the expert loop
+        key_mask = torch.zeros((num_segments, max_segment_len), dtype=torch.bool, device=device)
+        key_mask[segment_ids, slot_ids] = True if attention_mask is None else attention_mask.reshape(-1)[token_ids].bool()
+        slots = torch.arange(max_segment_len, device=device)
+        distance = slots[:, None] - slots[None, :]
+        causal_mask = distance >= 0
+        if self.config.sliding_window is not None:
+            causal_mask &= distance < self.config.sliding_window
+        segment_mask = causal_mask[None] & key_mask[:, None, :]
+        attended = segment_mask.any(-1)  # (num_segments, max_segment_len)
+        segment_mask |= torch.eye(max_segment_len, dtype=torch.bool, device=device)  # fully masked rows give NaN in SDPA
+
+        attn_output = F.scaled_dot_product_attention(
+            query_states,
+            key_states,
+            value_states,
+            attn_mask=segment_mask[:, None],
+            dropout_p=self.attention_dropout if self.training else 0.0,
+        )
+        attn_output = attn_output * attended[:, None, :, None]  # 🔍 queries without keys only attended to themselves above
+
+        # 🔍 back to the packed tokens, per-expert output projections, rescale by softmax scores
+        attn_output = attn_output.transpose(1, 2)[segment_ids, slot_ids]
+        attn_output = attn_output.reshape(-1, num_heads * self.head_dim).split(expert_sizes)
+        attn_output = torch.cat([self.o_proj[i](x) for i, x in enumerate(attn_output)])
+        attn_output = attn_output * (routing_weights.reshape(-1)[order, None] * self.scale_factor_attn)
+
+        final_attn_output = torch.zeros_like(hidden_states)
+        final_attn_output.index_add_(0, token_ids, attn_output)
+        return final_attn_output
+
     @torch.no_grad()
     def from_vanilla_attention(attention: MixtralAttention, top_k_attn, scale_factor_attn):
         # config
@@ -1471,6 +1653,12 @@ class MixtralFlashAttention2MoE(MixtralFlashAttention2):
 
         all_attn_weights = [] if output_attentions else None
 
+        # 🔍 upper bound of the positions that is known on host
+        rotary_seq_len = max(
+            self.max_position_embeddings,
+            q_len if past_key_value is None else past_key_value._seen_tokens_total,
+        )
+
         for expert_idx in range(self.attn_experts):
             idx, top_x = torch.nonzero(expert_mask[expert_idx], as_tuple=True)
             # top_x_list = top_x.tolist()
@@ -1545,8 +1733,8 @@ class MixtralFlashAttention2MoE(MixtralFlashAttention2):
 
             if top_x.shape[0] > 0:  # apply only when there are tokens
                 cos, sin = self.rotary_emb(
-                    value_states, seq_len=current_position_ids.max().item() + 1
-                )  # 🔍 adjust the seq_len to the maximum possible value
+                    value_states, seq_len=rotary_seq_len
+                )  # 🔍 shared table, no host sync for the maximum position
                 query_states, key_states = apply_rotary_pos_emb(
                     query_states, key_states, cos, sin, current_position_ids
                 )
@@ -1773,6 +1961,12 @@ class MixtralSparseMoeBlock(nn.Module):
         # specialized for llama-moe-v2
         self.scale_factor = config.scale_factor
         self.moe_type = config.moe_type
+        self.static_moe = config.static_moe
+        self.static_moe_capacity_factor = config.static_moe_capacity_factor
+        if self.static_moe and self.moe_type != "modulelist":
+            raise ValueError("`static_moe` only supports the `modulelist` moe_type")
+        # 🔍 number of dropped assignments of the last static forward, stays on device
+        self.num_dropped_tokens = None
 
         # gating
         self.gate = nn.Linear(self.hidden_dim, self.num_experts, bias=False)
@@ -1812,8 +2006,13 @@ class MixtralSparseMoeBlock(nn.Module):
         else:
             raise NotImplementedError(f"Unsupported moe_type: {self.moe_type}")
 
-    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
-        """ """
+    def forward(
+        self, hidden_states: torch.Tensor, token_mask: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Returns the MoE outputs, the router logits and the routing statistics (see `compute_routing_stats`)
+        of non-padding tokens in `token_mask`.
+        """
         batch_size, sequence_length, hidden_dim = hidden_states.shape
         hidden_states = hidden_states.view(-1, hidden_dim)
         # router_logits: (batch * sequence_length, n_experts)
@@ -1824,8 +2023,30 @@ class MixtralSparseMoeBlock(nn.Module):
         routing_weights /= routing_weights.sum(dim=-1, keepdim=True)
         # we cast back to the input dtype
         routing_weights = routing_weights.to(hidden_states.dtype)
+        # 🔍 compact statistics for the balance loss, no need to keep all layers' logits for it
+        routing_stats = compute_routing_stats(
+            scores, selected_experts, self.num_experts, token_mask
+        )
 
-        if self.moe_type == "modulelist":
+        if self.static_moe:
+            # 🔍 fixed per-expert slot buffers, no host sync and no data-dependent shapes
+            capacity = compute_expert_capacity(
+                hidden_states.shape[0],
+                self.num_experts,
+                self.top_k,
+                self.static_moe_capacity_factor,
+            )
+            slot_tokens, assignment_slots, self.num_dropped_tokens = capacity_dispatch(
+                selected_experts, self.num_experts, capacity, token_mask=token_mask
+            )
+            final_hidden_states = static_moe_forward(
+                hidden_states,
+                routing_weights * self.scale_factor,
+                slot_tokens,
+                assignment_slots,
+                lambda x, expert_idx: self.experts[expert_idx](x),
+            )
+        elif self.moe_type == "modulelist":
             final_hidden_states = torch.zeros(
                 (batch_size * sequence_length, hidden_dim),
                 dtype=hidden_states.dtype,
@@ -1867,6 +2088,11 @@ class MixtralSparseMoeBlock(nn.Module):
                 )
         elif self.moe_type == "megablocks":
             final_hidden_states = self.experts(hidden_states, routing_weights, selected_experts)
+        elif self.moe_type == "expert_parallel":
+            # 🔍 experts placed over ranks by `smoe.modules.expert_parallel.enable_expert_parallel`
+            final_hidden_states = self.experts(
+                hidden_states, routing_weights * self.scale_factor, selected_experts
+            )
         else:
             raise NotImplementedError(f"Unsupported moe_type: {self.moe_type}")
 
@@ -1874,7 +2100,7 @@ class MixtralSparseMoeBlock(nn.Module):
             batch_size, sequence_length, hidden_dim
         )
 
-        return final_hidden_states, router_logits
+        return final_hidden_states, router_logits, routing_stats
 
 
 class MixtralDecoderLayer(nn.Module):
@@ -1924,6 +2150,7 @@ class MixtralDecoderLayer(nn.Module):
         output_attentions: Optional[bool] = False,
         output_router_logits: Optional[bool] = False,
         use_cache: Optional[bool] = False,
+        token_mask: Optional[torch.Tensor] = None,
         **kwargs,
     ) -> Tuple[
         torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]
@@ -1942,11 +2169,13 @@ class MixtralDecoderLayer(nn.Module):
                 Whether or not to return the attentions tensors of all attention layers. See `attentions` under
                 returned tensors for more detail.
             output_router_logits (`bool`, *optional*):
-                Whether or not to return the logits of all the routers. They are useful for computing the router loss, and
-                should not be returned during inference.
+                Whether or not to return the routing statistics of the MLP router and the logits of the attention router.
+                They are useful for computing the router loss, and should not be returned during inference.
             use_cache (`bool`, *optional*):
                 If set to `True`, `past_key_values` key value states are returned and can be used to speed up decoding
                 (see `past_key_values`).
+            token_mask (`torch.Tensor`, *optional*): non-padding tokens of shape `(batch, seq_len)`, padding tokens are
+                excluded from the routing statistics.
         """
 
         residual = hidden_states
@@ -1987,10 +2216,12 @@ class MixtralDecoderLayer(nn.Module):
 
         # 🔍
         if self.is_moe:
-            hidden_states, router_logits = self.block_sparse_moe(hidden_states_input)
+            hidden_states, router_logits, routing_stats = self.block_sparse_moe(
+                hidden_states_input, token_mask=token_mask
+            )
         else:
             hidden_states = self.block_sparse_moe(hidden_states_input)
-            router_logits = None
+            router_logits = routing_stats = None
 
         if self.mlp_residual is not None:
             hidden_states += self.mlp_residual(hidden_states_input)  #
@@ -2006,7 +2237,7 @@ class MixtralDecoderLayer(nn.Module):
             outputs += (present_key_value,)
 
         if output_router_logits:
-            outputs += (router_logits, attn_router_logits)  # 🔍
+            outputs += (router_logits, routing_stats, attn_router_logits)  # 🔍
 
         return outputs
 
@@ -2155,6 +2386,11 @@ class MixtralModel(MixtralPreTrainedModel):
         if inputs_embeds is None:
             inputs_embeds = self.embed_tokens(input_ids)
 
+        # 🔍 non-padding tokens of this forward, excluded from the routing statistics
+        token_mask = None
+        if output_router_logits and attention_mask is not None and attention_mask.dim() == 2:
+            token_mask = attention_mask[:, -seq_length:]
+
         if attention_mask is not None and self._use_flash_attention_2 and use_cache:
             is_padding_right = attention_mask[:, -1].sum().item() != batch_size
             if is_padding_right:
@@ -2189,6 +2425,7 @@ class MixtralModel(MixtralPreTrainedModel):
         all_hidden_states = () if output_hidden_states else None
         all_self_attns = () if output_attentions else None
         all_router_logits = () if output_router_logits else None
+        all_routing_stats = () if output_router_logits else None
         all_attn_router_logits = () if output_router_logits else None  # 🔍
         next_decoder_cache = None
 
@@ -2214,6 +2451,7 @@ class MixtralModel(MixtralPreTrainedModel):
                     output_attentions,
                     output_router_logits,
                     use_cache,
+                    token_mask,
                 )
 
             else:
@@ -2225,6 +2463,7 @@ class MixtralModel(MixtralPreTrainedModel):
                     output_attentions=output_attentions,
                     output_router_logits=output_router_logits,
                     use_cache=use_cache,
+                    token_mask=token_mask,
                 )
 
             hidden_states = layer_outputs[0]
@@ -2236,7 +2475,8 @@ class MixtralModel(MixtralPreTrainedModel):
                 all_self_attns += (layer_outputs[1],)
 
             if output_router_logits:
-                all_router_logits += (layer_outputs[-2],)
+                all_router_logits += (layer_outputs[-3],)
+                all_routing_stats += (layer_outputs[-2],)
                 all_attn_router_logits += (layer_outputs[-1],)
 
         hidden_states = self.norm(hidden_states)
@@ -2262,6 +2502,8 @@ class MixtralModel(MixtralPreTrainedModel):
                     all_hidden_states,
                     all_self_attns,
                     all_router_logits,
+                    all_routing_stats,
+                    all_attn_router_logits,
                 ]
                 if v is not None
             )
@@ -2271,6 +2513,7 @@ class MixtralModel(MixtralPreTrainedModel):
             hidden_states=all_hidden_states,
             attentions=all_self_attns,
             router_logits=all_router_logits,
+            routing_stats=all_routing_stats,
             attn_router_logits=all_attn_router_logits,  # 🔍
         )
 
@@ -2325,6 +2568,8 @@ class MixtralForCausalLM(MixtralPreTrainedModel):
         output_hidden_states: Optional[bool] = None,
         output_router_logits: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        return_logits: Optional[bool] = None,  # 🔍
+        return_loss_per_sample: Optional[bool] = None,  # 🔍
     ) -> Union[Tuple, MoeCausalLMOutputWithPast]:
         output_attentions = (
             output_attentions
@@ -2361,11 +2606,37 @@ class MixtralForCausalLM(MixtralPreTrainedModel):
         )
 
         hidden_states = outputs[0]
-        logits = self.lm_head(hidden_states)
-        logits = logits.float()
+        # 🔍 the chunked loss reads `lm_head.weight` outside its forward, not gathered under ZeRO-3
+        lm_loss_chunk_size = (
+            getattr(self.config, "lm_loss_chunk_size", 0)
+            if self.training and not is_partitioned(self.lm_head.weight)
+            else 0
+        )
+        return_logits = should_return_logits(return_logits, labels, lm_loss_chunk_size)
+        logits = None
+        if return_logits:
+            logits = self.lm_head(hidden_states)
+            logits = logits.float()
 
         loss = None
-        if labels is not None:
+        loss_per_sample = None
+        if labels is not None and (lm_loss_chunk_size > 0 or return_loss_per_sample):
+            # 🔍 fused lm_head + CE over token chunks in training, full logits are not materialized
+            # the per-sample losses (for domain reweighting) come from the same CE pass
+            loss = causal_lm_loss(
+                hidden_states,
+                self.lm_head,
+                labels,
+                chunk_size=lm_loss_chunk_size,
+                logits=logits,
+                return_per_sample=bool(return_loss_per_sample),
+            )
+            if return_loss_per_sample:
+                loss, loss_per_sample = loss
+        elif labels is not None:
+            if logits is None:
+                logits = self.lm_head(hidden_states)
+                logits = logits.float()
             # Shift so that tokens < n predict n
             shift_logits = logits[..., :-1, :].contiguous()
             shift_labels = labels[..., 1:].contiguous()
@@ -2380,17 +2651,17 @@ class MixtralForCausalLM(MixtralPreTrainedModel):
 
         aux_loss = None
         if output_router_logits:
-            valid_router_logits = tuple(
-                logits
-                for logits in (outputs.router_logits if return_dict else outputs[-2])
-                if logits is not None
+            valid_routing_stats = tuple(
+                stats
+                for stats in (outputs.routing_stats if return_dict else outputs[-2])
+                if stats is not None
             )
 
-            aux_loss = load_balancing_loss_func(
-                valid_router_logits,
-                self.num_experts,
+            aux_loss = load_balancing_loss_from_stats(
+                valid_routing_stats,
                 self.num_experts_per_tok,
                 use_layer_wise_balance=self.config.use_layer_wise_balance,  # ✨
+                use_router_prob_balance=self.config.use_router_prob_balance,
             )
             if labels is not None:
                 loss += self.router_aux_loss_coef * aux_loss
@@ -2414,6 +2685,13 @@ class MixtralForCausalLM(MixtralPreTrainedModel):
                     self.config.attn_experts,
                     self.config.top_k_attn,
                     use_layer_wise_balance=self.config.use_layer_wise_balance,  # ✨
+                    # 🔍 padding is only known from 2D masks, 4D masks count all tokens
+                    attention_mask=(
+                        attention_mask
+                        if attention_mask is not None and attention_mask.dim() == 2
+                        else None
+                    ),
+                    use_router_prob_balance=self.config.use_router_prob_balance,
                 )
                 if labels is not None:
                     loss += self.router_aux_loss_coef * attn_aux_loss
@@ -2436,6 +2714,8 @@ class MixtralForCausalLM(MixtralPreTrainedModel):
             hidden_states=outputs.hidden_states,
             attentions=outputs.attentions,
             router_logits=outputs.router_logits,
+            routing_stats=outputs.routing_stats,
+            loss_per_sample=loss_per_sample,
         )
 
     def prepare_inputs_for_generation(
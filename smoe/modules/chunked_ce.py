@@ -0,0 +1,180 @@
+"""
+Chunked lm_head + cross-entropy.
+
+The vocabulary projection and the CE loss are computed over chunks of tokens,
+and the chunk logits are recomputed in backward, so the full `(tokens, vocab_size)`
+logits (and their fp32 copies / gradients) are never materialized.
+"""
+
+from typing import Optional, Union
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from smoe.utils.vars import IGNORE_INDEX
+
+
+class ChunkedLinearCrossEntropyFunction(torch.autograd.Function):
+    """
+    Mean CE of `hidden @ weight.T` w.r.t. `labels`, over non-ignored tokens.
+    The detached CE of each token (0 for ignored tokens) is returned as well.
+    """
+
+    @staticmethod
+    @torch.cuda.amp.custom_fwd
+    def forward(
+        ctx,
+        hidden: torch.Tensor,
+        weight: torch.Tensor,
+        labels: torch.Tensor,
+        chunk_size: int,
+        ignore_index: int,
+    ):
+        num_tokens = hidden.shape[0]
+        valid = labels != ignore_index
+        num_valid = valid.sum().clamp(min=1)
+        weight_ = weight.to(hidden.dtype)
+
+        token_losses = torch.empty(
+            num_tokens, dtype=torch.float32, device=hidden.device
+        )
+        lse = torch.empty(num_tokens, dtype=torch.float32, device=hidden.device)
+        for start in range(0, num_tokens, chunk_size):
+            end = min(start + chunk_size, num_tokens)
+            logits = (hidden[start:end] @ weight_.t()).float()
+            chunk_lse = torch.logsumexp(logits, dim=-1)
+            target = logits.gather(1, labels[start:end].clamp(min=0).unsqueeze(1))
+            token_losses[start:end] = (chunk_lse - target.squeeze(1)) * valid[start:end]
+            lse[start:end] = chunk_lse
+
+        ctx.save_for_backward(hidden, weight, labels, lse, num_valid)
+        ctx.chunk_size = chunk_size
+        ctx.ignore_index = ignore_index
+        ctx.mark_non_differentiable(token_losses)
+        return token_losses.sum() / num_valid, token_losses
+
+    @staticmethod
+    @torch.cuda.amp.custom_bwd
+    def backward(ctx, grad_output: torch.Tensor, grad_token_losses: torch.Tensor):
+        hidden, weight, labels, lse, num_valid = ctx.saved_tensors
+        need_hidden_grad, need_weight_grad = ctx.needs_input_grad[:2]
+        weight_ = weight.to(hidden.dtype)
+
+        grad_hidden = torch.empty_like(hidden) if need_hidden_grad else None
+        # accumulate in fp32 across chunks
+        grad_weight = (
+            torch.zeros(weight.shape, dtype=torch.float32, device=weight.device)
+            if need_weight_grad
+            else None
+        )
+        scale = grad_output.float() / num_valid
+        for start in range(0, hidden.shape[0], ctx.chunk_size):
+            end = min(start + ctx.chunk_size, hidden.shape[0])
+            chunk_hidden = hidden[start:end]
+            chunk_labels = labels[start:end]
+            valid = chunk_labels != ctx.ignore_index
+
+            # d(lse - target) / d(logits) = softmax - one_hot(target)
+            grad_logits = (chunk_hidden @ weight_.t()).float()
+            grad_logits.sub_(lse[start:end].unsqueeze(1)).exp_()
+            rows = valid.nonzero().squeeze(1)
+            grad_logits[rows, chunk_labels[rows]] -= 1.0
+            grad_logits.mul_((valid * scale).unsqueeze(1))
+            grad_logits = grad_logits.to(hidden.dtype)
+
+            if need_hidden_grad:
+                grad_hidden[start:end] = grad_logits @ weight_
+            if need_weight_grad:
+                grad_weight.addmm_(grad_logits.t().float(), chunk_hidden.float())
+
+        if grad_weight is not None:
+            grad_weight = grad_weight.to(weight.dtype)
+        return grad_hidden, grad_weight, None, None, None
+
+
+def chunked_linear_cross_entropy(
+    hidden: torch.Tensor,
+    weight: torch.Tensor,
+    labels: torch.Tensor,
+    chunk_size: int = 1024,
+    ignore_index: int = IGNORE_INDEX,
+) -> torch.Tensor:
+    """
+    Args:
+        hidden: (num_tokens, hidden_size)
+        weight: (vocab_size, hidden_size)
+        labels: (num_tokens,)
+    """
+    loss, _ = ChunkedLinearCrossEntropyFunction.apply(
+        hidden, weight, labels, chunk_size, ignore_index
+    )
+    return loss
+
+
+def is_partitioned(param: torch.Tensor) -> bool:
+    """
+    Whether `param` is partitioned by DeepSpeed ZeRO-3, it is only gathered inside
+    the forward of its module, so the chunked loss can not read it directly.
+    """
+    return getattr(param, "ds_id", None) is not None or param.numel() == 0
+
+
+def causal_lm_loss(
+    hidden_states: torch.Tensor,
+    lm_head: nn.Linear,
+    labels: torch.Tensor,
+    chunk_size: int = 0,
+    ignore_index: int = IGNORE_INDEX,
+    logits: Optional[torch.Tensor] = None,
+    return_per_sample: bool = False,
+) -> Union[torch.Tensor, tuple[torch.Tensor, torch.Tensor]]:
+    """
+    Next-token CE loss of `lm_head(hidden_states)`, equal to shifting the logits and labels
+    and averaging `CrossEntropyLoss` over non-ignored tokens.
+
+    Args:
+        hidden_states: (bsz, seq_len, hidden_size)
+        labels: (bsz, seq_len), not shifted
+        chunk_size: number of tokens per chunk, 0 to compute full logits.
+            Full logits are computed as well if `lm_head` has a bias or a ZeRO-3 partitioned weight.
+        logits: (bsz, seq_len, vocab_size), reused instead of `lm_head(hidden_states)`
+            when the full logits are computed
+        return_per_sample: also return the detached CE summed over the tokens of each sample,
+            of shape (bsz,), taken from the same pass as the loss
+
+    Returns:
+        loss, or (loss, loss_sum_per_sample) if `return_per_sample`
+    """
+    bsz = labels.shape[0]
+    # shift labels instead of hidden states, the last position of each sequence is ignored
+    shift_labels = F.pad(labels[..., 1:], (0, 1), value=ignore_index)
+    shift_labels = shift_labels.reshape(-1).to(hidden_states.device)
+    hidden_states = hidden_states.reshape(-1, hidden_states.shape[-1])
+
+    if chunk_size <= 0 or lm_head.bias is not None or is_partitioned(lm_head.weight):
+        if logits is None:
+            logits = lm_head(hidden_states)
+        logits = logits.reshape(-1, logits.shape[-1]).float()
+        if not return_per_sample:
+            return F.cross_entropy(logits, shift_labels, ignore_index=ignore_index)
+        token_losses = F.cross_entropy(
+            logits, shift_labels, ignore_index=ignore_index, reduction="none"
+        )
+        loss = token_losses.sum() / (shift_labels != ignore_index).sum()
+    else:
+        loss, token_losses = ChunkedLinearCrossEntropyFunction.apply(
+            hidden_states, lm_head.weight, shift_labels, chunk_size, ignore_index
+        )
+        if not return_per_sample:
+            return loss
+    return loss, token_losses.detach().view(bsz, -1).sum(dim=1)
+
+
+def should_return_logits(
+    return_logits: Optional[bool], labels: Optional[torch.Tensor], chunk_size: int
+) -> bool:
+    """Logits are skipped by default only when the chunked loss is computed"""
+    if return_logits is not None:
+        return return_logits
+    return labels is None or chunk_size <= 0
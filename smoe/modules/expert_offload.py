@@ -0,0 +1,521 @@
+"""
+Expert offloading for memory-constrained inference.
+
+Expert weights of `MixtralSparseMoeBlock` (`block_sparse_moe.experts.{i}.w{1,2,3}`)
+and `LinearGLUExperts` (`calculator.experts.{weight,bias}_{gate,up,down}.{i}`) stay in
+memory-mapped safetensors files. Only the experts that are routed to are loaded, and a
+fixed number of them are kept resident in an LRU / LFU cache. Router decisions are used
+to prefetch experts in a background thread before they are computed.
+
+Usage:
+    engine = ExpertOffloadEngine.from_pretrained(
+        MixtralForCausalLM, folder, capacity=64, policy="lru", prefetch="next_layer"
+    )
+    outputs = engine.model.generate(...)
+    print(engine.stats())
+"""
+
+import json
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from safetensors import safe_open
+from transformers.activations import ACT2FN
+from transformers.utils import SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME
+
+from smoe.utils.logging import get_logger
+
+logger = get_logger(__file__)
+
+EVICTION_POLICIES = ("lru", "lfu")
+PREFETCH_MODES = (None, "current", "next_layer")
+
+# `block_sparse_moe.experts.{i}.w1.weight` -> ("...block_sparse_moe.experts", i, "w1.weight")
+MIXTRAL_EXPERT_PATTERN = re.compile(
+    r"^(?P<prefix>.*\.block_sparse_moe\.experts)\.(?P<expert>\d+)\.(?P<name>w[123]\.(weight|bias))$"
+)
+# `calculator.experts.weight_gate.{i}` -> ("...calculator.experts", i, "weight_gate")
+LINEAR_GLU_EXPERT_PATTERN = re.compile(
+    r"^(?P<prefix>.*\.calculator\.experts)\.(?P<name>(weight|bias)_(gate|up|down))\.(?P<expert>\d+)$"
+)
+
+
+def parse_expert_param_name(name: str) -> Optional[tuple[str, int, str]]:
+    """`(experts module name, expert index, param name)`, `None` for non-expert params."""
+    for pattern in (MIXTRAL_EXPERT_PATTERN, LINEAR_GLU_EXPERT_PATTERN):
+        match = pattern.match(name)
+        if match is not None:
+            return match["prefix"], int(match["expert"]), match["name"]
+    return None
+
+
+class SafetensorsExpertStore:
+    """Memory-mapped view of the expert tensors in a safetensors checkpoint folder."""
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        index_file = os.path.join(folder, SAFE_WEIGHTS_INDEX_NAME)
+        if os.path.exists(index_file):
+            with open(index_file, "r", encoding="utf8") as fin:
+                weight_map = json.load(fin)["weight_map"]
+        elif os.path.exists(os.path.join(folder, SAFE_WEIGHTS_NAME)):
+            with safe_open(
+                os.path.join(folder, SAFE_WEIGHTS_NAME), framework="pt"
+            ) as f:
+                weight_map = {key: SAFE_WEIGHTS_NAME for key in f.keys()}
+        else:
+            raise FileNotFoundError(f"No safetensors checkpoint found in {folder}")
+
+        # {(prefix, expert_idx): {param_name: (filename, key)}}
+        self.experts: dict[tuple[str, int], dict[str, tuple[str, str]]] = {}
+        # {key: filename}
+        self.non_expert_keys: dict[str, str] = {}
+        for key, filename in weight_map.items():
+            parsed = parse_expert_param_name(key)
+            if parsed is None:
+                self.non_expert_keys[key] = filename
+            else:
+                prefix, expert_idx, name = parsed
+                self.experts.setdefault((prefix, expert_idx), {})[name] = (
+                    filename,
+                    key,
+                )
+        self._handles = {}
+        self._lock = threading.Lock()
+
+    @property
+    def expert_prefixes(self) -> list[str]:
+        return sorted({prefix for prefix, _ in self.experts})
+
+    def num_experts(self, prefix: str) -> int:
+        return 1 + max(idx for p, idx in self.experts if p == prefix)
+
+    def _get_handle(self, filename: str):
+        with self._lock:
+            handle = self._handles.get(filename)
+            if handle is None:
+                handle = safe_open(
+                    os.path.join(self.folder, filename), framework="pt", device="cpu"
+                )
+                self._handles[filename] = handle
+            return handle
+
+    def get_tensor(self, filename: str, key: str) -> torch.Tensor:
+        return self._get_handle(filename).get_tensor(key)
+
+    def load_expert(
+        self, prefix: str, expert_idx: int, device=None, dtype=None
+    ) -> dict[str, torch.Tensor]:
+        weights = {}
+        for name, (filename, key) in self.experts[(prefix, expert_idx)].items():
+            tensor = self.get_tensor(filename, key)
+            weights[name] = tensor.to(device=device, dtype=dtype)
+        return weights
+
+    def load_non_expert_state_dict(self, prefix: str = "") -> dict[str, torch.Tensor]:
+        """Non-expert tensors, with `prefix` stripped from the keys."""
+        state_dict = {}
+        for key, filename in self.non_expert_keys.items():
+            if key.startswith(prefix):
+                state_dict[key[len(prefix) :]] = self.get_tensor(filename, key)
+        return state_dict
+
+
+class ResidentExpertCache:
+    """
+    Keeps at most `capacity` experts in memory, evicting by `policy`:
+        - `lru`: the least recently used expert.
+        - `lfu`: the least frequently used expert (ties broken by recency).
+
+    `prefetch` loads experts in a background thread, `get` waits for the in-flight load if any.
+    """
+
+    def __init__(
+        self,
+        store: SafetensorsExpertStore,
+        capacity: int,
+        policy: str = "lru",
+        device=None,
+        dtype: torch.dtype = None,
+        num_prefetch_workers: int = 1,
+    ):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(
+                f"policy must be one of {EVICTION_POLICIES}, got {policy!r}"
+            )
+        if capacity < 1:
+            raise ValueError(f"capacity must be positive, got {capacity}")
+        self.store = store
+        self.capacity = capacity
+        self.policy = policy
+        self.device = device
+        self.dtype = dtype
+
+        self._resident: OrderedDict[tuple, dict[str, torch.Tensor]] = OrderedDict()
+        self._frequency = Counter()
+        self._pending: dict[tuple, Future] = {}
+        self._lock = threading.RLock()
+        self._executor = (
+            ThreadPoolExecutor(num_prefetch_workers)
+            if num_prefetch_workers > 0
+            else None
+        )
+
+        self.hits = 0
+        self.prefetch_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_loaded = 0
+
+    def __len__(self):
+        return len(self._resident)
+
+    def __contains__(self, key):
+        return key in self._resident
+
+    def _evict(self, keep: tuple):
+        """Evict down to `capacity`, never the newly loaded `keep`."""
+        while len(self._resident) > self.capacity:
+            candidates = (key for key in self._resident if key != keep)
+            if self.policy == "lru":
+                key = next(candidates)
+            else:
+                # `min` returns the first minimum, the least recent one among ties
+                key = min(candidates, key=self._frequency.__getitem__)
+            del self._resident[key]
+            self.evictions += 1
+
+    def _load(self, key: tuple) -> dict[str, torch.Tensor]:
+        weights = self.store.load_expert(*key, device=self.device, dtype=self.dtype)
+        with self._lock:
+            self.bytes_loaded += sum(
+                w.numel() * w.element_size() for w in weights.values()
+            )
+            self._pending.pop(key, None)
+            self._resident[key] = weights
+            self._evict(keep=key)
+        return weights
+
+    def get(self, key: tuple) -> dict[str, torch.Tensor]:
+        with self._lock:
+            self._frequency[key] += 1
+            weights = self._resident.get(key)
+            if weights is not None:
+                self.hits += 1
+                self._resident.move_to_end(key)
+                return weights
+            future = self._pending.get(key)
+            if future is not None:
+                self.prefetch_hits += 1
+            else:
+                self.misses += 1
+        if future is not None:
+            return future.result()
+        return self._load(key)
+
+    def prefetch(self, keys):
+        if self._executor is None:
+            return
+        with self._lock:
+            for key in keys:
+                if key in self._resident:
+                    self._resident.move_to_end(key)
+                elif key not in self._pending:
+                    self._pending[key] = self._executor.submit(self._load, key)
+
+    def stats(self) -> dict:
+        num_requests = self.hits + self.prefetch_hits + self.misses
+        return {
+            "hits": self.hits,
+            "prefetch_hits": self.prefetch_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / max(num_requests, 1),
+            "evictions": self.evictions,
+            "bytes_loaded": self.bytes_loaded,
+            "num_resident": len(self._resident),
+        }
+
+    def reset_stats(self):
+        self.hits = self.prefetch_hits = self.misses = 0
+        self.evictions = self.bytes_loaded = 0
+
+    def clear(self):
+        with self._lock:
+            for future in list(self._pending.values()):
+                future.cancel()
+            self._pending.clear()
+            self._resident.clear()
+            self._frequency.clear()
+
+    def close(self):
+        self.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+class OffloadedMixtralExperts(nn.Module):
+    """Drop-in for `MixtralSparseMoeBlock.experts`, `experts[i](x)` fetches expert `i` from the cache."""
+
+    def __init__(
+        self, cache: ResidentExpertCache, prefix: str, num_experts: int, hidden_act
+    ):
+        super().__init__()
+        self.cache = cache
+        self.prefix = prefix
+        self.num_experts = num_experts
+        self.act_fn = ACT2FN[hidden_act] if isinstance(hidden_act, str) else hidden_act
+
+    def __len__(self):
+        return self.num_experts
+
+    def __getitem__(self, expert_idx: int) -> Callable:
+        def expert_forward(hidden_states):
+            return self.forward(hidden_states, expert_idx)
+
+        return expert_forward
+
+    def forward(self, hidden_states, expert_idx: int):
+        weights = self.cache.get((self.prefix, expert_idx))
+        current_hidden_states = self.act_fn(
+            F.linear(hidden_states, weights["w1.weight"])
+        ) * F.linear(hidden_states, weights["w3.weight"])
+        return F.linear(
+            current_hidden_states, weights["w2.weight"], weights.get("w2.bias")
+        )
+
+    def extra_repr(self):
+        return f"prefix={self.prefix}, num_experts={self.num_experts}"
+
+
+class OffloadedLinearGLUExperts(nn.Module):
+    """Drop-in for `LinearGLUExperts`, `forward(x, i)` fetches expert `i` from the cache."""
+
+    def __init__(
+        self,
+        cache: ResidentExpertCache,
+        prefix: str,
+        num_experts: int,
+        hidden_act,
+        in_features: int = None,
+        out_features: int = None,
+    ):
+        super().__init__()
+        self.cache = cache
+        self.prefix = prefix
+        self.num_experts = num_experts
+        self.hidden_act = hidden_act
+        self.act_fn = ACT2FN[hidden_act]
+        self.in_features = in_features
+        self.out_features = out_features
+
+    def forward(self, input, i):
+        weights = self.cache.get((self.prefix, i))
+        gate = self.act_fn(
+            F.linear(input, weights["weight_gate"], weights.get("bias_gate"))
+        )
+        up = F.linear(input, weights["weight_up"], weights.get("bias_up"))
+        return F.linear(gate * up, weights["weight_down"], weights.get("bias_down"))
+
+    def extra_repr(self):
+        return f"prefix={self.prefix}, num_experts={self.num_experts}"
+
+
+def _parent_name(name: str) -> tuple[str, str]:
+    if "." not in name:
+        return "", name
+    parent, child = name.rsplit(".", 1)
+    return parent, child
+
+
+class ExpertOffloadEngine:
+    """
+    Replaces the experts of `model` with cache-backed modules reading from `folder`.
+
+    Args:
+        capacity: number of resident experts (across all layers).
+        policy: eviction policy, `lru` or `lfu`.
+        prefetch: `None` to load on demand, `current` to prefetch the routed experts of a layer
+            right before it runs (loads overlap with the computation of the other experts),
+            `next_layer` to also prefetch the experts the next layer's router picks for the
+            current hidden states (a lookahead, hits as long as the routing is stable across layers).
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        folder: str,
+        capacity: int,
+        policy: str = "lru",
+        prefetch: Optional[str] = "next_layer",
+        device=None,
+        dtype: torch.dtype = None,
+        num_prefetch_workers: int = 1,
+    ):
+        if prefetch not in PREFETCH_MODES:
+            raise ValueError(
+                f"prefetch must be one of {PREFETCH_MODES}, got {prefetch!r}"
+            )
+        self.model = model
+        self.prefetch = prefetch
+        self.store = SafetensorsExpertStore(folder)
+        self.cache = ResidentExpertCache(
+            self.store,
+            capacity,
+            policy=policy,
+            device=device,
+            dtype=dtype,
+            # the workers also serve external prefetchers (`smoe.modules.expert_prefetch`)
+            num_prefetch_workers=num_prefetch_workers,
+        )
+        # [(moe module, experts prefix in the checkpoint)] in forward order
+        self.moe_layers: list[tuple[nn.Module, str]] = []
+        self._hooks = []
+
+        module_names = dict(model.named_modules())
+        for prefix in self.store.expert_prefixes:
+            name = self._find_module_name(prefix, module_names)
+            if name is None:
+                raise ValueError(f"Experts `{prefix}` are not found in the model")
+            self._offload(name, prefix, module_names)
+
+        if prefetch is not None:
+            for idx, (moe, _) in enumerate(self.moe_layers):
+                self._hooks.append(
+                    moe.register_forward_pre_hook(self._make_prefetch_hook(idx))
+                )
+        logger.info(
+            f"Offloaded {len(self.store.experts)} experts of {len(self.moe_layers)} layers,"
+            f" capacity: {capacity}, policy: {policy}, prefetch: {prefetch}"
+        )
+
+    @staticmethod
+    def _find_module_name(prefix: str, module_names: dict) -> Optional[str]:
+        # checkpoints of `*ForCausalLM` may be loaded into the base model and vice versa
+        candidates = [prefix]
+        if "." in prefix:
+            candidates.append(prefix.split(".", 1)[1])
+        candidates.append(f"model.{prefix}")
+        for name in candidates:
+            if name in module_names:
+                return name
+        return None
+
+    def _offload(self, name: str, prefix: str, module_names: dict):
+        experts = module_names[name]
+        parent_name, child_name = _parent_name(name)
+        parent = module_names[parent_name]
+        num_experts = self.store.num_experts(prefix)
+
+        if _parent_name(parent_name)[1] == "calculator":
+            # LinearGLUMoELayer: `{moe}.calculator.experts`
+            moe = module_names[_parent_name(parent_name)[0]]
+            offloaded = OffloadedLinearGLUExperts(
+                self.cache,
+                prefix,
+                num_experts,
+                experts.hidden_act,
+                in_features=experts.in_features,
+                out_features=experts.out_features,
+            )
+            top_k = moe.num_selects
+        elif isinstance(experts, nn.ModuleList):
+            # MixtralSparseMoeBlock: `{moe}.experts`
+            moe = parent
+            if getattr(moe, "moe_type", "modulelist") != "modulelist":
+                raise NotImplementedError(
+                    f"Offloading is not supported for moe_type={moe.moe_type}"
+                )
+            offloaded = OffloadedMixtralExperts(
+                self.cache, prefix, num_experts, experts[0].act_fn
+            )
+            top_k = moe.top_k
+        else:
+            raise NotImplementedError(f"Unsupported experts: {type(experts)}")
+
+        setattr(parent, child_name, offloaded)
+        moe._offload_top_k = top_k
+        self.moe_layers.append((moe, prefix))
+
+    @staticmethod
+    def _router_logits(moe: nn.Module, hidden_states: torch.Tensor):
+        gate = moe.gate
+        if isinstance(gate, nn.Linear):
+            return gate(hidden_states)
+        gate_network = getattr(gate, "gate_network", None)
+        if gate_network is not None:
+            return gate_network(hidden_states)
+        return None
+
+    @torch.no_grad()
+    def _routed_experts(self, idx: int, hidden_states: torch.Tensor) -> list[tuple]:
+        moe, prefix = self.moe_layers[idx]
+        hidden_states = hidden_states.reshape(-1, hidden_states.shape[-1])
+        gate_dtype = next(moe.gate.parameters()).dtype
+        logits = self._router_logits(moe, hidden_states.to(gate_dtype))
+        if logits is None:
+            return []
+        selected_experts = torch.topk(logits, moe._offload_top_k, dim=-1).indices
+        return [(prefix, e) for e in torch.unique(selected_experts).tolist()]
+
+    def _make_prefetch_hook(self, idx: int):
+        def hook(module, args):
+            if len(args) == 0:
+                return
+            hidden_states = args[0]
+            keys = self._routed_experts(idx, hidden_states)
+            if self.prefetch == "next_layer" and idx + 1 < len(self.moe_layers):
+                keys += self._routed_experts(idx + 1, hidden_states)
+            self.cache.prefetch(keys)
+
+        return hook
+
+    @classmethod
+    def from_pretrained(
+        cls,
+        model_cls,
+        folder: str,
+        capacity: int,
+        torch_dtype=None,
+        config=None,
+        **kwargs,
+    ) -> "ExpertOffloadEngine":
+        """Build `model_cls` from `folder` without materializing the expert weights."""
+        from accelerate import init_empty_weights
+
+        if config is None:
+            config = model_cls.config_class.from_pretrained(folder)
+        with init_empty_weights(include_buffers=False):
+            model = model_cls(config)
+        engine = cls(model, folder, capacity, dtype=torch_dtype, **kwargs)
+
+        state_dict = engine.store.load_non_expert_state_dict()
+        if torch_dtype is not None:
+            state_dict = {
+                k: v.to(torch_dtype) if v.is_floating_point() else v
+                for k, v in state_dict.items()
+            }
+        model.load_state_dict(state_dict, strict=False, assign=True)
+        if getattr(config, "tie_word_embeddings", False):
+            model.tie_weights()
+        missing = [n for n, p in model.named_parameters() if p.is_meta]
+        if missing:
+            raise ValueError(f"Weights are missing in {folder}: {missing}")
+        model.eval()
+        return engine
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+    def close(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+        self.cache.close()
@@ -0,0 +1,325 @@
+"""
+Expert-parallel execution of Mixtral MoE blocks.
+
+Experts of every `MixtralSparseMoeBlock` are split into contiguous blocks over the ranks of a
+process group. Each rank routes its own tokens, sends every (token, expert) assignment to the
+rank owning the expert with `all_to_all_single`, runs its local experts and sends the outputs back.
+
+Parameter names keep the "modulelist" layout (`experts.{global_idx}.w1.weight`):
+non-local experts are parameter-free placeholders, non-local keys are skipped when loading
+a full checkpoint, and `gather_expert_parallel_state_dict` rebuilds the full state dict.
+
+If the expert-parallel group is smaller than the world, the same experts are replicated on
+the ranks of an expert-data-parallel group, whose gradients are all-reduced by `sync_expert_grads`.
+
+Usage:
+    model = MixtralForCausalLM.from_pretrained(...)
+    enable_expert_parallel(model, group)  # every rank of `group` must call forward together
+
+    # or with 2 expert-parallel ranks per replica of the experts
+    group, expert_dp_group = new_expert_parallel_groups(2)
+    enable_expert_parallel(model, group, expert_data_parallel_group=expert_dp_group)
+    ...
+    loss.backward()
+    sync_expert_grads(model)  # before the optimizer step
+"""
+
+from typing import Optional
+
+import torch
+import torch.distributed as dist
+from torch import nn
+
+from smoe.utils.logging import get_logger
+
+logger = get_logger(__file__)
+
+
+class _AllToAll(torch.autograd.Function):
+    """Differentiable `all_to_all_single`, the backward pass sends gradients the other way."""
+
+    @staticmethod
+    def forward(
+        ctx,
+        input: torch.Tensor,
+        output_split_sizes: list[int],
+        input_split_sizes: list[int],
+        group,
+    ):
+        ctx.output_split_sizes = output_split_sizes
+        ctx.input_split_sizes = input_split_sizes
+        ctx.group = group
+        output = input.new_empty((sum(output_split_sizes),) + input.shape[1:])
+        dist.all_to_all_single(
+            output,
+            input.contiguous(),
+            output_split_sizes,
+            input_split_sizes,
+            group=group,
+        )
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        grad_input = _AllToAll.apply(
+            grad_output, ctx.input_split_sizes, ctx.output_split_sizes, ctx.group
+        )
+        return grad_input, None, None, None
+
+
+def all_to_all(
+    input: torch.Tensor,
+    output_split_sizes: list[int],
+    input_split_sizes: list[int],
+    group=None,
+) -> torch.Tensor:
+    return _AllToAll.apply(input, output_split_sizes, input_split_sizes, group)
+
+
+class ExpertParallelExperts(nn.ModuleList):
+    """
+    Drop-in replacement of the `experts` ModuleList of a `MixtralSparseMoeBlock`.
+    Holds the local experts at their global indices and `nn.Identity` placeholders elsewhere.
+    """
+
+    def __init__(
+        self,
+        experts: nn.ModuleList,
+        group=None,
+        scale_expert_grads: bool = True,
+        expert_data_parallel_group=None,
+    ):
+        num_experts = len(experts)
+        world_size = dist.get_world_size(group)
+        expert_dp_world_size = (
+            1
+            if expert_data_parallel_group is None
+            else dist.get_world_size(expert_data_parallel_group)
+        )
+        if world_size * expert_dp_world_size != dist.get_world_size():
+            raise ValueError(
+                f"{world_size} expert-parallel ranks x {expert_dp_world_size} expert-data-parallel ranks"
+                f" do not cover the world of {dist.get_world_size()} ranks,"
+                " pass the `expert_data_parallel_group` of the ranks holding the same experts"
+            )
+        if num_experts % world_size != 0:
+            raise ValueError(
+                f"{num_experts} experts can not be evenly placed on {world_size} ranks"
+            )
+        num_local_experts = num_experts // world_size
+        local_start = dist.get_rank(group) * num_local_experts
+        local_end = local_start + num_local_experts
+        super().__init__(
+            [
+                expert if local_start <= idx < local_end else nn.Identity()
+                for idx, expert in enumerate(experts)
+            ]
+        )
+
+        self.group = group
+        self.world_size = world_size
+        self.expert_data_parallel_group = expert_data_parallel_group
+        self.expert_dp_world_size = expert_dp_world_size
+        self.num_experts = num_experts
+        self.num_local_experts = num_local_experts
+        self.local_start = local_start
+        self.local_end = local_end
+        self._register_load_state_dict_pre_hook(self._drop_non_local_keys)
+
+        global_world_size = world_size * expert_dp_world_size
+        if scale_expert_grads and global_world_size > 1:
+            # local experts get the summed gradients of all ranks' tokens (after `sync_expert_grads`),
+            # average them like the data-parallel gradients of replicated parameters
+            for param in self.local_parameters():
+                param.register_hook(lambda grad: grad / global_world_size)
+
+    def is_local(self, expert_idx: int) -> bool:
+        return self.local_start <= expert_idx < self.local_end
+
+    def local_parameters(self):
+        for idx in range(self.local_start, self.local_end):
+            yield from self[idx].parameters()
+
+    def _drop_non_local_keys(self, state_dict, prefix, *args, **kwargs):
+        for key in list(state_dict.keys()):
+            if not key.startswith(prefix):
+                continue
+            expert_idx = key[len(prefix) :].split(".", 1)[0]
+            if expert_idx.isdigit() and not self.is_local(int(expert_idx)):
+                del state_dict[key]
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        routing_weights: torch.Tensor,
+        selected_experts: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Args:
+            hidden_states: (num_tokens, hidden_dim)
+            routing_weights: (num_tokens, top_k), already scaled
+            selected_experts: (num_tokens, top_k) global expert indices
+        """
+        num_tokens, top_k = selected_experts.shape
+        flat_experts = selected_experts.reshape(-1)
+        order = torch.sort(flat_experts, stable=True).indices
+        token_indices = order // top_k
+
+        # per-expert counts decide every split size, exchange them first
+        send_counts = torch.bincount(flat_experts, minlength=self.num_experts)
+        recv_counts = torch.empty_like(send_counts)
+        dist.all_to_all_single(recv_counts, send_counts, group=self.group)
+        # one host sync for all split sizes
+        counts = torch.stack((send_counts, recv_counts)).view(2, self.world_size, -1)
+        counts = counts.cpu()
+        input_split_sizes = counts[0].sum(1).tolist()
+        output_split_sizes = counts[1].sum(1).tolist()
+        # (world_size, num_local_experts) rows received from each rank for each local expert
+        recv_expert_counts = counts[1]
+
+        recv_states = all_to_all(
+            hidden_states[token_indices],
+            output_split_sizes,
+            input_split_sizes,
+            self.group,
+        )
+
+        # received rows are grouped by source rank, regroup them by local expert
+        local_expert_ids = torch.arange(
+            self.num_local_experts, device=hidden_states.device
+        ).repeat(self.world_size)
+        local_expert_ids = local_expert_ids.repeat_interleave(
+            recv_expert_counts.reshape(-1).to(hidden_states.device)
+        )
+        local_order = torch.sort(local_expert_ids, stable=True).indices
+        expert_inputs = recv_states[local_order].split(
+            recv_expert_counts.sum(0).tolist()
+        )
+        expert_outputs = torch.cat(
+            [
+                self[self.local_start + idx](expert_input)
+                for idx, expert_input in enumerate(expert_inputs)
+            ]
+        )
+        recv_outputs = expert_outputs.new_zeros(expert_outputs.shape).index_add(
+            0, local_order, expert_outputs
+        )
+
+        outputs = all_to_all(
+            recv_outputs, input_split_sizes, output_split_sizes, self.group
+        )
+        outputs = outputs * routing_weights.reshape(-1)[order].unsqueeze(1).to(
+            outputs.dtype
+        )
+        final_hidden_states = hidden_states.new_zeros((num_tokens, outputs.shape[1]))
+        return final_hidden_states.index_add(0, token_indices, outputs)
+
+
+def new_expert_parallel_groups(expert_parallel_size: int) -> tuple:
+    """
+    Split the world into expert-parallel groups of `expert_parallel_size` consecutive ranks.
+    Every rank must call this function.
+
+    Returns:
+        group: the expert-parallel group of this rank
+        expert_data_parallel_group: ranks at the same position of every expert-parallel group,
+            they hold the same experts
+    """
+    world_size = dist.get_world_size()
+    if world_size % expert_parallel_size != 0:
+        raise ValueError(
+            f"{world_size} ranks can not be split into expert-parallel groups of {expert_parallel_size}"
+        )
+    rank = dist.get_rank()
+    group = expert_dp_group = None
+    for start in range(0, world_size, expert_parallel_size):
+        ranks = list(range(start, start + expert_parallel_size))
+        new_group = dist.new_group(ranks)
+        if rank in ranks:
+            group = new_group
+    for offset in range(expert_parallel_size):
+        ranks = list(range(offset, world_size, expert_parallel_size))
+        new_group = dist.new_group(ranks)
+        if rank in ranks:
+            expert_dp_group = new_group
+    return group, expert_dp_group
+
+
+def enable_expert_parallel(
+    model: nn.Module,
+    group=None,
+    scale_expert_grads: bool = True,
+    expert_data_parallel_group=None,
+) -> nn.Module:
+    """
+    Place the experts of every modulelist `MixtralSparseMoeBlock` in `model` on the ranks of `group`.
+    Local expert parameters are excluded from `DistributedDataParallel` synchronization,
+    call `sync_expert_grads` after backward if `group` is smaller than the world.
+    """
+    from smoe.models.mixtral.modeling_mixtral import MixtralSparseMoeBlock
+
+    ignored_params = []
+    num_blocks = 0
+    for name, module in list(model.named_modules()):
+        if not isinstance(module, MixtralSparseMoeBlock):
+            continue
+        if module.moe_type != "modulelist":
+            raise ValueError(
+                f"Expert parallelism needs `modulelist` experts, got {module.moe_type} in {name}"
+            )
+        if module.static_moe:
+            raise ValueError(f"Expert parallelism does not support static_moe ({name})")
+        module.experts = ExpertParallelExperts(
+            module.experts,
+            group=group,
+            scale_expert_grads=scale_expert_grads,
+            expert_data_parallel_group=expert_data_parallel_group,
+        )
+        module.moe_type = "expert_parallel"
+        prefix = f"{name}.experts." if name else "experts."
+        for idx in range(module.experts.local_start, module.experts.local_end):
+            for param_name, _ in module.experts[idx].named_parameters():
+                ignored_params.append(f"{prefix}{idx}.{param_name}")
+        num_blocks += 1
+
+    # read by DistributedDataParallel, the local experts differ across ranks
+    model._ddp_params_and_buffers_to_ignore = ignored_params
+    logger.info(
+        f"Expert parallelism enabled for {num_blocks} MoE blocks on {dist.get_world_size(group)} ranks"
+    )
+    return model
+
+
+def sync_expert_grads(model: nn.Module):
+    """All-reduce the local expert gradients over the expert-data-parallel groups."""
+    for module in model.modules():
+        if not isinstance(module, ExpertParallelExperts):
+            continue
+        if module.expert_dp_world_size == 1:
+            continue
+        # every replica reduces the same parameters, missing grads count as zeros
+        params = [param for param in module.local_parameters() if param.requires_grad]
+        for param in params:
+            if param.grad is None:
+                param.grad = torch.zeros_like(param)
+        flat_grads = torch.cat([param.grad.reshape(-1) for param in params])
+        dist.all_reduce(flat_grads, group=module.expert_data_parallel_group)
+        for param, grad in zip(params, flat_grads.split([p.numel() for p in params])):
+            param.grad.copy_(grad.view_as(param))
+
+
+def gather_expert_parallel_state_dict(model: nn.Module, group=None) -> dict:
+    """Full "modulelist" state dict (on CPU) with the experts of all ranks, on every rank."""
+    expert_keys = set()
+    for name, module in model.named_modules():
+        if isinstance(module, ExpertParallelExperts):
+            prefix = f"{name}." if name else ""
+            expert_keys.update(f"{prefix}{key}" for key in module.state_dict().keys())
+
+    state_dict = {k: v.detach().cpu() for k, v in model.state_dict().items()}
+    local_experts = {k: v for k, v in state_dict.items() if k in expert_keys}
+    gathered: list[Optional[dict]] = [None] * dist.get_world_size(group)
+    dist.all_gather_object(gathered, local_experts, group=group)
+    for rank_experts in gathered:
+        state_dict.update(rank_experts)
+    return state_dict
@@ -0,0 +1,325 @@
+"""
+Speculative expert prefetching for autoregressive decoding.
+
+During decoding, the experts of a MoE layer are only known once its router has run, so with
+offloaded experts (`smoe.modules.expert_offload`) every step waits on cold expert weights.
+`ExpertPrefetcher` hooks the routers of a model and, at every layer, predicts the experts of the
+following layers from the current routing and stages them ahead of time:
+
+    - `RouterLookaheadPredictor`: applies the routers of the next `depth` layers to the current
+      hidden states. The router weights of all layers are stacked, so the lookahead of several
+      layers is a single matmul.
+    - `TransitionPredictor`: picks the experts most often routed to in the next layer after the
+      current experts, with the layer-to-layer transition counts of a `RoutingTrace`.
+
+Predictions are compared with the actual routing and reported as hits / misses per layer.
+
+Usage:
+    engine = ExpertOffloadEngine.from_pretrained(
+        MixtralForCausalLM, folder, capacity=64, prefetch=None
+    )
+    predictor = RouterLookaheadPredictor.from_model(engine.model, depth=2)
+    with ExpertPrefetcher(engine.model, predictor, engine=engine) as prefetcher:
+        outputs = engine.model.generate(...)
+    print(prefetcher.stats())
+"""
+
+from typing import Optional
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from smoe.utils.logging import get_logger
+from smoe.utils.routing_trace import RoutingTrace, find_moe_gates
+
+logger = get_logger(__file__)
+
+
+def _router_linear(gate: nn.Module) -> Optional[nn.Linear]:
+    """The linear router of a Mixtral gate or a `BaseMoELayer` gate with `gate_network="linear"`."""
+    if isinstance(gate, nn.Linear):
+        return gate
+    gate_network = getattr(gate, "gate_network", None)
+    if isinstance(gate_network, nn.Linear):
+        return gate_network
+    return None
+
+
+class RouterLookaheadPredictor:
+    """
+    Predicts the experts of layers `layer_idx + 1 ... layer_idx + depth` by routing the hidden
+    states of `layer_idx` with their routers, `num_candidates` (default: top_k) experts per token.
+
+    The router weights are copied into one (num_layers * num_experts, hidden_size) matrix,
+    call `refresh` after the routers are updated.
+    """
+
+    def __init__(
+        self,
+        routers: list[nn.Linear],
+        top_k: int,
+        depth: int = 1,
+        num_candidates: int = None,
+    ):
+        if depth < 1:
+            raise ValueError(f"depth must be positive, got {depth}")
+        self.routers = routers
+        self.num_layers = len(routers)
+        self.num_experts = routers[0].out_features
+        self.depth = depth
+        self.num_candidates = top_k if num_candidates is None else num_candidates
+        self.refresh()
+
+    @classmethod
+    def from_model(cls, model: nn.Module, **kwargs) -> "RouterLookaheadPredictor":
+        routers, top_k = [], None
+        for name, gate, gate_top_k in find_moe_gates(model):
+            router = _router_linear(gate)
+            if router is None:
+                raise ValueError(f"The router of {name} is not a linear layer")
+            routers.append(router)
+            top_k = gate.num_selects if gate_top_k is None else gate_top_k
+        if len(routers) == 0:
+            raise ValueError("No MoE layer is found in the model")
+        return cls(routers, top_k, **kwargs)
+
+    @torch.no_grad()
+    def refresh(self):
+        self.weight = torch.cat([router.weight for router in self.routers])
+        biases = [router.bias for router in self.routers]
+        self.bias = None if biases[0] is None else torch.cat(biases)
+
+    @torch.no_grad()
+    def predict(
+        self,
+        layer_idx: int,
+        hidden_states: torch.Tensor,
+        selected_experts: torch.Tensor,
+    ) -> dict[int, torch.Tensor]:
+        """`{future layer index: (num_tokens, num_candidates) expert indices}`"""
+        start = layer_idx + 1
+        end = min(start + self.depth, self.num_layers)
+        if start >= end:
+            return {}
+        rows = slice(start * self.num_experts, end * self.num_experts)
+        logits = F.linear(
+            hidden_states.to(self.weight.dtype),
+            self.weight[rows],
+            None if self.bias is None else self.bias[rows],
+        )
+        # (num_tokens, num_future_layers, num_candidates)
+        candidates = logits.view(-1, end - start, self.num_experts).topk(
+            self.num_candidates, dim=-1
+        )
+        return {start + idx: candidates.indices[:, idx] for idx in range(end - start)}
+
+
+class TransitionPredictor:
+    """
+    Predicts the `num_candidates` experts of `layer_idx + 1` with the highest transition counts
+    from the experts selected in `layer_idx`, summed over the top-k selections of each token.
+    """
+
+    def __init__(self, transitions: list[np.ndarray], num_candidates: int):
+        # [(num_experts, num_experts) counts from layer i to layer i + 1]
+        self.transitions = [torch.as_tensor(t, dtype=torch.float) for t in transitions]
+        self.num_candidates = num_candidates
+
+    @classmethod
+    def from_routing_trace(
+        cls, trace: RoutingTrace, num_candidates: int = None
+    ) -> "TransitionPredictor":
+        transitions = [
+            trace.layer_transitions(layer_idx)
+            for layer_idx in range(trace.num_layers - 1)
+        ]
+        if num_candidates is None:
+            num_candidates = trace.meta["top_k"]
+        return cls(transitions, num_candidates)
+
+    @torch.no_grad()
+    def predict(
+        self,
+        layer_idx: int,
+        hidden_states: torch.Tensor,
+        selected_experts: torch.Tensor,
+    ) -> dict[int, torch.Tensor]:
+        if layer_idx >= len(self.transitions):
+            return {}
+        transitions = self.transitions[layer_idx]
+        if transitions.device != selected_experts.device:
+            transitions = transitions.to(selected_experts.device)
+            self.transitions[layer_idx] = transitions
+        scores = transitions[selected_experts].sum(dim=1)
+        return {layer_idx + 1: scores.topk(self.num_candidates, dim=-1).indices}
+
+
+class ExpertPrefetcher:
+    """
+    Predicts the experts of the upcoming layers with `predictor` at every MoE layer and, with an
+    `ExpertOffloadEngine`, stages the routed experts of the current layer and the predicted experts
+    in its cache before they are computed.
+
+    Predictions are only made in forwards routing at most `max_tokens` tokens per layer (decoding
+    steps of `max_tokens` sequences), prefill is compute-bound and only stages its routed experts.
+
+    Args:
+        predictor: `predict(layer_idx, hidden_states, selected_experts) -> {layer_idx: experts}`,
+            e.g. `RouterLookaheadPredictor` or `TransitionPredictor`.
+        engine: an `ExpertOffloadEngine` built with `prefetch=None`. Without it, only the
+            prediction statistics are collected.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        predictor,
+        engine=None,
+        max_tokens: int = 1,
+    ):
+        self.model = model
+        self.predictor = predictor
+        self.max_tokens = max_tokens
+        self.cache = None
+        self.gates = find_moe_gates(model)
+        if len(self.gates) == 0:
+            raise ValueError("No MoE layer is found in the model")
+
+        # cache key prefix of every layer
+        self.prefixes: list[Optional[str]] = [None] * len(self.gates)
+        if engine is not None:
+            if engine.prefetch is not None:
+                raise ValueError(
+                    "The engine prefetches by itself, build it with `prefetch=None`"
+                )
+            self.cache = engine.cache
+            module_names = dict(model.named_modules())
+            prefix_by_module = {id(moe): prefix for moe, prefix in engine.moe_layers}
+            for idx, (name, _, _) in enumerate(self.gates):
+                self.prefixes[idx] = prefix_by_module.get(id(module_names[name]))
+
+        num_layers = len(self.gates)
+        # the latest prediction of every layer, as a set of expert indices
+        self._pending: list[Optional[set]] = [None] * num_layers
+        self.num_routed = [0] * num_layers
+        self.num_predicted = [0] * num_layers
+        self.num_hits = [0] * num_layers
+        self.num_steps = 0
+
+        self._hooks = [model.register_forward_pre_hook(self._model_pre_hook)]
+        for idx, (_, gate, top_k) in enumerate(self.gates):
+            self._hooks.append(
+                gate.register_forward_hook(self._make_gate_hook(idx, top_k))
+            )
+
+    def _model_pre_hook(self, module, args):
+        self._pending = [None] * len(self.gates)
+
+    def _make_gate_hook(self, idx: int, top_k: Optional[int]):
+        @torch.no_grad()
+        def hook(module, args, output):
+            if top_k is None:
+                selected_experts = output["topK_indices"]
+            else:
+                selected_experts = output.topk(top_k, dim=-1).indices
+            if selected_experts.shape[0] > self.max_tokens:
+                # prefill: no prediction, only stage the routed experts of this layer
+                if self.cache is not None and self.prefixes[idx] is not None:
+                    routed = torch.unique(selected_experts).tolist()
+                    self.cache.prefetch([(self.prefixes[idx], e) for e in routed])
+                return
+            if idx == 0:
+                self.num_steps += 1
+
+            predictions = self.predictor.predict(idx, args[0], selected_experts)
+            layer_ids = sorted(predictions)
+            # one host copy for the routed and the predicted experts
+            flat = torch.cat(
+                [selected_experts.reshape(-1)]
+                + [predictions[i].reshape(-1) for i in layer_ids]
+            ).tolist()
+            routed = set(flat[: selected_experts.numel()])
+            offset = selected_experts.numel()
+            predicted = {}
+            for layer_idx in layer_ids:
+                size = predictions[layer_idx].numel()
+                predicted[layer_idx] = set(flat[offset : offset + size])
+                offset += size
+
+            self._score(idx, routed)
+            if self.cache is not None:
+                # the routed experts first, they are computed right after the router
+                keys = [(self.prefixes[idx], e) for e in sorted(routed)]
+                for layer_idx in layer_ids:
+                    keys.extend(
+                        (self.prefixes[layer_idx], e)
+                        for e in sorted(predicted[layer_idx])
+                    )
+                self.cache.prefetch([key for key in keys if key[0] is not None])
+            for layer_idx, experts in predicted.items():
+                self._pending[layer_idx] = experts
+
+        return hook
+
+    def _score(self, idx: int, routed: set):
+        predicted = self._pending[idx]
+        if predicted is None:
+            return
+        self.num_routed[idx] += len(routed)
+        self.num_predicted[idx] += len(predicted)
+        self.num_hits[idx] += len(routed & predicted)
+
+    def stats(self) -> dict:
+        """
+        Prediction statistics of the decoding steps, `hits` are routed experts that were
+        predicted, `misses` are routed experts that were not (computed on cold weights).
+        """
+        layers = []
+        for routed, predicted, hits in zip(
+            self.num_routed, self.num_predicted, self.num_hits
+        ):
+            layers.append(
+                {
+                    "hits": hits,
+                    "misses": routed - hits,
+                    "wasted": predicted - hits,
+                    "hit_rate": hits / max(routed, 1),
+                    "precision": hits / max(predicted, 1),
+                }
+            )
+        num_routed = sum(self.num_routed)
+        num_hits = sum(self.num_hits)
+        stats = {
+            "num_steps": self.num_steps,
+            "hits": num_hits,
+            "misses": num_routed - num_hits,
+            "wasted": sum(self.num_predicted) - num_hits,
+            "hit_rate": num_hits / max(num_routed, 1),
+            "precision": num_hits / max(sum(self.num_predicted), 1),
+            "layers": layers,
+        }
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+    def reset_stats(self):
+        num_layers = len(self.gates)
+        self.num_routed = [0] * num_layers
+        self.num_predicted = [0] * num_layers
+        self.num_hits = [0] * num_layers
+        self.num_steps = 0
+        if self.cache is not None:
+            self.cache.reset_stats()
+
+    def close(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
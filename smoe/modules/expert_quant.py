@@ -0,0 +1,528 @@
+"""
+Weight-only int8 / int4 quantization of the expert weights for inference.
+
+The weights of the routed experts of `MixtralSparseMoeBlock` (`block_sparse_moe.experts.{i}.w{1,2,3}`)
+and of `LinearGLUExperts` (`calculator.experts.weight_{gate,up,down}.{i}`) are stored as integers with
+symmetric scales, per output channel or per group of `group_size` input channels. int4 values are
+packed two per byte. Biases and all other weights keep the model dtype, including the always-on
+residual experts (`residual_block` of `LinearGLUMoEResidualLayer`, `mlp_residual` of Mixtral).
+
+The expert forward dequantizes `block_rows` output rows at a time right before their matmul, so the
+full-precision weights are never materialized and the weight traffic shrinks 2x (int8) / 4x (int4),
+which is what bandwidth-bound CPU inference pays for. Per-channel int8 weights with bfloat16 inputs on
+CPU run with the weight-only int8 matmul of PyTorch instead.
+
+Usage:
+    # in memory
+    model = quantize_experts(model, bits=4, group_size=128)
+
+    # saved checkpoints
+    quantize_safetensors_experts(folder, quantized_folder, bits=4, group_size=128)
+    model = load_quantized_model(MixtralForCausalLM, quantized_folder, torch_dtype=torch.float32)
+
+The quantization config is kept as `expert_quantization` in `config.json`.
+"""
+
+import json
+import math
+import os
+import shutil
+from typing import Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from safetensors import safe_open
+from safetensors.torch import save_file
+from transformers.activations import ACT2FN
+from transformers.utils import CONFIG_NAME, SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME
+
+from smoe.modules.expert_offload import _parent_name, parse_expert_param_name
+from smoe.modules.moe.moe_experts import LinearGLUExperts
+from smoe.utils.io import create_dir
+from smoe.utils.logging import get_logger
+
+logger = get_logger(__file__)
+
+SUPPORTED_BITS = (4, 8)
+# output rows dequantized at a time, the dequantized block stays in the CPU caches
+DEFAULT_BLOCK_ROWS = 256
+
+
+def _is_residual(name: str) -> bool:
+    return "residual_block" in name.split(".")
+
+
+def _check_bits(bits: int):
+    if bits not in SUPPORTED_BITS:
+        raise ValueError(f"bits must be one of {SUPPORTED_BITS}, got {bits}")
+
+
+def _group_layout(in_features: int, group_size: Optional[int]) -> tuple[int, int]:
+    """(group size, number of groups), the last group is zero-padded if it is not full."""
+    if group_size is None or group_size >= in_features:
+        return in_features, 1
+    return group_size, math.ceil(in_features / group_size)
+
+
+def pack_int4(q: torch.Tensor) -> torch.Tensor:
+    """(out, in) int8 values in [-8, 7] -> (out, ceil(in / 2)) uint8, two values per byte."""
+    if q.shape[-1] % 2 != 0:
+        q = F.pad(q, (0, 1))
+    q = (q + 8).to(torch.uint8)
+    return q[..., 0::2] | (q[..., 1::2] << 4)
+
+
+def unpack_int4(packed: torch.Tensor, in_features: int) -> torch.Tensor:
+    low = packed & 0x0F
+    high = packed >> 4
+    q = torch.stack([low, high], dim=-1).reshape(packed.shape[:-1] + (-1,))
+    return q[..., :in_features].to(torch.int8) - 8
+
+
+def quantize_weight(
+    weight: torch.Tensor, bits: int = 8, group_size: Optional[int] = None
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Symmetric quantization of the (out_features, in_features) `weight`.
+
+    Returns:
+        qweight: int8 (out_features, in_features), or uint8 (out_features, ceil(in_features / 2)) for int4.
+        scales: (out_features, num_groups) in the dtype of `weight`.
+    """
+    _check_bits(bits)
+    out_features, in_features = weight.shape
+    group_size, num_groups = _group_layout(in_features, group_size)
+    qmax = 2 ** (bits - 1) - 1
+
+    w = weight.float()
+    padding = group_size * num_groups - in_features
+    if padding > 0:
+        w = F.pad(w, (0, padding))
+    w = w.reshape(out_features, num_groups, group_size)
+    scales = w.abs().amax(dim=-1).clamp(min=1e-8) / qmax
+    q = torch.round(w / scales.unsqueeze(-1)).clamp(-qmax, qmax).to(torch.int8)
+    q = q.reshape(out_features, -1)[:, :in_features]
+    if bits == 4:
+        q = pack_int4(q)
+    return q.contiguous(), scales.to(weight.dtype)
+
+
+def dequantize_weight(
+    qweight: torch.Tensor,
+    scales: torch.Tensor,
+    bits: int,
+    in_features: int,
+    group_size: Optional[int] = None,
+    dtype: torch.dtype = None,
+) -> torch.Tensor:
+    """Inverse of `quantize_weight`, also for a block of rows of `qweight` and `scales`."""
+    dtype = scales.dtype if dtype is None else dtype
+    q = unpack_int4(qweight, in_features) if bits == 4 else qweight
+    group_size, num_groups = _group_layout(in_features, group_size)
+    padding = group_size * num_groups - in_features
+    if padding > 0:
+        q = F.pad(q, (0, padding))
+    w = q.to(dtype).reshape(q.shape[0], num_groups, group_size)
+    w = w * scales.to(dtype).unsqueeze(-1)
+    return w.reshape(q.shape[0], -1)[:, :in_features]
+
+
+class QuantizedLinear(nn.Module):
+    """`nn.Linear` with a weight-only quantized `weight`, dequantized on the fly in blocks of output rows."""
+
+    def __init__(
+        self,
+        in_features: int,
+        out_features: int,
+        bits: int = 8,
+        group_size: Optional[int] = None,
+        bias: bool = False,
+        block_rows: int = DEFAULT_BLOCK_ROWS,
+        device=None,
+        dtype=None,
+    ):
+        super().__init__()
+        _check_bits(bits)
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        self.block_rows = block_rows
+
+        packed_in_features = math.ceil(in_features / 2) if bits == 4 else in_features
+        _, num_groups = _group_layout(in_features, group_size)
+        self.register_buffer(
+            "qweight",
+            torch.empty(
+                (out_features, packed_in_features),
+                dtype=torch.uint8 if bits == 4 else torch.int8,
+                device=device,
+            ),
+        )
+        self.register_buffer(
+            "scales",
+            torch.empty((out_features, num_groups), dtype=dtype, device=device),
+        )
+        if bias:
+            self.bias = nn.Parameter(
+                torch.empty(out_features, dtype=dtype, device=device),
+                requires_grad=False,
+            )
+        else:
+            self.register_parameter("bias", None)
+
+    @classmethod
+    def from_float(
+        cls,
+        weight: torch.Tensor,
+        bias: torch.Tensor = None,
+        bits: int = 8,
+        group_size: Optional[int] = None,
+        block_rows: int = DEFAULT_BLOCK_ROWS,
+    ) -> "QuantizedLinear":
+        out_features, in_features = weight.shape
+        module = cls(
+            in_features,
+            out_features,
+            bits=bits,
+            group_size=group_size,
+            bias=bias is not None,
+            block_rows=block_rows,
+            device=weight.device,
+            dtype=weight.dtype,
+        )
+        with torch.no_grad():
+            qweight, scales = quantize_weight(weight, bits=bits, group_size=group_size)
+            # `assign`-like replacement, the weights may be on the meta device
+            module.qweight = qweight
+            module.scales = scales
+            if bias is not None:
+                module.bias = nn.Parameter(bias.detach().clone(), requires_grad=False)
+        return module
+
+    def dequantize(self, start: int = 0, end: int = None, dtype=None) -> torch.Tensor:
+        """Dequantized weight rows `[start, end)`."""
+        end = self.out_features if end is None else end
+        return dequantize_weight(
+            self.qweight[start:end],
+            self.scales[start:end],
+            self.bits,
+            self.in_features,
+            group_size=self.group_size,
+            dtype=dtype,
+        )
+
+    def _use_int8_kernel(self, input: torch.Tensor) -> bool:
+        # weight-only int8 matmul of PyTorch (CPU: bfloat16 inputs), per output channel scales only,
+        # the CPU kernel reads the input channels in blocks of 16
+        return (
+            self.bits == 8
+            and self.scales.shape[1] == 1
+            and self.in_features % 16 == 0
+            and input.device.type == "cpu"
+            and input.dtype == torch.bfloat16
+            and hasattr(torch.ops.aten, "_weight_int8pack_mm")
+        )
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        if self._use_int8_kernel(input):
+            output = torch.ops.aten._weight_int8pack_mm(
+                input.reshape(-1, self.in_features).contiguous(),
+                self.qweight,
+                self.scales.reshape(-1).to(input.dtype),
+            ).reshape(input.shape[:-1] + (self.out_features,))
+            if self.bias is not None:
+                output = output + self.bias.to(output.dtype)
+            return output
+
+        if self.block_rows is None or self.block_rows >= self.out_features:
+            return F.linear(input, self.dequantize(dtype=input.dtype), self.bias)
+
+        output = input.new_empty(input.shape[:-1] + (self.out_features,))
+        for start in range(0, self.out_features, self.block_rows):
+            end = min(start + self.block_rows, self.out_features)
+            output[..., start:end] = F.linear(
+                input, self.dequantize(start, end, dtype=input.dtype)
+            )
+        if self.bias is not None:
+            output += self.bias.to(output.dtype)
+        return output
+
+    def extra_repr(self):
+        return (
+            "in_features={}, out_features={}, bits={}, group_size={}, bias={}".format(
+                self.in_features,
+                self.out_features,
+                self.bits,
+                self.group_size,
+                self.bias is not None,
+            )
+        )
+
+
+class QuantizedMixtralExpert(nn.Module):
+    """Drop-in for `MixtralBLockSparseTop2MLP` with quantized `w1` (gate), `w2` (down) and `w3` (up)."""
+
+    def __init__(
+        self, w1: QuantizedLinear, w2: QuantizedLinear, w3: QuantizedLinear, act_fn
+    ):
+        super().__init__()
+        self.ffn_dim = w1.out_features
+        self.hidden_dim = w1.in_features
+        self.w1 = w1
+        self.w2 = w2
+        self.w3 = w3
+        self.act_fn = act_fn
+
+    @classmethod
+    def from_float(cls, expert: nn.Module, **kwargs) -> "QuantizedMixtralExpert":
+        linears = [
+            QuantizedLinear.from_float(linear.weight, linear.bias, **kwargs)
+            for linear in (expert.w1, expert.w2, expert.w3)
+        ]
+        return cls(*linears, expert.act_fn)
+
+    def forward(self, hidden_states):
+        current_hidden_states = self.act_fn(self.w1(hidden_states)) * self.w3(
+            hidden_states
+        )
+        current_hidden_states = self.w2(current_hidden_states)
+        return current_hidden_states
+
+
+class QuantizedLinearGLUExperts(nn.Module):
+    """Drop-in for `LinearGLUExperts`, `weight_{gate,up,down}[i]` are `QuantizedLinear` modules."""
+
+    def __init__(self, experts: LinearGLUExperts, **kwargs):
+        super().__init__()
+        self.in_features = experts.in_features
+        self.hidden_features = experts.hidden_features
+        self.out_features = experts.out_features
+        self.hidden_act = experts.hidden_act
+        self.num_experts = experts.num_experts
+        self.size_experts = experts.size_experts
+        self.act_fn = ACT2FN[experts.hidden_act]
+
+        self.weight_gate = nn.ModuleList(
+            [QuantizedLinear.from_float(w, **kwargs) for w in experts.weight_gate]
+        )
+        self.weight_up = nn.ModuleList(
+            [QuantizedLinear.from_float(w, **kwargs) for w in experts.weight_up]
+        )
+        self.weight_down = nn.ModuleList(
+            [QuantizedLinear.from_float(w, **kwargs) for w in experts.weight_down]
+        )
+        # biases are small, they are kept in the model dtype
+        self.bias_gate = experts.bias_gate
+        self.bias_up = experts.bias_up
+        self.bias_down = experts.bias_down
+
+    def forward(self, input, i):
+        gate = self.weight_gate[i](input)
+        up = self.weight_up[i](input)
+        if self.bias_gate is not None:
+            gate = gate + self.bias_gate[i]
+            up = up + self.bias_up[i]
+        down = self.weight_down[i](self.act_fn(gate) * up)
+        if self.bias_down is not None:
+            down = down + self.bias_down[i]
+        return down
+
+    def extra_repr(self):
+        return (
+            "in_features={}, hidden_features={}, out_features={}, hidden_act={},"
+            " num_experts={}, size_experts={}, bias={}".format(
+                self.in_features,
+                self.hidden_features,
+                self.out_features,
+                self.hidden_act,
+                self.num_experts,
+                self.size_experts,
+                self.bias_gate is not None,
+            )
+        )
+
+
+def quantize_experts(
+    model: nn.Module,
+    bits: int = 8,
+    group_size: Optional[int] = None,
+    block_rows: int = DEFAULT_BLOCK_ROWS,
+) -> nn.Module:
+    """
+    Replaces the experts of `model` with quantized ones in place, meta-device experts give empty quantized
+    experts to load a quantized state dict into. `model.config.expert_quantization` records the config.
+    """
+    from smoe.models.mixtral.modeling_mixtral import MixtralSparseMoeBlock
+
+    _check_bits(bits)
+    kwargs = dict(bits=bits, group_size=group_size, block_rows=block_rows)
+    module_names = dict(model.named_modules())
+    num_experts = 0
+    for name, module in module_names.items():
+        if isinstance(module, LinearGLUExperts) and not _is_residual(name):
+            parent_name, child_name = _parent_name(name)
+            setattr(
+                module_names[parent_name],
+                child_name,
+                QuantizedLinearGLUExperts(module, **kwargs),
+            )
+            num_experts += module.num_experts
+        elif isinstance(module, MixtralSparseMoeBlock):
+            if module.moe_type != "modulelist":
+                raise NotImplementedError(
+                    f"Expert quantization is not supported for moe_type={module.moe_type} ({name})"
+                )
+            for idx, expert in enumerate(module.experts):
+                if not isinstance(expert, QuantizedMixtralExpert):
+                    module.experts[idx] = QuantizedMixtralExpert.from_float(
+                        expert, **kwargs
+                    )
+                    num_experts += 1
+
+    config = getattr(model, "config", None)
+    if config is not None:
+        config.expert_quantization = {"bits": bits, "group_size": group_size}
+    logger.info(
+        f"Quantized {num_experts} experts to int{bits}, group size: {group_size or 'per channel'}"
+    )
+    return model
+
+
+def _is_expert_weight(key: str) -> bool:
+    parsed = parse_expert_param_name(key)
+    if parsed is None or _is_residual(parsed[0]):
+        return False
+    return parsed[2] in (
+        "w1.weight",
+        "w2.weight",
+        "w3.weight",
+        "weight_gate",
+        "weight_up",
+        "weight_down",
+    )
+
+
+def quantized_weight_keys(key: str) -> tuple[str, str]:
+    """Keys of the quantized weight & scales, `{...}.w1.weight` -> `{...}.w1.qweight`, `{...}.w1.scales`."""
+    base = key[: -len(".weight")] if key.endswith(".weight") else key
+    return f"{base}.qweight", f"{base}.scales"
+
+
+def _shard_files(folder: str) -> tuple[list[str], Optional[dict]]:
+    index_file = os.path.join(folder, SAFE_WEIGHTS_INDEX_NAME)
+    if os.path.exists(index_file):
+        with open(index_file, "r", encoding="utf8") as fin:
+            index = json.load(fin)
+        return sorted(set(index["weight_map"].values())), index
+    if os.path.exists(os.path.join(folder, SAFE_WEIGHTS_NAME)):
+        return [SAFE_WEIGHTS_NAME], None
+    raise FileNotFoundError(f"No safetensors checkpoint found in {folder}")
+
+
+def quantize_safetensors_experts(
+    src: str, dst: str, bits: int = 8, group_size: Optional[int] = None
+):
+    """
+    Converts the safetensors checkpoint folder `src` into `dst` with quantized expert weights,
+    one shard at a time. Other files (config, tokenizer, ...) are copied, and the quantization config is
+    added to `config.json`.
+    """
+    _check_bits(bits)
+    create_dir(dst)
+    shard_files, index = _shard_files(src)
+    weight_map = {}
+    total_size = 0
+    num_quantized = 0
+    for filename in shard_files:
+        tensors = {}
+        with safe_open(os.path.join(src, filename), framework="pt") as f:
+            metadata = f.metadata() or {}
+            for key in f.keys():
+                tensor = f.get_tensor(key)
+                if _is_expert_weight(key):
+                    qweight, scales = quantize_weight(tensor, bits, group_size)
+                    qweight_key, scales_key = quantized_weight_keys(key)
+                    tensors[qweight_key] = qweight
+                    tensors[scales_key] = scales
+                    num_quantized += 1
+                else:
+                    tensors[key] = tensor
+        save_file(
+            tensors, os.path.join(dst, filename), metadata={"format": "pt", **metadata}
+        )
+        for key, tensor in tensors.items():
+            weight_map[key] = filename
+            total_size += tensor.numel() * tensor.element_size()
+        logger.info(f"{filename} done.")
+
+    if index is not None:
+        index = {"metadata": {**index.get("metadata", {}), "total_size": total_size}}
+        index["weight_map"] = dict(sorted(weight_map.items()))
+        with open(
+            os.path.join(dst, SAFE_WEIGHTS_INDEX_NAME), "w", encoding="utf8"
+        ) as fout:
+            json.dump(index, fout, indent=2)
+
+    for filename in os.listdir(src):
+        path = os.path.join(src, filename)
+        if (
+            os.path.isfile(path)
+            and not filename.endswith(".safetensors")
+            and filename != SAFE_WEIGHTS_INDEX_NAME
+        ):
+            shutil.copy2(path, os.path.join(dst, filename))
+    config_file = os.path.join(dst, CONFIG_NAME)
+    if os.path.exists(config_file):
+        with open(config_file, "r", encoding="utf8") as fin:
+            config = json.load(fin)
+        config["expert_quantization"] = {"bits": bits, "group_size": group_size}
+        with open(config_file, "w", encoding="utf8") as fout:
+            json.dump(config, fout, indent=2, sort_keys=True)
+    logger.info(
+        f"Quantized {num_quantized} expert weights to int{bits}, saved to {dst}"
+    )
+
+
+def load_quantized_model(
+    model_cls,
+    folder: str,
+    torch_dtype: torch.dtype = None,
+    config=None,
+    block_rows: int = DEFAULT_BLOCK_ROWS,
+) -> nn.Module:
+    """Builds `model_cls` from a folder converted by `quantize_safetensors_experts` (or saved after `quantize_experts`)."""
+    from accelerate import init_empty_weights
+
+    if config is None:
+        config = model_cls.config_class.from_pretrained(folder)
+    quantization = getattr(config, "expert_quantization", None)
+    if quantization is None:
+        raise ValueError(f"{folder} has no `expert_quantization` in its config")
+    with init_empty_weights(include_buffers=False):
+        model = model_cls(config)
+    # meta experts -> empty quantized experts
+    quantize_experts(model, block_rows=block_rows, **quantization)
+
+    state_dict = {}
+    shard_files, _ = _shard_files(folder)
+    for filename in shard_files:
+        with safe_open(os.path.join(folder, filename), framework="pt") as f:
+            for key in f.keys():
+                tensor = f.get_tensor(key)
+                if torch_dtype is not None and tensor.is_floating_point():
+                    tensor = tensor.to(torch_dtype)
+                state_dict[key] = tensor
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    if getattr(config, "tie_word_embeddings", False):
+        model.tie_weights()
+    missing = [
+        name
+        for name, tensor in list(model.named_parameters()) + list(model.named_buffers())
+        if tensor.is_meta
+    ]
+    if missing:
+        raise ValueError(f"Weights are missing in {folder}: {missing}")
+    model.eval()
+    return model
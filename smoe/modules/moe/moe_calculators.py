@@ -8,6 +8,11 @@ from transformers.utils import ModelOutput
 
 from smoe.modules.moe.moe_experts import LinearGLUExperts
 from smoe.modules.norm import WeightNorm
+from smoe.modules.static_moe import (
+    capacity_dispatch,
+    compute_expert_capacity,
+    static_moe_forward,
+)
 from smoe.utils.debugging import remote_breakpoint
 
 
@@ -139,6 +144,59 @@ class UniversalCalculator(BaseCalculator):
         # fmt: on
 
 
+class StaticCapacityCalculator(BaseCalculator):
+    """
+    Static-shape variant of `UniversalCalculator` for `torch.compile` and CUDA graphs.
+    Each expert computes a fixed buffer of `capacity` slots (see `smoe.modules.static_moe`),
+    assignments over capacity are dropped and `num_dropped_tokens` stays on device.
+    With `capacity_factor=None` no token is dropped and the outputs equal `UniversalCalculator`,
+    but every expert computes a slot for each token.
+    """
+
+    def __init__(
+        self,
+        experts: LinearGLUExperts,
+        multiply_gate_scores=True,
+        score_scale_factor=1.0,
+        capacity_factor=1.25,
+        add_weight_norm: bool = False,
+    ):
+        super(StaticCapacityCalculator, self).__init__()
+        self.experts = experts
+        self.multiply_gate_scores = multiply_gate_scores
+        self.score_scale_factor = score_scale_factor
+        self.capacity_factor = capacity_factor
+        self.num_experts = experts.num_experts
+        self.mlp_norm = None
+        if multiply_gate_scores and add_weight_norm:
+            self.mlp_norm = WeightNorm(1, scale=score_scale_factor)
+            self.mlp_norm.reset_parameters()
+
+    def forward(self, x, topK_indices, topK_scores, **kwargs) -> CalculatorOutput:
+        num_tokens, num_selects = topK_indices.shape
+        capacity = compute_expert_capacity(
+            num_tokens, self.num_experts, num_selects, self.capacity_factor
+        )
+        if not self.multiply_gate_scores:
+            weights = torch.ones_like(topK_scores)
+        elif self.mlp_norm is None:
+            weights = topK_scores * self.score_scale_factor
+        else:
+            weights = topK_scores
+        slot_tokens, assignment_slots, num_dropped_tokens = capacity_dispatch(
+            topK_indices, self.num_experts, capacity
+        )
+        y = static_moe_forward(
+            x,
+            weights,
+            slot_tokens,
+            assignment_slots,
+            self.experts,
+            output_norm=self.mlp_norm,
+        )
+        return CalculatorOutput(hidden_states=y, num_dropped_tokens=num_dropped_tokens)
+
+
 class SwitchDropTokenCalculator(BaseCalculator):
     """
     https://arxiv.org/pdf/2101.03961.pdf
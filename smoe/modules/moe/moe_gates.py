@@ -299,7 +299,7 @@ class TopKBalancedNoisyGate(BaseGate):
         top_k_scores = top_k_scores.to(logits.dtype)
 
         """计算importance"""
-        zeros = torch.zeros_like(logits, requires_grad=True, device=logits.device)
+        zeros = torch.zeros_like(logits)  # gradients flow through `src`, a leaf with `requires_grad` breaks `torch.compile` graphs
         scores_filtered = zeros.scatter(dim=1, index=top_k_indices, src=top_k_scores)  # shape(batch_size, num_experts)
         importance = scores_filtered.sum(0)  # shape(num_experts)
 
@@ -321,13 +321,14 @@ class TopKBalancedNoisyGate(BaseGate):
                 prob = torch.where(is_in, prob_if_in, prob_if_out)
                 load = prob.sum(0)
             else:
-                load = (scores_filtered > 0).sum(0)
+                load = (scores_filtered > 0).float().sum(0)
                 if not self.add_noise and not self.warned:
                     warnings.warn('Gradient-trackable implementation for load calculation is only available when "add_noise=True". '
                                   'Training without noise will block the gradient from "load" path and lead to inconsistency in optimization objectives.')
                     self.warned = True
         else:
-            load = (scores_filtered > 0).sum(0)
+            # float32 counts: bf16 is not exact above 256, integer sums after a float scatter fail in inductor cpu codegen
+            load = (scores_filtered > 0).float().sum(0)
 
         """计算balance loss"""
         if self.use_balance:
@@ -371,7 +372,7 @@ class TopKBalancedNoisyGate(BaseGate):
         top_k_scores = self.softmax(top_k_logits) if self.use_softmax else top_k_logits
 
         """计算importance"""
-        zeros = torch.zeros_like(logits, requires_grad=True, device=logits.device)
+        zeros = torch.zeros_like(logits)
         scores_filtered = zeros.scatter(dim=1, index=top_k_indices, src=top_k_scores)  # shape(batch_size, num_experts)
         importance = scores_filtered.sum(0)  # shape(num_experts)
 
@@ -393,13 +394,13 @@ class TopKBalancedNoisyGate(BaseGate):
                 prob = torch.where(is_in, prob_if_in, prob_if_out)
                 load = prob.sum(0)
             else:
-                load = (scores_filtered > 0).sum(0)
+                load = (scores_filtered > 0).float().sum(0)
                 if not self.add_noise and not self.warned:
                     warnings.warn('Gradient-trackable implementation for load calculation is only available when "add_noise=True". '
                                   'Training without noise will block the gradient from "load" path and lead to inconsistency in optimization objectives.')
                     self.warned = True
         else:
-            load = (scores_filtered > 0).sum(0)
+            load = (scores_filtered > 0).float().sum(0)
 
         """计算balance loss"""
         if self.use_balance:
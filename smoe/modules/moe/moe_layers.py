@@ -8,6 +8,7 @@ from transformers.utils import ModelOutput
 
 from .moe_calculators import (
     CalculatorOutput,
+    StaticCapacityCalculator,
     SwitchDropTokenCalculator,
     UniformCalculator,
     UniversalCalculator,
@@ -45,7 +46,10 @@ class BaseMoELayer(nn.Module):
             SwitchBalancedGate,
         ]
         self.calculator: Union[
-            UniformCalculator, UniversalCalculator, SwitchDropTokenCalculator
+            UniformCalculator,
+            UniversalCalculator,
+            StaticCapacityCalculator,
+            SwitchDropTokenCalculator,
         ]
 
     def _create_gate(self, **kwargs):
@@ -123,6 +127,14 @@ class BaseMoELayer(nn.Module):
                 score_scale_factor=kwargs.get("score_scale_factor", 1.0),
                 add_weight_norm=kwargs.get("add_weight_norm", False),
             )
+        elif self.calculator_type == "StaticCapacityCalculator":  # static top K
+            self.calculator = StaticCapacityCalculator(
+                experts,
+                multiply_gate_scores=kwargs.get("multiply_gate_scores", True),
+                score_scale_factor=kwargs.get("score_scale_factor", 1.0),
+                capacity_factor=kwargs.get("capacity_factor", 1.25),
+                add_weight_norm=kwargs.get("add_weight_norm", False),
+            )
         elif self.calculator_type == "SwitchDropTokenCalculator":  # switch calculator
             self.calculator = SwitchDropTokenCalculator(
                 experts,
@@ -8,7 +8,7 @@ from smoe.modules.moe.moe_layers import (
     LinearMoELayer,
     MoEMlpOutput,
 )
-from smoe.modules.moe_residual.residual_blocks import LinearGLU
+from smoe.modules.moe_residual.residual_blocks import FusedResidualGLU, LinearGLU
 
 
 class BaseMoEResidualLayer(nn.Module):
@@ -248,6 +248,33 @@ class LinearGLUMoEResidualLayer(BaseMoEResidualLayer):
         else:
             self.weighting_network = None
 
+        self.fuse_residual = kwargs.get("fuse_residual", True)
+        self._fused_residual = None
+
+    def set_fuse_residual(self, fuse_residual):
+        self.fuse_residual = fuse_residual
+
+    def forward(self, x) -> MoEMlpOutput:
+        if (
+            not self.fuse_residual
+            or self.weighting_network is not None
+            or not FusedResidualGLU.supports(self.residual_block)
+        ):
+            return super().forward(x)
+
+        if (
+            self._fused_residual is None
+            or self._fused_residual.residual_block is not self.residual_block
+        ):
+            self._fused_residual = FusedResidualGLU(self.residual_block)
+
+        # the residual outputs are accumulated into the outputs of the routed experts
+        moe_output = self.moe_layer(x)
+        y = moe_output.hidden_states.reshape(-1, self.moe_layer.output_size)
+        y = self._fused_residual.forward(x.reshape(-1, self.moe_layer.input_size), y)
+        moe_output.hidden_states = y.reshape(moe_output.hidden_states.shape)
+        return moe_output
+
     def from_moe_layer(
         moe_layer,
         num_experts_residual=None,
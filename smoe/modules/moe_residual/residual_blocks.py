@@ -5,6 +5,10 @@ import torch.nn.functional as F
 from torch import nn
 from transformers.activations import ACT2FN
 
+from smoe.modules.moe.moe_calculators import UniformCalculator
+from smoe.modules.moe.moe_experts import LinearGLUExperts
+from smoe.modules.moe.moe_gates import UniformLearnableGate
+
 
 class LinearGLU(nn.Module):
     """
@@ -96,3 +100,148 @@ class LinearGLU(nn.Module):
             self.hidden_act,
             self.bias_gate is not None,
         )
+
+
+class FusedResidualGLU:
+    """
+    Fused forward of the always-on residual block (a `LinearGLUMoELayer` with a `UniformLearnableGate`
+    and a `UniformCalculator`) of `LinearGLUMoEResidualLayer`.
+
+    The linear gate network and the gate / up projections of all residual experts share the input,
+    so they run as one matmul with the weight rows
+        [gate_network (num_experts); weight_gate of all experts (hidden); weight_up of all experts (hidden)]
+    and the weighted down projections are accumulated into the output of the routed experts.
+
+    Without autograd the parameters are turned into views of the fused buffer, so that the weights are
+    not duplicated and the state dict is unchanged. The buffer is rebuilt when the parameters are
+    replaced (e.g. by `.to()` or `load_state_dict(assign=True)`). With autograd the fused weight is
+    concatenated from the parameters at every forward.
+    """
+
+    def __init__(self, residual_block):
+        self.residual_block = residual_block
+        self.weight = None
+        self._ptrs = None
+        self._sizes = {}
+
+    @staticmethod
+    def supports(residual_block) -> bool:
+        calculator = getattr(residual_block, "calculator", None)
+        return (
+            isinstance(calculator, UniformCalculator)
+            and isinstance(calculator.experts, LinearGLUExperts)
+            and isinstance(residual_block.gate, UniformLearnableGate)
+            # params gathered by ZeRO-3 are empty outside of their modules
+            and all(param.dim() > 0 for param in calculator.experts.parameters())
+        )
+
+    def _gate_network_weight(self):
+        gate_network = self.residual_block.gate.gate_network
+        if isinstance(gate_network, nn.Linear) and gate_network.bias is None:
+            return gate_network.weight
+        # MLP gate networks run separately
+        return None
+
+    def _params(self) -> list[nn.Parameter]:
+        """Parameters in the row order of the fused weight."""
+        experts = self.residual_block.calculator.experts
+        gate_network_weight = self._gate_network_weight()
+        head = [] if gate_network_weight is None else [gate_network_weight]
+        return head + list(experts.weight_gate) + list(experts.weight_up)
+
+    def _concat_weight(self) -> torch.Tensor:
+        return torch.cat(self._params(), dim=0)
+
+    @torch.no_grad()
+    def _fuse_params(self) -> torch.Tensor:
+        params = self._params()
+        weight = torch.cat(params, dim=0)
+        start = 0
+        for param in params:
+            end = start + param.shape[0]
+            param.data = weight[start:end]
+            start = end
+        self._ptrs = [param.data_ptr() for param in params]
+        return weight
+
+    def _fused_weight(self) -> torch.Tensor:
+        if torch.is_grad_enabled() and any(
+            param.requires_grad for param in self._params()
+        ):
+            return self._concat_weight()
+        if self.weight is None or self._ptrs != [
+            param.data_ptr() for param in self._params()
+        ]:
+            self.weight = self._fuse_params()
+        return self.weight
+
+    def _bias(self, weight) -> torch.Tensor | None:
+        experts = self.residual_block.calculator.experts
+        if experts.bias_gate is None:
+            return None
+        head = []
+        if self._gate_network_weight() is not None:
+            head = [weight.new_zeros(experts.num_experts)]
+        return torch.cat(head + list(experts.bias_gate) + list(experts.bias_up))
+
+    def _repeats(self, device) -> torch.Tensor:
+        """Expert size of every expert, to expand the expert scores to the hidden neurons."""
+        if device not in self._sizes:
+            self._sizes[device] = torch.tensor(
+                self.residual_block.calculator.experts.size_experts, device=device
+            )
+        return self._sizes[device]
+
+    def forward(self, x: torch.Tensor, out: torch.Tensor) -> torch.Tensor:
+        """
+        Adds the residual block outputs of `x` (num_tokens, input_size) to `out` (num_tokens, output_size),
+        in place when autograd is disabled.
+        """
+        gate = self.residual_block.gate
+        calculator = self.residual_block.calculator
+        experts = calculator.experts
+        num_experts = experts.num_experts
+        hidden_features = experts.hidden_features
+
+        weight = self._fused_weight()
+        projected = F.linear(x, weight, self._bias(weight))
+        if self._gate_network_weight() is not None:
+            logits, projected = projected.split(
+                [num_experts, 2 * hidden_features], dim=-1
+            )
+        else:
+            logits = gate.gate_network(x)
+        hidden_gate, hidden_up = projected.split(hidden_features, dim=-1)
+        hidden = experts.act_fn(hidden_gate) * hidden_up
+
+        coefficients = None
+        if calculator.multiply_gate_scores:
+            scores = gate.softmax(logits) if gate.use_softmax else logits
+            coefficients = scores * calculator.score_scale_factor
+            # weighting the hidden neurons weights the down projections without bias
+            hidden = hidden * coefficients.repeat_interleave(
+                self._repeats(x.device), dim=1, output_size=hidden_features
+            )
+
+        in_place = not torch.is_grad_enabled()
+        start = 0
+        for i in range(num_experts):
+            end = start + experts.size_experts[i]
+            weight_down = experts.weight_down[i].t()
+            if in_place:
+                out.addmm_(hidden[:, start:end], weight_down)
+            else:
+                out = torch.addmm(out, hidden[:, start:end], weight_down)
+            start = end
+
+        if experts.bias_down is not None:
+            bias_down = torch.stack(list(experts.bias_down))
+            if coefficients is not None:
+                out = (
+                    out.addmm_(coefficients, bias_down)
+                    if in_place
+                    else torch.addmm(out, coefficients, bias_down)
+                )
+            else:
+                out = out.add_(bias_down.sum(0)) if in_place else out + bias_down.sum(0)
+        return out
@@ -0,0 +1,61 @@
+"""
+Rotary cos/sin tables shared across layers and attention experts.
+
+Tables are computed once per (rotary config, device, dtype) in fp32, cast to the
+requested dtype, and grown geometrically, so every layer indexes the same tensors
+by `position_ids` instead of keeping (and rebuilding) its own cache.
+"""
+
+import torch
+
+# {(dim, base, max_position_embeddings, device, dtype): (cos, sin)}
+_ROTARY_TABLES: dict[tuple, tuple[torch.Tensor, torch.Tensor]] = {}
+
+
+def compute_rotary_table(
+    dim: int,
+    seq_len: int,
+    base: float = 10000,
+    device: torch.device = None,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """fp32 cos/sin of positions `[0, seq_len)`, both of shape (seq_len, dim)."""
+    inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2, device=device).float() / dim))
+    t = torch.arange(seq_len, device=device, dtype=inv_freq.dtype)
+
+    freqs = torch.outer(t, inv_freq)
+    # Different from paper, but it uses a different permutation in order to obtain the same calculation
+    emb = torch.cat((freqs, freqs), dim=-1)
+    return emb.cos(), emb.sin()
+
+
+def get_rotary_table(
+    dim: int,
+    seq_len: int,
+    device: torch.device,
+    dtype: torch.dtype,
+    base: float = 10000,
+    max_position_embeddings: int = 2048,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Shared cos/sin tables covering at least `seq_len` positions (and `max_position_embeddings`).
+    Index them with `position_ids` directly, no host sync is needed.
+
+    Tables grow to twice their length when a longer `seq_len` comes.
+    """
+    key = (dim, base, max_position_embeddings, torch.device(device), dtype)
+    table = _ROTARY_TABLES.get(key)
+    if table is not None and table[0].shape[0] >= seq_len:
+        return table
+
+    if table is None:
+        length = max(seq_len, max_position_embeddings)
+    else:
+        length = max(seq_len, 2 * table[0].shape[0])
+    cos, sin = compute_rotary_table(dim, length, base=base, device=device)
+    table = (cos.to(dtype), sin.to(dtype))
+    _ROTARY_TABLES[key] = table
+    return table
+
+
+def clear_rotary_tables():
+    _ROTARY_TABLES.clear()
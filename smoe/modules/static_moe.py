@@ -0,0 +1,143 @@
+"""
+Static-shape (capacity-padded) MoE execution.
+
+Every expert gets a fixed buffer of `capacity` token slots, so all shapes only depend on
+the number of tokens and the MoE config, not on the routing decisions.
+Empty slots point at a zero padding row and have a zero routing weight,
+assignments over capacity are dropped and counted on device.
+There is no `.tolist()`, no host-sized `torch.split` and no empty-expert skipping,
+so a MoE layer compiles into a single graph and can be captured by CUDA graphs.
+"""
+
+import math
+from typing import Callable, Optional
+
+import torch
+import torch.nn.functional as F
+
+
+def compute_expert_capacity(
+    num_tokens: int,
+    num_experts: int,
+    top_k: int,
+    capacity_factor: Optional[float] = 1.25,
+) -> int:
+    """
+    Number of token slots of each expert.
+
+    Args:
+        capacity_factor: slots per expert relative to the balanced load `num_tokens * top_k / num_experts`.
+            `None` (or <= 0) gives every expert room for all tokens, so no token is dropped,
+            at `num_experts / top_k` times the FLOPs of the routed tokens.
+    """
+    if capacity_factor is None or capacity_factor <= 0:
+        return num_tokens
+    capacity = math.ceil(capacity_factor * num_tokens * top_k / num_experts)
+    return max(1, min(capacity, num_tokens))
+
+
+def capacity_dispatch(
+    selected_experts: torch.Tensor,
+    num_experts: int,
+    capacity: int,
+    token_mask: Optional[torch.Tensor] = None,
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Assign (token, expert) pairs to fixed expert slots.
+    The k-th choices of all tokens are placed before the (k+1)-th choices, in token order.
+    Only sorts and gathers are used (no scatter), which compilers parallelize well.
+
+    Args:
+        selected_experts: (num_tokens, top_k)
+        token_mask: (num_tokens,) or (bsz, seq_len), padding tokens take no slot and are not counted as dropped
+
+    Returns:
+        slot_tokens: (num_experts, capacity) token index of each slot, `num_tokens` for empty slots
+        assignment_slots: (num_tokens, top_k) flat slot index of each assignment,
+            `num_experts * capacity` for dropped and padding assignments
+        num_dropped_tokens: device scalar, the number of assignments over capacity
+    """
+    num_tokens, top_k = selected_experts.shape
+    device = selected_experts.device
+
+    flat_experts = selected_experts.t().reshape(-1)
+    one_hot = F.one_hot(flat_experts, num_classes=num_experts)
+    if token_mask is not None:
+        valid = token_mask.reshape(-1).bool().repeat(top_k)
+        one_hot = one_hot * valid.unsqueeze(1)
+    cum_counts = one_hot.cumsum(0)
+    # position of each assignment inside its expert buffer
+    position = cum_counts.gather(1, flat_experts.unsqueeze(1)).squeeze(1) - 1
+    keep = position < capacity
+    if token_mask is not None:
+        num_dropped_tokens = (valid & ~keep).sum()
+        keep = keep & valid
+    else:
+        num_dropped_tokens = (~keep).sum()
+    assignment_slots = torch.where(
+        keep, flat_experts * capacity + position, num_experts * capacity
+    )
+
+    # slot (e, c) holds the c-th assignment of expert e in priority order
+    sort_keys = (
+        flat_experts
+        if token_mask is None
+        else flat_experts.masked_fill(~valid, num_experts)
+    )
+    order = torch.sort(sort_keys, stable=True).indices
+    counts = cum_counts[-1]
+    starts = counts.cumsum(0) - counts
+    slot_ids = torch.arange(capacity, device=device)
+    sources = (starts.unsqueeze(1) + slot_ids).clamp(max=order.shape[0] - 1)
+    slot_tokens = torch.where(
+        slot_ids < counts.unsqueeze(1),
+        order[sources] % num_tokens,
+        num_tokens,
+    )
+    return (
+        slot_tokens,
+        assignment_slots.view(top_k, num_tokens).t(),
+        num_dropped_tokens,
+    )
+
+
+def static_moe_forward(
+    hidden_states: torch.Tensor,
+    routing_weights: torch.Tensor,
+    slot_tokens: torch.Tensor,
+    assignment_slots: torch.Tensor,
+    expert_fn: Callable[[torch.Tensor, int], torch.Tensor],
+    output_norm: Optional[Callable[[torch.Tensor], torch.Tensor]] = None,
+) -> torch.Tensor:
+    """
+    Run every expert on its full slot buffer and combine the weighted outputs.
+
+    Args:
+        hidden_states: (num_tokens, in_features)
+        routing_weights: (num_tokens, top_k)
+        slot_tokens, assignment_slots: from `capacity_dispatch`
+        expert_fn: `expert_fn(x, expert_idx)` maps (capacity, in_features) to (capacity, out_features)
+        output_norm: applied on the weighted expert outputs before summing over top_k
+
+    Returns:
+        (num_tokens, out_features)
+    """
+    num_tokens, top_k = assignment_slots.shape
+    num_experts = slot_tokens.shape[0]
+    # the last row is the zero input of empty slots
+    padded = F.pad(hidden_states, (0, 0, 0, 1))
+    expert_outputs = torch.cat(
+        [
+            expert_fn(padded[slot_tokens[expert_idx]], expert_idx)
+            for expert_idx in range(num_experts)
+        ],
+        0,
+    )
+    # the last row is the zero output of dropped assignments
+    expert_outputs = F.pad(expert_outputs, (0, 0, 0, 1))
+
+    outputs = expert_outputs[assignment_slots.reshape(-1)].view(num_tokens, top_k, -1)
+    outputs = outputs * routing_weights.unsqueeze(-1).to(outputs.dtype)
+    if output_norm is not None:
+        outputs = output_norm(outputs)
+    return outputs.sum(1)
@@ -1,3 +1,4 @@
+import inspect
 import math
 import os
 import re
@@ -28,7 +29,12 @@ from torch.utils.data import DataLoader
 from transformers.debug_utils import DebugOption, DebugUnderflowOverflow
 from transformers.deepspeed import deepspeed_init
 from transformers.pytorch_utils import ALL_LAYERNORM_LAYERS
-from transformers.trainer import OPTIMIZER_NAME, TRAINER_STATE_NAME, Trainer
+from transformers.trainer import (
+    OPTIMIZER_NAME,
+    TRAINER_STATE_NAME,
+    TRAINING_ARGS_NAME,
+    Trainer,
+)
 from transformers.trainer_callback import TrainerState
 from transformers.trainer_pt_utils import get_model_param_count, get_parameter_names
 from transformers.trainer_utils import (
@@ -49,11 +55,24 @@ from transformers.utils import (
 )
 
 from smoe.data.dynamic_selection import (
-    LLAMA2_7B_SLIMPAJAMA_VAL_REF_LOSS,
-    update_weight_sheared_llama,
-    update_weight_sheared_llama_paper,
+    DomainProbeSet,
+    DomainReweightingEngine,
+    load_reference_loss,
+)
+from smoe.utils.async_checkpoint import (
+    AsyncShardedCheckpointWriter,
+    is_sharded_checkpoint,
+    load_sharded_checkpoint,
 )
 from smoe.utils.config import EnhancedTrainingArguments
+from smoe.utils.telemetry import (
+    ROUTING_STATS_KEYS,
+    DomainTokenCounter,
+    RoutingStatsAccumulator,
+    TelemetryEventWriter,
+    stats_to_logs,
+)
+from smoe.utils.vars import TELEMETRY_EVENTS_NAME
 
 if is_apex_available():
     from apex import amp
@@ -132,8 +151,13 @@ def _get_cosine_schedule_with_warmup_lr_lambda(
 class EnhancedTrainerState(TrainerState):
     # last Token/GPU/second timestamp
     start_timestamp: float = 0.0
+    # non-padding tokens of all ranks, per domain and in total
     consumed_tokens: dict = field(default_factory=dict)
     tot_consumed_tokens: int = 0
+    # tot_consumed_tokens at start_timestamp
+    start_consumed_tokens: int = 0
+    # state of the domain reweighting engine in dynamic data selection
+    domain_reweighting: dict = field(default_factory=dict)
 
 
 class LlamaLrSchedulingTrainer(Trainer):
@@ -145,6 +169,99 @@ class LlamaLrSchedulingTrainer(Trainer):
             is_local_process_zero=self.is_local_process_zero(),
             is_world_process_zero=self.is_world_process_zero(),
         )
+        self.async_ckpt_writer = None
+        if getattr(self.args, "async_checkpoint", False):
+            self.async_ckpt_writer = AsyncShardedCheckpointWriter()
+        # routing stats are accumulated on device and copied back once per logging interval
+        self.routing_telemetry = RoutingStatsAccumulator()
+        self.telemetry_writer = None
+        self._last_logged_prob_map = None
+        # real (non-padding) tokens per domain, reduced across ranks at logging & saving steps
+        self.token_counter = DomainTokenCounter(
+            list(getattr(self.train_dataset, "source2idx", {}))
+        )
+
+        self.domain_reweighting = None
+        self.domain_probes = None
+        self._return_loss_per_sample = False
+        self._last_reweighting_step = -1
+        if (
+            isinstance(self.args.dynamic_data_selection, str)
+            and self.args.dynamic_data_selection != "none"
+            and hasattr(self.train_dataset, "source2idx")
+        ):
+            self.domain_reweighting = DomainReweightingEngine(
+                list(self.train_dataset.source2idx),
+                self.train_dataset.prob_map,
+                load_reference_loss(self.args.reference_loss_file),
+                method=self.args.dynamic_data_selection,
+                probe_interval=self.args.dynamic_data_selection_probe_interval,
+            )
+            # per-sample losses are taken from the training forward if the model supports it
+            self._return_loss_per_sample = (
+                "return_loss_per_sample"
+                in inspect.signature(self.model.forward).parameters
+            )
+            if (
+                not self._return_loss_per_sample
+                and getattr(self.model.config, "lm_loss_chunk_size", 0) > 0
+            ):
+                raise ValueError(
+                    "Dynamic data selection needs the per-sample losses of the training batches, "
+                    "which are not available from the chunked lm loss (`lm_loss_chunk_size > 0`) "
+                    f"of {type(self.model).__name__}, please set `lm_loss_chunk_size=0`."
+                )
+            if (
+                isinstance(self.eval_dataset, dict)
+                and self.args.dynamic_data_selection_probe_blocks > 0
+                and self.args.dynamic_data_selection_probe_interval > 0
+            ):
+                self.domain_probes = DomainProbeSet(
+                    self.eval_dataset,
+                    num_blocks=self.args.dynamic_data_selection_probe_blocks,
+                    seed=self.args.seed,
+                )
+
+    def save_model(self, output_dir: str = None, _internal_call: bool = False):
+        # checkpoints during training are written by every rank in the background,
+        # final/explicit saves and deepspeed checkpoints keep the default behaviour.
+        if (
+            self.async_ckpt_writer is None
+            or not _internal_call
+            or self.is_deepspeed_enabled
+        ):
+            return super().save_model(output_dir, _internal_call=_internal_call)
+
+        output_dir = output_dir if output_dir is not None else self.args.output_dir
+        self.async_ckpt_writer.save(
+            self.model, output_dir, metadata={"global_step": self.state.global_step}
+        )
+        if self.args.should_save:
+            self.model.config.save_pretrained(output_dir)
+            if self.tokenizer is not None:
+                self.tokenizer.save_pretrained(output_dir)
+            torch.save(self.args, os.path.join(output_dir, TRAINING_ARGS_NAME))
+
+    def _load_from_checkpoint(self, resume_from_checkpoint, model=None):
+        if is_sharded_checkpoint(resume_from_checkpoint):
+            logger.info(
+                f"Loading async sharded checkpoint from {resume_from_checkpoint}"
+            )
+            load_sharded_checkpoint(
+                model if model is not None else self.model, resume_from_checkpoint
+            )
+            return
+        super()._load_from_checkpoint(resume_from_checkpoint, model=model)
+
+    def _load_best_model(self):
+        if is_sharded_checkpoint(self.state.best_model_checkpoint):
+            logger.info(
+                f"Loading best model from async sharded checkpoint {self.state.best_model_checkpoint}"
+                f" (score: {self.state.best_metric})."
+            )
+            load_sharded_checkpoint(self.model, self.state.best_model_checkpoint)
+            return
+        super()._load_best_model()
 
     def create_optimizer(self):
         """
@@ -286,6 +403,84 @@ class LlamaLrSchedulingTrainer(Trainer):
         # zhutong: return outputs
         return loss.detach() / self.args.gradient_accumulation_steps, outputs
 
+    def _set_signature_columns_if_needed(self):
+        super()._set_signature_columns_if_needed()
+        # keep `domain_id` when unused columns are removed, it is popped in `compute_loss`
+        if "domain_id" not in self._signature_columns:
+            self._signature_columns.append("domain_id")
+
+    def compute_loss(self, model, inputs, return_outputs=False):
+        # `domain_id` is added by `SubDirWeightedPackedJsonlDataset` and is not a model input
+        domain_ids = inputs.pop("domain_id", None)
+        observe = (
+            domain_ids is not None
+            and self.domain_reweighting is not None
+            and model.training
+        )
+        if observe and self._return_loss_per_sample:
+            inputs["return_loss_per_sample"] = True
+        loss, outputs = super().compute_loss(model, inputs, return_outputs=True)
+        if observe:
+            self.domain_reweighting.observe(
+                domain_ids,
+                labels=inputs.get("labels"),
+                loss_per_sample=getattr(outputs, "loss_per_sample", None),
+                logits=getattr(outputs, "logits", None),
+                loss=loss,
+            )
+        return (loss, outputs) if return_outputs else loss
+
+    def _reweight_domains(self, model):
+        if self.domain_probes is not None and self.domain_reweighting.should_probe():
+            model.eval()
+            with self.compute_loss_context_manager():
+                probe_losses = self.domain_probes.evaluate(
+                    model,
+                    batch_size=self.args.per_device_eval_batch_size,
+                    device=self.args.device,
+                )
+            model.train()
+            self.domain_reweighting.set_probe_losses(probe_losses)
+        new_prob_map = self.domain_reweighting.step()
+        self.train_dataset.update_existed_prob_map(new_prob_map)
+        self.state.domain_reweighting = self.domain_reweighting.state_dict()
+        self._last_reweighting_step = self.state.global_step
+        logger.info(
+            f"Domain reweighting at step {self.state.global_step}, "
+            f"loss estimates: {self.domain_reweighting.estimate_losses()}, "
+            f"prob_map: {new_prob_map}"
+        )
+
+    def _log_routing_telemetry(self, logs: dict, blocking: bool = False):
+        """Launch host copies of this interval's routing stats and add the finished ones to `logs`.
+
+        On GPUs the copies of the current interval usually finish after this call returns,
+        so the routing stats in `logs` may lag one logging interval behind.
+        The event file always records the step each interval ended at.
+        """
+        self.routing_telemetry.flush(self.state.global_step)
+        for step, stats in self.routing_telemetry.collect(blocking=blocking):
+            logs.update(stats_to_logs(stats))
+            if self.args.save_telemetry_events and self.args.should_save:
+                if self.telemetry_writer is None:
+                    self.telemetry_writer = TelemetryEventWriter(
+                        os.path.join(self.args.output_dir, TELEMETRY_EVENTS_NAME)
+                    )
+                self.telemetry_writer.write(step, stats)
+        if self.telemetry_writer is not None:
+            self.telemetry_writer.flush()
+
+    def _update_consumed_tokens(self):
+        """Add the tokens counted on all ranks since the last call to the state, called by all ranks."""
+        counts = self.token_counter.reduce(
+            partial(self.accelerator.reduce, reduction="sum"), device=self.args.device
+        )
+        for domain, num_tokens in counts.items():
+            self.state.consumed_tokens[domain] = (
+                self.state.consumed_tokens.get(domain, 0) + num_tokens
+            )
+        self.state.tot_consumed_tokens += sum(counts.values())
+
     def _maybe_log_save_evaluate(
         self,
         tr_loss,
@@ -293,11 +488,11 @@ class LlamaLrSchedulingTrainer(Trainer):
         trial,
         epoch,
         ignore_keys_for_eval,
-        balance_loss: torch.FloatTensor = None,
-        num_dropped_tokens: tuple[int] = None,
-        gate_load: tuple[torch.FloatTensor] = None,
-        gate_importance: tuple[torch.FloatTensor] = None,
     ):
+        if self.control.should_log or self.control.should_save:
+            # saved states must include the tokens since the last logging step
+            self._update_consumed_tokens()
+
         if self.control.should_log:
             if is_torch_tpu_available():
                 xm.mark_step()
@@ -316,14 +511,14 @@ class LlamaLrSchedulingTrainer(Trainer):
                 4,
             )
             logs["learning_rate"] = self._get_learning_rate()
-            logs["num_dropped_tokens"] = [x.item() for x in num_dropped_tokens]
-            logs["gate_load"] = [x.detach().cpu().tolist() for x in gate_load]
-            logs["gate_importance"] = [
-                x.detach().cpu().tolist() for x in gate_importance
-            ]
-            logs["balance_loss"] = balance_loss.item()
+            self._log_routing_telemetry(logs)
             logs["tot_consumed_tokens"] = self.state.tot_consumed_tokens
-            logs["prob_map"] = self.train_dataset.prob_map
+            logs["consumed_tokens"] = dict(self.state.consumed_tokens)
+            # prob_map is only logged when it changes
+            prob_map = getattr(self.train_dataset, "prob_map", None)
+            if prob_map is not None and prob_map != self._last_logged_prob_map:
+                logs["prob_map"] = dict(prob_map)
+                self._last_logged_prob_map = dict(prob_map)
 
             self._total_loss_scalar += tr_loss_scalar
             self._globalstep_last_logged = self.state.global_step
@@ -355,32 +550,18 @@ class LlamaLrSchedulingTrainer(Trainer):
                     metric_to_check = f"eval_{metric_to_check}"
                 self.lr_scheduler.step(metrics[metric_to_check])
 
-            if (
-                isinstance(self.args.dynamic_data_selection, str)
-                and self.args.dynamic_data_selection != "none"
-                and metrics is not None
-                and self.train_dataset is not None
-            ):
-                curr_loss_map = {}
-                for key, value in metrics.items():
-                    sobj = re.search(r"eval_(.*?)_loss", key)
-                    if sobj:
-                        dataset_name = sobj.group(1)
-                        curr_loss_map[dataset_name] = value
-                new_prob_map = self.train_dataset.prob_map
-                if self.args.dynamic_data_selection == "sheared_llama_paper":
-                    new_prob_map = update_weight_sheared_llama_paper(
-                        self.train_dataset.prob_map,
-                        LLAMA2_7B_SLIMPAJAMA_VAL_REF_LOSS,
-                        curr_loss_map,
-                    )
-                elif self.args.dynamic_data_selection == "sheared_llama":
-                    new_prob_map = update_weight_sheared_llama(
-                        self.train_dataset.prob_map,
-                        LLAMA2_7B_SLIMPAJAMA_VAL_REF_LOSS,
-                        curr_loss_map,
-                    )
-                self.train_dataset.update_existed_prob_map(new_prob_map)
+        if (
+            self.domain_reweighting is not None
+            and self._last_reweighting_step != self.state.global_step
+        ):
+            if self.args.dynamic_data_selection_steps > 0:
+                should_reweight = (
+                    self.state.global_step % self.args.dynamic_data_selection_steps == 0
+                )
+            else:
+                should_reweight = self.control.should_evaluate
+            if should_reweight:
+                self._reweight_domains(model)
 
         if self.control.should_save:
             self._save_checkpoint(model, trial, metrics=metrics)
@@ -451,14 +632,6 @@ class LlamaLrSchedulingTrainer(Trainer):
         train_dataset = self.train_dataset
         data_collator = self.data_collator
 
-        # # zhutong: update consumed_tokens
-        # state_ctokens = sum(self.state.consumed_tokens.values())
-        # dataset_ctokens = sum(train_dataset.consumed_tokens.values())
-        # if state_ctokens > dataset_ctokens:
-        #     train_dataset.skip_tokens(state_ctokens)
-        # # bind dataset recordings to state
-        # self.state.consumed_tokens = train_dataset.consumed_tokens
-
         if is_datasets_available() and isinstance(train_dataset, datasets.Dataset):
             train_dataset = self._remove_unused_columns(
                 train_dataset, description="training"
@@ -705,6 +878,11 @@ class LlamaLrSchedulingTrainer(Trainer):
             self.state = EnhancedTrainerState.load_from_json(
                 os.path.join(resume_from_checkpoint, TRAINER_STATE_NAME)
             )
+            if self.domain_reweighting is not None and self.state.domain_reweighting:
+                self.domain_reweighting.load_state_dict(self.state.domain_reweighting)
+                self.train_dataset.update_existed_prob_map(
+                    self.domain_reweighting.prob_map
+                )
             epochs_trained = self.state.global_step // num_update_steps_per_epoch
             if not args.ignore_data_skip:
                 steps_trained_in_current_epoch = self.state.global_step % (
@@ -771,6 +949,7 @@ class LlamaLrSchedulingTrainer(Trainer):
                     break
 
         self.state.start_timestamp = time.time()
+        self.state.start_consumed_tokens = self.state.tot_consumed_tokens
         total_batched_samples = 0
         for epoch in range(epochs_trained, num_train_epochs):
             epoch_iterator = train_dataloader
@@ -841,6 +1020,12 @@ class LlamaLrSchedulingTrainer(Trainer):
                         args, self.state, self.control
                     )
 
+                if "input_ids" in inputs:
+                    self.token_counter.update(
+                        inputs["input_ids"],
+                        attention_mask=inputs.get("attention_mask"),
+                        domain_ids=inputs.get("domain_id"),
+                    )
                 with self.accelerator.accumulate(model):
                     tr_loss_step, model_training_outputs = self.training_step(
                         model, inputs
@@ -858,6 +1043,12 @@ class LlamaLrSchedulingTrainer(Trainer):
                 else:
                     tr_loss += tr_loss_step
 
+                self.routing_telemetry.update(
+                    **{
+                        key: getattr(model_training_outputs, key, None)
+                        for key in ROUTING_STATS_KEYS
+                    }
+                )
                 self.current_flos += float(self.floating_point_ops(inputs))
 
                 is_last_step_and_steps_less_than_grad_acc = (
@@ -949,8 +1140,6 @@ class LlamaLrSchedulingTrainer(Trainer):
                     model.zero_grad()
                     self.state.global_step += 1
                     # prof.step()
-                    # self.state.consumed_tokens = self.train_dataset.consumed_tokens
-                    self.state.tot_consumed_tokens += self.args.num_tokens_per_batch
                     self.state.epoch = (
                         epoch + (step + 1 + steps_skipped) / steps_in_epoch
                     )
@@ -958,24 +1147,8 @@ class LlamaLrSchedulingTrainer(Trainer):
                         args, self.state, self.control
                     )
 
-                    keys = [
-                        "balance_loss",
-                        "num_dropped_tokens",
-                        "gate_load",
-                        "gate_importance",
-                    ]
-                    _result_dict = {key: None for key in keys}
-                    for key in keys:
-                        if hasattr(model_training_outputs, key):
-                            _result_dict[key] = getattr(model_training_outputs, key)
-
                     self._maybe_log_save_evaluate(
-                        tr_loss,
-                        model,
-                        trial,
-                        epoch,
-                        ignore_keys_for_eval,
-                        **_result_dict,
+                        tr_loss, model, trial, epoch, ignore_keys_for_eval
                     )
                 else:
                     self.control = self.callback_handler.on_substep_end(
@@ -996,15 +1169,7 @@ class LlamaLrSchedulingTrainer(Trainer):
                 args, self.state, self.control
             )
             self._maybe_log_save_evaluate(
-                tr_loss,
-                model,
-                trial,
-                epoch,
-                ignore_keys_for_eval,
-                balance_loss=None,
-                num_dropped_tokens=None,
-                gate_load=None,
-                gate_importance=None,
+                tr_loss, model, trial, epoch, ignore_keys_for_eval
             )
 
             if DebugOption.TPU_METRICS_DEBUG in self.args.debug:
@@ -1023,6 +1188,18 @@ class LlamaLrSchedulingTrainer(Trainer):
             # Clean the state at the end of training
             delattr(self, "_past")
 
+        if self.async_ckpt_writer is not None:
+            # the last checkpoint must be committed before loading the best model
+            self.async_ckpt_writer.wait()
+
+        # tokens after the last logging step
+        self._update_consumed_tokens()
+        # write out routing stats of the last (possibly partial) logging intervals
+        self._log_routing_telemetry({}, blocking=True)
+        if self.telemetry_writer is not None:
+            self.telemetry_writer.close()
+            self.telemetry_writer = None
+
         logger.info(
             "\n\nTraining completed. Do not forget to share your model on huggingface.co/models =)\n\n"
         )
@@ -0,0 +1,565 @@
+"""
+Asynchronous, sharded model checkpointing.
+
+Every rank copies the tensors it is responsible for into reusable (pinned) host buffers,
+and a background thread writes them into a per-rank safetensors shard. Once all ranks
+have finished, rank 0 commits a manifest atomically, so a checkpoint directory either has
+a complete manifest or is treated as unfinished. Shards can be loaded back directly
+(`load_sharded_checkpoint`) or merged into a HF-format checkpoint offline
+(`merge_sharded_checkpoint`, or `python -m smoe.utils.async_checkpoint`).
+
+Ownership of tensors:
+    - FSDP `SHARDED_STATE_DICT` tensors (`ShardedTensor` / `DTensor`) are written by the
+      rank holding the local shard, together with their offsets in the global tensor.
+    - Plain (replicated) tensors are assigned to ranks greedily by size, so no gathering
+      is needed and the write volume is spread over all ranks.
+"""
+
+import argparse
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from pathlib import Path
+
+import torch
+import torch.distributed as dist
+from safetensors import safe_open
+from safetensors.torch import save_file
+from torch import nn
+from transformers.modeling_utils import dtype_byte_size
+from transformers.utils.hub import convert_file_size_to_int
+
+from smoe.utils.io import dump_json, load_json
+from smoe.utils.logging import get_logger
+from smoe.utils.random_utils import get_random_string
+from smoe.utils.vars import (
+    ASYNC_CKPT_MANIFEST_NAME,
+    ASYNC_CKPT_RANK_META_NAME,
+    ASYNC_CKPT_SHARD_NAME,
+)
+
+logger = get_logger(__file__)
+
+
+def _get_rank_and_world_size() -> tuple[int, int]:
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+
+
+def _is_fsdp_model(model: nn.Module) -> bool:
+    try:
+        from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+    except ImportError:
+        return False
+    return isinstance(model, FSDP)
+
+
+def _dtype_from_str(dtype: str) -> torch.dtype:
+    # "torch.bfloat16" -> torch.bfloat16
+    return getattr(torch, dtype.split(".")[-1])
+
+
+def _atomic_dump_json(obj, filepath):
+    tmp_filepath = f"{filepath}.tmp"
+    dump_json(obj, tmp_filepath, indent=2)
+    os.replace(tmp_filepath, filepath)
+
+
+def assign_tensor_owners(
+    state_dict: dict[str, torch.Tensor], world_size: int
+) -> dict[str, int]:
+    """
+    Greedily assigns each tensor to the least loaded rank, largest tensors first.
+    The assignment only depends on names and shapes, so all ranks agree on it without communication.
+    """
+    loads = [0] * world_size
+    owners = {}
+    ordered = sorted(
+        state_dict.items(),
+        key=lambda item: (-item[1].numel() * item[1].element_size(), item[0]),
+    )
+    for name, tensor in ordered:
+        rank = min(range(world_size), key=lambda r: (loads[r], r))
+        owners[name] = rank
+        loads[rank] += tensor.numel() * tensor.element_size()
+    return owners
+
+
+def get_local_state_dict(
+    model_or_state_dict: nn.Module | dict, rank: int, world_size: int
+) -> dict[str, tuple[torch.Tensor, dict]]:
+    """
+    Returns:
+        key in the shard file -> (local tensor, placement), where placement records the
+        parameter name, the global shape and the offsets of the local tensor.
+    """
+    if isinstance(model_or_state_dict, nn.Module):
+        if _is_fsdp_model(model_or_state_dict):
+            from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+            from torch.distributed.fsdp import StateDictType
+
+            with FSDP.state_dict_type(
+                model_or_state_dict, StateDictType.SHARDED_STATE_DICT
+            ):
+                state_dict = model_or_state_dict.state_dict()
+        else:
+            state_dict = model_or_state_dict.state_dict()
+    else:
+        state_dict = model_or_state_dict
+
+    from torch.distributed._shard.sharded_tensor import ShardedTensor
+    from torch.distributed._tensor import DTensor
+
+    entries = {}
+    replicated = {}
+    for name, tensor in state_dict.items():
+        if isinstance(tensor, ShardedTensor):
+            for i, shard in enumerate(tensor.local_shards()):
+                entries[f"{name}::{i}"] = (
+                    shard.tensor,
+                    {
+                        "name": name,
+                        "global_shape": list(tensor.size()),
+                        "offsets": list(shard.metadata.shard_offsets),
+                    },
+                )
+        elif isinstance(tensor, DTensor):
+            from torch.distributed._tensor._utils import (
+                compute_local_shape_and_global_offset,
+            )
+
+            _, offsets = compute_local_shape_and_global_offset(
+                tensor.shape, tensor.device_mesh, tensor.placements
+            )
+            entries[f"{name}::0"] = (
+                tensor.to_local(),
+                {
+                    "name": name,
+                    "global_shape": list(tensor.shape),
+                    "offsets": list(offsets),
+                },
+            )
+        elif isinstance(tensor, torch.Tensor):
+            replicated[name] = tensor
+
+    owners = assign_tensor_owners(replicated, world_size)
+    for name, tensor in replicated.items():
+        if owners[name] == rank:
+            entries[name] = (
+                tensor,
+                {
+                    "name": name,
+                    "global_shape": list(tensor.shape),
+                    "offsets": [0] * tensor.dim(),
+                },
+            )
+    return entries
+
+
+class AsyncShardedCheckpointWriter:
+    """
+    Writes per-rank safetensors shards from a background thread.
+
+    At most one checkpoint is in flight: `save()` waits for the previous one before
+    reusing the host buffers, and `wait()` blocks until the last checkpoint is committed
+    (re-raising errors from the writer thread).
+
+    Rank meta files carry a `run_id` shared by the writers of all ranks, so rank 0 never
+    commits stale meta files left in a reused directory by an earlier run.
+    It is broadcast from rank 0 if `torch.distributed` is initialized, otherwise
+    it must be given explicitly when `world_size > 1`.
+
+    Example:
+        >>> writer = AsyncShardedCheckpointWriter()
+        >>> writer.save(model, "outputs/checkpoint-100", metadata={"global_step": 100})
+        >>> ...  # training continues
+        >>> writer.wait()
+        >>> merge_sharded_checkpoint("outputs/checkpoint-100")
+    """
+
+    def __init__(
+        self,
+        rank: int = None,
+        world_size: int = None,
+        pin_memory: bool = None,
+        commit_timeout: float = 1800.0,
+        run_id: str = None,
+    ):
+        _rank, _world_size = _get_rank_and_world_size()
+        self.rank = _rank if rank is None else rank
+        self.world_size = _world_size if world_size is None else world_size
+        self.run_id = self._get_run_id() if run_id is None else run_id
+        self.pin_memory = (
+            torch.cuda.is_available() if pin_memory is None else pin_memory
+        )
+        self.commit_timeout = commit_timeout
+
+        self._buffers: dict[str, torch.Tensor] = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="async_ckpt"
+        )
+        self._future = None
+        self._num_saves = 0
+        self._lock = threading.Lock()
+
+    def _get_run_id(self) -> str:
+        if self.world_size == 1:
+            return get_random_string(16)
+        if not (dist.is_available() and dist.is_initialized()):
+            raise ValueError(
+                "`run_id` must be given when `torch.distributed` is not initialized and `world_size > 1`"
+            )
+        run_id = [get_random_string(16) if dist.get_rank() == 0 else None]
+        dist.broadcast_object_list(run_id, src=0)
+        return run_id[0]
+
+    @property
+    def is_saving(self) -> bool:
+        return self._future is not None and not self._future.done()
+
+    def save(
+        self,
+        model_or_state_dict: nn.Module | dict,
+        output_dir: str,
+        metadata: dict = None,
+    ):
+        """Snapshots the tensors to host memory and returns while the shard is being written."""
+        self.wait()
+        os.makedirs(output_dir, exist_ok=True)
+
+        save_id = self._num_saves
+        self._num_saves += 1
+        meta_path = os.path.join(
+            output_dir, ASYNC_CKPT_RANK_META_NAME.format(self.rank, self.world_size)
+        )
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        if self.rank == 0:
+            manifest_path = os.path.join(output_dir, ASYNC_CKPT_MANIFEST_NAME)
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+
+        entries = get_local_state_dict(model_or_state_dict, self.rank, self.world_size)
+        host_tensors, event = self._snapshot(entries)
+        placements = {key: placement for key, (_, placement) in entries.items()}
+
+        self._future = self._executor.submit(
+            self._write,
+            host_tensors,
+            placements,
+            output_dir,
+            event,
+            save_id,
+            metadata or {},
+        )
+
+    def wait(self):
+        if self._future is not None:
+            future, self._future = self._future, None
+            future.result()
+
+    def release_buffers(self):
+        self.wait()
+        self._buffers.clear()
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown(wait=True)
+
+    def _snapshot(self, entries: dict) -> tuple[dict[str, torch.Tensor], object]:
+        host_tensors = {}
+        has_cuda = False
+        with self._lock:
+            for key, (tensor, _) in entries.items():
+                tensor = tensor.detach()
+                buffer = self._buffers.get(key)
+                if (
+                    buffer is None
+                    or buffer.shape != tensor.shape
+                    or buffer.dtype != tensor.dtype
+                ):
+                    buffer = torch.empty(
+                        tensor.shape,
+                        dtype=tensor.dtype,
+                        device="cpu",
+                        pin_memory=self.pin_memory,
+                    )
+                    self._buffers[key] = buffer
+                # device -> pinned host copies are queued on the current stream,
+                # so later optimizer updates cannot overtake them.
+                buffer.copy_(tensor, non_blocking=tensor.is_cuda)
+                has_cuda = has_cuda or tensor.is_cuda
+                host_tensors[key] = buffer
+
+        event = None
+        if has_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        return host_tensors, event
+
+    def _write(
+        self,
+        host_tensors: dict[str, torch.Tensor],
+        placements: dict[str, dict],
+        output_dir: str,
+        event,
+        save_id: int,
+        metadata: dict,
+    ):
+        start = time.time()
+        if event is not None:
+            event.synchronize()
+
+        shard_name = ASYNC_CKPT_SHARD_NAME.format(self.rank, self.world_size)
+        shard_path = os.path.join(output_dir, shard_name)
+        save_file(host_tensors, f"{shard_path}.tmp", metadata={"format": "pt"})
+        os.replace(f"{shard_path}.tmp", shard_path)
+
+        rank_meta = {
+            "rank": self.rank,
+            "world_size": self.world_size,
+            "run_id": self.run_id,
+            "save_id": save_id,
+            "shard_file": shard_name,
+            "tensors": {
+                key: {
+                    **placements[key],
+                    "shape": list(tensor.shape),
+                    "dtype": str(tensor.dtype),
+                }
+                for key, tensor in host_tensors.items()
+            },
+        }
+        _atomic_dump_json(
+            rank_meta,
+            os.path.join(
+                output_dir, ASYNC_CKPT_RANK_META_NAME.format(self.rank, self.world_size)
+            ),
+        )
+        logger.info(
+            f"rank {self.rank}: wrote {shard_name} ({len(host_tensors)} tensors) in {time.time() - start:.2f}s"
+        )
+
+        if self.rank == 0:
+            self._commit(output_dir, save_id, metadata)
+
+    def _commit(self, output_dir: str, save_id: int, metadata: dict):
+        meta_paths = [
+            os.path.join(
+                output_dir, ASYNC_CKPT_RANK_META_NAME.format(r, self.world_size)
+            )
+            for r in range(self.world_size)
+        ]
+        deadline = time.time() + self.commit_timeout
+        rank_metas = [None] * self.world_size
+        while True:
+            for r, path in enumerate(meta_paths):
+                if rank_metas[r] is None and os.path.exists(path):
+                    rank_meta = load_json(path)
+                    # meta files of earlier runs in the same directory are not committed
+                    if (
+                        rank_meta.get("run_id") == self.run_id
+                        and rank_meta["save_id"] == save_id
+                    ):
+                        rank_metas[r] = rank_meta
+            if all(rank_meta is not None for rank_meta in rank_metas):
+                break
+            if time.time() > deadline:
+                missing = [r for r, m in enumerate(rank_metas) if m is None]
+                raise TimeoutError(
+                    f"Ranks {missing} did not finish writing {output_dir} in {self.commit_timeout}s"
+                )
+            time.sleep(0.5)
+
+        tensors = {}
+        for rank_meta in rank_metas:
+            for key, info in rank_meta["tensors"].items():
+                name = info["name"]
+                if name not in tensors:
+                    tensors[name] = {
+                        "dtype": info["dtype"],
+                        "shape": info["global_shape"],
+                        "pieces": [],
+                    }
+                tensors[name]["pieces"].append(
+                    {
+                        "file": rank_meta["shard_file"],
+                        "key": key,
+                        "offsets": info["offsets"],
+                        "shape": info["shape"],
+                    }
+                )
+
+        manifest = {
+            "world_size": self.world_size,
+            "metadata": metadata,
+            "shard_files": [rank_meta["shard_file"] for rank_meta in rank_metas],
+            "tensors": tensors,
+        }
+        _atomic_dump_json(manifest, os.path.join(output_dir, ASYNC_CKPT_MANIFEST_NAME))
+        logger.info(f"Committed async checkpoint: {output_dir}")
+
+
+def is_sharded_checkpoint(checkpoint_dir: str) -> bool:
+    """Whether `checkpoint_dir` holds a committed async sharded checkpoint."""
+    return os.path.isfile(os.path.join(checkpoint_dir, ASYNC_CKPT_MANIFEST_NAME))
+
+
+def _iter_sharded_tensors(checkpoint_dir: str, manifest: dict, names: list[str]):
+    with ExitStack() as stack:
+        handles = {}
+        for name in names:
+            info = manifest["tensors"][name]
+            pieces = info["pieces"]
+            for piece in pieces:
+                if piece["file"] not in handles:
+                    handles[piece["file"]] = stack.enter_context(
+                        safe_open(
+                            os.path.join(checkpoint_dir, piece["file"]),
+                            framework="pt",
+                            device="cpu",
+                        )
+                    )
+
+            if len(pieces) == 1 and pieces[0]["shape"] == info["shape"]:
+                tensor = handles[pieces[0]["file"]].get_tensor(pieces[0]["key"])
+            else:
+                tensor = torch.empty(
+                    info["shape"], dtype=_dtype_from_str(info["dtype"])
+                )
+                for piece in pieces:
+                    index = tuple(
+                        slice(offset, offset + size)
+                        for offset, size in zip(piece["offsets"], piece["shape"])
+                    )
+                    tensor[index] = handles[piece["file"]].get_tensor(piece["key"])
+            yield name, tensor
+
+
+def load_sharded_state_dict(checkpoint_dir: str) -> dict[str, torch.Tensor]:
+    """Reassembles the full (CPU) state dict of a committed async sharded checkpoint."""
+    if not is_sharded_checkpoint(checkpoint_dir):
+        raise FileNotFoundError(
+            f"No committed async checkpoint manifest found in {checkpoint_dir}"
+        )
+    manifest = load_json(os.path.join(checkpoint_dir, ASYNC_CKPT_MANIFEST_NAME))
+    return dict(
+        _iter_sharded_tensors(checkpoint_dir, manifest, list(manifest["tensors"]))
+    )
+
+
+def load_sharded_checkpoint(model: nn.Module, checkpoint_dir: str, strict: bool = True):
+    """Loads an async sharded checkpoint into `model` without merging it into HF format first."""
+    state_dict = load_sharded_state_dict(checkpoint_dir)
+    if _is_fsdp_model(model):
+        from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+        from torch.distributed.fsdp import StateDictType
+
+        with FSDP.state_dict_type(model, StateDictType.FULL_STATE_DICT):
+            return model.load_state_dict(state_dict, strict=strict)
+    return model.load_state_dict(state_dict, strict=strict)
+
+
+def merge_sharded_checkpoint(
+    checkpoint_dir: str,
+    output_dir: str = None,
+    max_shard_size: int | str = "5GB",
+    remove_shards: bool = False,
+):
+    """
+    Merges a committed async sharded checkpoint into HF safetensors files
+    (`model.safetensors` or `model-xxxxx-of-xxxxx.safetensors` + index), reading at most
+    one output file's worth of tensors at a time.
+    """
+    if not is_sharded_checkpoint(checkpoint_dir):
+        raise FileNotFoundError(
+            f"No committed async checkpoint manifest found in {checkpoint_dir}"
+        )
+    output_dir = checkpoint_dir if output_dir is None else output_dir
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_json(os.path.join(checkpoint_dir, ASYNC_CKPT_MANIFEST_NAME))
+    max_shard_size = convert_file_size_to_int(max_shard_size)
+
+    # split in the same greedy order as `PreTrainedModel.save_pretrained`
+    groups = [[]]
+    group_size = 0
+    total_size = 0
+    for name, info in manifest["tensors"].items():
+        numel = 1
+        for dim in info["shape"]:
+            numel *= dim
+        size = numel * dtype_byte_size(_dtype_from_str(info["dtype"]))
+        if group_size + size > max_shard_size and len(groups[-1]) > 0:
+            groups.append([])
+            group_size = 0
+        groups[-1].append(name)
+        group_size += size
+        total_size += size
+
+    weight_map = {}
+    for i, names in enumerate(groups, 1):
+        if len(groups) == 1:
+            filename = "model.safetensors"
+        else:
+            filename = f"model-{i:05d}-of-{len(groups):05d}.safetensors"
+        tensors = {
+            name: tensor.contiguous()
+            for name, tensor in _iter_sharded_tensors(checkpoint_dir, manifest, names)
+        }
+        save_file(
+            tensors, os.path.join(output_dir, filename), metadata={"format": "pt"}
+        )
+        weight_map.update({name: filename for name in names})
+        logger.info(f"Merged {len(names)} tensors into {filename}")
+        del tensors
+
+    if len(groups) > 1:
+        index = {"metadata": {"total_size": total_size}, "weight_map": weight_map}
+        dump_json(
+            index, os.path.join(output_dir, "model.safetensors.index.json"), indent=2
+        )
+
+    # config, tokenizer and trainer files live next to the shards
+    shard_files = set(manifest["shard_files"])
+    if os.path.realpath(output_dir) != os.path.realpath(checkpoint_dir):
+        for filepath in Path(checkpoint_dir).glob("*"):
+            if (
+                filepath.is_file()
+                and filepath.name not in shard_files
+                and not filepath.name.startswith("model-rank")
+                and filepath.name != ASYNC_CKPT_MANIFEST_NAME
+            ):
+                shutil.copy2(filepath, os.path.join(output_dir, filepath.name))
+
+    if remove_shards:
+        for r, shard_file in enumerate(manifest["shard_files"]):
+            os.remove(os.path.join(checkpoint_dir, shard_file))
+            meta_path = os.path.join(
+                checkpoint_dir,
+                ASYNC_CKPT_RANK_META_NAME.format(r, manifest["world_size"]),
+            )
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+        os.remove(os.path.join(checkpoint_dir, ASYNC_CKPT_MANIFEST_NAME))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Merge an async sharded checkpoint into HF format."
+    )
+    parser.add_argument("--checkpoint_dir", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, default=None)
+    parser.add_argument("--max_shard_size", type=str, default="5GB")
+    parser.add_argument("--remove_shards", action="store_true")
+    args = parser.parse_args()
+
+    merge_sharded_checkpoint(
+        args.checkpoint_dir,
+        output_dir=args.output_dir,
+        max_shard_size=args.max_shard_size,
+        remove_shards=args.remove_shards,
+    )
@@ -0,0 +1,536 @@
+"""
+Layer-wise calibration forward for dense LLaMA and LLaMA-MoE / LLaMA-MoE-v2 models.
+
+Calibration tasks (gate clustering, hidden distributions, score scale factors, alignment) only
+need the activations of one decoder layer at a time. `LayerwiseCalibrator` runs the model up to
+its first decoder layer once per batch, with the mask / position preparation of the model itself,
+and then streams the hidden states of all batches through one decoder layer after another:
+
+    - only the running decoder layer (and the embeddings for the first step) is moved to `device`,
+      so models much larger than the device memory can be calibrated.
+    - hidden states between layers and the other layer inputs (attention masks, position ids) are
+      kept on CPU up to `max_memory_bytes` and spilled to memory-mapped shards beyond that.
+    - `CalibrationCallback`s are called per layer / pass / batch to capture features, collect
+      statistics or modify the layer. A callback may ask to re-run a layer after modifying it,
+      the hidden states are only advanced with the outputs of the last pass.
+
+Usage:
+    distribution = HiddenDistributionCallback(model.config.hidden_size)
+    LayerwiseCalibrator(model, device="cuda").run(batches, [distribution])
+    distribution_info = distribution.gather(accelerator.gather)
+"""
+
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+import torch
+from torch import nn
+
+from smoe.utils.logging import get_logger
+
+logger = get_logger(__file__)
+
+
+class HiddenStateStore:
+    """
+    Hidden states of every batch on CPU, at most `max_memory_bytes` (None for no limit) in memory.
+    Batches beyond the budget are written to one memory-mapped shard each in `spill_dir`,
+    shards are overwritten in place when the shapes do not change.
+    """
+
+    def __init__(self, max_memory_bytes: int = None, spill_dir: str = None):
+        self.max_memory_bytes = max_memory_bytes
+        self.spill_dir = spill_dir
+        self._tmp_dir = None
+        self._in_memory: dict[int, torch.Tensor] = {}
+        # {batch index: (memmap, shape, dtype)}
+        self._spilled: dict[int, tuple[np.memmap, torch.Size, torch.dtype]] = {}
+        self.memory_bytes = 0
+
+    def __len__(self):
+        return len(self._in_memory) + len(self._spilled)
+
+    @property
+    def num_spilled(self) -> int:
+        return len(self._spilled)
+
+    def _shard_path(self, idx: int) -> str:
+        if self.spill_dir is None:
+            self._tmp_dir = tempfile.TemporaryDirectory(
+                prefix="calibration_hidden_states_"
+            )
+            self.spill_dir = self._tmp_dir.name
+        os.makedirs(self.spill_dir, exist_ok=True)
+        return os.path.join(self.spill_dir, f"hidden_states-{idx:05d}.bin")
+
+    def __setitem__(self, idx: int, tensor: torch.Tensor):
+        tensor = tensor.detach().to("cpu")
+        num_bytes = tensor.numel() * tensor.element_size()
+
+        if idx in self._in_memory:
+            old = self._in_memory.pop(idx)
+            self.memory_bytes -= old.numel() * old.element_size()
+        if idx not in self._spilled and (
+            self.max_memory_bytes is None
+            or self.memory_bytes + num_bytes <= self.max_memory_bytes
+        ):
+            self._in_memory[idx] = tensor.clone()
+            self.memory_bytes += num_bytes
+            return
+
+        # numpy has no bfloat16, shards hold the raw bytes
+        data = tensor.contiguous().view(-1).view(torch.uint8).numpy()
+        spilled = self._spilled.get(idx)
+        if spilled is None or spilled[0].shape != data.shape:
+            memmap = np.memmap(
+                self._shard_path(idx), dtype=np.uint8, mode="w+", shape=data.shape
+            )
+        else:
+            memmap = spilled[0]
+        memmap[:] = data
+        self._spilled[idx] = (memmap, tensor.shape, tensor.dtype)
+
+    def __getitem__(self, idx: int) -> torch.Tensor:
+        if idx in self._in_memory:
+            return self._in_memory[idx]
+        memmap, shape, dtype = self._spilled[idx]
+        return torch.from_numpy(np.asarray(memmap)).view(dtype).view(shape)
+
+    def close(self):
+        self._in_memory.clear()
+        self._spilled.clear()
+        self.memory_bytes = 0
+        if self._tmp_dir is not None:
+            self._tmp_dir.cleanup()
+            self._tmp_dir = None
+            self.spill_dir = None
+
+
+def new_distribution(hidden_size: int) -> dict:
+    return {
+        "number": torch.zeros((1,)),
+        "mean": torch.zeros((hidden_size,)),
+        "variance": torch.zeros((hidden_size,)),
+    }
+
+
+def update_distribution(distribution: dict, hidden_states: torch.Tensor):
+    """Merges the (non-padding) `hidden_states` of shape (num_tokens, hidden_size) into the running statistics."""
+    this_num = torch.tensor((hidden_states.shape[0],), device=hidden_states.device)
+    this_mean = hidden_states.mean(dim=0)
+    this_var = hidden_states.var(dim=0)
+
+    old_num = distribution["number"].to(hidden_states.device)
+    old_mean = distribution["mean"].to(hidden_states.device)
+    old_var = distribution["variance"].to(hidden_states.device)
+
+    distribution["number"] = old_num + this_num
+    distribution["mean"] = (old_num * old_mean + this_num * this_mean) / (
+        old_num + this_num
+    )
+    distribution["variance"] = (
+        old_num * old_var
+        + this_num * this_var
+        + old_num * this_num / (old_num + this_num) * (old_mean - this_mean) ** 2
+    ) / (old_num + this_num)
+
+
+def gather_distribution(distribution: dict, gather_fn: Callable = None) -> tuple:
+    """`(number, mean, variance)` over all processes, `gather_fn` is e.g. `accelerator.gather`."""
+    num, mean, var = (
+        distribution["number"],
+        distribution["mean"],
+        distribution["variance"],
+    )
+    if gather_fn is None:
+        return num.sum(), mean, var
+    hidden_size = mean.shape[-1]
+    all_num = gather_fn(num)
+    all_mean = gather_fn(mean).reshape(-1, hidden_size)
+    all_var = gather_fn(var).reshape(-1, hidden_size)
+    final_num = all_num.sum()
+    final_mean = (all_num[:, None] * all_mean).sum(0) / final_num
+    final_var = (all_num[:, None] * (all_var + all_mean**2)).sum(
+        0
+    ) / final_num - final_mean**2
+    return final_num, final_mean, final_var
+
+
+def get_mlp(layer: nn.Module) -> nn.Module:
+    """The MLP (dense or MoE) of a LLaMA / LLaMA-MoE / LLaMA-MoE-v2 decoder layer."""
+    block_sparse_moe = getattr(layer, "block_sparse_moe", None)
+    return layer.mlp if block_sparse_moe is None else block_sparse_moe
+
+
+def output_hidden_states(outputs) -> torch.Tensor:
+    """Hidden states of the outputs of a decoder layer, an attention module or an MLP."""
+    if isinstance(outputs, torch.Tensor):
+        return outputs
+    if hasattr(outputs, "hidden_states"):
+        # `MoEMlpOutput` of LLaMA-MoE
+        return outputs.hidden_states
+    return outputs[0]
+
+
+def _to_device(obj, device):
+    if isinstance(obj, torch.Tensor):
+        return obj.to(device)
+    if isinstance(obj, (tuple, list)):
+        return type(obj)(_to_device(o, device) for o in obj)
+    if isinstance(obj, dict):
+        return {k: _to_device(v, device) for k, v in obj.items()}
+    return obj
+
+
+@dataclass(frozen=True)
+class _StoredTensor:
+    """Placeholder of a layer input tensor kept in a `HiddenStateStore`"""
+
+    idx: int
+
+
+def _store_tensors(obj, store: HiddenStateStore):
+    if isinstance(obj, torch.Tensor):
+        idx = len(store)
+        store[idx] = obj
+        return _StoredTensor(idx)
+    if isinstance(obj, (tuple, list)):
+        return type(obj)(_store_tensors(o, store) for o in obj)
+    if isinstance(obj, dict):
+        return {k: _store_tensors(v, store) for k, v in obj.items()}
+    return obj
+
+
+def _load_tensors(obj, store: HiddenStateStore, device):
+    if isinstance(obj, _StoredTensor):
+        return store[obj.idx].to(device)
+    if isinstance(obj, (tuple, list)):
+        return type(obj)(_load_tensors(o, store, device) for o in obj)
+    if isinstance(obj, dict):
+        return {k: _load_tensors(v, store, device) for k, v in obj.items()}
+    return obj
+
+
+def _module_device(module: nn.Module) -> Optional[torch.device]:
+    for param in module.parameters():
+        return param.device
+    return None
+
+
+class _StopForward(Exception):
+    pass
+
+
+@dataclass
+class CalibrationState:
+    """Progress of `LayerwiseCalibrator.run`, shared with the callbacks and updated in place."""
+
+    num_layers: int
+    layer_idx: int = -1
+    pass_idx: int = 0
+    batch_idx: int = -1
+    # (batch_size, seq_len) bool mask of the non-padding tokens of the batch, None for no padding
+    padding_mask: Optional[torch.Tensor] = None
+
+
+class CalibrationCallback:
+    """
+    Per-layer hooks of `LayerwiseCalibrator.run`, all no-ops by default.
+    Every layer runs `on_layer_begin`, then passes of (`on_batch_begin`, `on_batch_end`) over all
+    batches closed by `on_pass_end`, and finally `on_layer_end`.
+    """
+
+    def on_layer_begin(self, state: CalibrationState, layer: nn.Module):
+        pass
+
+    def on_batch_begin(self, state: CalibrationState, layer: nn.Module):
+        pass
+
+    def on_batch_end(
+        self, state: CalibrationState, layer: nn.Module, hidden_states: torch.Tensor
+    ):
+        """`hidden_states` are the outputs of the layer for the batch."""
+        pass
+
+    def on_pass_end(self, state: CalibrationState, layer: nn.Module) -> bool:
+        """Returns True to run the layer over all batches once more, e.g. after modifying it."""
+        return False
+
+    def on_layer_end(self, state: CalibrationState, layer: nn.Module):
+        pass
+
+
+class HiddenDistributionCallback(CalibrationCallback):
+    """
+    Running mean / variance of the attention and MLP (MoE) outputs of every layer over the
+    non-padding tokens of the first pass, the statistics of `get_hidden_distribution.py`.
+    """
+
+    def __init__(self, hidden_size: int):
+        self.hidden_size = hidden_size
+        self.distributions: dict[int, dict] = {}
+        self._state = None
+        self._hooks = []
+
+    def _make_hook(self, module_name: str):
+        @torch.no_grad()
+        def hook(module, args, output):
+            if self._state.pass_idx > 0:
+                return
+            hidden_states = output_hidden_states(output)
+            if self._state.padding_mask is not None:
+                hidden_states = hidden_states[self._state.padding_mask]
+            else:
+                hidden_states = hidden_states.reshape(-1, hidden_states.shape[-1])
+            update_distribution(
+                self.distributions[self._state.layer_idx][module_name], hidden_states
+            )
+
+        return hook
+
+    def on_layer_begin(self, state, layer):
+        self._state = state
+        self.distributions[state.layer_idx] = {
+            "attn": new_distribution(self.hidden_size),
+            "mlp": new_distribution(self.hidden_size),
+        }
+        self._hooks = [
+            layer.self_attn.register_forward_hook(self._make_hook("attn")),
+            get_mlp(layer).register_forward_hook(self._make_hook("mlp")),
+        ]
+
+    def on_layer_end(self, state, layer):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+    def gather(self, gather_fn: Callable = None) -> dict:
+        """`{layer_idx: {"attn" / "mlp": {"number", "mean", "variance"}}}` over all processes, on CPU."""
+        distribution_info = {}
+        for layer_idx, distributions in self.distributions.items():
+            distribution_info[layer_idx] = {}
+            for module_name, distribution in distributions.items():
+                num, mean, var = gather_distribution(distribution, gather_fn)
+                distribution_info[layer_idx][module_name] = {
+                    "number": num.cpu(),
+                    "mean": mean.cpu(),
+                    "variance": var.cpu(),
+                }
+        return distribution_info
+
+
+class FeatureCaptureCallback(CalibrationCallback):
+    """
+    Captures the inputs of the MLP of every layer (the outputs of `post_attention_layernorm`) at
+    the non-padding tokens of the first pass, and calls `fn(layer_idx, features)` with the
+    (num_tokens, hidden_size) CPU features at the end of the layer.
+
+    The features of the batches are held in a `HiddenStateStore` with `max_memory_bytes` / `spill_dir`.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[int, torch.Tensor], None],
+        max_memory_bytes: int = None,
+        spill_dir: str = None,
+    ):
+        self.fn = fn
+        self.store = HiddenStateStore(max_memory_bytes, spill_dir)
+        self._state = None
+        self._hook = None
+
+    @torch.no_grad()
+    def _hook_fn(self, module, args):
+        if self._state.pass_idx > 0:
+            return
+        features = args[0].detach()
+        if self._state.padding_mask is not None:
+            features = features[self._state.padding_mask]
+        self.store[self._state.batch_idx] = features.reshape(-1, features.shape[-1])
+
+    def on_layer_begin(self, state, layer):
+        self._state = state
+        self._hook = get_mlp(layer).register_forward_pre_hook(self._hook_fn)
+
+    def on_layer_end(self, state, layer):
+        self._hook.remove()
+        self._hook = None
+        features = torch.cat([self.store[idx] for idx in range(len(self.store))])
+        self.store.close()
+        self.fn(state.layer_idx, features)
+
+
+class LayerwiseCalibrator:
+    """
+    Streams calibration batches through the decoder layers of `model` one layer at a time.
+
+    Args:
+        model: `LlamaForCausalLM` / `LlamaModel`, or a model of `smoe.models` (and its base model),
+            with `embed_tokens` and `layers`. Call `accelerator.unwrap_model` on prepared models.
+        device: where the running layer is computed. Each layer is moved there before its forward
+            and back to its original device afterwards, None runs every layer where it is.
+        max_memory_bytes / spill_dir: memory budget of the layer inputs (split evenly between the
+            hidden states into and out of the running layer and the other inputs such as the 4D
+            attention masks) and where to spill the batches beyond it (a temporary folder by default).
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        device: str | torch.device = None,
+        max_memory_bytes: int = None,
+        spill_dir: str = None,
+    ):
+        self.model = model
+        self.base_model = getattr(model, "model", model)
+        self.layers = self.base_model.layers
+        self.device = None if device is None else torch.device(device)
+        self.max_memory_bytes = max_memory_bytes
+        self.spill_dir = spill_dir
+
+    def _new_store(self, name: str) -> HiddenStateStore:
+        max_memory_bytes = self.max_memory_bytes
+        if max_memory_bytes is not None:
+            max_memory_bytes //= 3
+        spill_dir = None
+        if self.spill_dir is not None:
+            spill_dir = os.path.join(self.spill_dir, name)
+        return HiddenStateStore(max_memory_bytes, spill_dir)
+
+    def _layer_inputs(
+        self,
+        batches: Iterable[dict],
+        store: HiddenStateStore,
+        kwargs_store: HiddenStateStore,
+    ) -> list:
+        """
+        Runs the model up to the first decoder layer. The hidden states go to `store`, and the
+        tensors of the other layer inputs to `kwargs_store`, the returned inputs of each batch
+        only refer to them.
+        """
+        # the embeddings, norm, rotary embeddings ... (everything but the layers) on the device
+        modules = [
+            module
+            for name, module in self.base_model.named_children()
+            if name != "layers"
+        ]
+        original_devices = [_module_device(module) for module in modules]
+        if self.device is not None:
+            for module in modules:
+                module.to(self.device)
+        device = self.device or _module_device(self.base_model.embed_tokens)
+
+        captured = {}
+
+        def hook(module, args, kwargs):
+            captured["args"] = args
+            captured["kwargs"] = kwargs
+            raise _StopForward
+
+        layer_inputs = []
+        handle = self.layers[0].register_forward_pre_hook(hook, with_kwargs=True)
+        try:
+            for batch_idx, batch in enumerate(batches):
+                attention_mask = batch.get("attention_mask")
+                inputs = {
+                    key: batch[key].to(device)
+                    for key in ("input_ids", "attention_mask", "position_ids")
+                    if batch.get(key) is not None
+                }
+                try:
+                    self.base_model(**inputs, use_cache=False)
+                except _StopForward:
+                    pass
+                store[batch_idx] = captured["args"][0]
+                padding_mask = None
+                if attention_mask is not None and not attention_mask.bool().all():
+                    padding_mask = attention_mask.bool().cpu()
+                layer_inputs.append(
+                    (
+                        _store_tensors(captured["args"][1:], kwargs_store),
+                        _store_tensors(captured["kwargs"], kwargs_store),
+                        padding_mask,
+                    )
+                )
+                captured.clear()
+        finally:
+            handle.remove()
+            if self.device is not None:
+                for module, original_device in zip(modules, original_devices):
+                    if original_device is not None:
+                        module.to(original_device)
+        return layer_inputs
+
+    @torch.no_grad()
+    def run(
+        self,
+        batches: Iterable[dict],
+        callbacks: list[CalibrationCallback] = (),
+        num_layers: int = None,
+    ) -> CalibrationState:
+        """
+        Args:
+            batches: calibration batches with `input_ids` and optionally `attention_mask` /
+                `position_ids`, consumed once.
+            num_layers: stops after the first `num_layers` decoder layers, all layers by default.
+        """
+        num_layers = len(self.layers) if num_layers is None else num_layers
+        state = CalibrationState(num_layers=num_layers)
+        inputs_store = self._new_store("inputs")
+        outputs_store = self._new_store("outputs")
+        kwargs_store = self._new_store("layer_inputs")
+        try:
+            layer_inputs = self._layer_inputs(batches, inputs_store, kwargs_store)
+            for layer_idx in range(num_layers):
+                layer = self.layers[layer_idx]
+                original_device = _module_device(layer)
+                if self.device is not None:
+                    layer.to(self.device)
+                device = self.device or original_device
+
+                state.layer_idx = layer_idx
+                state.pass_idx = 0
+                for callback in callbacks:
+                    callback.on_layer_begin(state, layer)
+                while True:
+                    for batch_idx, (args, kwargs, padding_mask) in enumerate(
+                        layer_inputs
+                    ):
+                        state.batch_idx = batch_idx
+                        state.padding_mask = _to_device(padding_mask, device)
+                        for callback in callbacks:
+                            callback.on_batch_begin(state, layer)
+                        hidden_states = output_hidden_states(
+                            layer(
+                                inputs_store[batch_idx].to(device),
+                                *_load_tensors(args, kwargs_store, device),
+                                **_load_tensors(kwargs, kwargs_store, device),
+                            )
+                        )
+                        for callback in callbacks:
+                            callback.on_batch_end(state, layer, hidden_states)
+                        outputs_store[batch_idx] = hidden_states
+                    # every callback sees the end of the pass
+                    repeat = [
+                        callback.on_pass_end(state, layer) for callback in callbacks
+                    ]
+                    if not any(repeat):
+                        break
+                    state.pass_idx += 1
+                state.batch_idx = -1
+                state.padding_mask = None
+                for callback in callbacks:
+                    callback.on_layer_end(state, layer)
+
+                if self.device is not None and original_device is not None:
+                    layer.to(original_device)
+                inputs_store, outputs_store = outputs_store, inputs_store
+                logger.info(f"layer {layer_idx} done, passes: {state.pass_idx + 1}")
+        finally:
+            inputs_store.close()
+            outputs_store.close()
+            kwargs_store.close()
+        return state
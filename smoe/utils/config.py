@@ -272,6 +272,12 @@ class DataArguments:
             "help": ("data portion. choices in ['llama', 'uniform', 'sheared_llama']")
         },
     )
+    domain_exhaustion_policy: Optional[str] = field(
+        default="stop",
+        metadata={
+            "help": "What to do when a domain runs out of data. choices in ['stop', 'recycle', 'drop']: stop the whole stream, re-iterate over the domain, or drop the domain and renormalize the weights of the others."
+        },
+    )
 
     def __post_init__(self):
         if self.streaming:
@@ -335,6 +341,42 @@ class EnhancedTrainingArguments(TrainingArguments):
             "help": "dynamic data selection strategy (change data portion dynamically based on current loss and reference loss)."
         },
     )
+    dynamic_data_selection_steps: Optional[int] = field(
+        default=0,
+        metadata={
+            "help": "Reweight domains every N steps. If set to 0, domains are reweighted at evaluation steps."
+        },
+    )
+    dynamic_data_selection_probe_blocks: Optional[int] = field(
+        default=8,
+        metadata={
+            "help": "Number of cached blocks per domain (sampled from the eval sets) used to probe domain losses."
+        },
+    )
+    dynamic_data_selection_probe_interval: Optional[int] = field(
+        default=4,
+        metadata={
+            "help": "Re-score the probe blocks every N reweighting steps, running losses of training batches are used in between. Set to 0 to disable probing."
+        },
+    )
+    reference_loss_file: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "json file of domain name -> reference loss for dynamic data selection. Defaults to llama2-7B losses on SlimPajama."
+        },
+    )
+    async_checkpoint: Optional[bool] = field(
+        default=False,
+        metadata={
+            "help": "If set to True, model weights in checkpoints are written as per-rank safetensors shards from a background thread. Merge them with `python -m smoe.utils.async_checkpoint`."
+        },
+    )
+    save_telemetry_events: Optional[bool] = field(
+        default=True,
+        metadata={
+            "help": "If set to True, routing statistics averaged over each logging interval are appended to `telemetry_events.bin` in the output dir. Read them with `smoe.utils.telemetry.read_telemetry_events`."
+        },
+    )
 
     @property
     def block_size(self):
@@ -0,0 +1,174 @@
+"""
+Layer-incremental alignment of converted LLaMA-MoE-v2 (Mixtral) models.
+
+The output distributions of the attention / MLP modules of every MoE layer are aligned to those of the
+dense model by rescaling the output projections of the experts (see `align_converted_model.py`).
+
+Instead of re-running the model from the embeddings for every aligned module, the calibration batches are
+streamed through one layer at a time by `LayerwiseCalibrator`, so every layer runs once more per aligned
+module. Hidden states between layers are kept in memory up to `max_memory_bytes` and spilled to
+memory-mapped shards beyond that.
+"""
+
+from typing import Callable
+
+import torch
+from torch.nn.parameter import Parameter
+
+from smoe.utils.calibration import (  # noqa: F401
+    CalibrationCallback,
+    HiddenStateStore,
+    LayerwiseCalibrator,
+    gather_distribution,
+    new_distribution,
+    update_distribution,
+)
+from smoe.utils.logging import get_logger
+
+logger = get_logger(__file__)
+
+
+def _scale_factors(distribution, ref, gather_fn, device) -> tuple:
+    final_num, final_mean, final_var = gather_distribution(distribution, gather_fn)
+    ref_mean = ref["mean"].to(device)
+    ref_var = ref["variance"].to(device)
+    scale_magnitude = torch.sqrt(ref_var / final_var)
+    scale_bias = ref_mean - final_mean * scale_magnitude
+    logger.info(
+        f"tokens: {int(final_num)}, mean: {final_mean[:4].tolist()} -> {ref_mean[:4].tolist()},"
+        f" variance: {final_var[:4].tolist()} -> {ref_var[:4].tolist()}"
+    )
+    return scale_bias, scale_magnitude
+
+
+def _rescale(projections, scale_bias, scale_magnitude):
+    for projection in projections:
+        projection.bias = Parameter(
+            scale_bias.clone().to(projection.weight.dtype), requires_grad=False
+        )
+        projection.weight *= scale_magnitude.unsqueeze(1).to(projection.weight.dtype)
+
+
+class _AlignmentCallback(CalibrationCallback):
+    """
+    Aligns the modules of every MoE layer in turn, one pass each: the statistics of the module outputs
+    are collected, the module is rescaled and the layer runs again with the aligned module.
+    """
+
+    def __init__(self, ref_distribution, target_modules, gather_fn, hidden_size):
+        self.ref_distribution = ref_distribution
+        self.target_modules = target_modules
+        self.gather_fn = gather_fn
+        self.hidden_size = hidden_size
+        self.scale_factors = {}
+        self._state = None
+        self._hooks = []
+        self._distribution = None
+
+    def _current_module(self):
+        if self._state.pass_idx < len(self.target_modules):
+            return self.target_modules[self._state.pass_idx]
+        return None
+
+    def _make_hook(self, module_name):
+        @torch.no_grad()
+        def hook(module, args, output):
+            if self._current_module() != module_name:
+                return
+            hidden_states = output[0]
+            if self._state.padding_mask is not None:
+                hidden_states = hidden_states[self._state.padding_mask]
+            else:
+                hidden_states = hidden_states.reshape(-1, hidden_states.shape[-1])
+            update_distribution(self._distribution, hidden_states)
+
+        return hook
+
+    def on_layer_begin(self, state, layer):
+        self._state = state
+        if not layer.is_moe:
+            return
+        self.scale_factors[state.layer_idx] = {}
+        self._distribution = new_distribution(self.hidden_size)
+        self._hooks = [
+            layer.block_sparse_moe.register_forward_hook(self._make_hook("mlp"))
+        ]
+        if "attn" in self.target_modules:
+            self._hooks.append(
+                layer.self_attn.register_forward_hook(self._make_hook("attn"))
+            )
+
+    def on_pass_end(self, state, layer) -> bool:
+        module_name = self._current_module()
+        if not layer.is_moe or module_name is None:
+            return False
+        logger.info(f"layer {state.layer_idx} {module_name}")
+        device = self._distribution["mean"].device
+        scale_bias, scale_magnitude = _scale_factors(
+            self._distribution,
+            self.ref_distribution[state.layer_idx][module_name],
+            self.gather_fn,
+            device,
+        )
+        if module_name == "attn":
+            projections = layer.self_attn.o_proj
+        else:
+            projections = [expert.w2 for expert in layer.block_sparse_moe.experts]
+        _rescale(projections, scale_bias, scale_magnitude)
+        self.scale_factors[state.layer_idx][module_name] = {
+            "scale_bias": scale_bias.cpu(),
+            "scale_magnitude": scale_magnitude.cpu(),
+        }
+        self._distribution = new_distribution(self.hidden_size)
+        # run again with the aligned module, to align the next one or advance to the next layer
+        return True
+
+    def on_layer_end(self, state, layer):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+
+@torch.no_grad()
+def align_model_layerwise(
+    model,
+    batches: list[dict],
+    ref_distribution: dict,
+    gather_fn: Callable = None,
+    max_memory_bytes: int = None,
+    spill_dir: str = None,
+    device: str | torch.device = None,
+) -> dict:
+    """
+    Aligns the MoE layers of `model` (`MixtralForCausalLM` / `MixtralModel`, modulelist experts)
+    to `ref_distribution` in place, layer by layer.
+
+    Args:
+        batches: calibration batches with `input_ids` and optionally `attention_mask`.
+        ref_distribution: `{layer_idx: {"attn" / "mlp": {"mean", "variance"}}}` of the dense model,
+            see `get_hidden_distribution.py`.
+        gather_fn: gathers tensors from all processes (e.g. `accelerator.gather`) for multi-process runs.
+        max_memory_bytes / spill_dir: memory budget of the cached hidden states and where to spill
+            the batches beyond it (a temporary folder by default).
+        device: moves each layer there while it is aligned, see `LayerwiseCalibrator`.
+
+    Returns:
+        `{layer_idx: {"attn" / "mlp": {"scale_bias", "scale_magnitude"}}}` on CPU.
+    """
+    base_model = getattr(model, "model", model)
+    config = base_model.config
+    if config.moe_type != "modulelist":
+        raise ValueError("For now the only supported MoE type is modulelist!")
+    target_modules = ["attn", "mlp"] if config.use_attn_moe else ["mlp"]
+
+    callback = _AlignmentCallback(
+        ref_distribution, target_modules, gather_fn, config.hidden_size
+    )
+    calibrator = LayerwiseCalibrator(
+        base_model,
+        device=device,
+        max_memory_bytes=max_memory_bytes,
+        spill_dir=spill_dir,
+    )
+    calibrator.run(batches, [callback])
+    return callback.scale_factors
@@ -0,0 +1,313 @@
+"""
+Co-activation based expert split for sparsely activated (e.g. ReLU-LLaMA) FFNs.
+
+The neurons of every layer are split into experts so that neurons firing together on the calibration
+tokens stay in the same expert. Instead of the dense `intermediate_size`² co-activation matrix of
+`GraphSplit`, the statistics are kept as a sketch with the `num_neighbors` strongest co-activated
+neurons of every neuron:
+
+    - `CoActivationSketch`: exact firing counts and top-k co-activation neighbors of every neuron,
+      updated with the firing patterns of buffered tokens. Pairs that drop out of the top-k of a row
+      lose their counts, so `num_neighbors` should be larger than the neighbors used for the split.
+    - `CoActivationCallback`: collects the sketch of every layer with `LayerwiseCalibrator`.
+    - `balanced_graph_partition`: splits the sparse co-activation graph into equally sized parts on CPU,
+      by greedy graph growing and pairwise swap refinement.
+
+The results are `neuron_indices` in the format of `convert_safetensors`,
+see `smoe/entrypoint/expert_construction/split/split_coactivation.py`.
+"""
+
+import heapq
+from typing import Callable
+
+import numpy as np
+import scipy.sparse as sp
+import torch
+
+from smoe.utils.calibration import CalibrationCallback
+from smoe.utils.logging import get_logger
+
+logger = get_logger(__file__)
+
+
+class CoActivationSketch:
+    """
+    Firing counts and top-`num_neighbors` co-activation counts of `num_neurons` neurons.
+
+    Args:
+        flush_tokens: firing patterns are buffered and merged into the neighbor table every
+            `flush_tokens` tokens, more tokens per merge drop fewer counts.
+        max_block_bytes: memory budget of the co-activation block of a merge, as many rows of the
+            (num_neurons, num_neurons) counts are computed at once.
+    """
+
+    def __init__(
+        self,
+        num_neurons: int,
+        num_neighbors: int = 64,
+        flush_tokens: int = 8192,
+        max_block_bytes: int = 1 << 28,
+        device: str | torch.device = "cpu",
+    ):
+        self.num_neurons = num_neurons
+        self.num_neighbors = min(num_neighbors, num_neurons - 1)
+        self.flush_tokens = flush_tokens
+        self.max_block_bytes = max_block_bytes
+        self.device = torch.device(device)
+
+        self.num_tokens = 0
+        self.firing_counts = torch.zeros(num_neurons, dtype=torch.long, device=device)
+        # -1 for empty slots
+        self.neighbors = torch.full(
+            (num_neurons, self.num_neighbors), -1, dtype=torch.long, device=device
+        )
+        self.counts = torch.zeros(
+            (num_neurons, self.num_neighbors), dtype=torch.float, device=device
+        )
+        self._buffer: list[torch.Tensor] = []
+        self._num_buffered = 0
+
+    @torch.no_grad()
+    def update(self, fired: torch.Tensor):
+        """`fired`: (num_tokens, num_neurons) bool firing patterns."""
+        fired = fired.reshape(-1, self.num_neurons).to(self.device, torch.bool)
+        self.num_tokens += fired.shape[0]
+        self.firing_counts += fired.sum(0)
+        self._buffer.append(fired)
+        self._num_buffered += fired.shape[0]
+        if self._num_buffered >= self.flush_tokens:
+            self.flush()
+
+    @torch.no_grad()
+    def flush(self):
+        if self._num_buffered == 0:
+            return
+        fired = torch.cat(self._buffer).float()
+        self._buffer, self._num_buffered = [], 0
+
+        rows_per_block = max(1, self.max_block_bytes // (self.num_neurons * 4))
+        for start in range(0, self.num_neurons, rows_per_block):
+            end = min(start + rows_per_block, self.num_neurons)
+            rows = torch.arange(start, end, device=self.device)
+            # co-activation counts of the buffered tokens plus the kept counts
+            block = fired[:, start:end].t() @ fired
+            neighbors = self.neighbors[start:end]
+            block.scatter_add_(1, neighbors.clamp(min=0), self.counts[start:end])
+            block[rows - start, rows] = 0
+            counts, neighbors = block.topk(self.num_neighbors, dim=1)
+            neighbors[counts <= 0] = -1
+            self.neighbors[start:end] = neighbors
+            self.counts[start:end] = counts.clamp(min=0)
+
+    def to_graph(self, normalize: str = "jaccard") -> sp.csr_matrix:
+        """
+        Symmetric (num_neurons, num_neurons) co-activation graph of the kept neighbors.
+
+        Args:
+            normalize: "count" for co-activation counts, "jaccard" for counts divided by the number
+                of tokens on which either neuron fires, so that frequently firing neurons do not
+                dominate the graph.
+        """
+        self.flush()
+        neighbors = self.neighbors.cpu().numpy()
+        counts = self.counts.cpu().double().numpy()
+        rows = np.repeat(np.arange(self.num_neurons), self.num_neighbors)
+        cols = neighbors.reshape(-1)
+        weights = counts.reshape(-1)
+        valid = cols >= 0
+        rows, cols, weights = rows[valid], cols[valid], weights[valid]
+
+        if normalize == "jaccard":
+            firing_counts = self.firing_counts.cpu().double().numpy()
+            union = firing_counts[rows] + firing_counts[cols] - weights
+            weights = weights / np.maximum(union, 1)
+        elif normalize != "count":
+            raise ValueError(f"Unknown normalization: {normalize}")
+
+        graph = sp.csr_matrix(
+            (weights, (rows, cols)), shape=(self.num_neurons, self.num_neurons)
+        )
+        # a pair may be kept in the table of one neuron only
+        return graph.maximum(graph.T).tocsr()
+
+    def state_dict(self) -> dict:
+        self.flush()
+        return {
+            "num_tokens": self.num_tokens,
+            "firing_counts": self.firing_counts.cpu(),
+            "neighbors": self.neighbors.cpu(),
+            "counts": self.counts.cpu(),
+        }
+
+    def load_state_dict(self, state_dict: dict):
+        self.num_tokens = state_dict["num_tokens"]
+        for key in ("firing_counts", "neighbors", "counts"):
+            setattr(self, key, state_dict[key].to(self.device))
+        self.num_neighbors = self.neighbors.shape[1]
+
+
+class CoActivationCallback(CalibrationCallback):
+    """
+    Collects a `CoActivationSketch` of the FFN neurons of every layer, a neuron fires on a non-padding
+    token when its activation (`mlp.act_fn` outputs) is above `threshold`.
+    `fn(layer_idx, sketch)` is called at the end of every layer.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[int, CoActivationSketch], None],
+        threshold: float = 0.0,
+        **sketch_kwargs,
+    ):
+        self.fn = fn
+        self.threshold = threshold
+        self.sketch_kwargs = sketch_kwargs
+        self.sketch = None
+        self._state = None
+        self._hook = None
+
+    @torch.no_grad()
+    def _hook_fn(self, module, args, output):
+        if self._state.pass_idx > 0:
+            return
+        fired = output > self.threshold
+        if self._state.padding_mask is not None:
+            fired = fired[self._state.padding_mask]
+        if self.sketch is None:
+            self.sketch = CoActivationSketch(
+                fired.shape[-1], device=fired.device, **self.sketch_kwargs
+            )
+        self.sketch.update(fired)
+
+    def on_layer_begin(self, state, layer):
+        act_fn = getattr(layer.mlp, "act_fn", None)
+        if act_fn is None:
+            raise ValueError(
+                "For now the only supported MLP is the gated MLP of LLaMA with `act_fn`!"
+            )
+        self._state = state
+        self.sketch = None
+        self._hook = act_fn.register_forward_hook(self._hook_fn)
+
+    def on_layer_end(self, state, layer):
+        self._hook.remove()
+        self._hook = None
+        self.sketch.flush()
+        self.fn(state.layer_idx, self.sketch)
+        self.sketch = None
+
+
+def partition_cut(graph: sp.csr_matrix, labels: np.ndarray) -> float:
+    """Ratio of the edge weights between different parts."""
+    coo = graph.tocoo()
+    total = coo.data.sum()
+    if total == 0:
+        return 0.0
+    return float(coo.data[labels[coo.row] != labels[coo.col]].sum() / total)
+
+
+def _grow_partition(graph: sp.csr_matrix, num_parts: int) -> np.ndarray:
+    """Grows the parts one after another from the strongest free node, adding the most connected free nodes."""
+    num_nodes = graph.shape[0]
+    part_size = num_nodes // num_parts
+    degrees = np.asarray(graph.sum(axis=1)).ravel()
+    seed_order = np.argsort(-degrees, kind="stable")
+    seed_pos = 0
+    labels = np.full(num_nodes, -1, dtype=np.int64)
+    connection = np.zeros(num_nodes)
+    indptr, indices, data = graph.indptr, graph.indices, graph.data
+
+    for part in range(num_parts):
+        connection[:] = 0
+        heap = []
+        size = 0
+        while size < part_size:
+            node = -1
+            while heap:
+                neg_conn, candidate = heapq.heappop(heap)
+                if labels[candidate] < 0 and -neg_conn == connection[candidate]:
+                    node = candidate
+                    break
+            if node < 0:
+                # a new component, start from the strongest free node
+                while labels[seed_order[seed_pos]] >= 0:
+                    seed_pos += 1
+                node = seed_order[seed_pos]
+            labels[node] = part
+            size += 1
+            for ptr in range(indptr[node], indptr[node + 1]):
+                neighbor = indices[ptr]
+                if labels[neighbor] < 0:
+                    connection[neighbor] += data[ptr]
+                    heapq.heappush(heap, (-connection[neighbor], neighbor))
+    return labels
+
+
+def _refine_partition(
+    graph: sp.csr_matrix, labels: np.ndarray, num_parts: int, max_iter: int
+) -> np.ndarray:
+    """Swaps node pairs between parts while that lowers the cut, the part sizes do not change."""
+    num_nodes = graph.shape[0]
+    cut = partition_cut(graph, labels)
+    for iteration in range(max_iter):
+        one_hot = sp.csr_matrix(
+            (np.ones(num_nodes), (np.arange(num_nodes), labels)),
+            shape=(num_nodes, num_parts),
+        )
+        # (num_nodes, num_parts) edge weights to each part
+        connection = np.asarray((graph @ one_hot).todense())
+        gains = connection - connection[np.arange(num_nodes), labels][:, None]
+
+        new_labels = labels.copy()
+        moved = np.zeros(num_nodes, dtype=bool)
+        members = [np.nonzero(labels == part)[0] for part in range(num_parts)]
+        for a in range(num_parts):
+            for b in range(a + 1, num_parts):
+                nodes_a = members[a][~moved[members[a]]]
+                nodes_b = members[b][~moved[members[b]]]
+                nodes_a = nodes_a[np.argsort(-gains[nodes_a, b], kind="stable")]
+                nodes_b = nodes_b[np.argsort(-gains[nodes_b, a], kind="stable")]
+                num_pairs = min(len(nodes_a), len(nodes_b))
+                if num_pairs == 0:
+                    continue
+                nodes_a, nodes_b = nodes_a[:num_pairs], nodes_b[:num_pairs]
+                # the edge between the swapped nodes stays cut
+                pair_weights = np.asarray(graph[nodes_a, nodes_b]).ravel()
+                swap_gains = gains[nodes_a, b] + gains[nodes_b, a] - 2 * pair_weights
+                swap = swap_gains > 0
+                new_labels[nodes_a[swap]] = b
+                new_labels[nodes_b[swap]] = a
+                moved[nodes_a[swap]] = True
+                moved[nodes_b[swap]] = True
+
+        # the gains of the neighbors of swapped nodes are outdated, keep the swaps only if they help
+        new_cut = partition_cut(graph, new_labels)
+        logger.info(f"refinement iteration {iteration}: cut {cut:.4f} -> {new_cut:.4f}")
+        if not moved.any() or new_cut >= cut:
+            break
+        labels, cut = new_labels, new_cut
+    return labels
+
+
+def balanced_graph_partition(
+    graph: sp.csr_matrix, num_parts: int, max_iter: int = 20
+) -> np.ndarray:
+    """
+    Splits the nodes of the symmetric `graph` into `num_parts` parts of the same size with a low
+    cut weight. Returns the part of every node.
+    """
+    num_nodes = graph.shape[0]
+    if num_nodes % num_parts != 0:
+        raise ValueError(
+            f"The number of neurons ({num_nodes}) must be exactly divided by the number of experts ({num_parts})!"
+        )
+    graph = sp.csr_matrix(graph, dtype=np.float64)
+    graph.setdiag(0)
+    graph.eliminate_zeros()
+    labels = _grow_partition(graph, num_parts)
+    return _refine_partition(graph, labels, num_parts, max_iter)
+
+
+def labels_to_neuron_indices(labels: np.ndarray, num_experts: int) -> list[list[int]]:
+    """Expert index of every neuron -> neuron indices of every expert, as used by `convert_safetensors`."""
+    return [np.nonzero(labels == expert)[0].tolist() for expert in range(num_experts)]
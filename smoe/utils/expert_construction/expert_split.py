@@ -60,7 +60,8 @@ class ClusteringSplit(LayerSplit):
         self.type = "split_clustering"
         self.distance = distance
         self.model = model
-        self.model_dict = model.state_dict()
+        # a model, or its state dict (e.g. shared by `ParallelLayerSplitter`)
+        self.model_dict = model if isinstance(model, dict) else model.state_dict()
 
     def load_param(self):
         self.ffn_weight = load_ffn_weight(self.model_dict, self.template, self.layer)
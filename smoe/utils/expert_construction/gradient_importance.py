@@ -0,0 +1,168 @@
+"""
+Gradient importance scores of the MLP neurons for each gate cluster.
+
+Reference:
+    SNIP: Single-shot Network Pruning based on Connection Sensitivity
+    https://arxiv.org/abs/1810.02340
+
+Used by `smoe/entrypoint/expert_construction/split/split_gradient_get_grads_v2.py`
+and the expert construction benchmark.
+"""
+
+import types
+from typing import Callable
+
+import torch
+from torch import nn
+from transformers.models.llama.modeling_llama import LlamaMLP
+
+from smoe.utils.model_operation.change_llama_forward import (
+    forward_llama_mlp_with_backward_hook_bug_fix,
+)
+
+
+class GradientImportanceScorer:
+    """
+    Accumulates `|grad * activation|` of the intermediate neurons of every LLaMA MLP, separately for the
+    tokens classified into each cluster by `gate_weights` (argmax of the MLP input features @ gate weights).
+
+    Example:
+        >>> scorer = GradientImportanceScorer(model, gate_weights)
+        >>> for batch in batches:
+        >>>     scorer.set_attention_mask(batch["attention_mask"])
+        >>>     model(**batch).loss.backward()
+        >>>     optimizer.zero_grad()
+        >>> importance_scores = scorer.get_scores()
+        >>> scorer.remove()
+
+    Args:
+        model: `LlamaForCausalLM` (unwrapped)
+        gate_weights: {layer_id: (num_clusters, hidden_size)}
+    """
+
+    def __init__(
+        self, model: nn.Module, gate_weights: dict[int, torch.Tensor], device=None
+    ):
+        self.layers = model.model.layers
+        self.device = device if device is not None else model.device
+        self.gate_weights = {
+            layer_id: weight.to(self.device)
+            for layer_id, weight in gate_weights.items()
+        }
+        self.attention_mask = None
+        self.classified_cluster_ids = {}
+        self.cached_features_intermediate = {}
+        neuron_num = model.config.intermediate_size
+        self.importance_scores = {
+            layer_id: {
+                cluster_id: torch.zeros((neuron_num,), device=self.device)
+                for cluster_id in range(len(self.gate_weights[layer_id]))
+            }
+            for layer_id in range(len(self.layers))
+        }
+        # number of classified tokens in each cluster
+        self.token_count = {
+            layer_id: {
+                cluster_id: torch.zeros((), dtype=torch.long, device=self.device)
+                for cluster_id in range(len(self.gate_weights[layer_id]))
+            }
+            for layer_id in range(len(self.layers))
+        }
+
+        self._handles = []
+        for layer_id, layer in enumerate(self.layers):
+            if not isinstance(layer.mlp, LlamaMLP):
+                raise ValueError("For now the only supported model is LLaMA!")
+            # replace forward func (IMPORTANT)
+            layer.mlp.forward = types.MethodType(
+                forward_llama_mlp_with_backward_hook_bug_fix, layer.mlp
+            )
+            layer.mlp.up_proj.layer_id = layer_id
+            layer.mlp.down_proj.layer_id = layer_id
+            self._handles.append(
+                layer.mlp.up_proj.register_forward_hook(self._forward_hook_input_token)
+            )
+            # input of "down_proj" <==> "up_proj * gate_proj" output
+            self._handles.append(
+                layer.mlp.down_proj.register_forward_hook(
+                    self._forward_hook_intermediate
+                )
+            )
+            # grad_in of "down_proj" <==> grad of "up_proj * gate_proj" output
+            self._handles.append(
+                layer.mlp.down_proj.register_backward_hook(
+                    self._backward_hook_intermediate
+                )
+            )
+
+    def set_attention_mask(self, attention_mask: torch.Tensor = None):
+        """Padding tokens of the next batch are not counted"""
+        self.attention_mask = (
+            attention_mask.bool().flatten() if attention_mask is not None else None
+        )
+
+    def _select_tokens(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        if self.attention_mask is not None:
+            hidden_states = hidden_states[self.attention_mask]
+        return hidden_states
+
+    def _forward_hook_input_token(self, module, input, output):
+        """Captures the input features to the MLP layers and classifies the tokens into clusters"""
+        hidden_states = self._select_tokens(input[0])
+        layer_id = module.layer_id
+        feature_logits = hidden_states.detach() @ self.gate_weights[layer_id].t().to(
+            hidden_states.dtype
+        )
+        self.classified_cluster_ids[layer_id] = torch.argmax(feature_logits, dim=-1)
+
+    def _forward_hook_intermediate(self, module, input, output):
+        """Captures the intermediate features of the neurons"""
+        layer_id = module.layer_id
+        self.cached_features_intermediate[layer_id] = self._select_tokens(
+            input[0]
+        ).detach()
+
+    def _backward_hook_intermediate(self, module, grad_in, grad_out):
+        """Captures the gradients of the intermediate neurons and accumulates the importance scores"""
+        hidden_states_grad = self._select_tokens(grad_in[0])
+        layer_id = module.layer_id
+        for cluster_id in range(self.gate_weights[layer_id].shape[0]):
+            feature_mask = self.classified_cluster_ids[layer_id] == cluster_id
+            importance_score = (
+                hidden_states_grad[feature_mask].detach()
+                * self.cached_features_intermediate[layer_id][feature_mask]
+            )
+            self.importance_scores[layer_id][cluster_id] += torch.sum(
+                torch.abs(importance_score), dim=0
+            )
+            self.token_count[layer_id][cluster_id] += feature_mask.sum()
+
+    def get_scores(
+        self, reduce_fn: Callable[[torch.Tensor], torch.Tensor] = None
+    ) -> dict[int, dict[int, torch.Tensor]]:
+        """
+        Importance scores averaged over the classified tokens, on CPU.
+
+        Args:
+            reduce_fn: sums a tensor over processes, e.g. `partial(accelerator.reduce, reduction="sum")`
+        """
+        final_importance_scores = {}
+        for layer_id, layer_scores in self.importance_scores.items():
+            final_importance_scores[layer_id] = {}
+            for cluster_id, scores in layer_scores.items():
+                token_count = self.token_count[layer_id][cluster_id]
+                if reduce_fn is not None:
+                    token_count = reduce_fn(token_count)
+                    scores = reduce_fn(scores)
+                if token_count > 0:
+                    scores = scores / token_count
+                final_importance_scores[layer_id][cluster_id] = scores.cpu()
+        return final_importance_scores
+
+    def remove(self):
+        """Removes the hooks and restores the MLP forward"""
+        for handle in self._handles:
+            handle.remove()
+        self._handles.clear()
+        for layer in self.layers:
+            layer.mlp.__dict__.pop("forward", None)
@@ -0,0 +1,82 @@
+"""
+Gate weights of the MoE layers from the MLP input features of the dense model.
+
+Used by `smoe/entrypoint/expert_construction/get_gates/hidden_feature_random_selection.py`,
+`smoe/entrypoint/expert_construction/get_gates/hidden_feature_clustering.py`
+and the expert construction benchmark.
+"""
+
+import math
+
+import numpy as np
+import torch
+from k_means_constrained import KMeansConstrained
+
+from smoe.utils.expert_construction.k_means_constrained_cos import KMeansConstrainedCos
+from smoe.utils.logging import get_logger
+
+logger = get_logger(__file__)
+
+
+def select_gate_weights(
+    features: torch.Tensor, num_experts: int, generator: torch.Generator = None
+) -> torch.Tensor:
+    """`num_experts` randomly selected features of shape (num_features, hidden_size)"""
+    num_features = features.shape[0]
+    return features[torch.randperm(num_features, generator=generator)[:num_experts]]
+
+
+def cluster_gate_weights(
+    features: np.ndarray,
+    num_experts: int,
+    balance_jitter_factor: float = 0.1,
+    distance_metric: str = "l2",
+    max_iter: int = 100,
+    random_state: int = None,
+    n_init: int = 10,
+    n_jobs: int = 10,
+    verbose: bool = False,
+) -> torch.Tensor:
+    """
+    Cluster centers of the features by size-constrained k-means.
+
+    Args:
+        features: (num_features, hidden_size)
+        balance_jitter_factor: the maximum tolerance of the cluster sizes compared to the balanced size
+        distance_metric: "l2" or "cos"
+
+    Returns:
+        (num_experts, hidden_size) gate weights
+    """
+    balance_jitter_factor = max(0.0, balance_jitter_factor)
+    num_features = features.shape[0]
+    balanced_num_features = num_features / num_experts
+    min_cluster_size = max(
+        0, math.floor(balanced_num_features * (1 - balance_jitter_factor))
+    )
+    max_cluster_size = min(
+        num_features, math.ceil(balanced_num_features * (1 + balance_jitter_factor))
+    )
+    logger.info(
+        f"total number of features: {num_features}, ideally balanced cluster size: {balanced_num_features}, "
+        f"min cluster size: {min_cluster_size}, max cluster size: {max_cluster_size}"
+    )
+
+    if distance_metric == "l2":
+        kmeans_cls = KMeansConstrained
+    elif distance_metric == "cos":
+        kmeans_cls = KMeansConstrainedCos
+    else:
+        raise ValueError(f"Unknown distance metric: {distance_metric}")
+    kmeans = kmeans_cls(
+        n_clusters=num_experts,
+        size_min=min_cluster_size,
+        size_max=max_cluster_size,
+        tol=1e-3,
+        n_init=n_init,
+        max_iter=max_iter,
+        random_state=random_state,
+        n_jobs=n_jobs,
+        verbose=verbose,
+    ).fit(features, None)
+    return torch.from_numpy(kmeans.cluster_centers_)
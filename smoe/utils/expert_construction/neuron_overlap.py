@@ -0,0 +1,229 @@
+"""
+Vectorized overlap statistics of the neurons shared by experts (share-neuron splits).
+
+The neurons selected by every expert are packed into bitsets of `uint64` words with shape
+(num_layers, num_experts, num_words), so that the pairwise intersections of all experts in all layers
+are AND + popcount over words, and unions follow from the per-expert counts.
+
+    - `neuron_overlap_stats`: pairwise intersection / union / overlap rate, overlap counts and
+      selected neurons of every layer, as plotted by `visualize_expert_neuron_overlap`.
+    - `selection_overlap_sweep`: overlap counts of the top-`expert_size` selections of importance
+      scores for all expert sizes at once (`visualize_expert_neuron_overlap_overview.py`).
+    - `load_or_compute_overlap`: caches the results next to the score files, keyed by the scores'
+      modification times and the selection arguments.
+"""
+
+import os
+from typing import Callable
+
+import numpy as np
+import torch
+
+from smoe.utils.io import ArtifactStore, is_artifact_store, save_artifact_store
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def popcount64(words: np.ndarray) -> np.ndarray:
+    """Number of set bits of every `uint64` word."""
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        return np.bitwise_count(words)
+    # SWAR popcount
+    words = words - ((words >> np.uint64(1)) & _M1)
+    words = (words & _M2) + ((words >> np.uint64(2)) & _M2)
+    words = (words + (words >> np.uint64(4))) & _M4
+    return (words * _H01) >> np.uint64(56)
+
+
+def pack_neuron_masks(masks) -> np.ndarray:
+    """(..., num_neurons) bool masks -> (..., ceil(num_neurons / 64)) `uint64` bitsets."""
+    if isinstance(masks, torch.Tensor):
+        masks = masks.cpu().numpy()
+    masks = np.asarray(masks, dtype=bool)
+    padding = (-masks.shape[-1]) % 64
+    if padding > 0:
+        masks = np.concatenate(
+            [masks, np.zeros(masks.shape[:-1] + (padding,), dtype=bool)], axis=-1
+        )
+    packed = np.packbits(masks, axis=-1, bitorder="little")
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def unpack_neuron_masks(bitsets: np.ndarray, num_neurons: int) -> np.ndarray:
+    unpacked = np.unpackbits(
+        np.ascontiguousarray(bitsets).view(np.uint8), axis=-1, bitorder="little"
+    )
+    return unpacked[..., :num_neurons].astype(bool)
+
+
+def indices_to_masks(neuron_indices: list[list[int]], num_neurons: int) -> np.ndarray:
+    """Neuron indices selected by every expert -> (num_experts, num_neurons) bool masks."""
+    masks = np.zeros((len(neuron_indices), num_neurons), dtype=bool)
+    for expert_id, indices in enumerate(neuron_indices):
+        masks[expert_id, np.asarray(indices, dtype=np.int64)] = True
+    return masks
+
+
+def pairwise_overlap(bitsets: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """(..., num_experts, num_words) bitsets -> (..., num_experts, num_experts) intersection & union sizes."""
+    counts = popcount64(bitsets).sum(-1, dtype=np.int64)
+    num_experts = bitsets.shape[-2]
+    intersection = np.empty(bitsets.shape[:-1] + (num_experts,), dtype=np.int64)
+    # one expert against all others at a time, over all layers
+    for expert_id in range(num_experts):
+        intersection[..., expert_id, :] = popcount64(
+            bitsets[..., expert_id : expert_id + 1, :] & bitsets
+        ).sum(-1, dtype=np.int64)
+    union = counts[..., :, None] + counts[..., None, :] - intersection
+    return intersection, union
+
+
+def neuron_overlap_stats(masks) -> dict[str, np.ndarray]:
+    """
+    Overlap statistics of the (num_layers, num_experts, num_neurons) bool `masks` of selected neurons.
+
+    Returns (leading dim: layers):
+        intersection / union / overlap_rate: (num_experts, num_experts) between each expert pair,
+            the rate is intersection / union.
+        overlap_count: (num_experts, num_experts), row `t` column `e` is the number of neurons of expert
+            `e` that are selected by exactly `t + 1` experts.
+        total_neurons: number of neurons selected by any expert.
+    """
+    if isinstance(masks, torch.Tensor):
+        masks = masks.cpu().numpy()
+    masks = np.asarray(masks, dtype=bool)
+    num_layers, num_experts, _ = masks.shape
+    bitsets = pack_neuron_masks(masks)
+    intersection, union = pairwise_overlap(bitsets)
+    overlap_rate = np.divide(
+        intersection,
+        union,
+        out=np.zeros(intersection.shape, dtype=np.float64),
+        where=union > 0,
+    )
+
+    sum_count = masks.sum(1)  # (num_layers, num_neurons)
+    # (layer, expert, times - 1) of every selected neuron
+    layer_ids, expert_ids, neuron_ids = np.nonzero(masks)
+    flat_ids = (
+        layer_ids * num_experts + (sum_count[layer_ids, neuron_ids] - 1)
+    ) * num_experts + expert_ids
+    overlap_count = np.bincount(
+        flat_ids, minlength=num_layers * num_experts * num_experts
+    ).reshape(num_layers, num_experts, num_experts)
+
+    return {
+        "intersection": intersection,
+        "union": union,
+        "overlap_rate": overlap_rate,
+        "overlap_count": overlap_count,
+        "total_neurons": (sum_count > 0).sum(-1),
+    }
+
+
+def selection_ranks(scores, criterion: str = "max") -> np.ndarray:
+    """Rank of every neuron in the scores of every expert, 0 for the first selected one."""
+    if criterion not in ("min", "max"):
+        raise NotImplementedError
+    scores = torch.as_tensor(scores)
+    order = torch.sort(scores, dim=-1, descending=criterion == "max", stable=True)[1]
+    ranks = torch.empty_like(order)
+    ranks.scatter_(-1, order, torch.arange(order.shape[-1]).expand_as(order))
+    return ranks.numpy()
+
+
+def selected_masks_from_scores(
+    scores, expert_size: int, criterion: str = "max"
+) -> np.ndarray:
+    """(..., num_experts, num_neurons) scores -> masks of the top-`expert_size` neurons of every expert."""
+    if criterion not in ("min", "max"):
+        raise NotImplementedError
+    scores = torch.as_tensor(scores)
+    indices = scores.topk(expert_size, dim=-1, largest=criterion == "max")[1]
+    masks = torch.zeros(scores.shape, dtype=torch.bool)
+    masks.scatter_(-1, indices, True)
+    return masks.numpy()
+
+
+def selection_overlap_sweep(
+    scores, expert_sizes: list[int], criterion: str = "max"
+) -> dict[str, np.ndarray]:
+    """
+    Overlaps of the top-`expert_size` selections for all `expert_sizes` at once.
+
+    A neuron is selected by at least `k` experts at an expert size when its k-th smallest rank over
+    the experts is below the size, so counting the k-th smallest ranks gives every size.
+
+    Args:
+        scores: (num_layers, num_experts, num_neurons) importance scores.
+
+    Returns:
+        overlap_neurons: (num_layers, num_sizes, num_experts), column `k - 1` is the number of neurons
+            selected by exactly `k` experts.
+        independent_neurons: (num_layers, num_sizes), neurons selected by any expert.
+    """
+    ranks = np.sort(selection_ranks(scores, criterion), axis=1)  # over experts
+    num_layers, num_experts, num_neurons = ranks.shape
+    # at_least[l, k - 1, r]: neurons of layer l selected by at least k experts at expert size r + 1
+    flat_ids = (
+        ranks
+        + np.arange(num_layers * num_experts).reshape(num_layers, num_experts, 1)
+        * num_neurons
+    )
+    at_least = np.bincount(flat_ids.ravel(), minlength=ranks.size).reshape(ranks.shape)
+    at_least = at_least.cumsum(-1)[..., np.asarray(expert_sizes) - 1]
+    at_least = at_least.transpose(0, 2, 1)  # (num_layers, num_sizes, num_experts)
+    exactly = at_least - np.concatenate(
+        [at_least[..., 1:], np.zeros_like(at_least[..., :1])], axis=-1
+    )
+    return {"overlap_neurons": exactly, "independent_neurons": at_least[..., 0]}
+
+
+def _source_signature(path: str) -> str:
+    """Latest modification time & number of files under `path`."""
+    if os.path.isfile(path):
+        return f"{os.stat(path).st_mtime_ns}-1"
+    mtimes = [
+        os.stat(os.path.join(root, filename)).st_mtime_ns
+        for root, _, filenames in os.walk(path)
+        for filename in filenames
+    ]
+    return f"{max(mtimes, default=0)}-{len(mtimes)}"
+
+
+def overlap_cache_file(source: str, name: str) -> str:
+    """`{source}.{name}.safetensors` next to the score file / folder `source`."""
+    source = source.rstrip("/")
+    if os.path.isfile(source):
+        source = os.path.splitext(source)[0]
+    return f"{source}.{name}.safetensors"
+
+
+def load_or_compute_overlap(
+    cache_file: str, source: str, compute_fn: Callable[[], dict], **params
+) -> dict:
+    """
+    Loads the overlap statistics from `cache_file` if they were computed from the current `source`
+    with the same `params`, otherwise computes them with `compute_fn` and saves the cache.
+    """
+    signature = _source_signature(source)
+    params = {key: str(value) for key, value in params.items()}
+    if is_artifact_store(cache_file):
+        store = ArtifactStore(cache_file)
+        if (
+            store.manifest.get("source_signature") == signature
+            and store.manifest.get("params") == params
+        ):
+            return {key: store[key].numpy() for key in store}
+    results = compute_fn()
+    save_artifact_store(
+        {key: np.asarray(value) for key, value in results.items()},
+        cache_file,
+        source=source,
+        source_signature=signature,
+        params=params,
+    )
+    return results
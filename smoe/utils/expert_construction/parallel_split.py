@@ -0,0 +1,261 @@
+"""
+Parallel driver for the per-layer split jobs of `expert_split.py`.
+
+The layers are split independently, so every layer is a job of a process pool:
+
+    - The tensors the jobs read (FFN weights, importance scores) are moved to shared memory once and
+      handed to every worker at startup, instead of being pickled into every job.
+    - Every worker is limited to `threads_per_worker` BLAS / OpenMP / torch threads, so that
+      `num_workers` workers do not oversubscribe the cores.
+    - The result of every finished layer is saved to `checkpoint_dir` right away, an interrupted run
+      skips the layers that are already there. `manifest.json` keeps a fingerprint of the job, the
+      layer kwargs and the shared tensors of every checkpoint, checkpoints of other arguments or
+      scores are recomputed.
+
+Usage:
+    splitter = ParallelLayerSplitter(num_workers=8, checkpoint_dir=f"{save_path}/checkpoints")
+    labels = splitter.run(
+        clustering_split_job,
+        {layer: dict(config=args, template=template) for layer in range(num_layers)},
+        shared=model.state_dict(),
+    )
+
+`fn(layer, shared, **kwargs)` must be picklable (defined at the module level).
+"""
+
+import hashlib
+import json
+import os
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Any, Callable
+
+import torch
+import torch.multiprocessing as mp
+
+from smoe.utils.expert_construction.expert_split import ClusteringSplit
+from smoe.utils.io import create_dir
+from smoe.utils.logging import get_logger
+
+logger = get_logger(__file__)
+
+THREAD_LIMIT_ENV_NAMES = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+)
+
+MANIFEST_NAME = "manifest.json"
+# args that do not change the results
+RESUME_IGNORED_ARGS = ("num_workers", "threads_per_worker", "checkpoint_dir")
+# elements of every shared tensor hashed for the fingerprint
+FINGERPRINT_SAMPLES = 4096
+
+# tensors shared with the jobs of the current worker
+_worker_shared: dict = None
+
+
+def _init_worker(shared: dict, threads: int):
+    global _worker_shared
+    _worker_shared = shared
+    torch.set_num_threads(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+
+        # BLAS pools already loaded (e.g. by numpy), the env vars only cover the ones loaded later
+        threadpool_limits(limits=threads)
+    except ImportError:
+        pass
+
+
+def _run_job(fn: Callable, layer: int, kwargs: dict):
+    return layer, fn(layer, _worker_shared, **kwargs)
+
+
+def _jsonable(value):
+    if isinstance(value, Namespace):
+        value = {k: v for k, v in vars(value).items() if k not in RESUME_IGNORED_ARGS}
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in sorted(value.items(), key=str)}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    return value
+
+
+def _tensor_fingerprint(tensor: torch.Tensor) -> str:
+    """Shape, dtype & a strided sample of the values, reading a whole score file would take too long."""
+    flat = tensor.detach().reshape(-1)
+    step = max(1, flat.numel() // FINGERPRINT_SAMPLES)
+    sample = flat[::step].cpu().contiguous()
+    digest = hashlib.sha256(sample.view(torch.uint8).numpy().tobytes()).hexdigest()
+    return f"{tuple(tensor.shape)}-{tensor.dtype}-{digest}"
+
+
+def job_fingerprint(fn: Callable, kwargs: dict, shared: dict) -> str:
+    """Hash of the job, its kwargs (except `RESUME_IGNORED_ARGS`) and the shared tensors."""
+    content = {
+        "fn": f"{fn.__module__}.{fn.__qualname__}",
+        "kwargs": _jsonable(kwargs),
+        "shared": {key: _tensor_fingerprint(shared[key]) for key in sorted(shared)},
+    }
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, default=str).encode("utf8")
+    ).hexdigest()
+
+
+@contextmanager
+def _limit_child_threads(threads: int):
+    """Thread limits of the env vars inherited by the spawned workers."""
+    backup = {name: os.environ.get(name) for name in THREAD_LIMIT_ENV_NAMES}
+    os.environ.update({name: str(threads) for name in THREAD_LIMIT_ENV_NAMES})
+    try:
+        yield
+    finally:
+        for name, value in backup.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+class ParallelLayerSplitter:
+    """
+    Runs `fn(layer, shared, **layer_kwargs[layer])` for every layer with `num_workers` processes.
+
+    Args:
+        num_workers: number of processes, `None` for one per core (at most one per layer).
+            With 1 worker the jobs run in the current process, one after another.
+        threads_per_worker: thread limit of every worker, `None` to divide the cores evenly.
+        checkpoint_dir: where the result of every finished layer is saved, `None` to disable resuming.
+        start_method: "spawn" by default, as forking a process with initialized OpenMP / CUDA
+            runtimes is not safe.
+    """
+
+    def __init__(
+        self,
+        num_workers: int = None,
+        threads_per_worker: int = None,
+        checkpoint_dir: str = None,
+        start_method: str = "spawn",
+    ):
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.checkpoint_dir = checkpoint_dir
+        self.start_method = start_method
+        # {layer: fingerprint} of the checkpoints in `checkpoint_dir`
+        self._manifest: dict[str, str] = {}
+
+    def _checkpoint_file(self, layer: int) -> str:
+        return os.path.join(self.checkpoint_dir, f"layer{layer}.pt")
+
+    def _manifest_file(self) -> str:
+        return os.path.join(self.checkpoint_dir, MANIFEST_NAME)
+
+    def _load_manifest(self) -> dict:
+        if not os.path.exists(self._manifest_file()):
+            return {}
+        with open(self._manifest_file(), "r", encoding="utf8") as fin:
+            return json.load(fin)
+
+    def _write_manifest(self):
+        filename = self._manifest_file()
+        with open(f"{filename}.tmp", "w", encoding="utf8") as fout:
+            json.dump(self._manifest, fout, indent=2, sort_keys=True)
+        os.replace(f"{filename}.tmp", filename)
+
+    def _load_finished(self, fingerprints: dict[int, str]) -> dict:
+        finished = {}
+        if self.checkpoint_dir is None:
+            return finished
+        stale = []
+        for layer, fingerprint in fingerprints.items():
+            if not os.path.exists(self._checkpoint_file(layer)):
+                continue
+            if self._manifest.get(str(layer)) == fingerprint:
+                finished[layer] = torch.load(self._checkpoint_file(layer))
+            else:
+                stale.append(layer)
+        if stale:
+            logger.warning(
+                f"Checkpoints of layers {stale} were created with other arguments or shared tensors,"
+                " recomputing them"
+            )
+        return finished
+
+    def _save(self, layer: int, result, fingerprint: str):
+        if self.checkpoint_dir is None:
+            return
+        # write & rename, so that an interrupted save is not taken as finished
+        filename = self._checkpoint_file(layer)
+        torch.save(result, f"{filename}.tmp")
+        os.replace(f"{filename}.tmp", filename)
+        self._manifest[str(layer)] = fingerprint
+        self._write_manifest()
+
+    def run(
+        self,
+        fn: Callable[..., Any],
+        layer_kwargs: dict[int, dict],
+        shared: dict[str, torch.Tensor] = None,
+    ) -> dict[int, Any]:
+        """Returns `{layer: result}` of all layers, including those finished by previous runs."""
+        shared = {} if shared is None else shared
+        fingerprints = {}
+        self._manifest = {}
+        if self.checkpoint_dir is not None:
+            create_dir(self.checkpoint_dir)
+            self._manifest = self._load_manifest()
+            fingerprints = {
+                layer: job_fingerprint(fn, kwargs, shared)
+                for layer, kwargs in layer_kwargs.items()
+            }
+        results = self._load_finished(fingerprints)
+        pending = [layer for layer in layer_kwargs if layer not in results]
+        if results:
+            logger.info(f"Skipping finished layers {sorted(results)}")
+        if not pending:
+            return {layer: results[layer] for layer in layer_kwargs}
+
+        cpu_count = os.cpu_count() or 1
+        num_workers = min(self.num_workers or cpu_count, len(pending))
+        if num_workers <= 1:
+            for layer in pending:
+                results[layer] = fn(layer, shared, **layer_kwargs[layer])
+                self._save(layer, results[layer], fingerprints.get(layer))
+                logger.info(f"Layer {layer} done.")
+            return {layer: results[layer] for layer in layer_kwargs}
+
+        threads = self.threads_per_worker or max(1, cpu_count // num_workers)
+        for tensor in shared.values():
+            tensor.share_memory_()
+        logger.info(
+            f"Splitting {len(pending)} layers with {num_workers} workers, {threads} threads each"
+        )
+        with _limit_child_threads(threads), ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=mp.get_context(self.start_method),
+            initializer=_init_worker,
+            initargs=(shared, threads),
+        ) as executor:
+            futures = [
+                executor.submit(_run_job, fn, layer, layer_kwargs[layer])
+                for layer in pending
+            ]
+            for future in as_completed(futures):
+                layer, result = future.result()
+                results[layer] = result
+                self._save(layer, result, fingerprints.get(layer))
+                logger.info(f"Layer {layer} done.")
+        return {layer: results[layer] for layer in layer_kwargs}
+
+
+def clustering_split_job(
+    layer: int, shared: dict, config, template: str, distance: str = "l2"
+) -> list:
+    """`ClusteringSplit` of a layer, `shared` is the state dict of the model."""
+    split = ClusteringSplit(config, shared, template, layer, distance=distance)
+    split.split(cpu_threads=1)
+    return split.labels
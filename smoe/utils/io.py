@@ -1,11 +1,21 @@
 import gzip
+import hashlib
 import json
 import lzma
 import os
 import pickle
 import shutil
+from collections.abc import Mapping
+from functools import lru_cache
 
+import numpy as np
 import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+ARTIFACT_STORE_SUFFIX = ".safetensors"
+ARTIFACT_STORE_FORMAT = "smoe-artifacts"
+ARTIFACT_STORE_VERSION = 1
 
 
 def create_dir(dir):
@@ -23,11 +33,19 @@ def delete_file_or_dir(dir):
 
 
 def torch_load_template_file(path, template, layer):
+    if is_artifact_store(path):
+        return _open_artifact_store(path)[template.format(layer)]
     target = os.path.join(path, template.format(layer))
     return torch.load(target)
 
 
 def torch_load_template_score_file(path, template, layer):
+    if is_artifact_store(path):
+        store = _open_artifact_store(path)
+        return [
+            store[f"{expert_folder_name}/{template.format(layer)}"]
+            for expert_folder_name in store.children()
+        ]
     score_list = []
     for expert_folder_name in sorted(os.listdir(path)):
         score_file = os.path.join(path, expert_folder_name, template.format(layer))
@@ -36,6 +54,213 @@ def torch_load_template_score_file(path, template, layer):
     return score_list
 
 
+def config_hash(config) -> str:
+    """Hash of a (HF) model config, to check that artifacts belong to the model."""
+    if not isinstance(config, dict):
+        config = config.to_dict()
+    config = {
+        key: value
+        for key, value in config.items()
+        if key not in ("_name_or_path", "transformers_version")
+    }
+    return hashlib.sha256(
+        json.dumps(config, sort_keys=True, default=str).encode("utf8")
+    ).hexdigest()
+
+
+def is_artifact_store(path) -> bool:
+    return str(path).endswith(ARTIFACT_STORE_SUFFIX) and os.path.isfile(path)
+
+
+def _flatten_artifacts(obj, prefix, tensors, kinds):
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            key = str(key)
+            if "/" in key or "#" in key:
+                raise ValueError(f"Artifact keys must not contain '/' or '#': {key}")
+            _flatten_artifacts(
+                value, f"{prefix}/{key}" if prefix else key, tensors, kinds
+            )
+        return
+    if isinstance(obj, torch.Tensor):
+        tensors[prefix] = obj
+    elif isinstance(obj, np.ndarray):
+        tensors[prefix] = torch.from_numpy(obj)
+    elif isinstance(obj, (list, tuple)) and all(
+        isinstance(x, (list, tuple)) for x in obj
+    ):
+        # ragged lists of ints (e.g. neuron indices of experts): values + offsets
+        lengths = torch.tensor([len(x) for x in obj], dtype=torch.long)
+        tensors[prefix] = torch.tensor(
+            [int(v) for x in obj for v in x], dtype=torch.long
+        )
+        tensors[f"{prefix}#offsets"] = torch.cat(
+            [torch.zeros(1, dtype=torch.long), lengths.cumsum(0)]
+        )
+        kinds[prefix] = "nested_list"
+    elif isinstance(obj, (list, tuple)):
+        tensors[prefix] = torch.tensor([int(v) for v in obj], dtype=torch.long)
+        kinds[prefix] = "list"
+    else:
+        raise TypeError(f"Unsupported artifact type for {prefix}: {type(obj)}")
+
+
+def save_artifact_store(obj: dict, path: str, config=None, **manifest):
+    """
+    Saves the (nested) dict `obj` of tensors, numpy arrays, lists of ints and lists of lists of ints
+    to a single safetensors file, with nested keys joined by "/" (e.g. `{layer: {expert: scores}}`
+    -> "0/3"). `config` (a model config) is hashed into the manifest in the header, together with
+    the extra `manifest` fields.
+    """
+    tensors, kinds = {}, {}
+    _flatten_artifacts(obj, "", tensors, kinds)
+    # safetensors refuses shared storages
+    tensors = {
+        key: value.detach().cpu().contiguous().clone() for key, value in tensors.items()
+    }
+    manifest = {
+        "format": ARTIFACT_STORE_FORMAT,
+        "version": ARTIFACT_STORE_VERSION,
+        "config_hash": None if config is None else config_hash(config),
+        "kinds": kinds,
+        **manifest,
+    }
+    save_file(tensors, path, metadata={"manifest": json.dumps(manifest, default=str)})
+
+
+def _to_artifact_key(name: str):
+    return int(name) if name.isdigit() else name
+
+
+def _artifact_name_order(name: str):
+    return (0, int(name), "") if name.isdigit() else (1, 0, name)
+
+
+class ArtifactStore(Mapping):
+    """
+    Read-only, memory-mapped view of a file written by `save_artifact_store`.
+
+    The header is read once on open, every tensor is loaded on access only, so any layer is
+    available without reading the others. Indexing returns a leaf (tensor / list) or the nested
+    dict under the key, e.g. `store[3]` for the artifacts of layer 3 and `store["3/0"]` for one
+    of its experts. Digit keys are restored as ints.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._handle = safe_open(path, framework="pt", device="cpu")
+        metadata = self._handle.metadata() or {}
+        self.manifest: dict = json.loads(metadata.get("manifest", "{}"))
+        if self.manifest.get("format") != ARTIFACT_STORE_FORMAT:
+            raise ValueError(f"{path} is not an artifact store!")
+        self._kinds: dict = self.manifest.get("kinds", {})
+        self._leaves = {key for key in self._handle.keys() if "#" not in key}
+        # {top level name: [keys]}
+        self._index: dict[str, list[str]] = {}
+        for key in sorted(self._leaves):
+            self._index.setdefault(key.split("/", 1)[0], []).append(key)
+
+    def check_config(self, config):
+        expected = self.manifest.get("config_hash")
+        if expected is not None and expected != config_hash(config):
+            raise ValueError(
+                f"The artifacts in {self.path} were not created for this model config!"
+            )
+
+    def children(self, prefix: str = "") -> list[str]:
+        """
+        Sorted names right under `prefix` ("" for the top level), digit names (layers, experts) in
+        numeric order like the dicts they were saved from.
+        """
+        if not prefix:
+            return sorted(self._index, key=_artifact_name_order)
+        prefix = f"{prefix}/"
+        keys = self._index.get(prefix.split("/", 1)[0], [])
+        return sorted(
+            {
+                key[len(prefix) :].split("/", 1)[0]
+                for key in keys
+                if key.startswith(prefix)
+            },
+            key=_artifact_name_order,
+        )
+
+    def _load_leaf(self, key: str):
+        tensor = self._handle.get_tensor(key)
+        kind = self._kinds.get(key)
+        if kind == "list":
+            return tensor.tolist()
+        if kind == "nested_list":
+            offsets = self._handle.get_tensor(f"{key}#offsets").tolist()
+            values = tensor.tolist()
+            return [values[begin:end] for begin, end in zip(offsets[:-1], offsets[1:])]
+        return tensor
+
+    def get_slice(self, key):
+        """Lazy slice of a tensor leaf, only the sliced part is read, e.g. `store.get_slice("3")[:, :128]`."""
+        return self._handle.get_slice(str(key))
+
+    def __getitem__(self, key):
+        key = str(key)
+        if key in self._leaves:
+            return self._load_leaf(key)
+        names = self.children(key)
+        if not names:
+            raise KeyError(key)
+        return {_to_artifact_key(name): self[f"{key}/{name}"] for name in names}
+
+    def __contains__(self, key) -> bool:
+        key = str(key)
+        return key in self._leaves or bool(self.children(key))
+
+    def __iter__(self):
+        return (_to_artifact_key(name) for name in self.children())
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+@lru_cache(maxsize=16)
+def _open_artifact_store_cached(path: str, mtime_ns: int) -> ArtifactStore:
+    return ArtifactStore(path)
+
+
+def _open_artifact_store(path) -> ArtifactStore:
+    """Opened stores are reused by the per-layer loaders until the file changes."""
+    path = os.path.realpath(path)
+    return _open_artifact_store_cached(path, os.stat(path).st_mtime_ns)
+
+
+def load_artifacts(path: str):
+    """`ArtifactStore` for artifact stores, the unpickled object for `torch.save` files."""
+    if is_artifact_store(path):
+        return ArtifactStore(path)
+    return torch.load(path, map_location="cpu")
+
+
+def pack_artifacts(src: str, dst: str, config=None, **manifest):
+    """
+    Packs `torch.save` artifacts into an artifact store: a single file (e.g. `importance_scores.pt`),
+    or a folder of per-layer / per-expert files (e.g. the outputs of `LayerSplit.save`), which are
+    keyed by their relative paths so that `torch_load_template_file` and
+    `torch_load_template_score_file` read the store as they read the folder.
+    """
+    if os.path.isfile(src):
+        obj = torch.load(src, map_location="cpu")
+    else:
+        obj = {}
+        for root, _, filenames in os.walk(src):
+            for filename in sorted(filenames):
+                keys = os.path.relpath(os.path.join(root, filename), src).split(os.sep)
+                node = obj
+                for key in keys[:-1]:
+                    node = node.setdefault(key, {})
+                node[keys[-1]] = torch.load(
+                    os.path.join(root, filename), map_location="cpu"
+                )
+    save_artifact_store(obj, dst, config=config, source=src, **manifest)
+
+
 def save_compressed_file_7z(tensor, path):  # 7z
     with lzma.open(path, "wb") as file:
         pickle.dump(tensor, file)
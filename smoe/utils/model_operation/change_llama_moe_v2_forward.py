@@ -98,10 +98,10 @@ def forward_llama_moe_v2_decoder_with_hidden_states_distribution_recording(
 
     # 🔍
     if self.is_moe:
-        hidden_states, router_logits = self.block_sparse_moe(hidden_states)
+        hidden_states, router_logits, routing_stats = self.block_sparse_moe(hidden_states)
     else:
         hidden_states = self.block_sparse_moe(hidden_states)
-        router_logits = None
+        router_logits = routing_stats = None
 
     ##########################################################
     # record distribution for MLP
@@ -141,7 +141,7 @@ def forward_llama_moe_v2_decoder_with_hidden_states_distribution_recording(
         outputs += (present_key_value,)
 
     if output_router_logits:
-        outputs += (router_logits, attn_router_logits)  # 🔍
+        outputs += (router_logits, routing_stats, attn_router_logits)  # 🔍
 
     return outputs
     # fmt: on
@@ -236,7 +236,7 @@ def forward_llama_moe_v2_decoder_with_hidden_states_distribution_recording_for_a
             outputs += (present_key_value,)
 
         if output_router_logits:
-            outputs += (None, attn_router_logits)
+            outputs += (None, None, attn_router_logits)
 
         return outputs
     ##########################################################
@@ -249,10 +249,10 @@ def forward_llama_moe_v2_decoder_with_hidden_states_distribution_recording_for_a
 
     # 🔍
     if self.is_moe:
-        hidden_states, router_logits = self.block_sparse_moe(hidden_states)
+        hidden_states, router_logits, routing_stats = self.block_sparse_moe(hidden_states)
     else:
         hidden_states = self.block_sparse_moe(hidden_states)
-        router_logits = None
+        router_logits = routing_stats = None
 
     ##########################################################
     # record distribution for MLP
@@ -293,7 +293,7 @@ def forward_llama_moe_v2_decoder_with_hidden_states_distribution_recording_for_a
         outputs += (present_key_value,)
 
     if output_router_logits:
-        outputs += (router_logits, attn_router_logits)  # 🔍
+        outputs += (router_logits, routing_stats, attn_router_logits)  # 🔍
 
     return outputs
     # fmt: on
@@ -419,6 +419,7 @@ def forward_llama_moe_v2_model_with_early_stopping(
     all_hidden_states = () if output_hidden_states else None
     all_self_attns = () if output_attentions else None
     all_router_logits = () if output_router_logits else None
+    all_routing_stats = () if output_router_logits else None
     all_attn_router_logits = () if output_router_logits else None  # 🔍
     next_decoder_cache = None
 
@@ -471,7 +472,8 @@ def forward_llama_moe_v2_model_with_early_stopping(
             all_self_attns += (layer_outputs[1],)
 
         if output_router_logits:
-            all_router_logits += (layer_outputs[-2],)
+            all_router_logits += (layer_outputs[-3],)
+            all_routing_stats += (layer_outputs[-2],)
             all_attn_router_logits += (layer_outputs[-1],)
 
     hidden_states = self.norm(hidden_states)
@@ -497,6 +499,8 @@ def forward_llama_moe_v2_model_with_early_stopping(
                 all_hidden_states,
                 all_self_attns,
                 all_router_logits,
+                all_routing_stats,
+                all_attn_router_logits,
             ]
             if v is not None
         )
@@ -506,5 +510,6 @@ def forward_llama_moe_v2_model_with_early_stopping(
         hidden_states=all_hidden_states,
         attentions=all_self_attns,
         router_logits=all_router_logits,
+        routing_stats=all_routing_stats,
         attn_router_logits=all_attn_router_logits,  # 🔍
     )
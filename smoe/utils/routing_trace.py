@@ -0,0 +1,363 @@
+"""
+Compact routing traces for offline routing analysis.
+
+`RoutingTraceRecorder` hooks the gates of a MoE model and records, for every non-padding token,
+its token id and the top-k expert ids and routing weights of every MoE layer.
+Records are written by `RoutingTraceWriter` as columnar chunks in a folder:
+
+    ROUTING_TRACE_INDEX_NAME      {"num_layers", "num_experts", "top_k", "vocab_size", "token_dtype", "chunks": [{"name", "num_tokens"}, ...]}
+    chunk-00000.tokens.bin        (num_tokens,) uint16 (uint32 for vocabularies over 65536)
+    chunk-00000.experts.bin       (num_tokens, num_layers, top_k) uint8 (uint16 for over 256 experts)
+    chunk-00000.weights.bin       (num_tokens, num_layers, top_k) bfloat16 bits as uint16
+
+`RoutingTrace` memory-maps a trace and computes expert load, co-occurrence,
+per-token specialization and layer-to-layer transitions chunk by chunk,
+so statistics can be changed without re-running the model.
+"""
+
+import os
+from pathlib import Path
+from typing import Iterator, Optional
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from smoe.modules.moe.moe_layers import BaseMoELayer
+from smoe.utils.io import dump_json, load_json
+from smoe.utils.logging import get_logger
+from smoe.utils.vars import ROUTING_TRACE_INDEX_NAME
+
+logger = get_logger(__file__)
+
+ROUTING_TRACE_COLUMNS = ("tokens", "experts", "weights")
+
+
+def bf16_bits_to_float32(bits: np.ndarray) -> np.ndarray:
+    return (bits.astype(np.uint32) << 16).view(np.float32)
+
+
+class RoutingTraceWriter:
+    def __init__(
+        self,
+        folder: str,
+        num_layers: int,
+        num_experts: int,
+        top_k: int,
+        vocab_size: int = None,
+        chunk_size: int = 1 << 20,
+    ):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.chunk_size = chunk_size
+        self.meta = {
+            "num_layers": num_layers,
+            "num_experts": num_experts,
+            "top_k": top_k,
+            "vocab_size": vocab_size,
+            "token_dtype": (
+                "uint16"
+                if vocab_size is not None and vocab_size <= 1 << 16
+                else "uint32"
+            ),
+            "expert_dtype": "uint8" if num_experts <= 1 << 8 else "uint16",
+            "chunks": [],
+        }
+        self._buffers = {name: [] for name in ROUTING_TRACE_COLUMNS}
+        self._num_buffered = 0
+
+    @property
+    def num_tokens(self) -> int:
+        return sum(c["num_tokens"] for c in self.meta["chunks"]) + self._num_buffered
+
+    def append(self, tokens: np.ndarray, experts: np.ndarray, weight_bits: np.ndarray):
+        """
+        Args:
+            tokens: (num_tokens,)
+            experts: (num_tokens, num_layers, top_k)
+            weight_bits: (num_tokens, num_layers, top_k) bfloat16 bits
+        """
+        self._buffers["tokens"].append(tokens.astype(self.meta["token_dtype"]))
+        self._buffers["experts"].append(experts.astype(self.meta["expert_dtype"]))
+        self._buffers["weights"].append(weight_bits.astype(np.uint16))
+        self._num_buffered += len(tokens)
+        if self._num_buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._num_buffered == 0:
+            return
+        name = f"chunk-{len(self.meta['chunks']):05d}"
+        for column, arrays in self._buffers.items():
+            with open(self.folder / f"{name}.{column}.bin", "wb") as fout:
+                for arr in arrays:
+                    fout.write(np.ascontiguousarray(arr).tobytes())
+            arrays.clear()
+        self.meta["chunks"].append({"name": name, "num_tokens": self._num_buffered})
+        self._num_buffered = 0
+        # the index only lists finished chunks, so an interrupted trace stays readable
+        tmp_path = self.folder / f"{ROUTING_TRACE_INDEX_NAME}.tmp"
+        dump_json(self.meta, tmp_path, indent=2)
+        os.replace(tmp_path, self.folder / ROUTING_TRACE_INDEX_NAME)
+
+    def close(self):
+        self.flush()
+
+
+def find_moe_gates(model: nn.Module) -> list[tuple[str, nn.Module, Optional[int]]]:
+    """
+    `(name, gate, top_k)` of the MoE layers in forward order.
+    `top_k` is None for `BaseMoELayer` gates, which return the selected experts themselves,
+    and the number of selected experts for Mixtral-style linear routers.
+    """
+    gates = []
+    for name, module in model.named_modules():
+        if isinstance(module, BaseMoELayer):
+            gates.append((name, module.gate, None))
+        elif (
+            isinstance(getattr(module, "gate", None), nn.Linear)
+            and hasattr(module, "experts")
+            and hasattr(module, "top_k")
+        ):
+            # MixtralSparseMoeBlock
+            gates.append((name, module.gate, module.top_k))
+    return gates
+
+
+class RoutingTraceRecorder:
+    """
+    Records the routing of every forward pass of `model` into a `RoutingTraceWriter`.
+    Token ids and the attention mask are read from the `input_ids` and `attention_mask`
+    arguments of `model.forward`, padding tokens are skipped.
+
+    Per forward pass, the routing of all layers is converted to compact dtypes on device
+    and copied to host once.
+
+    Usage:
+        with RoutingTraceRecorder(model, folder) as recorder:
+            for batch in loader:
+                model(**batch)
+        trace = RoutingTrace(folder)
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        folder: str,
+        chunk_size: int = 1 << 20,
+        vocab_size: int = None,
+    ):
+        self.model = model
+        self.gates = find_moe_gates(model)
+        if len(self.gates) == 0:
+            raise ValueError("No MoE layer is found in the model")
+        first_gate = self.gates[0][1]
+        if self.gates[0][2] is None:
+            num_experts, top_k = first_gate.num_experts, first_gate.num_selects
+        else:
+            num_experts, top_k = first_gate.out_features, self.gates[0][2]
+        if vocab_size is None:
+            vocab_size = getattr(getattr(model, "config", None), "vocab_size", None)
+        self.writer = RoutingTraceWriter(
+            folder,
+            num_layers=len(self.gates),
+            num_experts=num_experts,
+            top_k=top_k,
+            vocab_size=vocab_size,
+            chunk_size=chunk_size,
+        )
+
+        self._input_ids = None
+        self._token_mask = None
+        self._layer_experts = []
+        self._layer_weights = []
+        self._hooks = [
+            model.register_forward_pre_hook(self._model_pre_hook, with_kwargs=True),
+            model.register_forward_hook(self._model_hook),
+        ]
+        for _, gate, top_k in self.gates:
+            self._hooks.append(gate.register_forward_hook(self._make_gate_hook(top_k)))
+
+    def _model_pre_hook(self, module, args, kwargs):
+        input_ids = kwargs.get("input_ids", args[0] if len(args) > 0 else None)
+        if input_ids is None:
+            raise ValueError("RoutingTraceRecorder needs `input_ids`")
+        attention_mask = kwargs.get("attention_mask")
+        self._input_ids = input_ids.reshape(-1)
+        self._token_mask = None
+        if attention_mask is not None:
+            # only the mask of the new tokens when decoding with cache
+            self._token_mask = attention_mask[:, -input_ids.shape[-1] :].reshape(-1)
+        self._layer_experts = []
+        self._layer_weights = []
+
+    def _make_gate_hook(self, top_k: Optional[int]):
+        @torch.no_grad()
+        def hook(module, args, output):
+            if top_k is None:
+                experts, weights = output["topK_indices"], output["topK_scores"]
+            else:
+                # the same routing as `MixtralSparseMoeBlock.forward`
+                scores = F.softmax(output, dim=-1, dtype=torch.float)
+                weights, experts = torch.topk(scores, top_k, dim=-1)
+                weights = weights / weights.sum(dim=-1, keepdim=True)
+            self._layer_experts.append(experts.to(torch.int32))
+            self._layer_weights.append(weights.to(torch.bfloat16))
+
+        return hook
+
+    @torch.no_grad()
+    def _model_hook(self, module, args, output):
+        if len(self._layer_experts) != len(self.gates):
+            logger.warning(
+                f"Got {len(self._layer_experts)} routed layers instead of {len(self.gates)}, skip this forward"
+            )
+            return
+        # (num_tokens, num_layers, top_k)
+        experts = torch.stack(self._layer_experts, dim=1)
+        weights = torch.stack(self._layer_weights, dim=1).view(torch.int16)
+        tokens = self._input_ids
+        if self._token_mask is not None:
+            keep = self._token_mask.bool()
+            tokens, experts, weights = tokens[keep], experts[keep], weights[keep]
+        self.writer.append(
+            tokens.cpu().numpy(),
+            experts.cpu().numpy(),
+            weights.cpu().numpy().view(np.uint16),
+        )
+        self._layer_experts = []
+        self._layer_weights = []
+
+    def close(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RoutingTrace:
+    """Read-only view of a routing trace folder, statistics are accumulated chunk by chunk."""
+
+    def __init__(self, folder: str):
+        self.folder = Path(folder)
+        self.meta = load_json(self.folder / ROUTING_TRACE_INDEX_NAME)
+        self.num_layers = self.meta["num_layers"]
+        self.num_experts = self.meta["num_experts"]
+        self.top_k = self.meta["top_k"]
+        self.vocab_size = self.meta["vocab_size"]
+
+    @property
+    def num_tokens(self) -> int:
+        return sum(c["num_tokens"] for c in self.meta["chunks"])
+
+    def __len__(self) -> int:
+        return self.num_tokens
+
+    def load_chunk(self, chunk_idx: int) -> dict[str, np.ndarray]:
+        """Memory maps of one chunk, `weights` are bfloat16 bits (see `bf16_bits_to_float32`)"""
+        chunk = self.meta["chunks"][chunk_idx]
+        n = chunk["num_tokens"]
+        shape = (n, self.num_layers, self.top_k)
+
+        def _map(column, dtype, shape):
+            path = self.folder / f"{chunk['name']}.{column}.bin"
+            return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+        return {
+            "tokens": _map("tokens", self.meta["token_dtype"], (n,)),
+            "experts": _map("experts", self.meta["expert_dtype"], shape),
+            "weights": _map("weights", np.uint16, shape),
+        }
+
+    def iter_chunks(self) -> Iterator[dict[str, np.ndarray]]:
+        for chunk_idx in range(len(self.meta["chunks"])):
+            yield self.load_chunk(chunk_idx)
+
+    def expert_load(self, weighted: bool = False) -> np.ndarray:
+        """(num_layers, num_experts) number of routed tokens, or the sum of routing weights"""
+        num_experts = self.num_experts
+        load = np.zeros(self.num_layers * num_experts, dtype=np.float64)
+        offsets = (np.arange(self.num_layers) * num_experts)[None, :, None]
+        for chunk in self.iter_chunks():
+            ids = (chunk["experts"] + offsets).reshape(-1)
+            weights = None
+            if weighted:
+                weights = bf16_bits_to_float32(chunk["weights"]).reshape(-1)
+            load += np.bincount(ids, weights=weights, minlength=load.shape[0])
+        load = load.reshape(self.num_layers, num_experts)
+        return load if weighted else load.astype(np.int64)
+
+    def co_occurrence(self, layer_idx: int) -> np.ndarray:
+        """
+        (num_experts, num_experts) number of tokens routed to both experts in `layer_idx`,
+        the diagonal is the expert load.
+        """
+        num_experts = self.num_experts
+        counts = np.zeros(num_experts * num_experts, dtype=np.int64)
+        for chunk in self.iter_chunks():
+            experts = chunk["experts"][:, layer_idx].astype(np.int64)
+            for i in range(self.top_k):
+                for j in range(self.top_k):
+                    counts += np.bincount(
+                        experts[:, i] * num_experts + experts[:, j],
+                        minlength=counts.shape[0],
+                    )
+        return counts.reshape(num_experts, num_experts)
+
+    def token_specialization(
+        self, layer_idx: int, vocab_size: int = None, normalize: bool = False
+    ) -> np.ndarray:
+        """
+        (vocab_size, num_experts) number of times each token id is routed to each expert in `layer_idx`.
+        With `normalize`, rows are the routing distributions of the token ids (zeros for unseen ids).
+        """
+        vocab_size = vocab_size or self.vocab_size
+        if vocab_size is None:
+            vocab_size = 1 + max(
+                (
+                    int(c["tokens"].max())
+                    for c in self.iter_chunks()
+                    if len(c["tokens"])
+                ),
+                default=0,
+            )
+        num_experts = self.num_experts
+        counts = np.zeros(vocab_size * num_experts, dtype=np.int64)
+        for chunk in self.iter_chunks():
+            tokens = chunk["tokens"].astype(np.int64)[:, None] * num_experts
+            ids = (tokens + chunk["experts"][:, layer_idx]).reshape(-1)
+            counts += np.bincount(ids, minlength=counts.shape[0])
+        counts = counts.reshape(vocab_size, num_experts)
+        if normalize:
+            totals = counts.sum(axis=1, keepdims=True)
+            return counts / np.maximum(totals, 1)
+        return counts
+
+    def layer_transitions(
+        self, src_layer: int, dst_layer: int = None, normalize: bool = False
+    ) -> np.ndarray:
+        """
+        (num_experts, num_experts) number of (expert in `src_layer`, expert in `dst_layer`) pairs
+        over all top-k selections of each token, `dst_layer` defaults to the next layer.
+        With `normalize`, rows are the transition probabilities from the `src_layer` experts.
+        """
+        if dst_layer is None:
+            dst_layer = src_layer + 1
+        num_experts = self.num_experts
+        counts = np.zeros(num_experts * num_experts, dtype=np.int64)
+        for chunk in self.iter_chunks():
+            src = chunk["experts"][:, src_layer].astype(np.int64)
+            dst = chunk["experts"][:, dst_layer].astype(np.int64)
+            ids = (src[:, :, None] * num_experts + dst[:, None, :]).reshape(-1)
+            counts += np.bincount(ids, minlength=counts.shape[0])
+        counts = counts.reshape(num_experts, num_experts)
+        if normalize:
+            return counts / np.maximum(counts.sum(axis=1, keepdims=True), 1)
+        return counts
@@ -0,0 +1,315 @@
+"""
+Low-overhead training telemetry.
+
+Routing statistics (`balance_loss`, `num_dropped_tokens`, `gate_load`, `gate_importance`)
+are accumulated on the device they are produced on, and only copied back to host once
+per logging interval with non-blocking copies into pinned buffers.
+The host values are picked up when the copy has finished (usually at the next logging step),
+so logging never forces a device synchronization.
+
+Collected values can be appended to a compact binary event file, see `TelemetryEventWriter`
+and `read_telemetry_events`.
+
+Consumed tokens are counted the same way: `DomainTokenCounter` accumulates the non-padding
+tokens of every source domain on device and reduces them across ranks at logging steps only.
+"""
+
+import os
+import struct
+import time
+from collections import deque
+from typing import Iterator, Optional
+
+import numpy as np
+import torch
+
+from smoe.utils.logging import get_logger
+
+logger = get_logger(__file__)
+
+ROUTING_STATS_KEYS = (
+    "balance_loss",
+    "num_dropped_tokens",
+    "gate_load",
+    "gate_importance",
+)
+
+TELEMETRY_MAGIC = b"SMOETEL1"
+# record length (excluding itself), global step, timestamp, name length, ndim
+_RECORD_HEADER = struct.Struct("<IqdHB")
+
+
+def _stack_stats(value) -> Optional[torch.Tensor]:
+    """Convert a model output field into a single tensor, `None` if it is not usable."""
+    if value is None:
+        return None
+    if isinstance(value, torch.Tensor):
+        return value.detach()
+    if isinstance(value, (int, float)):
+        return torch.tensor(float(value))
+    if isinstance(value, (list, tuple)) and len(value) > 0:
+        if not all(isinstance(v, torch.Tensor) for v in value):
+            return None
+        try:
+            return torch.stack([v.detach() for v in value])
+        except RuntimeError:
+            # mismatched shapes or devices across layers
+            return None
+    return None
+
+
+class RoutingStatsAccumulator:
+    """Accumulates routing statistics on device and copies their means to host asynchronously.
+
+    Usage:
+        acc.update(gate_load=outputs.gate_load, ...)  # every micro batch, no sync
+        acc.flush(global_step)  # at logging steps, launches non-blocking D2H copies
+        for step, stats in acc.collect():  # finished copies only
+            ...
+    """
+
+    def __init__(self, pin_memory: bool = None):
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+        self.pin_memory = pin_memory
+
+        self._sums: dict[str, torch.Tensor] = {}
+        self._counts: dict[str, int] = {}
+        # (step, {key: host tensor}, cuda event or None)
+        self._pending: deque = deque()
+        # reusable host buffers, {(key, shape): [tensor, ...]}
+        self._free_buffers: dict[tuple, list[torch.Tensor]] = {}
+
+    @property
+    def num_pending(self) -> int:
+        return len(self._pending)
+
+    @torch.no_grad()
+    def update(self, **stats):
+        for key, value in stats.items():
+            value = _stack_stats(value)
+            if value is None:
+                continue
+            value = value.float()
+            _sum = self._sums.get(key)
+            if _sum is None or _sum.shape != value.shape or _sum.device != value.device:
+                if _sum is not None:
+                    logger.warning(
+                        f"Telemetry `{key}` changed from {tuple(_sum.shape)} to {tuple(value.shape)}, restart accumulating"
+                    )
+                self._sums[key] = value.clone()
+                self._counts[key] = 1
+            else:
+                _sum.add_(value)
+                self._counts[key] += 1
+
+    def _get_host_buffer(self, key: str, tensor: torch.Tensor) -> torch.Tensor:
+        buffers = self._free_buffers.get((key, tuple(tensor.shape)))
+        if buffers:
+            return buffers.pop()
+        return torch.empty(
+            tensor.shape,
+            dtype=tensor.dtype,
+            device="cpu",
+            pin_memory=self.pin_memory and tensor.is_cuda,
+        )
+
+    @torch.no_grad()
+    def flush(self, step: int):
+        """Launch host copies of the interval means and reset the accumulators."""
+        if len(self._sums) == 0:
+            return
+        host_tensors = {}
+        event = None
+        for key, _sum in self._sums.items():
+            mean = _sum.div_(self._counts[key])
+            buf = self._get_host_buffer(key, mean)
+            buf.copy_(mean, non_blocking=mean.is_cuda and buf.is_pinned())
+            host_tensors[key] = buf
+            if mean.is_cuda:
+                event = torch.cuda.Event()
+                event.record(torch.cuda.current_stream(mean.device))
+        self._pending.append((step, host_tensors, event))
+        self._sums = {}
+        self._counts = {}
+
+    def collect(
+        self, blocking: bool = False
+    ) -> list[tuple[int, dict[str, np.ndarray]]]:
+        """Return `(step, stats)` of the finished copies in flush order.
+
+        Args:
+            blocking: wait for unfinished copies instead of leaving them to the next call.
+        """
+        results = []
+        while len(self._pending) > 0:
+            step, host_tensors, event = self._pending[0]
+            if event is not None and not event.query():
+                if not blocking:
+                    break
+                event.synchronize()
+            self._pending.popleft()
+            stats = {}
+            for key, buf in host_tensors.items():
+                stats[key] = buf.numpy().copy()
+                self._free_buffers.setdefault((key, tuple(buf.shape)), []).append(buf)
+            results.append((step, stats))
+        return results
+
+    def reset(self):
+        self._sums = {}
+        self._counts = {}
+        self._pending.clear()
+
+
+class DomainTokenCounter:
+    """Counts the non-padding tokens of every domain on device.
+
+    Batches without `domain_id` (or a counter without domains) are counted as `UNKNOWN_DOMAIN`.
+
+    Usage:
+        counter.update(input_ids, attention_mask=..., domain_ids=...)  # every micro batch, no sync
+        counts = counter.reduce(accelerator.reduce)  # at logging steps, {domain: num tokens}
+    """
+
+    UNKNOWN_DOMAIN = "unknown"
+
+    def __init__(self, domains: list[str] = None):
+        self.domains = list(domains) if domains is not None else []
+        # the last slot is for tokens without a known domain
+        self._counts: Optional[torch.Tensor] = None
+
+    @torch.no_grad()
+    def update(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor = None,
+        domain_ids: torch.Tensor = None,
+    ):
+        if attention_mask is not None:
+            num_tokens = attention_mask.view(attention_mask.shape[0], -1).sum(-1)
+        else:
+            num_tokens = torch.full(
+                (input_ids.shape[0],),
+                input_ids[0].numel(),
+                device=input_ids.device,
+            )
+        num_tokens = num_tokens.long()
+        if self._counts is None or self._counts.device != num_tokens.device:
+            self._counts = torch.zeros(
+                len(self.domains) + 1, dtype=torch.long, device=num_tokens.device
+            )
+        if domain_ids is None or len(self.domains) == 0:
+            self._counts[-1] += num_tokens.sum()
+        else:
+            self._counts.index_add_(
+                0, domain_ids.view(-1).to(num_tokens.device).long(), num_tokens
+            )
+
+    def reduce(self, reduce_fn=None, device=None) -> dict[str, int]:
+        """Counts since the last call, summed over ranks with `reduce_fn` (e.g. `accelerator.reduce`).
+
+        Must be called by all ranks, the device counts are copied to host once.
+        `device` holds the zero counts of a rank without batches in this interval.
+        """
+        counts = self._counts
+        if counts is None:
+            counts = torch.zeros(len(self.domains) + 1, dtype=torch.long, device=device)
+        if reduce_fn is not None:
+            counts = reduce_fn(counts)
+        values = counts.tolist()
+        self._counts = None
+
+        results = {domain: values[idx] for idx, domain in enumerate(self.domains)}
+        if values[-1] > 0:
+            results[self.UNKNOWN_DOMAIN] = values[-1]
+        return results
+
+
+def stats_to_logs(stats: dict[str, np.ndarray]) -> dict:
+    """Convert collected stats into python values for `Trainer.log`."""
+    logs = {}
+    for key, value in stats.items():
+        logs[key] = value.item() if value.ndim == 0 else value.tolist()
+    return logs
+
+
+class TelemetryEventWriter:
+    """Appends telemetry records to a compact binary file.
+
+    File layout: `TELEMETRY_MAGIC` followed by records of
+    `<IqdHB` header (record length, step, timestamp, name length, ndim),
+    utf-8 name, `ndim` uint32 dims, and float32 values in C order.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        folder = os.path.dirname(filepath)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        is_new = not os.path.exists(filepath) or os.path.getsize(filepath) == 0
+        self._fp = open(filepath, "ab")
+        if is_new:
+            self._fp.write(TELEMETRY_MAGIC)
+
+    def write(self, step: int, values: dict, timestamp: float = None):
+        if self._fp is None:
+            raise RuntimeError(f"TelemetryEventWriter({self.filepath}) is closed")
+        if timestamp is None:
+            timestamp = time.time()
+        chunks = []
+        for name, value in values.items():
+            arr = np.asarray(value, dtype=np.float32)
+            name_bytes = name.encode("utf-8")
+            body = (
+                name_bytes
+                + struct.pack(f"<{arr.ndim}I", *arr.shape)
+                + arr.tobytes(order="C")
+            )
+            length = _RECORD_HEADER.size - 4 + len(body)
+            chunks.append(
+                _RECORD_HEADER.pack(length, step, timestamp, len(name_bytes), arr.ndim)
+            )
+            chunks.append(body)
+        self._fp.write(b"".join(chunks))
+
+    def flush(self):
+        if self._fp is not None:
+            self._fp.flush()
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+def read_telemetry_events(filepath: str) -> Iterator[dict]:
+    """Yield `{"step", "time", "name", "value"}` records from a telemetry event file."""
+    with open(filepath, "rb") as fin:
+        data = fin.read()
+    if not data.startswith(TELEMETRY_MAGIC):
+        raise ValueError(f"{filepath} is not a telemetry event file")
+    offset = len(TELEMETRY_MAGIC)
+    while offset + _RECORD_HEADER.size <= len(data):
+        length, step, timestamp, name_len, ndim = _RECORD_HEADER.unpack_from(
+            data, offset
+        )
+        end = offset + 4 + length
+        if end > len(data):
+            # truncated tail, e.g. the job was killed while writing
+            break
+        pos = offset + _RECORD_HEADER.size
+        name = data[pos : pos + name_len].decode("utf-8")
+        pos += name_len
+        shape = struct.unpack_from(f"<{ndim}I", data, pos)
+        pos += 4 * ndim
+        value = np.frombuffer(
+            data, dtype=np.float32, count=int(np.prod(shape)), offset=pos
+        )
+        yield {
+            "step": step,
+            "time": timestamp,
+            "name": name,
+            "value": value.reshape(shape).copy(),
+        }
+        offset = end
@@ -1,37 +1,302 @@
+import os
 from pathlib import Path
+from typing import Iterable, Iterator
 
 import joblib
 import numpy as np
 from sentence_transformers import SentenceTransformer
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 
-from smoe.utils.vars import CLUSTERING_MODEL_NAME
+from smoe.utils.io import dump_json, load_json
+from smoe.utils.logging import get_logger
+from smoe.utils.vars import (
+    CLUSTERING_EMB_META_NAME,
+    CLUSTERING_EMB_NAME,
+    CLUSTERING_MODEL_NAME,
+)
+
+logger = get_logger(__file__)
+
+
+def iter_batches(items: Iterable, batch_size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+class EmbeddingStore:
+    """
+    Append-only float16 embedding matrix on disk, read back as a memory map.
+
+    Files in `folder`: `CLUSTERING_EMB_NAME` (raw row-major float16)
+    and `CLUSTERING_EMB_META_NAME` (`{"num": ..., "dim": ...}`).
+    """
+
+    def __init__(self, folder: str, dim: int = None, num: int = 0):
+        self.folder = Path(folder)
+        self.dim = dim
+        self.num = num
+        self._fout = None
+        self._mmap = None
+
+    @property
+    def emb_path(self) -> Path:
+        return self.folder / CLUSTERING_EMB_NAME
+
+    @property
+    def meta_path(self) -> Path:
+        return self.folder / CLUSTERING_EMB_META_NAME
+
+    @classmethod
+    def create(cls, folder: str) -> "EmbeddingStore":
+        store = cls(folder)
+        store.folder.mkdir(parents=True, exist_ok=True)
+        store._fout = open(store.emb_path, "wb")
+        return store
+
+    @classmethod
+    def open(cls, folder: str) -> "EmbeddingStore":
+        meta = load_json(Path(folder) / CLUSTERING_EMB_META_NAME)
+        return cls(folder, dim=meta["dim"], num=meta["num"])
+
+    def append(self, emb: np.ndarray):
+        if self._fout is None:
+            raise RuntimeError(f"EmbeddingStore({self.folder}) is not writable")
+        emb = np.asarray(emb)
+        if self.dim is None:
+            self.dim = emb.shape[1]
+        if emb.ndim != 2 or emb.shape[1] != self.dim:
+            raise ValueError(f"Expected (n, {self.dim}) embeddings, got {emb.shape}")
+        self._fout.write(np.ascontiguousarray(emb, dtype=np.float16).tobytes())
+        self.num += emb.shape[0]
+
+    def close(self):
+        if self._fout is not None:
+            self._fout.close()
+            self._fout = None
+            dump_json({"num": self.num, "dim": self.dim}, self.meta_path)
+
+    def __len__(self) -> int:
+        return self.num
+
+    @property
+    def array(self) -> np.ndarray:
+        """(num, dim) float16 read-only memory map"""
+        if self._fout is not None:
+            raise RuntimeError("Close the store before reading it")
+        if self._mmap is None:
+            self._mmap = np.memmap(
+                self.emb_path, dtype=np.float16, mode="r", shape=(self.num, self.dim)
+            )
+        return self._mmap
+
+    def iter_chunks(self, chunk_size: int, order: np.ndarray = None):
+        """Yield float32 chunks, `order` is an optional permutation of chunk indices"""
+        num_chunks = (self.num + chunk_size - 1) // chunk_size
+        if order is None:
+            order = range(num_chunks)
+        for chunk_idx in order:
+            start = chunk_idx * chunk_size
+            yield self.array[start : start + chunk_size].astype(np.float32)
 
 
 class TextClustering:
+    """
+    Sentence-embedding k-means clustering that scales beyond memory.
+
+    Texts are encoded in fixed-size batches, optionally on a pool of CPU worker processes,
+    embeddings are streamed into a float16 `EmbeddingStore`, clusters are fitted with
+    mini-batch k-means over memory-mapped chunks, and prediction is a chunked
+    nearest-centroid search. In-memory embedding arrays are fitted with full-batch k-means.
+
+    Example:
+        >>> clustering = TextClustering(num_clusters=16, num_workers=8)
+        >>> store = clustering.encode_to_store(texts, "results/emb")
+        >>> clustering.fit_emb(store, num_epochs=2)
+        >>> labels = clustering.predict_store(store)
+    """
+
     def __init__(
-        self, num_clusters: int = 16, encoder: str = "all-mpnet-base-v2"
+        self,
+        num_clusters: int = 16,
+        encoder: str = "all-mpnet-base-v2",
+        encode_batch_size: int = 256,
+        kmeans_batch_size: int = 4096,
+        num_workers: int = 0,
+        seed: int = 1227,
     ) -> None:
-        self.kmeans = KMeans(n_clusters=num_clusters)
-        self.emb = SentenceTransformer(encoder)
+        self.emb = SentenceTransformer(encoder) if isinstance(encoder, str) else encoder
+        self.encode_batch_size = encode_batch_size
+        self.kmeans_batch_size = kmeans_batch_size
+        self.num_workers = num_workers
+        self.seed = seed
+        self._pool = None
+        self.kmeans = self._new_kmeans(num_clusters, minibatch=True)
 
     @property
     def num_clusters(self) -> int:
         return self.kmeans.n_clusters
 
+    def _new_kmeans(
+        self, num_clusters: int, minibatch: bool
+    ) -> KMeans | MiniBatchKMeans:
+        if minibatch:
+            return MiniBatchKMeans(
+                n_clusters=num_clusters,
+                batch_size=self.kmeans_batch_size,
+                random_state=self.seed,
+                n_init="auto",
+            )
+        return KMeans(n_clusters=num_clusters, random_state=self.seed, n_init="auto")
+
+    def start_pool(self):
+        """Start CPU encoding worker processes, no-op if `num_workers` <= 1"""
+        if self._pool is None and self.num_workers > 1:
+            self._pool = self.emb.start_multi_process_pool(
+                target_devices=["cpu"] * self.num_workers
+            )
+
+    def stop_pool(self):
+        if self._pool is not None:
+            SentenceTransformer.stop_multi_process_pool(self._pool)
+            self._pool = None
+
     def encode_emb(self, sentences: list[str]) -> np.ndarray:
-        arr: np.ndarray = self.emb.encode(sentences=sentences, show_progress_bar=False)
+        if self._pool is not None:
+            return self.emb.encode_multi_process(
+                sentences,
+                self._pool,
+                batch_size=self.encode_batch_size,
+                chunk_size=self.encode_batch_size,
+            )
+        arr: np.ndarray = self.emb.encode(
+            sentences=sentences,
+            batch_size=self.encode_batch_size,
+            show_progress_bar=False,
+        )
         return arr
 
-    def fit_emb(self, emb: np.ndarray):
-        self.kmeans.fit(emb)
+    def encode_to_store(
+        self, sentences: Iterable[str], folder: str, flush_size: int = None
+    ) -> EmbeddingStore:
+        """
+        Encode a (possibly lazy) stream of texts into an `EmbeddingStore`.
+
+        Args:
+            flush_size: number of texts encoded and written at a time,
+                defaults to `encode_batch_size * max(1, num_workers) * 4`
+        """
+        if flush_size is None:
+            flush_size = self.encode_batch_size * max(1, self.num_workers) * 4
+        own_pool = self._pool is None
+        self.start_pool()
+        store = EmbeddingStore.create(folder)
+        try:
+            for batch in iter_batches(sentences, flush_size):
+                store.append(self.encode_emb(batch))
+                logger.debug(f"Encoded {store.num} texts into {folder}")
+        finally:
+            store.close()
+            if own_pool:
+                self.stop_pool()
+        return store
+
+    def fit_emb(
+        self,
+        emb: np.ndarray | EmbeddingStore,
+        num_epochs: int = 1,
+        minibatch: bool = None,
+    ):
+        """
+        Args:
+            num_epochs: passes over the embeddings, only used by mini-batch k-means
+            minibatch: fit mini-batch k-means over shuffled chunks, defaults to True
+                for an `EmbeddingStore` and False for in-memory arrays,
+                which are fitted with full-batch k-means
+        """
+        if minibatch is None:
+            minibatch = isinstance(emb, EmbeddingStore)
+        if not minibatch:
+            if isinstance(emb, EmbeddingStore):
+                emb = emb.array.astype(np.float32)
+            self.kmeans = self._new_kmeans(self.num_clusters, minibatch=False)
+            self.kmeans.fit(emb)
+            return
+        if not isinstance(self.kmeans, MiniBatchKMeans):
+            self.kmeans = self._new_kmeans(self.num_clusters, minibatch=True)
+        num = len(emb)
+        if num < self.num_clusters:
+            raise ValueError(
+                f"Number of samples ({num}) < number of clusters ({self.num_clusters})"
+            )
+        rng = np.random.default_rng(self.seed)
+        chunk_size = max(self.kmeans_batch_size, self.num_clusters)
+        num_chunks = (num + chunk_size - 1) // chunk_size
+        for epoch in range(num_epochs):
+            order = rng.permutation(num_chunks)
+            if isinstance(emb, EmbeddingStore):
+                chunks = emb.iter_chunks(chunk_size, order)
+            else:
+                chunks = (
+                    emb[i * chunk_size : (i + 1) * chunk_size].astype(np.float32)
+                    for i in order
+                )
+            for chunk in chunks:
+                # the first partial_fit call needs at least `num_clusters` samples
+                if chunk.shape[0] < self.num_clusters and not hasattr(
+                    self.kmeans, "cluster_centers_"
+                ):
+                    continue
+                self.kmeans.partial_fit(chunk)
+            logger.debug(f"MiniBatchKMeans epoch {epoch} done")
 
     def fit(self, sentences: list[str]):
         emb_arr = self.encode_emb(sentences)
-        self.kmeans.fit(emb_arr)
+        self.fit_emb(emb_arr)
+
+    def _nearest_centroids(self, chunk: np.ndarray) -> np.ndarray:
+        centers = self.kmeans.cluster_centers_.astype(np.float32)
+        # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, |x|^2 does not change the argmin
+        dist = (centers * centers).sum(axis=1)[None, :] - 2.0 * (chunk @ centers.T)
+        return dist.argmin(axis=1).astype(np.int32)
+
+    def predict_emb(self, emb: np.ndarray, chunk_size: int = 65536) -> list[int]:
+        labels = [
+            self._nearest_centroids(emb[start : start + chunk_size].astype(np.float32))
+            for start in range(0, len(emb), chunk_size)
+        ]
+        if len(labels) == 0:
+            return []
+        return np.concatenate(labels).tolist()
+
+    def predict_store(
+        self, store: EmbeddingStore, chunk_size: int = 65536, output_path: str = None
+    ) -> np.ndarray:
+        """
+        Cluster ids of all embeddings in `store`.
 
-    def predict_emb(self, emb: np.ndarray) -> list[int]:
-        return self.kmeans.predict(emb).tolist()
+        Args:
+            output_path: if set, labels are written to this `.npy` file as a memory map
+        """
+        if output_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+            labels = np.lib.format.open_memmap(
+                output_path, mode="w+", dtype=np.int32, shape=(len(store),)
+            )
+        else:
+            labels = np.empty(len(store), dtype=np.int32)
+        start = 0
+        for chunk in store.iter_chunks(chunk_size):
+            labels[start : start + chunk.shape[0]] = self._nearest_centroids(chunk)
+            start += chunk.shape[0]
+        if isinstance(labels, np.memmap):
+            labels.flush()
+        return labels
 
     def predict(self, sentences: list[str]) -> list[int]:
         emb_arr = self.encode_emb(sentences)
@@ -43,9 +308,9 @@ class TextClustering:
         joblib.dump(self.kmeans, model_path)
 
     @classmethod
-    def from_pretrained(cls, folder: str):
+    def from_pretrained(cls, folder: str, **kwargs):
         model_path = Path(folder) / CLUSTERING_MODEL_NAME
         kmeans = joblib.load(model_path)
-        model = cls()
+        model = cls(num_clusters=kmeans.n_clusters, **kwargs)
         model.kmeans = kmeans
         return model
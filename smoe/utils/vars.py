@@ -4,3 +4,10 @@ MIDDLE_MODEL_CKPT_DIR = "middle"
 CLUSTERING_MODEL_NAME = "clustering.model"
 JSONL_DATASET_CACHE_NAME = "jsonl_dataset-{}.bin"
 META_SUFFIX = ".meta"
+ASYNC_CKPT_SHARD_NAME = "model-rank{:05d}-of-{:05d}.safetensors"
+ASYNC_CKPT_RANK_META_NAME = "model-rank{:05d}-of-{:05d}.json"
+ASYNC_CKPT_MANIFEST_NAME = "async_ckpt_manifest.json"
+TELEMETRY_EVENTS_NAME = "telemetry_events.bin"
+CLUSTERING_EMB_NAME = "embeddings.fp16.bin"
+CLUSTERING_EMB_META_NAME = "embeddings.json"
+ROUTING_TRACE_INDEX_NAME = "routing_trace.json"
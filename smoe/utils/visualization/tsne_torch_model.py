@@ -12,6 +12,8 @@
 #  Created by Xiao Li on 23-03-2020.
 #  Copyright (c) 2020, 2021 Xiao Li, Palle Klewitz. All rights reserved.
 
+import itertools
+import math
 import sys
 from typing import Union
 
@@ -41,12 +43,54 @@ else:
 
 
 # noinspection PyPep8Naming
-def _h_beta_torch(D: torch.Tensor, beta: float = 1.0):
+def _binary_search_perplexity(
+    D: torch.Tensor,
+    perplexity: float = 30.0,
+    tol: float = 1e-5,
+    max_tries: int = 50,
+    verbose: bool = False,
+):
+    """
+    Binary search of the precisions of all rows of the (N, M) squared distances D at once,
+    so that each conditional Gaussian has the same perplexity. Returns the (N, M) conditional P-values.
+    """
+    # the entropy does not change with a shift of the distances, which keeps exp(-D * beta) from underflowing
+    D = D - D.min(dim=1, keepdim=True).values
+    n = D.shape[0]
+    beta = torch.ones(n, 1, device=D.device)
+    betamin = torch.full((n, 1), -float("inf"), device=D.device)
+    betamax = torch.full((n, 1), float("inf"), device=D.device)
+    logU = math.log(perplexity)
+
+    bar = range(max_tries)
+    if verbose:
+        bar = tqdm(bar, desc="perplexity search")
+    for _ in bar:
+        P = torch.exp(-D * beta)
+        sumP = torch.sum(P, dim=1, keepdim=True) + 1e-10
+        H = torch.log(sumP) + beta * torch.sum(D * P, dim=1, keepdim=True) / sumP
+        h_diff = H - logU
+        todo = torch.abs(h_diff) > tol
+        if not todo.any():
+            break
+        # If not, increase or decrease precision
+        higher = todo & (h_diff > 0)
+        lower = todo & (h_diff <= 0)
+        betamin = torch.where(higher, beta, betamin)
+        betamax = torch.where(lower, beta, betamax)
+        beta = torch.where(
+            higher,
+            torch.where(torch.isinf(betamax), beta * 2.0, (beta + betamax) / 2.0),
+            beta,
+        )
+        beta = torch.where(
+            lower,
+            torch.where(torch.isinf(betamin), beta / 2.0, (beta + betamin) / 2.0),
+            beta,
+        )
+
     P = torch.exp(-D * beta)
-    sumP = torch.sum(P) + 1e-10
-    H = torch.log(sumP) + beta * torch.sum(D * P) / sumP
-    P = P / sumP
-    return H, P
+    return P / (torch.sum(P, dim=1, keepdim=True) + 1e-10)
 
 
 # noinspection PyPep8Naming
@@ -64,61 +108,22 @@ def _x2p_torch(
     """
 
     # Initialize some variables
-    # print("Computing pairwise distances...")
     (n, d) = X.shape
 
     sum_X = torch.sum(X * X, 1)
     D = torch.add(torch.add(-2 * torch.mm(X, X.t()), sum_X).t(), sum_X).to(device)
 
+    # all rows are searched at once, on the distances to the other points
+    off_diagonal = ~torch.eye(n, dtype=torch.bool, device=device)
+    thisP = _binary_search_perplexity(
+        D[off_diagonal].view(n, n - 1),
+        perplexity,
+        tol=tol,
+        max_tries=initial_dims,
+        verbose=verbose,
+    )
     P = torch.zeros(n, n, device=device)
-    beta = torch.ones(n, 1, device=device)
-    logU = torch.log(torch.tensor([perplexity], device=device))
-    n_list = [i for i in range(n)]
-
-    # Loop over all datapoints
-    bar = range(n)
-    if verbose:
-        bar = tqdm(bar)
-
-    for i in bar:
-        # Print progress
-        # if i % 500 == 0:
-        #     print("Computing P-values for point %d of %d..." % (i, n))
-
-        # Compute the Gaussian kernel and entropy for the current precision
-        # there may be something wrong with this setting None
-        betamin = None
-        betamax = None
-        Di = D[i, n_list[0:i] + n_list[i + 1 : n]]
-
-        (H, thisP) = _h_beta_torch(Di, beta[i])
-
-        # Evaluate whether the perplexity is within tolerance
-        h_diff = H - logU
-        tries = 0
-        while torch.abs(h_diff) > tol and tries < initial_dims:
-            # If not, increase or decrease precision
-            if h_diff > 0:
-                betamin = beta[i].clone()
-                if betamax is None:
-                    beta[i] = beta[i] * 2.0
-                else:
-                    beta[i] = (beta[i] + betamax) / 2.0
-            else:
-                betamax = beta[i].clone()
-                if betamin is None:
-                    beta[i] = beta[i] / 2.0
-                else:
-                    beta[i] = (beta[i] + betamin) / 2.0
-
-            # Recompute the values
-            (H, thisP) = _h_beta_torch(Di, beta[i])
-
-            h_diff = H - logU
-            tries += 1
-
-        # Set the final row of P
-        P[i, n_list[0:i] + n_list[i + 1 : n]] = thisP
+    P[off_diagonal] = thisP.view(-1)
 
     # Return final P-matrix
     return P
@@ -147,6 +152,281 @@ def _pca_torch(X, device, no_dims=50, verbose=False):
     return Y
 
 
+def _as_float_tensor(X, device) -> Tensor:
+    if isinstance(X, np.ndarray):  # also np.memmap
+        X = torch.from_numpy(np.ascontiguousarray(X))
+    return X.to(device=device, dtype=torch.float32)
+
+
+def _rows_per_chunk(max_memory_bytes: int, bytes_per_row: int) -> int:
+    return max(1, int(max_memory_bytes // max(bytes_per_row, 1)))
+
+
+def _pca_torch_chunked(X, device, no_dims=50, max_memory_bytes=1 << 30) -> Tensor:
+    """
+    PCA of the (N, D) X (tensor, ndarray or memmap), reading at most `max_memory_bytes`
+    of rows at a time. The components are sorted by decreasing variance.
+    """
+    (n, d) = X.shape
+    chunk_size = _rows_per_chunk(max_memory_bytes, 8 * d)
+
+    mean = torch.zeros(d, dtype=torch.float64, device=device)
+    for start in range(0, n, chunk_size):
+        mean += _as_float_tensor(X[start : start + chunk_size], device).double().sum(0)
+    mean /= n
+
+    M = None
+    if no_dims < d:
+        cov = torch.zeros(d, d, dtype=torch.float64, device=device)
+        for start in range(0, n, chunk_size):
+            chunk = _as_float_tensor(X[start : start + chunk_size], device).double()
+            chunk -= mean
+            cov += torch.mm(chunk.t(), chunk)
+        # ascending eigenvalues
+        (_, M) = torch.linalg.eigh(cov)
+        M = M[:, -no_dims:].flip(1).float()
+
+    Y = torch.empty(n, min(no_dims, d), device=device)
+    for start in range(0, n, chunk_size):
+        chunk = _as_float_tensor(X[start : start + chunk_size], device) - mean.float()
+        Y[start : start + chunk.shape[0]] = chunk if M is None else torch.mm(chunk, M)
+    return Y
+
+
+def _knn_torch(X: torch.Tensor, k: int, max_memory_bytes=1 << 30, verbose=False):
+    """
+    Exact k nearest neighbours of every row of X, as (N, k) squared distances and indices.
+    Rows are processed in chunks of at most `max_memory_bytes` of distances.
+    """
+    n = X.shape[0]
+    chunk_size = _rows_per_chunk(max_memory_bytes, 8 * n)
+    sum_X = torch.sum(X * X, 1)
+    distances = torch.empty(n, k, device=X.device)
+    indices = torch.empty(n, k, dtype=torch.long, device=X.device)
+
+    bar = range(0, n, chunk_size)
+    if verbose:
+        bar = tqdm(bar, desc="kNN")
+    for start in bar:
+        end = min(start + chunk_size, n)
+        # |x_j|^2 - 2 x_i x_j, |x_i|^2 does not change the ranking of a row and is added back after topk
+        D = torch.addmm(sum_X.unsqueeze(0), X[start:end], X.t(), alpha=-2)
+        rows = torch.arange(end - start, device=X.device)
+        D[rows, rows + start] = float("inf")
+        values, idx = torch.topk(D, k, dim=1, largest=False)
+        distances[start:end] = (values + sum_X[start:end, None]).clamp_(min=0)
+        indices[start:end] = idx
+    return distances, indices
+
+
+def _joint_probabilities_knn(P: torch.Tensor, indices: torch.Tensor):
+    """
+    Symmetric joint P-values (p_j|i + p_i|j) / 2N of the (N, k) conditional P-values of the kNN graph.
+    Every pair (i, j) is kept once with i < j, returns the rows, columns and values.
+    """
+    (n, k) = indices.shape
+    rows = torch.arange(n, device=indices.device).repeat_interleave(k)
+    cols = indices.reshape(-1)
+    keys = torch.minimum(rows, cols) * n + torch.maximum(rows, cols)
+    keys, inverse = torch.unique(keys, return_inverse=True)
+    values = torch.zeros(keys.shape[0], device=P.device)
+    values.index_add_(0, inverse, P.reshape(-1))
+    # each pair appears twice in the full matrix, which sums to 1
+    values /= 2 * torch.sum(values)
+    return keys // n, keys % n, values
+
+
+def _attractive_forces(Y, rows, cols, P, chunk_size):
+    """sum_j P_ij q_ij (y_i - y_j) over the pairs of the kNN graph, and sum_ij P_ij log(1 / q_ij) for the cost"""
+    forces = torch.zeros_like(Y)
+    cross_entropy = torch.zeros((), device=Y.device)
+    for start in range(0, rows.shape[0], chunk_size):
+        r = rows[start : start + chunk_size]
+        c = cols[start : start + chunk_size]
+        p = P[start : start + chunk_size]
+        diff = Y[r] - Y[c]
+        dist = torch.sum(diff * diff, dim=1)
+        f = diff * (p / (1.0 + dist)).unsqueeze(1)
+        forces.index_add_(0, r, f)
+        forces.index_add_(0, c, -f)
+        cross_entropy += 2 * torch.sum(p * torch.log1p(dist))
+    return forces, cross_entropy
+
+
+def _repulsive_forces_fft(Y: torch.Tensor, grid_spacing=0.25, max_grid_size=1024):
+    """
+    Repulsive forces sum_j q_ij^2 (y_i - y_j) / Z and the normalization Z = sum_{i != j} q_ij,
+    where q_ij = 1 / (1 + |y_i - y_j|^2).
+
+    The points are spread on a regular grid (cloud-in-cell), convolved with the kernels q and q^2
+    by FFT and interpolated back, which is O(N + G^no_dims log G) instead of O(N^2).
+    """
+    (n, no_dims) = Y.shape
+    low = Y.min(dim=0).values
+    extent = max((Y.max(dim=0).values - low).max().item(), 1e-12)
+    grid_size = int(min(max(math.ceil(extent / grid_spacing) + 1, 16), max_grid_size))
+    h = extent / (grid_size - 1)
+
+    # grid cells and linear interpolation weights of every point
+    u = (Y - low) / h
+    base = u.floor().long().clamp_(0, grid_size - 2)
+    frac = u - base
+    strides = torch.tensor(
+        [grid_size ** (no_dims - 1 - d) for d in range(no_dims)], device=Y.device
+    )
+    corners = list(itertools.product((0, 1), repeat=no_dims))
+    corner_indices, corner_weights = [], []
+    for corner in corners:
+        offset = torch.tensor(corner, device=Y.device)
+        corner_indices.append(torch.sum((base + offset) * strides, dim=1))
+        corner_weights.append(torch.prod(torch.where(offset == 1, frac, 1 - frac), 1))
+
+    # charges: 1 for Z and the q^2 sums, y for the q^2-weighted positions
+    charges = torch.cat([torch.ones(n, 1, device=Y.device), Y], dim=1)
+    grid = torch.zeros(no_dims + 1, grid_size**no_dims, device=Y.device)
+    for index, weight in zip(corner_indices, corner_weights):
+        grid.index_add_(1, index, (charges * weight.unsqueeze(1)).t())
+
+    # kernels on the circular (2G)^no_dims grid, so the convolution does not wrap around
+    fft_shape = [2 * grid_size] * no_dims
+    fft_dims = tuple(range(1, no_dims + 1))
+    offsets = torch.arange(2 * grid_size, device=Y.device)
+    offsets = torch.where(offsets < grid_size, offsets, offsets - 2 * grid_size) * h
+    squared = torch.zeros(fft_shape, device=Y.device)
+    for d in range(no_dims):
+        shape = [1] * no_dims
+        shape[d] = -1
+        squared = squared + (offsets**2).view(shape)
+    kernel = 1.0 / (1.0 + squared)
+    kernels = torch.stack([kernel, kernel**2])
+    kernels_f = torch.fft.rfftn(kernels, s=fft_shape, dim=fft_dims)
+
+    grid = grid.view(no_dims + 1, *([grid_size] * no_dims))
+    grid_f = torch.fft.rfftn(grid, s=fft_shape, dim=fft_dims)
+    potentials = torch.cat(
+        [grid_f[:1] * kernels_f[0], grid_f * kernels_f[1]], dim=0
+    )  # (no_dims + 2, ...)
+    potentials = torch.fft.irfftn(potentials, s=fft_shape, dim=fft_dims)
+    potentials = potentials[(slice(None),) + (slice(0, grid_size),) * no_dims]
+    potentials = potentials.reshape(no_dims + 2, -1)
+
+    phi = torch.zeros(n, no_dims + 2, device=Y.device)
+    for index, weight in zip(corner_indices, corner_weights):
+        phi += potentials[:, index].t() * weight.unsqueeze(1)
+
+    # the interaction of every point with itself through the grid, removed from Z
+    # (it cancels out in the forces, the charge y_i is the same on all its corners)
+    self_q = torch.zeros(n, device=Y.device)
+    for a, (corner_a, weight_a) in enumerate(zip(corners, corner_weights)):
+        for corner_b, weight_b in zip(corners, corner_weights):
+            distance = sum((ca - cb) ** 2 for ca, cb in zip(corner_a, corner_b)) * h * h
+            self_q += weight_a * weight_b / (1.0 + distance)
+
+    Z = torch.sum(phi[:, 0] - self_q)
+    forces = Y * phi[:, 1:2] - phi[:, 2:]
+    return forces / Z, Z
+
+
+# noinspection PyPep8Naming
+def _tsne_knn(
+    X: Union[torch.Tensor, np.ndarray],
+    no_dims: int = 2,
+    initial_dims: int = 50,
+    perplexity: float = 30.0,
+    max_iter: int = 1000,
+    verbose: bool = False,
+    device=None,
+    max_memory_bytes: int = 1 << 30,
+    early_exaggeration: float = 12.0,
+    exaggeration_iter: int = 250,
+    grid_spacing: float = 0.25,
+) -> Tensor:
+    """
+    t-SNE with sparse P-values on the exact kNN graph (3 * perplexity neighbours) and
+    FFT-interpolated repulsive forces, so it scales to 10^5-10^6 points.
+
+    X can be a tensor, an ndarray or a memmap, it is read in chunks of `max_memory_bytes`,
+    which also bounds the kNN distance chunks, the edge chunks and the interpolation grid.
+    """
+    if not isinstance(no_dims, int) or no_dims <= 0:
+        raise ValueError("dims must be positive integer")
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if verbose:
+        print(f"using {device}", file=sys.stderr)
+
+    (n, d) = X.shape
+    if verbose:
+        print("initializing...", file=sys.stderr)
+    X = _pca_torch_chunked(X, device, initial_dims, max_memory_bytes=max_memory_bytes)
+
+    # Compute P-values on the kNN graph
+    k = min(n - 1, int(3 * perplexity))
+    if verbose:
+        print(f"computing {k} nearest neighbours...", file=sys.stderr)
+    distances, indices = _knn_torch(X, k, max_memory_bytes, verbose=verbose)
+    if verbose:
+        print("computing p-values...", file=sys.stderr)
+    chunk_size = _rows_per_chunk(max_memory_bytes, 32 * k)
+    conditional_P = torch.cat(
+        [
+            _binary_search_perplexity(distances[start : start + chunk_size], perplexity)
+            for start in range(0, n, chunk_size)
+        ]
+    )
+    del distances
+    rows, cols, P = _joint_probabilities_knn(conditional_P, indices)
+    del conditional_P, indices
+    edge_chunk_size = _rows_per_chunk(max_memory_bytes, 16 * (no_dims + 2))
+    fft_bytes = 16 * (no_dims + 3) * 2**no_dims
+    max_grid_size = max(
+        16, min(2048, int((max_memory_bytes / fft_bytes) ** (1 / no_dims)))
+    )
+
+    # the first components, scaled to a small standard deviation
+    Y = X[:, :no_dims].clone()
+    if Y.shape[1] < no_dims:
+        Y = torch.cat([Y, torch.randn(n, no_dims - Y.shape[1], device=device)], dim=1)
+    Y = Y / (torch.std(Y[:, 0]) + 1e-12) * 1e-4
+    del X
+    iY = torch.zeros(n, no_dims, device=device)
+    gains = torch.ones(n, no_dims, device=device)
+    # the "auto" learning rate of Belkina et al. (2019) for gradients without the factor of 4
+    eta = max(n / early_exaggeration, 200.0)
+    min_gain = 0.01
+
+    if verbose:
+        print("fitting...", file=sys.stderr)
+    bar = range(max_iter)
+    if verbose:
+        bar = tqdm(bar)
+    for it in bar:
+        exaggeration = early_exaggeration if it < exaggeration_iter else 1.0
+        momentum = 0.5 if it < exaggeration_iter else 0.8
+
+        attractive, cross_entropy = _attractive_forces(
+            Y, rows, cols, P, edge_chunk_size
+        )
+        repulsive, Z = _repulsive_forces_fft(Y, grid_spacing, max_grid_size)
+        dY = exaggeration * attractive - repulsive
+
+        gains = (gains + 0.2) * ((dY > 0.0) != (iY > 0.0)).float() + (gains * 0.8) * (
+            (dY > 0.0) == (iY > 0.0)
+        ).float()
+        gains[gains < min_gain] = min_gain
+        iY = momentum * iY - eta * (gains * dY)
+        Y = Y + iY
+        Y = Y - torch.mean(Y, 0)
+
+        if verbose and it % 50 == 0:
+            # KL(P || Q) = sum P log P - sum P log q + log Z
+            C = 2 * torch.sum(P * torch.log(P)) + cross_entropy + torch.log(Z)
+            bar.set_description(f"error: {C.cpu().item():.3f}")
+
+    # Return solution
+    return Y
+
+
 # noinspection PyPep8Naming
 def _tsne(
     X: Union[torch.Tensor, np.ndarray],
@@ -224,14 +504,9 @@ def _tsne(
 
         # Compute gradient
         PQ = P - Q
-        # ((N, 1, N).repeat -> (N, no_dims, N).permute -> (N, N, no_dims)) *
-        # ((N, no_dims) - (N, 1, no_dims) -> (N, N, no_dims))
-        # -> (N, N, no_dims).sum[1] -> (N, no_dims)
-        dY = torch.sum(
-            (PQ * num).unsqueeze(1).repeat(1, no_dims, 1).transpose(2, 1)
-            * (Y.unsqueeze(1) - Y),
-            dim=1,
-        )
+        # sum_j W_ij (y_i - y_j) = y_i * sum_j W_ij - (W @ Y)_i, without the (N, N, no_dims) difference tensor
+        W = PQ * num
+        dY = Y * torch.sum(W, dim=1, keepdim=True) - torch.mm(W, Y)
 
         # Perform the update
         if it < 20:
@@ -263,6 +538,13 @@ def _tsne(
 
 
 class TorchTSNE:
+    """
+    Args:
+        method: "exact" computes dense (N, N) P-values and forces, for up to a few thousand points.
+            "fft" uses sparse kNN P-values and FFT-interpolated repulsive forces for 10^5-10^6 points.
+        max_memory_bytes: memory budget of the chunked computations of the "fft" method.
+    """
+
     def __init__(
         self,
         perplexity: float = 30.0,
@@ -271,24 +553,41 @@ class TorchTSNE:
         initial_dims: int = 50,
         verbose: bool = False,
         device=None,
+        method: str = "exact",
+        max_memory_bytes: int = 1 << 30,
     ):
+        if method not in ("exact", "fft"):
+            raise ValueError(f"method must be 'exact' or 'fft', got {method}")
         self.perplexity = perplexity
         self.n_iter = n_iter
         self.n_components = n_components
         self.initial_dims = initial_dims
         self.verbose = verbose
         self.device = device
+        self.method = method
+        self.max_memory_bytes = max_memory_bytes
 
     # noinspection PyPep8Naming,PyUnusedLocal
     def fit_transform(self, X, y=None) -> Tensor:
         """
         Learns the t-stochastic neighbor embedding of the given data.
 
-        :param X: ndarray or torch tensor (n_samples, *)
+        :param X: ndarray, memmap ("fft" method) or torch tensor (n_samples, *)
         :param y: ignored
         :return: ndarray (n_samples, n_components)
         """
         with torch.no_grad():
+            if self.method == "fft":
+                return _tsne_knn(
+                    X,
+                    no_dims=self.n_components,
+                    initial_dims=self.initial_dims,
+                    perplexity=self.perplexity,
+                    verbose=self.verbose,
+                    max_iter=self.n_iter,
+                    device=self.device,
+                    max_memory_bytes=self.max_memory_bytes,
+                )
             return _tsne(
                 X,
                 no_dims=self.n_components,
@@ -11,6 +11,7 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 from smoe.data.datasets_moe import ShardDataset
+from smoe.utils.expert_construction.neuron_overlap import neuron_overlap_stats
 from smoe.utils.io import compress_png_image
 from smoe.utils.operations.operation_tensor import pass_kernel_function
 from smoe.utils.visualization.plotter import plotter
@@ -335,7 +336,13 @@ def visualize_expert_neuron_overlap(
     layer_idx: int,
     save_dir: str = "./",
     save_fig: bool = True,
+    overlap_stats: dict = None,
 ):
+    """
+    `selected_masks`: (num_experts, intermediate_size) masks of the neurons selected by every expert.
+    `overlap_stats`: precomputed statistics of this layer (see `neuron_overlap_stats`), in which case
+    `selected_masks` is not used.
+    """
     # fmt: off
     torch.set_printoptions(
         precision=4,  # 精度，保留小数点后几位，默认4
@@ -346,35 +353,21 @@ def visualize_expert_neuron_overlap(
         sci_mode=False  # 用科学技术法显示数据，默认True
     )
 
+    if overlap_stats is None:
+        overlap_stats = {key: value[0] for key, value in neuron_overlap_stats(selected_masks[None]).items()}
+
     """overlap rate between each expert pair"""
     # rate calculation: intersection(Ei, Ej) / union(Ei, Ej)
-    intersection_num = torch.mm(selected_masks, selected_masks.transpose(0, 1))
-    union_num = torch.full_like(intersection_num, fill_value=intermediate_size) - torch.mm((1 - selected_masks), (1 - selected_masks).transpose(0, 1))
-    overlap_rate = intersection_num / union_num
-
-    # print(intersection_num)
-    # print(union_num)
+    overlap_rate = torch.from_numpy(np.asarray(overlap_stats["overlap_rate"]))
     print("overlap_rate", overlap_rate, sep="\n", flush=True)
 
     """overlap count for each expert"""
     # rows: overlap count,  columns: different experts
-    overlap_count = torch.zeros((num_experts, num_experts), dtype=torch.int)
-
-    sum_count = selected_masks.sum(0)  # shape(intermediate_size,)
-    selected_masks = selected_masks.bool()
-    for overlap_times in range(num_experts):
-        this_overlap_neurons = (sum_count == (overlap_times + 1))  # shape(intermediate_size,)
-        # print(this_overlap_neurons.sum())
-        each_expert_overlap_neurons = selected_masks & this_overlap_neurons  # shape(num_experts, intermediate_size)
-        # print(each_expert_overlap_neurons.sum())
-        overlap_count[overlap_times, :] = each_expert_overlap_neurons.sum(1)
-        # print(overlap_count[overlap_times, :])
-
-    # print(overlap_count.sum(0))
+    overlap_count = torch.from_numpy(np.asarray(overlap_stats["overlap_count"]))
     print("overlap_count", overlap_count, sep="\n", flush=True)
 
     """save graphs"""
-    total_neurons = (sum_count > 0).sum().item()
+    total_neurons = int(overlap_stats["total_neurons"])
     overlap_rate = overlap_rate.numpy()
     overlap_count = overlap_count.numpy()
 
@@ -0,0 +1,130 @@
+import tempfile
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+import pytest
+from torch.utils.data import DataLoader
+
+from smoe.data.streaming import SubDirWeightedPackedJsonlDataset, WeightedDomainSampler
+from smoe.utils.io import dump_jsonlines
+
+
+def _make_dataset_dir(temp_dir: str, num_instances: dict[str, int]):
+    for name, num in num_instances.items():
+        folder = Path(temp_dir) / name
+        folder.mkdir()
+        dump_jsonlines([{"input_ids": [i] * 4} for i in range(num)], folder / "0.jsonl")
+
+
+def test_weighted_domain_sampler():
+    weights = [0.5, 0.0, 0.3, 0.2]
+    sampler = WeightedDomainSampler(weights, seed=1, block_size=1000)
+    counts = np.bincount([next(sampler) for _ in range(100000)], minlength=4)
+    assert counts[1] == 0
+    assert np.allclose(counts / counts.sum(), weights, atol=0.01)
+
+    sampler.set_weights([0.0, 1.0, 0.0, 0.0])
+    assert sampler.num_remaining == 0
+    assert {next(sampler) for _ in range(100)} == {1}
+
+    with pytest.raises(ValueError):
+        sampler.set_weights([0.0, 0.0])
+
+
+def test_exhaustion_policies():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        _make_dataset_dir(temp_dir, {"a": 40, "b": 400})
+        kwargs = dict(
+            prob_map={"a": 0.5, "b": 0.5},
+            buffer_size=8,
+            block_size=4,
+            return_domain_id=True,
+        )
+
+        dataset = SubDirWeightedPackedJsonlDataset(
+            temp_dir, exhaustion_policy="stop", **kwargs
+        )
+        counts = Counter(ins["domain_id"] for ins in dataset)
+        assert counts[dataset.source2idx["a"]] == 40
+        assert counts[dataset.source2idx["b"]] < 400
+
+        dataset = SubDirWeightedPackedJsonlDataset(
+            temp_dir, exhaustion_policy="drop", **kwargs
+        )
+        counts = Counter(ins["domain_id"] for ins in dataset)
+        assert counts[dataset.source2idx["a"]] == 40
+        assert counts[dataset.source2idx["b"]] == 400
+
+        dataset = SubDirWeightedPackedJsonlDataset(
+            temp_dir, exhaustion_policy="recycle", **kwargs
+        )
+        counts = Counter()
+        for step, ins in enumerate(dataset):
+            counts[ins["domain_id"]] += 1
+            if step == 999:
+                break
+        assert counts[dataset.source2idx["a"]] > 40
+        assert dataset.task_type_to_num_epochs["a"] > 0
+
+
+def test_update_prob_map_rebuilds_sampler():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        _make_dataset_dir(temp_dir, {"a": 400, "b": 400})
+        dataset = SubDirWeightedPackedJsonlDataset(
+            temp_dir,
+            prob_map={"a": 1.0, "b": 0.0},
+            buffer_size=8,
+            block_size=4,
+            return_domain_id=True,
+            sampling_block_size=16,
+        )
+        domain_ids = []
+        for step, ins in enumerate(dataset):
+            domain_ids.append(ins["domain_id"])
+            if step == 15:
+                dataset.update_existed_prob_map({"a": 0.0, "b": 1.0})
+            if step == 31:
+                break
+        assert set(domain_ids[:16]) == {dataset.source2idx["a"]}
+        assert set(domain_ids[16:]) == {dataset.source2idx["b"]}
+
+
+def test_domain_sequence_changes_between_iterations():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        _make_dataset_dir(temp_dir, {"a": 400, "b": 400})
+        kwargs = dict(
+            prob_map={"a": 0.5, "b": 0.5},
+            buffer_size=8,
+            block_size=4,
+            return_domain_id=True,
+            exhaustion_policy="recycle",
+        )
+
+        def _domain_ids(dataset):
+            domain_ids = []
+            for step, ins in enumerate(dataset):
+                domain_ids.append(ins["domain_id"])
+                if step == 63:
+                    break
+            return domain_ids
+
+        dataset = SubDirWeightedPackedJsonlDataset(temp_dir, **kwargs)
+        first = _domain_ids(dataset)
+        assert _domain_ids(dataset) != first
+        # reproducible with the same seed
+        dataset = SubDirWeightedPackedJsonlDataset(temp_dir, **kwargs)
+        assert _domain_ids(dataset) == first
+
+        # dataloader workers draw different sequences, batches alternate between them
+        dataset = SubDirWeightedPackedJsonlDataset(temp_dir, **kwargs)
+        loader = DataLoader(dataset, batch_size=None, num_workers=2)
+        domain_ids = _domain_ids(loader)
+        assert domain_ids[0::2] != domain_ids[1::2]
+
+
+if __name__ == "__main__":
+    test_weighted_domain_sampler()
+    test_exhaustion_policies()
+    test_update_prob_map_rebuilds_sampler()
+    test_domain_sequence_changes_between_iterations()
@@ -0,0 +1,171 @@
+import os
+import tempfile
+from pathlib import Path
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+
+from smoe.data.collate_fn import fault_tolerance_data_collator
+from smoe.data.dynamic_selection import (
+    DomainProbeSet,
+    DomainReweightingEngine,
+    causal_lm_loss_per_sample,
+)
+from smoe.data.streaming import SubDirWeightedPackedJsonlDataset
+from smoe.utils.io import dump_jsonlines
+
+
+class _Outputs:
+    def __init__(self, logits):
+        self.logits = logits
+
+
+class _TinyLM(torch.nn.Module):
+    def __init__(self, vocab_size=16):
+        super().__init__()
+        self.emb = torch.nn.Embedding(vocab_size, vocab_size)
+        self.num_forwards = 0
+
+    def forward(self, input_ids, attention_mask=None):
+        self.num_forwards += 1
+        return _Outputs(self.emb(input_ids))
+
+
+PROBE_DATASETS = {
+    "a": [{"input_ids": [1, 2, 3, 4]}] * 5,
+    "b": [{"input_ids": [5, 6, 7]}, {"input_ids": [8, 9, 10, 11]}],
+}
+
+
+def test_causal_lm_loss_per_sample():
+    logits = torch.randn(3, 7, 11)
+    labels = torch.randint(0, 11, (3, 7))
+    labels[1, 4:] = -100
+    loss_sum, num_tokens = causal_lm_loss_per_sample(logits, labels, chunk_size=5)
+    ref = torch.nn.functional.cross_entropy(
+        logits[:, :-1].reshape(-1, 11), labels[:, 1:].reshape(-1), reduction="sum"
+    )
+    assert torch.allclose(loss_sum.sum(), ref, atol=1e-4)
+    assert num_tokens.tolist() == [6.0, 3.0, 6.0]
+
+
+def test_domain_reweighting_engine():
+    domains = ["a", "b", "c"]
+    engine = DomainReweightingEngine(
+        domains,
+        {"a": 1 / 3, "b": 1 / 3, "c": 1 / 3},
+        {"a": 1.0, "b": 1.0, "c": 1.0},
+        probe_shrinkage=4.0,
+    )
+    # mean losses: a=3.0, b=2.0, `c` is never seen
+    engine.observe(torch.tensor([0, 1, 0]), loss=torch.tensor(3.0))
+    engine.observe(torch.tensor([1]), loss=torch.tensor(1.0))
+    prob_map = engine.step()
+    assert prob_map["a"] > prob_map["b"] > prob_map["c"]
+    assert abs(sum(prob_map.values()) - 1.0) < 1e-6
+
+    # per-sample losses of the training forward are averaged over tokens
+    labels = torch.ones(2, 5, dtype=torch.long)
+    labels[1, 3:] = -100
+    engine.observe(
+        torch.tensor([0, 1]),
+        labels=labels,
+        loss_per_sample=torch.tensor([8.0, 4.0]),
+        loss=torch.tensor(100.0),
+    )
+    assert engine._loss_sum.tolist() == [8.0, 4.0, 0.0]
+    assert engine._num_tokens.tolist() == [4.0, 2.0, 0.0]
+    engine._init_window(engine._loss_sum.device)
+
+    # the probe loss fills in unseen domains
+    engine.set_probe_losses({"c": 5.0})
+    assert engine.estimate_losses()["c"] == 5.0
+    prob_map = engine.step()
+    assert prob_map["c"] > prob_map["a"]
+
+    new_engine = DomainReweightingEngine(
+        domains, {"a": 1 / 3, "b": 1 / 3, "c": 1 / 3}, {}
+    )
+    new_engine.load_state_dict(engine.state_dict())
+    assert new_engine.prob_map == engine.prob_map
+    assert new_engine.estimate_losses() == engine.estimate_losses()
+
+
+def test_domain_probe_set():
+    probes = DomainProbeSet(PROBE_DATASETS, num_blocks=3)
+    assert len(probes) == 5
+    losses = probes.evaluate(_TinyLM(), batch_size=2)
+    assert set(losses) == {"a", "b"}
+    assert all(loss > 0 for loss in losses.values())
+
+
+def _run_sharded_probe_set(rank, init_file, ref_losses):
+    dist.init_process_group(
+        "gloo", init_method=f"file://{init_file}", rank=rank, world_size=2
+    )
+    probes = DomainProbeSet(PROBE_DATASETS, num_blocks=3)
+    torch.manual_seed(0)
+    model = _TinyLM()
+    losses = probes.evaluate(model, batch_size=2)
+    # 5 blocks over 2 ranks, rank 1 pads its shard with a dummy block
+    assert model.num_forwards == 2
+    assert losses.keys() == ref_losses.keys()
+    for name, loss in losses.items():
+        assert abs(loss - ref_losses[name]) < 1e-5, name
+    dist.destroy_process_group()
+
+
+def test_sharded_domain_probe_set():
+    probes = DomainProbeSet(PROBE_DATASETS, num_blocks=3)
+    torch.manual_seed(0)
+    ref_losses = probes.evaluate(_TinyLM(), batch_size=2)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mp.spawn(
+            _run_sharded_probe_set,
+            args=(os.path.join(tmp_dir, "init"), ref_losses),
+            nprocs=2,
+            join=True,
+        )
+
+
+def test_prob_map_reaches_dataloader_workers():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name in ["a", "b"]:
+            folder = Path(temp_dir) / name
+            folder.mkdir()
+            dump_jsonlines(
+                [{"input_ids": [i] * 4} for i in range(2000)], folder / "0.jsonl"
+            )
+        dataset = SubDirWeightedPackedJsonlDataset(
+            temp_dir,
+            prob_map={"a": 1.0, "b": 0.0},
+            buffer_size=8,
+            block_size=4,
+            return_domain_id=True,
+            sampling_block_size=16,
+        )
+        loader = DataLoader(
+            dataset,
+            batch_size=4,
+            num_workers=1,
+            collate_fn=fault_tolerance_data_collator,
+        )
+        seen = set()
+        for batch_idx, batch in enumerate(loader):
+            seen.update(batch["domain_id"].tolist())
+            if batch_idx == 0:
+                assert seen == {dataset.source2idx["a"]}
+                dataset.update_existed_prob_map({"a": 0.0, "b": 1.0})
+            if dataset.source2idx["b"] in seen or batch_idx > 200:
+                break
+        assert dataset.source2idx["b"] in seen
+
+
+if __name__ == "__main__":
+    test_causal_lm_loss_per_sample()
+    test_domain_reweighting_engine()
+    test_domain_probe_set()
+    test_sharded_domain_probe_set()
+    test_prob_map_reaches_dataloader_workers()
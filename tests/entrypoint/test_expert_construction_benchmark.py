@@ -0,0 +1,41 @@
+import torch
+
+from smoe.entrypoint.benchmark.expert_construction import (
+    compare_with_baseline,
+    tensor_checksum,
+)
+
+
+def test_tensor_checksum():
+    scores = {1: torch.arange(4.0), 0: [torch.ones(2, dtype=torch.int64)]}
+    assert tensor_checksum(scores) == tensor_checksum(
+        {0: [torch.ones(2, dtype=torch.int64)], 1: torch.arange(4.0)}
+    )
+    assert tensor_checksum(scores) != tensor_checksum(
+        {1: torch.arange(4.0), 0: [torch.ones(2, dtype=torch.int32)]}
+    )
+    assert tensor_checksum(torch.zeros(4)) != tensor_checksum(torch.zeros(2, 2))
+
+
+def test_compare_with_baseline():
+    baseline = {
+        "split": {"wall_time": 1.0, "peak_rss_mb": 100.0, "checksum": "abc"},
+        "convert": {"wall_time": 1.0, "peak_rss_mb": 100.0, "checksum": "def"},
+    }
+    results = {
+        "split": {"wall_time": 1.4, "peak_rss_mb": 110.0, "checksum": "abc"},
+        "convert": {"wall_time": 2.0, "peak_rss_mb": 130.0, "checksum": "xyz"},
+        "align": {"wall_time": 1.0, "peak_rss_mb": 100.0, "checksum": "new"},
+    }
+    regressions = compare_with_baseline(results, baseline)
+    assert len(regressions) == 3
+    assert all(regression.startswith("convert:") for regression in regressions)
+    regressions = compare_with_baseline(results, baseline, check_checksums=False)
+    assert len(regressions) == 2
+    regressions = compare_with_baseline(results, baseline, check_resources=False)
+    assert regressions == ["convert: checksum xyz != baseline def"]
+
+
+if __name__ == "__main__":
+    test_tensor_checksum()
+    test_compare_with_baseline()
@@ -0,0 +1,165 @@
+import copy
+import tempfile
+
+import torch
+
+from smoe.models.mixtral.configuration_mixtral import MixtralConfig
+from smoe.models.mixtral.modeling_mixtral import MixtralForCausalLM
+from smoe.utils.expert_construction.align_layerwise import (
+    HiddenStateStore,
+    align_model_layerwise,
+    new_distribution,
+    update_distribution,
+)
+from smoe.utils.model_operation.modify_llama_moe_v2_model import (
+    llama_moe_v2_with_hidden_distribution_recording_for_alignment,
+)
+
+
+def _tiny_mixtral(**kwargs):
+    config = MixtralConfig(
+        vocab_size=64,
+        hidden_size=16,
+        intermediate_size=24,
+        num_hidden_layers=3,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        num_local_experts=4,
+        num_experts_per_tok=2,
+        **kwargs,
+    )
+    config._attn_implementation = "eager"
+    torch.manual_seed(0)
+    model = MixtralForCausalLM(config).eval()
+    for layer in model.model.layers:
+        torch.nn.init.normal_(layer.block_sparse_moe.gate.weight, std=0.2)
+    return model
+
+
+def _batches():
+    torch.manual_seed(1)
+    batches = []
+    for _ in range(3):
+        input_ids = torch.randint(0, 64, (2, 8))
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[1, :3] = 0
+        batches.append({"input_ids": input_ids, "attention_mask": attention_mask})
+    return batches
+
+
+def _ref_distribution(num_layers, hidden_size):
+    torch.manual_seed(2)
+    return {
+        layer_idx: {
+            module: {
+                "mean": torch.randn(hidden_size) * 0.1,
+                "variance": torch.rand(hidden_size) + 0.5,
+            }
+            for module in ("attn", "mlp")
+        }
+        for layer_idx in range(num_layers)
+    }
+
+
+@torch.no_grad()
+def _align_by_reforwarding(model, batches, ref_distribution):
+    """The per-layer re-forward of `align_converted_model.py` before the layer-wise engine"""
+    model.model = llama_moe_v2_with_hidden_distribution_recording_for_alignment(
+        model.model
+    )
+    model.config.use_cache = False
+    hidden_size = model.config.hidden_size
+    scale_factors = {}
+    for target_layer, target in enumerate(model.model.layers):
+        for layer in model.model.layers:
+            layer.align_module = "mlp" if layer is target else None
+            layer.distribution = {
+                "number": torch.zeros((1,)),
+                "mean": torch.zeros((hidden_size,)),
+                "variance": torch.zeros((hidden_size,)),
+            }
+        model.model.early_stopping_layer = target_layer
+        for batch in batches:
+            model(**batch)
+        distribution = target.distribution
+        ref = ref_distribution[target_layer]["mlp"]
+        scale_magnitude = torch.sqrt(ref["variance"] / distribution["variance"])
+        scale_bias = ref["mean"] - distribution["mean"] * scale_magnitude
+        scale_factors[target_layer] = {
+            "mlp": {"scale_bias": scale_bias, "scale_magnitude": scale_magnitude}
+        }
+        for expert in target.block_sparse_moe.experts:
+            expert.w2.bias = torch.nn.Parameter(scale_bias.clone())
+            expert.w2.weight *= scale_magnitude.unsqueeze(1)
+    return scale_factors
+
+
+def test_hidden_state_store():
+    with tempfile.TemporaryDirectory() as folder:
+        # room for one of the two batches
+        store = HiddenStateStore(max_memory_bytes=4 * 2 * 3 * 4, spill_dir=folder)
+        first = torch.randn(2, 3, 4)
+        second = torch.randn(2, 3, 4).to(torch.bfloat16)
+        store[0] = first
+        store[1] = second
+        assert store.num_spilled == 1
+        assert torch.equal(store[0], first) and torch.equal(store[1], second)
+        # overwritten in place
+        store[1] = second * 2
+        assert torch.equal(store[1], second * 2)
+        store.close()
+        assert len(store) == 0
+
+
+def test_mixtral_align_layerwise():
+    model = _tiny_mixtral()
+    batches = _batches()
+    ref_distribution = _ref_distribution(3, 16)
+
+    ref_model = copy.deepcopy(model)
+    ref_scale_factors = _align_by_reforwarding(ref_model, batches, ref_distribution)
+
+    for max_memory_bytes in (None, 0):
+        aligned = copy.deepcopy(model)
+        scale_factors = align_model_layerwise(
+            aligned, batches, ref_distribution, max_memory_bytes=max_memory_bytes
+        )
+        assert sorted(scale_factors) == [0, 1, 2]
+        for layer_idx, factors in ref_scale_factors.items():
+            for key, value in factors["mlp"].items():
+                assert torch.allclose(
+                    scale_factors[layer_idx]["mlp"][key], value, atol=1e-5
+                )
+        ref_state_dict = ref_model.state_dict()
+        for name, param in aligned.state_dict().items():
+            assert torch.allclose(param, ref_state_dict[name], atol=1e-5), name
+
+
+def test_mixtral_align_layerwise_distribution():
+    model = _tiny_mixtral()
+    batches = _batches()
+    ref_distribution = _ref_distribution(3, 16)
+    align_model_layerwise(model, batches, ref_distribution)
+
+    # the aligned MLP outputs of the last layer follow the reference distribution
+    outputs = []
+
+    def hook(module, args, output):
+        outputs.append(output[0])
+
+    model.model.layers[2].block_sparse_moe.register_forward_hook(hook)
+    with torch.no_grad():
+        for batch in batches:
+            model(**batch)
+    distribution = new_distribution(16)
+    for output, batch in zip(outputs, batches):
+        update_distribution(distribution, output[batch["attention_mask"].bool()])
+    ref = ref_distribution[2]["mlp"]
+    assert torch.allclose(distribution["mean"], ref["mean"], atol=1e-4)
+    assert torch.allclose(distribution["variance"], ref["variance"], rtol=1e-3)
+
+
+if __name__ == "__main__":
+    test_hidden_state_store()
+    test_mixtral_align_layerwise()
+    test_mixtral_align_layerwise_distribution()
@@ -0,0 +1,49 @@
+import torch
+
+from smoe.models.mixtral.configuration_mixtral import MixtralConfig
+from smoe.models.mixtral.modeling_mixtral import MixtralAttentionMoE
+
+
+def test_batched_attn_moe_matches_expert_loop():
+    torch.manual_seed(0)
+    config = MixtralConfig(
+        hidden_size=64,
+        num_attention_heads=8,
+        num_key_value_heads=4,
+        use_attn_moe=True,
+        attn_experts=4,
+        top_k_attn=2,
+        scale_factor_attn=2.0,
+        sliding_window=5,
+    )
+    attn = MixtralAttentionMoE(config, layer_idx=0)
+    bsz, q_len = 3, 12
+    hidden_states = torch.randn(bsz, q_len, config.hidden_size)
+    attention_mask = torch.ones(bsz, q_len, dtype=torch.long)
+    attention_mask[1, :4] = 0  # left padding
+    attention_mask[2, -3:] = 0  # right padding
+    position_ids = torch.arange(q_len)[None]
+
+    outputs, grads = [], []
+    for batched in (False, True):
+        config.batched_attn_moe = batched
+        attn.zero_grad()
+        output = attn(
+            hidden_states, attention_mask=attention_mask, position_ids=position_ids
+        )[0]
+        if batched:
+            # left padding tokens have no keys, their attention outputs are zeros
+            assert torch.equal(output[1, :4], torch.zeros_like(output[1, :4]))
+        # the expert loop averages over all values for them, only compare real tokens
+        output = output * attention_mask[..., None]
+        output.pow(2).sum().backward()
+        outputs.append(output)
+        grads.append([p.grad.clone() for p in attn.parameters()])
+
+    assert torch.allclose(outputs[0], outputs[1], atol=1e-5)
+    for grad, ref_grad in zip(grads[1], grads[0]):
+        assert torch.allclose(grad, ref_grad, atol=1e-4)
+
+
+if __name__ == "__main__":
+    test_batched_attn_moe_matches_expert_loop()
@@ -0,0 +1,115 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from smoe.models.mixtral.configuration_mixtral import MixtralConfig
+from smoe.models.mixtral.modeling_mixtral import (
+    MixtralForCausalLM,
+    compute_routing_stats,
+    load_balancing_loss_from_stats,
+    load_balancing_loss_func,
+)
+
+
+def _reference_balance_loss(gate_logits, num_experts, top_k, token_mask):
+    probs = F.softmax(torch.cat(gate_logits), dim=-1)
+    _, selected_experts = torch.topk(probs, top_k, dim=-1)
+    expert_mask = F.one_hot(selected_experts, num_experts).float()
+    token_mask = token_mask.reshape(-1).float().repeat(len(gate_logits))
+    tokens_per_expert = (expert_mask * token_mask[:, None, None]).sum(0)
+    router_prob_per_expert = (probs * token_mask[:, None]).sum(0)
+    return (
+        (tokens_per_expert * router_prob_per_expert[None]).sum()
+        * num_experts
+        / token_mask.sum() ** 2
+    )
+
+
+def test_balance_loss_from_stats():
+    torch.manual_seed(0)
+    num_experts, top_k = 6, 2
+    gate_logits = [torch.randn(10, num_experts, requires_grad=True) for _ in range(3)]
+    attention_mask = torch.ones(2, 5)
+    attention_mask[0, :2] = 0
+
+    loss = load_balancing_loss_func(
+        gate_logits,
+        num_experts,
+        top_k,
+        attention_mask=attention_mask,
+        use_router_prob_balance=True,
+    )
+    ref = _reference_balance_loss(gate_logits, num_experts, top_k, attention_mask)
+    assert torch.allclose(loss, ref, atol=1e-6)
+    grads = torch.autograd.grad(loss, gate_logits)
+    ref_grads = torch.autograd.grad(ref, gate_logits)
+    for grad, ref_grad in zip(grads, ref_grads):
+        assert torch.allclose(grad, ref_grad, atol=1e-6)
+
+    # padding tokens are not counted
+    scores = F.softmax(gate_logits[0], dim=-1)
+    _, selected_experts = torch.topk(scores, top_k, dim=-1)
+    stats = compute_routing_stats(scores, selected_experts, num_experts, attention_mask)
+    assert stats.shape == (2, num_experts)
+    assert stats[0].sum().item() == 8 * top_k
+    assert torch.allclose(stats[1].sum(), torch.tensor(8.0))
+
+    # uniform routing
+    stats = torch.tensor([[2.0, 2.0, 2.0, 2.0], [1.0, 1.0, 1.0, 1.0]])
+    loss = load_balancing_loss_from_stats(
+        (stats, stats), top_k=2, use_router_prob_balance=True
+    )
+    assert torch.allclose(loss, torch.tensor(2.0))
+
+    # the legacy mean of the top-k weights is the default, it is always `num_experts / top_k`
+    loss = load_balancing_loss_func(gate_logits, num_experts, top_k)
+    assert torch.allclose(loss, torch.tensor(num_experts / top_k))
+    grads = torch.autograd.grad(loss, gate_logits, allow_unused=True)
+    assert all(grad is None or not grad.any() for grad in grads)
+
+    # padding is only known from 2D masks
+    with pytest.raises(ValueError):
+        load_balancing_loss_func(
+            gate_logits, num_experts, top_k, attention_mask=torch.ones(2, 1, 5, 5)
+        )
+
+
+def test_router_logits_output():
+    config = MixtralConfig(
+        vocab_size=64,
+        hidden_size=16,
+        intermediate_size=24,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        num_local_experts=4,
+        num_experts_per_tok=2,
+        output_router_logits=True,
+    )
+    config._attn_implementation = "eager"
+    torch.manual_seed(0)
+    model = MixtralForCausalLM(config)
+    input_ids = torch.randint(0, 64, (2, 6))
+    attention_mask = torch.ones(2, 6, dtype=torch.long)
+    attention_mask[0, :2] = 0
+    outputs = model(input_ids, attention_mask=attention_mask, labels=input_ids)
+    assert len(outputs.router_logits) == len(outputs.routing_stats) == 2
+    assert outputs.router_logits[0].shape == (12, 4)
+    assert outputs.routing_stats[0].shape == (2, 4)
+    assert outputs.routing_stats[0][0].sum().item() == 10 * 2
+
+    model.config.use_router_prob_balance = True
+    ref_loss = load_balancing_loss_func(
+        outputs.router_logits,
+        4,
+        2,
+        attention_mask=attention_mask,
+        use_router_prob_balance=True,
+    )
+    outputs = model(input_ids, attention_mask=attention_mask, labels=input_ids)
+    assert torch.allclose(outputs.aux_loss, ref_loss, atol=1e-6)
+
+
+if __name__ == "__main__":
+    test_balance_loss_from_stats()
+    test_router_logits_output()
@@ -0,0 +1,148 @@
+import os
+import tempfile
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from smoe.models.mixtral.configuration_mixtral import MixtralConfig
+from smoe.models.mixtral.modeling_mixtral import MixtralForCausalLM
+from smoe.modules.expert_parallel import (
+    enable_expert_parallel,
+    gather_expert_parallel_state_dict,
+    new_expert_parallel_groups,
+    sync_expert_grads,
+)
+
+WORLD_SIZE = 2
+
+
+def _tiny_mixtral():
+    config = MixtralConfig(
+        vocab_size=64,
+        hidden_size=16,
+        intermediate_size=24,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        num_local_experts=4,
+        num_experts_per_tok=2,
+        scale_factor=2.0,
+    )
+    config._attn_implementation = "eager"
+    torch.manual_seed(0)
+    return MixtralForCausalLM(config)
+
+
+def _run_expert_parallel(rank, init_file):
+    dist.init_process_group(
+        "gloo", init_method=f"file://{init_file}", rank=rank, world_size=WORLD_SIZE
+    )
+    ref_model = _tiny_mixtral()
+    model = _tiny_mixtral()
+    full_state_dict = ref_model.state_dict()
+    enable_expert_parallel(model)
+    # a full "modulelist" checkpoint loads strictly, non-local experts are skipped
+    model.load_state_dict(full_state_dict)
+    local_idx, remote_idx = (0, 2) if rank == 0 else (2, 0)
+    state_dict = model.state_dict()
+    assert (
+        f"model.layers.0.block_sparse_moe.experts.{local_idx}.w1.weight" in state_dict
+    )
+    assert (
+        f"model.layers.0.block_sparse_moe.experts.{remote_idx}.w1.weight"
+        not in state_dict
+    )
+
+    # ranks feed different tokens (and numbers of tokens)
+    torch.manual_seed(rank + 1)
+    input_ids = torch.randint(0, 64, (2, 5 + rank))
+    ref = ref_model(input_ids=input_ids, labels=input_ids)
+    out = model(input_ids=input_ids, labels=input_ids)
+    assert torch.allclose(out.logits, ref.logits, atol=1e-5)
+
+    ref.loss.backward()
+    out.loss.backward()
+    ref_params = dict(ref_model.named_parameters())
+    for name, param in ref_params.items():
+        if ".experts." in name:
+            # expert grads are averaged over the tokens of all ranks
+            dist.all_reduce(param.grad)
+            param.grad /= WORLD_SIZE
+    for name, param in model.named_parameters():
+        assert torch.allclose(param.grad, ref_params[name].grad, atol=1e-5), name
+
+    gathered = gather_expert_parallel_state_dict(model)
+    assert gathered.keys() == full_state_dict.keys()
+    for key, value in full_state_dict.items():
+        assert torch.equal(gathered[key], value)
+    dist.destroy_process_group()
+
+
+def test_mixtral_expert_parallel():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mp.spawn(
+            _run_expert_parallel,
+            args=(os.path.join(tmp_dir, "init"),),
+            nprocs=WORLD_SIZE,
+            join=True,
+        )
+
+
+def _run_expert_parallel_groups(rank, init_file):
+    world_size = 2 * WORLD_SIZE
+    dist.init_process_group(
+        "gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size
+    )
+    # expert-parallel groups [0, 1] & [2, 3], the experts are replicated on [0, 2] & [1, 3]
+    group, expert_dp_group = new_expert_parallel_groups(WORLD_SIZE)
+    assert dist.get_world_size(group) == WORLD_SIZE
+    assert dist.get_world_size(expert_dp_group) == 2
+    # the replicated experts are only synced with an expert-data-parallel group
+    with pytest.raises(ValueError):
+        enable_expert_parallel(_tiny_mixtral(), group)
+
+    ref_model = _tiny_mixtral()
+    model = _tiny_mixtral()
+    enable_expert_parallel(model, group, expert_data_parallel_group=expert_dp_group)
+
+    torch.manual_seed(rank + 1)
+    input_ids = torch.randint(0, 64, (2, 5 + rank))
+    ref = ref_model(input_ids=input_ids, labels=input_ids)
+    out = model(input_ids=input_ids, labels=input_ids)
+    assert torch.allclose(out.logits, ref.logits, atol=1e-5)
+
+    ref.loss.backward()
+    out.loss.backward()
+    sync_expert_grads(model)
+    # all grads are averaged over the tokens of the whole world
+    ref_params = dict(ref_model.named_parameters())
+    for param in ref_params.values():
+        dist.all_reduce(param.grad)
+        param.grad /= world_size
+    for name, param in model.named_parameters():
+        if ".experts." not in name:
+            # done by DistributedDataParallel in training
+            dist.all_reduce(param.grad)
+            param.grad /= world_size
+        assert torch.allclose(param.grad, ref_params[name].grad, atol=1e-5), name
+
+    gathered = gather_expert_parallel_state_dict(model, group)
+    assert gathered.keys() == ref_model.state_dict().keys()
+    dist.destroy_process_group()
+
+
+def test_mixtral_expert_parallel_groups():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mp.spawn(
+            _run_expert_parallel_groups,
+            args=(os.path.join(tmp_dir, "init"),),
+            nprocs=2 * WORLD_SIZE,
+            join=True,
+        )
+
+
+if __name__ == "__main__":
+    test_mixtral_expert_parallel()
+    test_mixtral_expert_parallel_groups()
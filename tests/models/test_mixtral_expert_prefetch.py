@@ -0,0 +1,86 @@
+import tempfile
+
+import torch
+
+from smoe.models.mixtral.configuration_mixtral import MixtralConfig
+from smoe.models.mixtral.modeling_mixtral import MixtralForCausalLM
+from smoe.modules.expert_offload import ExpertOffloadEngine
+from smoe.modules.expert_prefetch import (
+    ExpertPrefetcher,
+    RouterLookaheadPredictor,
+    TransitionPredictor,
+)
+from smoe.utils.routing_trace import RoutingTrace, RoutingTraceRecorder
+
+
+def _tiny_mixtral():
+    config = MixtralConfig(
+        vocab_size=64,
+        hidden_size=16,
+        intermediate_size=24,
+        num_hidden_layers=3,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        num_local_experts=4,
+        num_experts_per_tok=2,
+    )
+    config._attn_implementation = "eager"
+    torch.manual_seed(0)
+    return MixtralForCausalLM(config).eval()
+
+
+def test_router_lookahead_predictor():
+    model = _tiny_mixtral()
+    predictor = RouterLookaheadPredictor.from_model(model, depth=2)
+    hidden_states = torch.randn(3, 16)
+    predictions = predictor.predict(0, hidden_states, None)
+    assert sorted(predictions) == [1, 2]
+    for layer_idx, experts in predictions.items():
+        gate = model.model.layers[layer_idx].block_sparse_moe.gate
+        ref = gate(hidden_states).topk(2, dim=-1).indices
+        assert torch.equal(experts, ref)
+    assert predictor.predict(2, hidden_states, None) == {}
+
+
+def test_mixtral_expert_prefetch():
+    model = _tiny_mixtral()
+    input_ids = torch.randint(0, 64, (1, 6))
+    generate_kwargs = dict(max_new_tokens=5, do_sample=False, pad_token_id=0)
+    ref = model.generate(input_ids, **generate_kwargs)
+
+    with tempfile.TemporaryDirectory() as folder:
+        model.save_pretrained(folder, safe_serialization=True)
+        engine = ExpertOffloadEngine.from_pretrained(
+            MixtralForCausalLM, folder, capacity=6, config=model.config, prefetch=None
+        )
+        # every expert is a candidate, so every routed expert is predicted
+        predictor = RouterLookaheadPredictor.from_model(
+            engine.model, depth=2, num_candidates=4
+        )
+        with ExpertPrefetcher(engine.model, predictor, engine=engine) as prefetcher:
+            out = engine.model.generate(input_ids, **generate_kwargs)
+        assert torch.equal(out, ref)
+        stats = prefetcher.stats()
+        # the prefill step is skipped
+        assert stats["num_steps"] == 4
+        assert stats["misses"] == 0 and stats["hits"] == 4 * 2 * 2
+        assert stats["layers"][0]["hits"] == 0
+        assert stats["cache"]["bytes_loaded"] > 0
+        engine.close()
+
+    with tempfile.TemporaryDirectory() as folder:
+        with RoutingTraceRecorder(model, folder):
+            model(torch.randint(0, 64, (4, 16)))
+        predictor = TransitionPredictor.from_routing_trace(RoutingTrace(folder))
+        with ExpertPrefetcher(model, predictor) as prefetcher:
+            out = model.generate(input_ids, **generate_kwargs)
+        assert torch.equal(out, ref)
+        stats = prefetcher.stats()
+        assert stats["hits"] + stats["misses"] == 4 * 2 * 2
+        assert stats["hits"] + stats["wasted"] == 4 * 2 * 2
+        assert "cache" not in stats
+
+
+if __name__ == "__main__":
+    test_router_lookahead_predictor()
+    test_mixtral_expert_prefetch()
@@ -0,0 +1,51 @@
+import torch
+
+from smoe.models.mixtral.configuration_mixtral import MixtralConfig
+from smoe.models.mixtral.modeling_mixtral import MixtralSparseMoeBlock
+
+
+def _moe_block(**kwargs):
+    config = MixtralConfig(
+        hidden_size=16,
+        intermediate_size=24,
+        num_local_experts=4,
+        num_experts_per_tok=2,
+        scale_factor=2.0,
+        **kwargs,
+    )
+    torch.manual_seed(0)
+    return MixtralSparseMoeBlock(config)
+
+
+def test_mixtral_static_moe():
+    x = torch.randn(2, 7, 16)
+    token_mask = torch.ones(2, 7, dtype=torch.long)
+    ref_block = _moe_block()
+    block = _moe_block(static_moe=True, static_moe_capacity_factor=None)
+    block.load_state_dict(ref_block.state_dict())
+
+    ref, ref_logits, ref_stats = ref_block(x, token_mask=token_mask)
+    out, router_logits, stats = block(x, token_mask=token_mask)
+    assert torch.allclose(out, ref, atol=1e-6)
+    assert torch.equal(router_logits, ref_logits)
+    assert torch.equal(stats, ref_stats)
+    assert block.num_dropped_tokens.item() == 0
+
+    ref.sum().backward()
+    out.sum().backward()
+    for param, ref_param in zip(block.parameters(), ref_block.parameters()):
+        assert torch.allclose(param.grad, ref_param.grad, atol=1e-5)
+
+    block.static_moe_capacity_factor = 1.0
+    block.eval()
+    compiled = torch.compile(block, backend="eager", fullgraph=True)
+    with torch.no_grad():
+        ref, _, _ = block(x)
+        num_dropped = block.num_dropped_tokens.item()
+        out, _, _ = compiled(x)
+    assert torch.allclose(out, ref)
+    assert block.num_dropped_tokens.item() == num_dropped > 0
+
+
+if __name__ == "__main__":
+    test_mixtral_static_moe()
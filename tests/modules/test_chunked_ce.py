@@ -0,0 +1,130 @@
+import torch
+import torch.nn as nn
+
+from smoe.models.mistral.configuration_mistral import MistralConfig
+from smoe.models.mistral.modeling_mistral import MistralForCausalLM
+from smoe.models.mixtral.configuration_mixtral import MixtralConfig
+from smoe.models.mixtral.modeling_mixtral import MixtralForCausalLM
+from smoe.modules.chunked_ce import causal_lm_loss
+
+
+def test_chunked_ce_matches_full_logits():
+    torch.manual_seed(0)
+    lm_head = nn.Linear(16, 50, bias=False)
+    hidden = torch.randn(2, 9, 16, requires_grad=True)
+    labels = torch.randint(0, 50, (2, 9))
+    labels[0, :3] = -100
+
+    logits = lm_head(hidden)[:, :-1].reshape(-1, 50)
+    ref = nn.functional.cross_entropy(logits, labels[:, 1:].reshape(-1))
+    ref_grads = torch.autograd.grad(ref, [hidden, lm_head.weight])
+
+    loss = causal_lm_loss(hidden, lm_head, labels, chunk_size=5)
+    grads = torch.autograd.grad(loss, [hidden, lm_head.weight])
+    assert torch.allclose(loss, ref, atol=1e-6)
+    for grad, ref_grad in zip(grads, ref_grads):
+        assert torch.allclose(grad, ref_grad, atol=1e-6)
+
+    # ZeRO-3 partitioned weights are only used through `lm_head`
+    lm_head.weight.ds_id = 0
+    loss = causal_lm_loss(hidden, lm_head, labels, chunk_size=5)
+    assert torch.allclose(loss, ref, atol=1e-6)
+    del lm_head.weight.ds_id
+
+    # per-sample losses from the same pass
+    ref_per_sample = nn.functional.cross_entropy(
+        logits, labels[:, 1:].reshape(-1), reduction="none"
+    )
+    ref_per_sample = ref_per_sample.view(2, -1).sum(dim=1)
+    for chunk_size in (0, 5):
+        loss, loss_per_sample = causal_lm_loss(
+            hidden, lm_head, labels, chunk_size=chunk_size, return_per_sample=True
+        )
+        assert torch.allclose(loss, ref, atol=1e-6)
+        assert not loss_per_sample.requires_grad
+        assert torch.allclose(loss_per_sample, ref_per_sample, atol=1e-5)
+        grads = torch.autograd.grad(loss, [hidden, lm_head.weight])
+        for grad, ref_grad in zip(grads, ref_grads):
+            assert torch.allclose(grad, ref_grad, atol=1e-6)
+
+
+def test_chunked_ce_in_causal_lm():
+    torch.manual_seed(0)
+    config = MistralConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        attn_implementation="eager",
+    )
+    model = MistralForCausalLM(config)
+    model.train()
+    input_ids = torch.randint(0, 64, (2, 12))
+
+    outputs = model(input_ids=input_ids, labels=input_ids)
+    ref_loss = outputs.loss
+    ref_loss.backward()
+    ref_grad = model.lm_head.weight.grad.clone()
+    model.zero_grad()
+
+    model.config.lm_loss_chunk_size = 7
+    outputs = model(input_ids=input_ids, labels=input_ids)
+    assert outputs.logits is None
+    outputs.loss.backward()
+    assert torch.allclose(outputs.loss, ref_loss, atol=1e-5)
+    assert torch.allclose(model.lm_head.weight.grad, ref_grad, atol=1e-5)
+
+    outputs = model(input_ids=input_ids, labels=input_ids, return_logits=True)
+    assert outputs.logits.shape == (2, 12, 64)
+
+    # ZeRO-3 partitioned lm_head weights fall back to the full logits
+    model.lm_head.weight.ds_id = 0
+    outputs = model(input_ids=input_ids, labels=input_ids)
+    assert outputs.logits is not None
+    assert torch.allclose(outputs.loss, ref_loss, atol=1e-5)
+    del model.lm_head.weight.ds_id
+    # logits are always computed without labels and in evaluation
+    model.eval()
+    assert model(input_ids=input_ids, labels=input_ids).logits is not None
+
+
+def test_loss_per_sample_in_causal_lm():
+    config = MixtralConfig(
+        vocab_size=64,
+        hidden_size=16,
+        intermediate_size=24,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        num_local_experts=4,
+        num_experts_per_tok=2,
+    )
+    config._attn_implementation = "eager"
+    torch.manual_seed(0)
+    model = MixtralForCausalLM(config)
+    model.train()
+    input_ids = torch.randint(0, 64, (3, 10))
+    labels = input_ids.clone()
+    labels[1, 6:] = -100
+
+    outputs = model(input_ids=input_ids, labels=labels)
+    assert outputs.loss_per_sample is None
+    ref_per_sample = nn.functional.cross_entropy(
+        outputs.logits[:, :-1].reshape(-1, 64),
+        labels[:, 1:].reshape(-1),
+        reduction="none",
+    ).view(3, -1)
+    ref_per_sample = ref_per_sample.sum(dim=1)
+    for chunk_size in (0, 4):
+        model.config.lm_loss_chunk_size = chunk_size
+        out = model(input_ids=input_ids, labels=labels, return_loss_per_sample=True)
+        assert torch.allclose(out.loss, outputs.loss, atol=1e-5)
+        assert torch.allclose(out.loss_per_sample, ref_per_sample, atol=1e-4)
+
+
+if __name__ == "__main__":
+    test_chunked_ce_matches_full_logits()
+    test_chunked_ce_in_causal_lm()
+    test_loss_per_sample_in_causal_lm()
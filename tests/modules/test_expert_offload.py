@@ -0,0 +1,104 @@
+import copy
+import os
+import tempfile
+
+import torch
+from safetensors.torch import save_file
+from torch import nn
+
+from smoe.modules.expert_offload import (
+    ExpertOffloadEngine,
+    ResidentExpertCache,
+    SafetensorsExpertStore,
+)
+from smoe.modules.moe.moe_layers import LinearGLUMoELayer
+
+
+class ToyMoEModel(nn.Module):
+    def __init__(self, num_layers=3, hidden_size=16, num_experts=4):
+        super().__init__()
+        self.layers = nn.ModuleList()
+        for _ in range(num_layers):
+            layer = nn.Module()
+            layer.mlp = LinearGLUMoELayer(
+                input_size=hidden_size,
+                hidden_size=hidden_size * num_experts,
+                output_size=hidden_size,
+                hidden_act="silu",
+                num_experts=num_experts,
+                num_selects=2,
+                bias=False,
+                gate_type="TopKBalancedNoisyGate",
+                gate_network="linear",
+                gate_add_noise=False,
+                calculator_type="UniversalCalculator",
+            )
+            nn.init.normal_(layer.mlp.gate.gate_network.weight)
+            self.layers.append(layer)
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = x + layer.mlp(x).hidden_states
+        return x
+
+
+def test_expert_offload_engine():
+    torch.manual_seed(0)
+    model = ToyMoEModel().eval()
+    x = torch.randn(2, 5, 16)
+    with torch.no_grad():
+        ref = model(x)
+
+    with tempfile.TemporaryDirectory() as folder:
+        save_file(model.state_dict(), os.path.join(folder, "model.safetensors"))
+        store = SafetensorsExpertStore(folder)
+        assert len(store.expert_prefixes) == 3
+        assert len(store.experts) == 12
+
+        for prefetch in (None, "current", "next_layer"):
+            offloaded = copy.deepcopy(model)
+            engine = ExpertOffloadEngine(
+                offloaded, folder, capacity=3, prefetch=prefetch
+            )
+            assert all(
+                "calculator.experts" not in name
+                for name, _ in offloaded.named_parameters()
+            )
+            with torch.no_grad():
+                out = offloaded(x)
+            assert torch.allclose(out, ref, atol=1e-6)
+            stats = engine.stats()
+            assert stats["num_resident"] <= 3
+            assert stats["bytes_loaded"] > 0
+            engine.close()
+
+
+def test_resident_expert_cache_policies():
+    torch.manual_seed(0)
+    model = ToyMoEModel(num_layers=1)
+    with tempfile.TemporaryDirectory() as folder:
+        save_file(model.state_dict(), os.path.join(folder, "model.safetensors"))
+        store = SafetensorsExpertStore(folder)
+        prefix = store.expert_prefixes[0]
+
+        cache = ResidentExpertCache(store, capacity=2, policy="lru")
+        for idx in (0, 1, 0, 2):
+            cache.get((prefix, idx))
+        assert (prefix, 0) in cache and (prefix, 1) not in cache
+        assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 3
+        cache.close()
+
+        cache = ResidentExpertCache(store, capacity=2, policy="lfu")
+        for idx in (0, 0, 1, 2):
+            cache.get((prefix, idx))
+        assert (prefix, 0) in cache and (prefix, 2) in cache
+        expert_bytes = sum(
+            w.numel() * w.element_size() for w in store.load_expert(prefix, 0).values()
+        )
+        assert cache.stats()["bytes_loaded"] == 3 * expert_bytes
+        cache.close()
+
+
+if __name__ == "__main__":
+    test_expert_offload_engine()
+    test_resident_expert_cache_policies()
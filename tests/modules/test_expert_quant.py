@@ -0,0 +1,210 @@
+import os
+import tempfile
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from smoe.models.mixtral.configuration_mixtral import MixtralConfig
+from smoe.models.mixtral.modeling_mixtral import MixtralForCausalLM
+from smoe.modules.expert_quant import (
+    QuantizedLinear,
+    QuantizedLinearGLUExperts,
+    QuantizedMixtralExpert,
+    dequantize_weight,
+    load_quantized_model,
+    pack_int4,
+    quantize_experts,
+    quantize_safetensors_experts,
+    quantize_weight,
+    unpack_int4,
+)
+from smoe.modules.moe.moe_experts import LinearGLUExperts
+from smoe.modules.moe.moe_layers import LinearGLUMoELayer
+from smoe.modules.moe_residual.moe_residual_layers import LinearGLUMoEResidualLayer
+
+
+def _tiny_mixtral():
+    config = MixtralConfig(
+        vocab_size=64,
+        hidden_size=16,
+        intermediate_size=24,
+        num_hidden_layers=3,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        num_local_experts=4,
+        num_experts_per_tok=2,
+        intermediate_size_residual=8,
+        num_moe_contract_layers=1,
+    )
+    config._attn_implementation = "eager"
+    torch.manual_seed(0)
+    return MixtralForCausalLM(config).eval()
+
+
+def _eager_config(folder):
+    config = MixtralConfig.from_pretrained(folder)
+    config._attn_implementation = "eager"
+    return config
+
+
+def test_quantize_weight():
+    q = torch.randint(-8, 8, (5, 7), dtype=torch.int8)
+    assert torch.equal(unpack_int4(pack_int4(q), 7), q)
+    assert pack_int4(q).shape == (5, 4)
+
+    torch.manual_seed(0)
+    weight = torch.randn(12, 40)
+    for bits, max_error in ((8, 0.02), (4, 0.35)):
+        for group_size in (None, 16, 40, 64):
+            qweight, scales = quantize_weight(weight, bits=bits, group_size=group_size)
+            assert scales.shape == (12, 1 if group_size in (None, 40, 64) else 3)
+            restored = dequantize_weight(qweight, scales, bits, 40, group_size)
+            assert restored.shape == weight.shape
+            assert (restored - weight).abs().max() < max_error
+            # rows dequantized in blocks
+            block = dequantize_weight(qweight[4:9], scales[4:9], bits, 40, group_size)
+            assert torch.equal(block, restored[4:9])
+
+    linear = torch.nn.Linear(40, 12)
+    for block_rows in (None, 5):
+        quantized = QuantizedLinear.from_float(
+            linear.weight, linear.bias, bits=8, group_size=16, block_rows=block_rows
+        )
+        x = torch.randn(3, 2, 40)
+        with torch.no_grad():
+            ref = torch.nn.functional.linear(x, quantized.dequantize(), linear.bias)
+            assert torch.allclose(quantized(x), ref, atol=1e-6)
+            assert torch.allclose(quantized(x), linear(x), atol=0.05)
+
+    # weight-only int8 kernel for bfloat16 inputs
+    for in_features in (40, 48):
+        linear = torch.nn.Linear(in_features, 12).bfloat16()
+        quantized = QuantizedLinear.from_float(linear.weight, linear.bias)
+        x = torch.randn(3, 2, in_features, dtype=torch.bfloat16)
+        assert quantized._use_int8_kernel(x) == (in_features == 48)
+        with torch.no_grad():
+            ref = torch.nn.functional.linear(
+                x.float(),
+                quantized.dequantize(dtype=torch.float32),
+                linear.bias.float(),
+            )
+            assert torch.allclose(quantized(x).float(), ref, atol=0.05)
+
+
+def test_quantize_linear_glu_experts():
+    torch.manual_seed(0)
+    layer = LinearGLUMoELayer(
+        input_size=32,
+        hidden_size=96,
+        output_size=32,
+        hidden_act="silu",
+        num_experts=4,
+        num_selects=2,
+        bias=True,
+        gate_type="TopKBalancedNoisyGate",
+        gate_network="linear",
+        gate_add_noise=False,
+        calculator_type="UniversalCalculator",
+    )
+    torch.nn.init.normal_(layer.gate.gate_network.weight)
+    x = torch.randn(2, 5, 32)
+    with torch.no_grad():
+        ref = layer(x).hidden_states
+        quantize_experts(layer, bits=8)
+        out = layer(x).hidden_states
+    assert isinstance(layer.calculator.experts, QuantizedLinearGLUExperts)
+    assert (out - ref).abs().max() < 0.02 * ref.abs().max()
+    assert "calculator.experts.weight_down.3.qweight" in layer.state_dict()
+    assert "calculator.experts.bias_down.3" in layer.state_dict()
+
+
+def test_quantize_residual_layer_experts():
+    torch.manual_seed(0)
+    layer = LinearGLUMoEResidualLayer(
+        input_size=16,
+        hidden_size=32,
+        output_size=16,
+        hidden_act="silu",
+        num_experts=4,
+        num_selects=2,
+        bias=False,
+        num_experts_residual=1,
+        gate_type="TopKBalancedNoisyGate",
+        gate_network="linear",
+        gate_add_noise=False,
+        calculator_type="UniversalCalculator",
+    )
+    model = torch.nn.Module()
+    model.mlp = layer
+    state_dict = {k: v.contiguous() for k, v in model.state_dict().items()}
+
+    # the always-on residual experts keep the model dtype
+    quantize_experts(model, bits=8)
+    assert isinstance(layer.moe_layer.calculator.experts, QuantizedLinearGLUExperts)
+    assert isinstance(layer.residual_block.calculator.experts, LinearGLUExperts)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        float_folder = f"{tmp_dir}/float"
+        os.makedirs(float_folder)
+        save_file(state_dict, f"{float_folder}/model.safetensors")
+        quantize_safetensors_experts(float_folder, f"{tmp_dir}/int8", bits=8)
+        with safe_open(f"{tmp_dir}/int8/model.safetensors", framework="pt") as f:
+            keys = set(f.keys())
+            assert torch.equal(
+                f.get_tensor("mlp.residual_block.calculator.experts.weight_up.0"),
+                state_dict["mlp.residual_block.calculator.experts.weight_up.0"],
+            )
+    # the checkpoint has the same keys as the model quantized in memory
+    assert keys == set(model.state_dict().keys())
+    assert "mlp.moe_layer.calculator.experts.weight_up.0.qweight" in keys
+
+
+def test_quantize_mixtral_experts():
+    model = _tiny_mixtral()
+    input_ids = torch.randint(0, 64, (2, 6))
+    with torch.no_grad():
+        ref = model(input_ids).logits
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model.save_pretrained(f"{tmp_dir}/float", max_shard_size="20KB")
+        assert os.path.exists(f"{tmp_dir}/float/model.safetensors.index.json")
+        quantize_safetensors_experts(
+            f"{tmp_dir}/float", f"{tmp_dir}/int4", bits=4, group_size=8
+        )
+        loaded = load_quantized_model(
+            MixtralForCausalLM,
+            f"{tmp_dir}/int4",
+            config=_eager_config(f"{tmp_dir}/int4"),
+        )
+
+        # the same as quantizing in memory
+        quantize_experts(model, bits=4, group_size=8)
+        assert model.config.expert_quantization == {"bits": 4, "group_size": 8}
+        assert isinstance(
+            model.model.layers[1].block_sparse_moe.experts[0], QuantizedMixtralExpert
+        )
+        # residual & dense MLPs keep the model dtype
+        assert isinstance(model.model.layers[1].mlp_residual.w1, torch.nn.Linear)
+        assert isinstance(model.model.layers[0].block_sparse_moe.w1, torch.nn.Linear)
+        with torch.no_grad():
+            out = model(input_ids).logits
+            assert torch.allclose(loaded(input_ids).logits, out, atol=1e-6)
+        assert (out - ref).abs().max() < 0.1 * ref.abs().max()
+
+        # quantized models are saved & loaded as they are
+        model.save_pretrained(f"{tmp_dir}/saved")
+        reloaded = load_quantized_model(
+            MixtralForCausalLM,
+            f"{tmp_dir}/saved",
+            config=_eager_config(f"{tmp_dir}/saved"),
+        )
+        with torch.no_grad():
+            assert torch.allclose(reloaded(input_ids).logits, out, atol=1e-6)
+
+
+if __name__ == "__main__":
+    test_quantize_weight()
+    test_quantize_linear_glu_experts()
+    test_quantize_residual_layer_experts()
+    test_quantize_mixtral_experts()
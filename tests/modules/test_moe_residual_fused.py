@@ -0,0 +1,119 @@
+import tempfile
+
+import torch
+
+from smoe.modules.moe_residual.moe_residual_layers import LinearGLUMoEResidualLayer
+
+
+def _residual_layer(bias=False, **kwargs):
+    torch.manual_seed(0)
+    layer = LinearGLUMoEResidualLayer(
+        input_size=16,
+        hidden_size=24,
+        output_size=16,
+        hidden_act="silu",
+        num_experts=4,
+        num_selects=2,
+        bias=bias,
+        num_experts_residual=2,
+        size_experts_residual=[4, 8],
+        gate_type="TopKBalancedNoisyGate",
+        gate_network="linear",
+        gate_add_noise=False,
+        calculator_type="UniversalCalculator",
+        score_scale_factor_residual=2.0,
+        **kwargs,
+    ).double()
+    torch.nn.init.normal_(layer.moe_layer.gate.gate_network.weight)
+    # the residual gate is initialized with zeros
+    torch.nn.init.normal_(layer.residual_block.gate.gate_network.weight)
+    return layer
+
+
+def test_fused_residual_forward():
+    x = torch.randn(2, 7, 16, dtype=torch.float64)
+    for bias in (False, True):
+        for multiply_gate_scores in (False, True):
+            layer = _residual_layer(
+                bias=bias, multiply_gate_scores_residual=multiply_gate_scores
+            )
+            with torch.no_grad():
+                layer.set_fuse_residual(False)
+                ref = layer(x).hidden_states
+                layer.set_fuse_residual(True)
+                out = layer(x).hidden_states
+            assert torch.allclose(out, ref)
+
+    # MLP gate networks run separately
+    layer = _residual_layer()
+    layer.residual_block.gate = type(layer.residual_block.gate)(16, 2, "mlp")
+    layer.double()
+    with torch.no_grad():
+        layer.set_fuse_residual(False)
+        ref = layer(x).hidden_states
+        layer.set_fuse_residual(True)
+        out = layer(x).hidden_states
+    assert torch.allclose(out, ref)
+
+
+def test_fused_residual_params():
+    x = torch.randn(2, 7, 16, dtype=torch.float64)
+    layer = _residual_layer(bias=True)
+    state_dict = {key: value.clone() for key, value in layer.state_dict().items()}
+    with torch.no_grad():
+        out = layer(x).hidden_states
+    # the params are views of the fused weight, with the same values
+    experts = layer.residual_block.calculator.experts
+    fused_weight = layer._fused_residual.weight
+    assert experts.weight_up[1].data_ptr() != fused_weight.data_ptr()
+    assert experts.weight_up[1].untyped_storage().data_ptr() == (
+        fused_weight.untyped_storage().data_ptr()
+    )
+    assert state_dict.keys() == layer.state_dict().keys()
+    for key, value in layer.state_dict().items():
+        assert torch.equal(value, state_dict[key])
+
+    # loaded params are copied into the fused weight
+    other = _residual_layer(bias=True)
+    for param in other.residual_block.parameters():
+        torch.nn.init.normal_(param)
+    with torch.no_grad():
+        layer.load_state_dict(other.state_dict())
+        assert torch.allclose(layer(x).hidden_states, other(x).hidden_states)
+
+    # the fused weight is rebuilt after the params are replaced
+    layer.float()
+    with torch.no_grad():
+        out = layer(x.float()).hidden_states
+        layer.set_fuse_residual(False)
+        ref = layer(x.float()).hidden_states
+    assert layer._fused_residual.weight.dtype == torch.float32
+    assert torch.allclose(out, ref, atol=1e-5)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        torch.save(layer.state_dict(), f"{tmp_dir}/layer.pt")
+        loaded = torch.load(f"{tmp_dir}/layer.pt")
+    for key, value in layer.state_dict().items():
+        assert loaded[key].shape == value.shape
+
+
+def test_fused_residual_backward():
+    x = torch.randn(2, 7, 16, dtype=torch.float64)
+    grads = []
+    for fuse_residual in (False, True):
+        layer = _residual_layer(bias=True)
+        layer.set_fuse_residual(fuse_residual)
+        layer(x).hidden_states.pow(2).sum().backward()
+        grads.append({name: param.grad for name, param in layer.named_parameters()})
+    assert grads[0].keys() == grads[1].keys()
+    for name, grad in grads[0].items():
+        if grad is None:
+            assert grads[1][name] is None
+        else:
+            assert torch.allclose(grads[1][name], grad), name
+
+
+if __name__ == "__main__":
+    test_fused_residual_forward()
+    test_fused_residual_params()
+    test_fused_residual_backward()
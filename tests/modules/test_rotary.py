@@ -0,0 +1,57 @@
+import torch
+
+from smoe.models.llama_moe.modeling_llama_moe_hf import (
+    LlamaDynamicNTKScalingRotaryEmbedding,
+    LlamaLinearScalingRotaryEmbedding,
+)
+from smoe.models.mistral.modeling_mistral import MistralRotaryEmbedding
+from smoe.modules.rotary import clear_rotary_tables, get_rotary_table
+
+
+def test_rotary_table_shared_and_grown():
+    clear_rotary_tables()
+    x = torch.zeros(1, 1, 4, 8)
+    rotary_a = MistralRotaryEmbedding(8, max_position_embeddings=16)
+    rotary_b = MistralRotaryEmbedding(8, max_position_embeddings=16)
+    cos_a, sin_a = rotary_a(x, seq_len=4)
+    cos_b, _ = rotary_b(x, seq_len=10)
+    assert cos_a.shape == (4, 8) and cos_b.shape == (10, 8)
+    assert cos_a.data_ptr() == cos_b.data_ptr()
+
+    position_ids = torch.arange(4)
+    inv_freq = 1.0 / (10000 ** (torch.arange(0, 8, 2).float() / 8))
+    freqs = torch.outer(position_ids.float(), inv_freq)
+    assert torch.allclose(cos_a, torch.cat((freqs, freqs), dim=-1).cos())
+    assert torch.allclose(sin_a, torch.cat((freqs, freqs), dim=-1).sin())
+
+    # geometric growth
+    cos, _ = get_rotary_table(8, 20, x.device, x.dtype, max_position_embeddings=16)
+    assert cos.shape[0] == 32
+    assert torch.allclose(cos[:4], cos_a)
+
+
+def test_rotary_table_scaling():
+    x = torch.zeros(1, 1, 4, 8)
+    for rotary_cls in (
+        LlamaLinearScalingRotaryEmbedding,
+        LlamaDynamicNTKScalingRotaryEmbedding,
+    ):
+        rotary = rotary_cls(8, max_position_embeddings=16, scaling_factor=2.0)
+        for seq_len in (8, 24):
+            cos, sin = rotary(x, seq_len=seq_len)
+            base, t = 10000, torch.arange(seq_len).float()
+            if rotary_cls is LlamaLinearScalingRotaryEmbedding:
+                t = t / 2.0
+            elif seq_len > 16:
+                base = base * ((2.0 * seq_len / 16) - 1.0) ** (8 / 6)
+            inv_freq = 1.0 / (base ** (torch.arange(0, 8, 2).float() / 8))
+            emb = torch.outer(t, inv_freq)
+            emb = torch.cat((emb, emb), dim=-1)
+            assert cos.shape == (1, 1, seq_len, 8)
+            assert torch.allclose(cos[0, 0], emb.cos(), atol=1e-6)
+            assert torch.allclose(sin[0, 0], emb.sin(), atol=1e-6)
+
+
+if __name__ == "__main__":
+    test_rotary_table_shared_and_grown()
+    test_rotary_table_scaling()
@@ -0,0 +1,104 @@
+import torch
+
+from smoe.modules.moe.moe_layers import LinearGLUMoELayer
+from smoe.modules.static_moe import capacity_dispatch, compute_expert_capacity
+
+
+def _moe_layer(calculator_type, **kwargs):
+    torch.manual_seed(0)
+    layer = LinearGLUMoELayer(
+        input_size=16,
+        hidden_size=24,
+        output_size=16,
+        hidden_act="silu",
+        num_experts=4,
+        num_selects=2,
+        bias=False,
+        gate_type="TopKBalancedNoisyGate",
+        gate_network="linear",
+        gate_add_noise=False,
+        calculator_type=calculator_type,
+        score_scale_factor=2.0,
+        **kwargs,
+    )
+    torch.nn.init.normal_(layer.gate.gate_network.weight)
+    return layer
+
+
+def test_capacity_dispatch():
+    selected_experts = torch.tensor([[0, 1], [0, 2], [0, 1], [3, 0]])
+    capacity = compute_expert_capacity(4, 4, 2, capacity_factor=1.0)
+    assert capacity == 2
+    # 1.25x the balanced load by default, `None` never drops tokens
+    assert compute_expert_capacity(64, 8, 2) == 20
+    assert compute_expert_capacity(64, 8, 2, capacity_factor=None) == 64
+
+    slot_tokens, assignment_slots, num_dropped = capacity_dispatch(
+        selected_experts, 4, capacity
+    )
+    # first choices of tokens 0 and 1 fill expert 0, the rest of expert 0 is dropped
+    assert slot_tokens.tolist() == [[0, 1], [0, 2], [1, 4], [3, 4]]
+    assert assignment_slots.tolist() == [[0, 2], [1, 4], [8, 3], [6, 8]]
+    assert num_dropped.item() == 2
+
+    token_mask = torch.tensor([0, 1, 1, 1])
+    slot_tokens, assignment_slots, num_dropped = capacity_dispatch(
+        selected_experts, 4, capacity, token_mask=token_mask
+    )
+    assert slot_tokens.tolist() == [[1, 2], [2, 4], [1, 4], [3, 4]]
+    assert assignment_slots.tolist() == [[8, 8], [0, 4], [1, 2], [6, 8]]
+    assert num_dropped.item() == 1
+
+
+def test_static_capacity_calculator():
+    x = torch.randn(2, 7, 16)
+    ref_layer = _moe_layer("UniversalCalculator")
+    layer = _moe_layer("StaticCapacityCalculator", capacity_factor=None)
+    layer.load_state_dict(ref_layer.state_dict())
+
+    ref = ref_layer(x)
+    out = layer(x)
+    assert torch.allclose(out.hidden_states, ref.hidden_states, atol=1e-6)
+    assert out.num_dropped_tokens.item() == 0
+
+    ref.hidden_states.sum().backward()
+    out.hidden_states.sum().backward()
+    for param, ref_param in zip(layer.parameters(), ref_layer.parameters()):
+        # experts without tokens are skipped by `UniversalCalculator`
+        ref_grad = torch.zeros_like(param) if ref_param.grad is None else ref_param.grad
+        assert torch.allclose(param.grad, ref_grad, atol=1e-5)
+
+    layer.set_calculator_capacity_factor(1.0)
+    assert layer(x).num_dropped_tokens.item() > 0
+
+
+def test_static_moe_single_graph():
+    x = torch.randn(2, 7, 16)
+    layer = _moe_layer("StaticCapacityCalculator", capacity_factor=1.5).eval()
+    # fullgraph raises on any graph break
+    compiled = torch.compile(layer, backend="eager", fullgraph=True)
+    with torch.no_grad():
+        ref = layer(x)
+        out = compiled(x)
+    assert torch.allclose(out.hidden_states, ref.hidden_states)
+    assert out.num_dropped_tokens.item() == ref.num_dropped_tokens.item()
+
+
+def test_gate_load_counts():
+    # bf16 cannot represent counts above 256 exactly
+    gate = _moe_layer("UniversalCalculator").gate.bfloat16()
+    x = torch.randn(4099, 16, dtype=torch.bfloat16)
+    for training in (True, False):
+        gate.train(training)
+        with torch.no_grad():
+            out = gate(x)
+        counts = out["topK_indices"].flatten().bincount(minlength=4)
+        assert out["load"].dtype == torch.float32
+        assert out["load"].tolist() == counts.tolist()
+
+
+if __name__ == "__main__":
+    test_capacity_dispatch()
+    test_static_capacity_calculator()
+    test_static_moe_single_graph()
+    test_gate_load_counts()
@@ -0,0 +1,95 @@
+import os
+import tempfile
+
+import pytest
+import torch
+from safetensors.torch import load_file
+from torch import nn
+
+from smoe.utils.async_checkpoint import (
+    AsyncShardedCheckpointWriter,
+    is_sharded_checkpoint,
+    load_sharded_checkpoint,
+    load_sharded_state_dict,
+    merge_sharded_checkpoint,
+)
+
+
+def _get_model():
+    return nn.Sequential(
+        nn.Linear(16, 32),
+        nn.ReLU(),
+        nn.Linear(32, 8, bias=False),
+        nn.LayerNorm(8),
+    )
+
+
+def test_async_checkpoint_single_rank():
+    model = _get_model()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        writer = AsyncShardedCheckpointWriter(rank=0, world_size=1)
+        writer.save(model, temp_dir, metadata={"global_step": 1})
+        writer.wait()
+        assert is_sharded_checkpoint(temp_dir)
+
+        # buffers are reused, the snapshot must not follow later updates
+        with torch.no_grad():
+            model[0].weight.add_(1.0)
+        writer.save(model, temp_dir, metadata={"global_step": 2})
+        with torch.no_grad():
+            model[0].weight.add_(1.0)
+        writer.close()
+
+        state_dict = load_sharded_state_dict(temp_dir)
+        assert torch.allclose(state_dict["0.weight"], model[0].weight - 1.0)
+
+        new_model = _get_model()
+        load_sharded_checkpoint(new_model, temp_dir)
+        assert torch.equal(new_model[2].weight, model[2].weight)
+
+
+def test_async_checkpoint_multi_rank_merge():
+    model = _get_model()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ckpt_dir = os.path.join(temp_dir, "checkpoint-1")
+        out_dir = os.path.join(temp_dir, "merged")
+        writers = [
+            AsyncShardedCheckpointWriter(rank=rank, world_size=2, run_id="run")
+            for rank in (1, 0)
+        ]
+        for writer in writers:
+            writer.save(model, ckpt_dir)
+        for writer in writers:
+            writer.close()
+        assert is_sharded_checkpoint(ckpt_dir)
+
+        merge_sharded_checkpoint(ckpt_dir, out_dir, max_shard_size=1024)
+        assert os.path.exists(os.path.join(out_dir, "model.safetensors.index.json"))
+        merged = {}
+        for filename in os.listdir(out_dir):
+            if filename.endswith(".safetensors"):
+                merged.update(load_file(os.path.join(out_dir, filename)))
+        for name, tensor in model.state_dict().items():
+            assert torch.equal(merged[name], tensor)
+
+        # a resumed run restarts `save_id`, stale meta files of rank 1 are not committed
+        ckpt_dir = os.path.join(temp_dir, "checkpoint-2")
+        writer = AsyncShardedCheckpointWriter(rank=1, world_size=2, run_id="old")
+        writer.save(model, ckpt_dir)
+        writer.close()
+        writer = AsyncShardedCheckpointWriter(
+            rank=0, world_size=2, run_id="new", commit_timeout=1.0
+        )
+        writer.save(model, ckpt_dir)
+        with pytest.raises(TimeoutError):
+            writer.wait()
+        writer.close()
+        assert not is_sharded_checkpoint(ckpt_dir)
+
+        with pytest.raises(ValueError):
+            AsyncShardedCheckpointWriter(rank=0, world_size=2)
+
+
+if __name__ == "__main__":
+    test_async_checkpoint_single_rank()
+    test_async_checkpoint_multi_rank_merge()
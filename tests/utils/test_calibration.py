@@ -0,0 +1,179 @@
+import os
+import tempfile
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from smoe.utils.calibration import (
+    CalibrationCallback,
+    FeatureCaptureCallback,
+    HiddenDistributionCallback,
+    LayerwiseCalibrator,
+    new_distribution,
+    update_distribution,
+)
+
+CONFIG_KWARGS = dict(
+    vocab_size=64,
+    hidden_size=16,
+    intermediate_size=32,
+    num_hidden_layers=3,
+    num_attention_heads=4,
+    num_key_value_heads=2,
+)
+
+
+def _tiny_llama():
+    config = LlamaConfig(**CONFIG_KWARGS)
+    config._attn_implementation = "eager"
+    torch.manual_seed(0)
+    return LlamaForCausalLM(config).eval()
+
+
+def _batches():
+    torch.manual_seed(1)
+    batches = []
+    for _ in range(3):
+        input_ids = torch.randint(0, 64, (2, 8))
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[1, 5:] = 0
+        batches.append({"input_ids": input_ids, "attention_mask": attention_mask})
+    return batches
+
+
+class _OutputRecorder(CalibrationCallback):
+    def __init__(self):
+        self.outputs = {}
+        self.num_passes = {}
+
+    def on_batch_end(self, state, layer, hidden_states):
+        self.outputs[(state.layer_idx, state.batch_idx)] = hidden_states.clone()
+
+    def on_layer_end(self, state, layer):
+        self.num_passes[state.layer_idx] = state.pass_idx + 1
+
+
+class _RepeatOnce(CalibrationCallback):
+    def on_pass_end(self, state, layer):
+        return state.pass_idx == 0
+
+
+@torch.no_grad()
+def _full_forward_outputs(model, batches):
+    """{(layer_idx, batch_idx): outputs of the layer} of the usual forward"""
+    outputs = {}
+    for layer_idx, layer in enumerate(model.model.layers):
+        layer.register_forward_hook(
+            lambda module, args, output, layer_idx=layer_idx: outputs.__setitem__(
+                layer_idx, output[0]
+            )
+        )
+    results = {}
+    for batch_idx, batch in enumerate(batches):
+        model(**batch)
+        for layer_idx, output in outputs.items():
+            results[(layer_idx, batch_idx)] = output
+    return results
+
+
+def test_layerwise_calibrator_matches_forward():
+    model = _tiny_llama()
+    batches = _batches()
+    expected = _full_forward_outputs(model, batches)
+    for layer in model.model.layers:
+        layer._forward_hooks.clear()
+
+    with tempfile.TemporaryDirectory() as folder:
+        recorder = _OutputRecorder()
+        calibrator = LayerwiseCalibrator(
+            model, device="cpu", max_memory_bytes=0, spill_dir=folder
+        )
+        calibrator.run(batches, [recorder, _RepeatOnce()])
+        # the 4D attention masks are spilled as well
+        assert len(os.listdir(os.path.join(folder, "layer_inputs"))) > 0
+    assert recorder.num_passes == {0: 2, 1: 2, 2: 2}
+    for key, value in expected.items():
+        assert torch.allclose(recorder.outputs[key], value, atol=1e-5), key
+
+
+def test_layerwise_calibrator_num_layers():
+    model = _tiny_llama()
+    recorder = _OutputRecorder()
+    state = LayerwiseCalibrator(model).run(_batches(), [recorder], num_layers=2)
+    assert state.layer_idx == 1
+    assert sorted(recorder.num_passes) == [0, 1]
+
+
+def test_hidden_distribution_callback():
+    model = _tiny_llama()
+    batches = _batches()
+
+    # statistics of the usual forward
+    expected = {i: {m: new_distribution(16) for m in ("attn", "mlp")} for i in range(3)}
+    masks = []
+
+    def make_hook(layer_idx, module_name):
+        def hook(module, args, output):
+            output = output if isinstance(output, torch.Tensor) else output[0]
+            update_distribution(expected[layer_idx][module_name], output[masks[-1]])
+
+        return hook
+
+    handles = []
+    for layer_idx, layer in enumerate(model.model.layers):
+        handles.append(
+            layer.self_attn.register_forward_hook(make_hook(layer_idx, "attn"))
+        )
+        handles.append(layer.mlp.register_forward_hook(make_hook(layer_idx, "mlp")))
+    with torch.no_grad():
+        for batch in batches:
+            masks.append(batch["attention_mask"].bool())
+            model(**batch)
+    for handle in handles:
+        handle.remove()
+
+    callback = HiddenDistributionCallback(16)
+    LayerwiseCalibrator(model).run(batches, [callback, _RepeatOnce()])
+    distribution_info = callback.gather()
+    for layer_idx in range(3):
+        for module_name in ("attn", "mlp"):
+            result = distribution_info[layer_idx][module_name]
+            ref = expected[layer_idx][module_name]
+            # the repeated pass is not counted
+            assert int(result["number"]) == 3 * (8 + 5)
+            assert torch.allclose(result["mean"], ref["mean"], atol=1e-5)
+            assert torch.allclose(result["variance"], ref["variance"], atol=1e-5)
+
+
+def test_feature_capture_callback():
+    model = _tiny_llama()
+    batches = _batches()
+    features = {}
+
+    def capture(layer_idx, layer_features):
+        features[layer_idx] = layer_features
+
+    inputs = []
+    handle = model.model.layers[1].mlp.register_forward_pre_hook(
+        lambda module, args: inputs.append(args[0])
+    )
+    with torch.no_grad():
+        for batch in batches:
+            model(**batch)
+    handle.remove()
+
+    callback = FeatureCaptureCallback(capture, max_memory_bytes=0)
+    LayerwiseCalibrator(model).run(batches, [callback])
+    assert sorted(features) == [0, 1, 2]
+    expected = torch.cat(
+        [x[batch["attention_mask"].bool()] for x, batch in zip(inputs, batches)]
+    )
+    assert features[1].shape == (3 * (8 + 5), 16)
+    assert torch.allclose(features[1], expected, atol=1e-5)
+
+
+if __name__ == "__main__":
+    test_layerwise_calibrator_matches_forward()
+    test_layerwise_calibrator_num_layers()
+    test_hidden_distribution_callback()
+    test_feature_capture_callback()
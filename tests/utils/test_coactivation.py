@@ -0,0 +1,159 @@
+import numpy as np
+import scipy.sparse as sp
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from smoe.utils.calibration import LayerwiseCalibrator
+from smoe.utils.expert_construction.coactivation import (
+    CoActivationCallback,
+    CoActivationSketch,
+    _refine_partition,
+    balanced_graph_partition,
+    labels_to_neuron_indices,
+    partition_cut,
+)
+from smoe.utils.model_operation.modify_llama_model import llama_with_relu_activation
+
+
+def _planted_firing(num_tokens, num_groups, group_size, seed=0):
+    """Neurons of the same (shuffled) group fire together."""
+    generator = torch.Generator().manual_seed(seed)
+    num_neurons = num_groups * group_size
+    groups = torch.randint(0, num_groups, (num_tokens,), generator=generator)
+    perm = torch.randperm(num_neurons, generator=generator)
+    group_of_neuron = torch.empty(num_neurons, dtype=torch.long)
+    group_of_neuron[perm] = torch.arange(num_neurons) // group_size
+    fired = group_of_neuron[None, :] == groups[:, None]
+    noise = torch.rand(num_tokens, num_neurons, generator=generator) < 0.05
+    return fired ^ noise, group_of_neuron
+
+
+def test_coactivation_sketch_exact():
+    fired, _ = _planted_firing(300, 4, 5)
+    # all neighbors fit, the sketch is exact
+    sketch = CoActivationSketch(
+        20, num_neighbors=32, flush_tokens=64, max_block_bytes=7 * 20 * 4
+    )
+    for chunk in fired.split(50):
+        sketch.update(chunk)
+    dense = fired.float().t() @ fired.float()
+    dense.fill_diagonal_(0)
+    graph = sketch.to_graph(normalize="count").toarray()
+    assert sketch.num_tokens == 300
+    assert torch.equal(sketch.firing_counts, fired.sum(0))
+    assert np.allclose(graph, dense.numpy())
+
+    # jaccard weights
+    counts = fired.sum(0).double().numpy()
+    union = counts[:, None] + counts[None, :] - dense.double().numpy()
+    jaccard = sketch.to_graph().toarray()
+    assert np.allclose(jaccard, dense.double().numpy() / np.maximum(union, 1))
+
+    restored = CoActivationSketch(20)
+    restored.load_state_dict(sketch.state_dict())
+    assert np.allclose(restored.to_graph().toarray(), jaccard)
+
+
+def test_coactivation_sketch_top_neighbors():
+    fired, group_of_neuron = _planted_firing(2000, 8, 16, seed=1)
+    sketch = CoActivationSketch(128, num_neighbors=24, flush_tokens=256)
+    sketch.update(fired)
+    # the kept neighbors are the neurons of the same group
+    neighbors = sketch.neighbors[:, :15]
+    assert (
+        group_of_neuron[neighbors] == group_of_neuron[:, None]
+    ).float().mean() > 0.99
+
+
+def test_balanced_graph_partition():
+    fired, group_of_neuron = _planted_firing(2000, 8, 16, seed=2)
+    sketch = CoActivationSketch(128, num_neighbors=24, flush_tokens=512)
+    sketch.update(fired)
+    graph = sketch.to_graph()
+    labels = balanced_graph_partition(graph, 8)
+    assert np.bincount(labels, minlength=8).tolist() == [16] * 8
+    # the planted groups are recovered
+    for part in range(8):
+        assert len(set(group_of_neuron[labels == part].tolist())) == 1
+    random_labels = np.random.default_rng(0).permutation(np.arange(128) // 16)
+    assert partition_cut(graph, labels) < 0.1 < partition_cut(graph, random_labels)
+
+    neuron_indices = labels_to_neuron_indices(labels, 8)
+    assert sorted(sum(neuron_indices, [])) == list(range(128))
+
+
+def test_refine_partition():
+    # 4 cliques of 6 nodes
+    graph = np.kron(np.eye(4), np.ones((6, 6)))
+    np.fill_diagonal(graph, 0)
+    graph = sp.csr_matrix(graph)
+    planted = np.arange(24) // 6
+    labels = planted.copy()
+    # swap 2 nodes between every pair of neighboring parts
+    for part in range(3):
+        a, b = part * 6, (part + 1) * 6 + 1
+        labels[a], labels[b] = labels[b], labels[a]
+    assert partition_cut(graph, labels) > 0.2
+    refined = _refine_partition(graph, labels, 4, max_iter=10)
+    assert np.bincount(refined).tolist() == [6] * 4
+    assert partition_cut(graph, refined) == 0
+    assert np.array_equal(refined, planted)
+
+
+def test_coactivation_callback():
+    config = LlamaConfig(
+        vocab_size=64,
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+    )
+    config._attn_implementation = "eager"
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(config).eval()
+    model.model = llama_with_relu_activation(model.model)
+    batches = []
+    for _ in range(2):
+        input_ids = torch.randint(0, 64, (2, 8))
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[0, 6:] = 0
+        batches.append({"input_ids": input_ids, "attention_mask": attention_mask})
+
+    # firing of the usual forward
+    fired = {0: [], 1: []}
+    for layer_idx, layer in enumerate(model.model.layers):
+        layer.mlp.act_fn.register_forward_hook(
+            lambda module, args, output, layer_idx=layer_idx: fired[layer_idx].append(
+                output > 0
+            )
+        )
+    with torch.no_grad():
+        for batch in batches:
+            model(**batch)
+    for layer in model.model.layers:
+        layer.mlp.act_fn._forward_hooks.clear()
+
+    sketches = {}
+    callback = CoActivationCallback(
+        lambda layer_idx, sketch: sketches.__setitem__(layer_idx, sketch),
+        num_neighbors=31,
+    )
+    LayerwiseCalibrator(model).run(batches, [callback])
+    for layer_idx in range(2):
+        expected = torch.cat(
+            [f[b["attention_mask"].bool()] for f, b in zip(fired[layer_idx], batches)]
+        )
+        sketch = sketches[layer_idx]
+        assert sketch.num_tokens == 2 * (8 + 6)
+        assert torch.equal(sketch.firing_counts, expected.sum(0))
+        dense = expected.float().t() @ expected.float()
+        dense.fill_diagonal_(0)
+        assert np.allclose(sketch.to_graph(normalize="count").toarray(), dense.numpy())
+
+
+if __name__ == "__main__":
+    test_coactivation_sketch_exact()
+    test_coactivation_sketch_top_neighbors()
+    test_balanced_graph_partition()
+    test_refine_partition()
+    test_coactivation_callback()
@@ -0,0 +1,79 @@
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from smoe.utils.expert_construction.gradient_importance import (
+    GradientImportanceScorer,
+)
+
+
+def _tiny_llama():
+    config = LlamaConfig(
+        vocab_size=64,
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    config._attn_implementation = "eager"
+    torch.manual_seed(0)
+    return LlamaForCausalLM(config)
+
+
+def test_gradient_importance_scores():
+    model = _tiny_llama()
+    gate_weights = {i: torch.randn(3, 16) for i in range(2)}
+    scorer = GradientImportanceScorer(model, gate_weights)
+
+    # reference: inputs and intermediate grads of every MLP, padding included
+    mlp_inputs, intermediates = {}, {}
+
+    def record_input(layer_id):
+        def hook(module, input, output):
+            mlp_inputs[layer_id] = input[0].detach()
+
+        return hook
+
+    def record_intermediate(layer_id):
+        def hook(module, input, output):
+            input[0].retain_grad()
+            intermediates[layer_id] = input[0]
+
+        return hook
+
+    for layer_id, layer in enumerate(model.model.layers):
+        layer.mlp.up_proj.register_forward_hook(record_input(layer_id))
+        layer.mlp.down_proj.register_forward_hook(record_intermediate(layer_id))
+
+    input_ids = torch.randint(0, 64, (2, 8))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, 5:] = 0
+    scorer.set_attention_mask(attention_mask)
+    model(
+        input_ids=input_ids, attention_mask=attention_mask, labels=input_ids
+    ).loss.backward()
+    scores = scorer.get_scores()
+
+    token_mask = attention_mask.bool().flatten()
+    for layer_id in range(2):
+        cluster_ids = (mlp_inputs[layer_id] @ gate_weights[layer_id].t()).argmax(-1)
+        importance = (
+            intermediates[layer_id].grad * intermediates[layer_id].detach()
+        ).abs()
+        counts = 0
+        for cluster_id in range(3):
+            mask = token_mask & (cluster_ids == cluster_id)
+            counts += scorer.token_count[layer_id][cluster_id].item()
+            assert scorer.token_count[layer_id][cluster_id] == mask.sum()
+            expected = importance[mask].sum(0) / max(mask.sum(), 1)
+            assert torch.allclose(scores[layer_id][cluster_id], expected, atol=1e-6)
+        assert counts == attention_mask.sum()
+
+    scorer.remove()
+    for layer in model.model.layers:
+        assert "forward" not in layer.mlp.__dict__
+        assert len(layer.mlp.down_proj._backward_hooks) == 0
+
+
+if __name__ == "__main__":
+    test_gradient_importance_scores()
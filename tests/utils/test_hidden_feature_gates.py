@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import torch
+
+from smoe.utils.expert_construction.hidden_feature_gates import (
+    cluster_gate_weights,
+    select_gate_weights,
+)
+
+
+def test_select_gate_weights():
+    features = torch.randn(32, 8)
+    gate_weights = select_gate_weights(
+        features, 4, generator=torch.Generator().manual_seed(0)
+    )
+    assert gate_weights.shape == (4, 8)
+    # selected without replacement
+    rows = {tuple(row.tolist()) for row in gate_weights}
+    assert len(rows) == 4
+    assert all(
+        tuple(row.tolist()) in {tuple(f.tolist()) for f in features}
+        for row in gate_weights
+    )
+
+
+def test_cluster_gate_weights():
+    rng = np.random.RandomState(0)
+    features = np.concatenate(
+        [rng.randn(16, 8) + 10 * i for i in range(4)], axis=0
+    ).astype(np.float32)
+    gate_weights = cluster_gate_weights(features, 4, random_state=0, n_init=1, n_jobs=1)
+    assert gate_weights.shape == (4, 8)
+    centers = sorted(gate_weights.mean(dim=1).tolist())
+    for i, center in enumerate(centers):
+        assert abs(center - 10 * i) < 1
+
+    gate_weights = cluster_gate_weights(
+        features, 4, distance_metric="cos", random_state=0, n_init=1, n_jobs=1
+    )
+    assert gate_weights.shape == (4, 8)
+
+    with pytest.raises(ValueError):
+        cluster_gate_weights(features, 4, distance_metric="l1")
+
+
+if __name__ == "__main__":
+    test_select_gate_weights()
+    test_cluster_gate_weights()
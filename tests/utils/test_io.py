@@ -0,0 +1,104 @@
+import os
+import tempfile
+
+import pytest
+import torch
+from transformers import LlamaConfig
+
+from smoe.utils.io import (
+    ArtifactStore,
+    load_artifacts,
+    pack_artifacts,
+    save_artifact_store,
+    torch_load_template_file,
+    torch_load_template_score_file,
+)
+
+
+def test_artifact_store_roundtrip():
+    config = LlamaConfig(hidden_size=16, intermediate_size=32, num_hidden_layers=2)
+    neuron_indices = {
+        0: [[0, 2, 4], [1, 3]],
+        1: {0: [5, 6], "residual": [7, 8, 9]},
+    }
+    gate_weights = {layer: torch.randn(4, 16) for layer in range(12)}
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "artifacts.safetensors")
+        save_artifact_store(
+            {"neuron_indices": neuron_indices, "gate_weights": gate_weights},
+            path,
+            config=config,
+            kind="test",
+        )
+        _check_store(load_artifacts(path), config, neuron_indices, gate_weights)
+
+
+def _check_store(store, config, neuron_indices, gate_weights):
+    assert isinstance(store, ArtifactStore)
+    assert store.manifest["kind"] == "test"
+    store.check_config(config)
+    with pytest.raises(ValueError):
+        store.check_config(LlamaConfig(hidden_size=8))
+
+    assert list(store) == ["gate_weights", "neuron_indices"]
+    assert store["neuron_indices"] == neuron_indices
+    assert store["neuron_indices/1"] == neuron_indices[1]
+    assert torch.equal(store["gate_weights"][1], gate_weights[1])
+    assert torch.equal(store.get_slice("gate_weights/0")[:, :4], gate_weights[0][:, :4])
+    assert "gate_weights/1" in store and "gate_weights/12" not in store
+    # layers in numeric order, as in the saved dict
+    assert list(store["gate_weights"]) == list(range(12))
+    assert store.children("gate_weights")[:3] == ["0", "1", "2"]
+    with pytest.raises(KeyError):
+        store["missing"]
+
+
+def test_pack_template_files():
+    with tempfile.TemporaryDirectory() as folder:
+        _check_pack_template_files(folder)
+
+
+def _check_pack_template_files(folder):
+    # per-layer label files & per-expert score folders
+    split_dir = os.path.join(folder, "split")
+    score_dir = os.path.join(folder, "scores")
+    template = "layers.{}.mlp.up_proj.weight"
+    labels, scores = {}, {}
+    for layer in range(2):
+        os.makedirs(split_dir, exist_ok=True)
+        labels[layer] = torch.randint(0, 4, (32,)).tolist()
+        torch.save(labels[layer], os.path.join(split_dir, template.format(layer)))
+        for expert in range(3):
+            os.makedirs(os.path.join(score_dir, str(expert)), exist_ok=True)
+            scores[layer, expert] = torch.randn(32)
+            torch.save(
+                scores[layer, expert],
+                os.path.join(score_dir, str(expert), template.format(layer)),
+            )
+
+    split_store = os.path.join(folder, "split.safetensors")
+    score_store = os.path.join(folder, "scores.safetensors")
+    pack_artifacts(split_dir, split_store)
+    pack_artifacts(score_dir, score_store)
+    for layer in range(2):
+        assert torch_load_template_file(split_store, template, layer) == labels[layer]
+        assert torch_load_template_file(split_dir, template, layer) == labels[layer]
+        packed = torch_load_template_score_file(score_store, template, layer)
+        unpacked = torch_load_template_score_file(score_dir, template, layer)
+        assert len(packed) == 3
+        for expert in range(3):
+            assert torch.equal(packed[expert], scores[layer, expert])
+            assert torch.equal(unpacked[expert], scores[layer, expert])
+
+    # single `torch.save` files
+    single_file = os.path.join(folder, "importance_scores.pt")
+    torch.save({0: {0: scores[0, 0], 1: scores[0, 1]}}, single_file)
+    pack_artifacts(single_file, os.path.join(folder, "importance_scores.safetensors"))
+    store = load_artifacts(os.path.join(folder, "importance_scores.safetensors"))
+    assert torch.equal(store[0][1], scores[0, 1])
+    assert store.manifest["source"] == single_file
+
+
+if __name__ == "__main__":
+    test_artifact_store_roundtrip()
+    test_pack_template_files()
@@ -0,0 +1,110 @@
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+from smoe.utils.expert_construction.neuron_overlap import (
+    indices_to_masks,
+    load_or_compute_overlap,
+    neuron_overlap_stats,
+    pack_neuron_masks,
+    popcount64,
+    selected_masks_from_scores,
+    selection_overlap_sweep,
+    unpack_neuron_masks,
+)
+
+
+def test_bitsets():
+    masks = np.random.default_rng(0).random((3, 5, 130)) < 0.3
+    bitsets = pack_neuron_masks(masks)
+    assert bitsets.shape == (3, 5, 3) and bitsets.dtype == np.uint64
+    assert np.array_equal(unpack_neuron_masks(bitsets, 130), masks)
+    assert np.array_equal(popcount64(bitsets).sum(-1), masks.sum(-1))
+
+    masks = indices_to_masks([[0, 2], [2, 3, 4]], 6)
+    assert masks.astype(int).tolist() == [[1, 0, 1, 0, 0, 0], [0, 0, 1, 1, 1, 0]]
+
+
+def test_neuron_overlap_stats():
+    torch.manual_seed(0)
+    num_experts, num_neurons = 6, 100
+    scores = torch.rand(2, num_experts, num_neurons)
+    masks = selected_masks_from_scores(scores, 30)
+    stats = neuron_overlap_stats(masks)
+    for layer_id in range(2):
+        # the dense computation
+        selected = torch.from_numpy(masks[layer_id]).int()
+        intersection = selected @ selected.t()
+        union = num_neurons - (1 - selected) @ (1 - selected).t()
+        sum_count = selected.sum(0)
+        overlap_count = torch.stack(
+            [
+                (selected.bool() & (sum_count == t + 1)).sum(1)
+                for t in range(num_experts)
+            ]
+        )
+        assert np.array_equal(stats["intersection"][layer_id], intersection.numpy())
+        assert np.array_equal(stats["union"][layer_id], union.numpy())
+        assert np.allclose(
+            stats["overlap_rate"][layer_id], (intersection / union).numpy()
+        )
+        assert np.array_equal(stats["overlap_count"][layer_id], overlap_count.numpy())
+        assert stats["total_neurons"][layer_id] == (sum_count > 0).sum()
+
+
+def test_selection_overlap_sweep():
+    torch.manual_seed(0)
+    num_experts, num_neurons = 4, 64
+    scores = torch.randn(2, num_experts, num_neurons)
+    expert_sizes = list(range(16, 65, 16))
+    sweep = selection_overlap_sweep(scores, expert_sizes, criterion="min")
+    for layer_id in range(2):
+        for size_id, expert_size in enumerate(expert_sizes):
+            masks = selected_masks_from_scores(
+                scores[layer_id], expert_size, criterion="min"
+            )
+            sum_count = masks.sum(0)
+            assert sweep["independent_neurons"][layer_id, size_id] == (
+                (sum_count > 0).sum()
+            )
+            for overlap_num in range(1, num_experts + 1):
+                assert sweep["overlap_neurons"][layer_id, size_id, overlap_num - 1] == (
+                    (sum_count == overlap_num).sum()
+                )
+
+
+def test_load_or_compute_overlap():
+    with tempfile.TemporaryDirectory() as folder:
+        source = os.path.join(folder, "scores.pt")
+        cache_file = os.path.join(folder, "scores.overlap.safetensors")
+        torch.save(torch.rand(1, 3, 32), source)
+        num_calls = []
+
+        def compute():
+            num_calls.append(1)
+            return neuron_overlap_stats(
+                selected_masks_from_scores(torch.load(source), 8)
+            )
+
+        stats = load_or_compute_overlap(cache_file, source, compute, expert_size=8)
+        cached = load_or_compute_overlap(cache_file, source, compute, expert_size=8)
+        assert len(num_calls) == 1
+        for key, value in stats.items():
+            assert np.array_equal(cached[key], value)
+
+        # recomputed for other arguments or changed scores
+        load_or_compute_overlap(cache_file, source, compute, expert_size=16)
+        assert len(num_calls) == 2
+        torch.save(torch.rand(1, 3, 32), source)
+        os.utime(source, ns=(0, 1))
+        load_or_compute_overlap(cache_file, source, compute, expert_size=16)
+        assert len(num_calls) == 3
+
+
+if __name__ == "__main__":
+    test_bitsets()
+    test_neuron_overlap_stats()
+    test_selection_overlap_sweep()
+    test_load_or_compute_overlap()
@@ -0,0 +1,97 @@
+import argparse
+import os
+import tempfile
+
+import torch
+
+from smoe.utils.expert_construction.parallel_split import (
+    ParallelLayerSplitter,
+    clustering_split_job,
+)
+
+
+def _threads_job(layer, shared, scale):
+    return {
+        "sum": shared[f"{layer}"].sum().item() * scale,
+        "threads": torch.get_num_threads(),
+        "omp": os.environ.get("OMP_NUM_THREADS"),
+        "shared": shared[f"{layer}"].is_shared(),
+        # tells reused results from recomputed ones
+        "token": torch.rand(1).item(),
+    }
+
+
+def test_parallel_layer_splitter():
+    shared = {f"{layer}": torch.full((4,), float(layer)) for layer in range(4)}
+    layer_kwargs = {layer: dict(scale=2) for layer in range(4)}
+    omp_num_threads = os.environ.get("OMP_NUM_THREADS")
+    results = ParallelLayerSplitter(num_workers=2, threads_per_worker=1).run(
+        _threads_job, layer_kwargs, shared=shared
+    )
+    assert list(results) == [0, 1, 2, 3]
+    for layer, result in results.items():
+        assert result["sum"] == layer * 4 * 2
+        assert result["threads"] == 1
+        assert result["omp"] == "1"
+        assert result["shared"]
+    # the limits are set for the workers only
+    assert os.environ.get("OMP_NUM_THREADS") == omp_num_threads
+
+
+def test_parallel_layer_splitter_resume():
+    shared = {f"{layer}": torch.full((4,), float(layer)) for layer in range(3)}
+    with tempfile.TemporaryDirectory() as folder:
+        splitter = ParallelLayerSplitter(num_workers=1, checkpoint_dir=folder)
+        first = splitter.run(
+            _threads_job, {0: dict(scale=1), 1: dict(scale=1)}, shared=shared
+        )
+        assert sorted(os.listdir(folder)) == ["layer0.pt", "layer1.pt", "manifest.json"]
+
+        # finished layers of the same job are loaded
+        results = ParallelLayerSplitter(num_workers=1, checkpoint_dir=folder).run(
+            _threads_job, {layer: dict(scale=1) for layer in range(3)}, shared=shared
+        )
+        assert [results[layer]["sum"] for layer in range(3)] == [0, 4, 8]
+        assert [results[layer]["token"] for layer in range(2)] == [
+            first[layer]["token"] for layer in range(2)
+        ]
+
+        # other kwargs: recomputed
+        results = splitter.run(
+            _threads_job, {layer: dict(scale=10) for layer in range(3)}, shared=shared
+        )
+        assert [results[layer]["sum"] for layer in range(3)] == [0, 40, 80]
+
+        # other shared tensors: recomputed
+        shared["1"] = torch.full((4,), 5.0)
+        results = splitter.run(
+            _threads_job, {layer: dict(scale=10) for layer in range(3)}, shared=shared
+        )
+        assert results[1]["sum"] == 200
+
+
+def test_clustering_split_job():
+    torch.manual_seed(0)
+    template = "layers.{}.mlp.up_proj.weight"
+    # two well separated directions per layer
+    centers = torch.randn(2, 8) * 10
+    state_dict = {
+        template.format(layer): centers.repeat_interleave(6, 0) + torch.randn(12, 8)
+        for layer in range(2)
+    }
+    config = argparse.Namespace(num_experts=2)
+    results = ParallelLayerSplitter(num_workers=1).run(
+        clustering_split_job,
+        {layer: dict(config=config, template=template) for layer in range(2)},
+        shared=state_dict,
+    )
+    for layer in range(2):
+        labels = results[layer]
+        assert len(set(labels[:6])) == 1 and len(set(labels[6:])) == 1
+        assert labels[0] != labels[6]
+
+
+if __name__ == "__main__":
+    test_parallel_layer_splitter()
+    test_parallel_layer_splitter_resume()
+    test_clustering_split_job()
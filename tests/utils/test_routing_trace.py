@@ -0,0 +1,139 @@
+import tempfile
+
+import numpy as np
+import torch
+from torch import nn
+
+from smoe.modules.moe.moe_layers import LinearGLUMoELayer
+from smoe.utils.routing_trace import (
+    RoutingTrace,
+    RoutingTraceRecorder,
+    bf16_bits_to_float32,
+)
+
+
+class ToyRouter(nn.Module):
+    """Mixtral-style block: a linear router followed by softmax top-k"""
+
+    def __init__(self, hidden_size, num_experts, top_k):
+        super().__init__()
+        self.top_k = top_k
+        self.gate = nn.Linear(hidden_size, num_experts, bias=False)
+        self.experts = nn.ModuleList(
+            [nn.Linear(hidden_size, hidden_size) for _ in range(num_experts)]
+        )
+
+    def forward(self, x):
+        x = x.reshape(-1, x.shape[-1])
+        weights, experts = torch.topk(self.gate(x).softmax(-1), self.top_k, dim=-1)
+        weights = weights / weights.sum(-1, keepdim=True)
+        out = torch.zeros_like(x)
+        for k in range(self.top_k):
+            for idx, expert in enumerate(self.experts):
+                mask = (experts[:, k] == idx).unsqueeze(1)
+                out = out + mask * weights[:, k : k + 1] * expert(x)
+        return out
+
+
+class ToyMoEModel(nn.Module):
+    def __init__(self, vocab_size=50, hidden_size=16, num_experts=4):
+        super().__init__()
+        self.embed = nn.Embedding(vocab_size, hidden_size)
+        self.moe = LinearGLUMoELayer(
+            input_size=hidden_size,
+            hidden_size=hidden_size,
+            output_size=hidden_size,
+            hidden_act="silu",
+            num_experts=num_experts,
+            num_selects=2,
+            gate_network="linear",
+            gate_add_noise=False,
+        )
+        nn.init.normal_(self.moe.gate.gate_network.weight)
+        self.router = ToyRouter(hidden_size, num_experts, top_k=2)
+
+    def forward(self, input_ids, attention_mask=None):
+        x = self.embed(input_ids)
+        x = x + self.moe(x).hidden_states
+        return x + self.router(x).reshape(x.shape)
+
+
+def test_routing_trace():
+    torch.manual_seed(0)
+    model = ToyMoEModel().eval()
+    routed = []
+
+    def _record_reference(module, args, output):
+        scores = output.softmax(-1)
+        weights, experts = scores.topk(2, dim=-1)
+        routed.append((experts, weights / weights.sum(-1, keepdim=True)))
+
+    model.moe.gate.register_forward_hook(
+        lambda m, a, o: routed.append((o["topK_indices"], o["topK_scores"]))
+    )
+    model.router.gate.register_forward_hook(_record_reference)
+
+    ref_tokens, ref_experts, ref_weights = [], [], []
+    with tempfile.TemporaryDirectory() as folder:
+        with RoutingTraceRecorder(
+            model, folder, chunk_size=16, vocab_size=50
+        ) as recorder:
+            assert len(recorder.gates) == 2
+            with torch.no_grad():
+                for _ in range(3):
+                    input_ids = torch.randint(0, 50, (2, 7))
+                    attention_mask = torch.ones_like(input_ids)
+                    attention_mask[0, :3] = 0
+                    routed.clear()
+                    model(input_ids, attention_mask=attention_mask)
+                    keep = attention_mask.reshape(-1).bool()
+                    ref_tokens.append(input_ids.reshape(-1)[keep])
+                    ref_experts.append(torch.stack([e for e, _ in routed], 1)[keep])
+                    ref_weights.append(torch.stack([w for _, w in routed], 1)[keep])
+
+        ref_tokens = torch.cat(ref_tokens).numpy()
+        ref_experts = torch.cat(ref_experts).numpy()
+        ref_weights = torch.cat(ref_weights).numpy()
+
+        trace = RoutingTrace(folder)
+        assert len(trace) == len(ref_tokens) == 33
+        assert [c["num_tokens"] for c in trace.meta["chunks"]] == [22, 11]
+        chunks = list(trace.iter_chunks())
+        np.testing.assert_array_equal(
+            np.concatenate([c["tokens"] for c in chunks]), ref_tokens
+        )
+        np.testing.assert_array_equal(
+            np.concatenate([c["experts"] for c in chunks]), ref_experts
+        )
+        weights = bf16_bits_to_float32(np.concatenate([c["weights"] for c in chunks]))
+        np.testing.assert_allclose(weights, ref_weights, atol=1e-2)
+
+        load = trace.expert_load()
+        for layer_idx in range(2):
+            np.testing.assert_array_equal(
+                load[layer_idx],
+                np.bincount(ref_experts[:, layer_idx].reshape(-1), minlength=4),
+            )
+            co_occurrence = trace.co_occurrence(layer_idx)
+            np.testing.assert_array_equal(np.diag(co_occurrence), load[layer_idx])
+            np.testing.assert_array_equal(co_occurrence, co_occurrence.T)
+        np.testing.assert_allclose(
+            trace.expert_load(weighted=True).sum(1), [33, 33], atol=0.1
+        )
+
+        transitions = trace.layer_transitions(0)
+        assert transitions.sum() == 33 * 2 * 2
+        np.testing.assert_array_equal(transitions.sum(1), load[0] * 2)
+
+        specialization = trace.token_specialization(1)
+        assert specialization.shape == (50, 4)
+        np.testing.assert_array_equal(specialization.sum(0), load[1])
+        token = ref_tokens[0]
+        np.testing.assert_array_equal(
+            specialization[token],
+            np.bincount(ref_experts[ref_tokens == token, 1].reshape(-1), minlength=4),
+        )
+
+
+if __name__ == "__main__":
+    test_routing_trace()
@@ -0,0 +1,97 @@
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+from smoe.utils.telemetry import (
+    DomainTokenCounter,
+    RoutingStatsAccumulator,
+    TelemetryEventWriter,
+    read_telemetry_events,
+    stats_to_logs,
+)
+
+
+def test_routing_stats_accumulator():
+    acc = RoutingStatsAccumulator()
+    for i in range(4):
+        acc.update(
+            balance_loss=torch.tensor(float(i)),
+            num_dropped_tokens=(torch.tensor(i), torch.tensor(2 * i)),
+            gate_load=(torch.ones(8) * i, torch.ones(8)),
+            gate_importance=None,
+        )
+    acc.flush(10)
+    results = acc.collect()
+    assert len(results) == 1
+    step, stats = results[0]
+    assert step == 10
+    assert "gate_importance" not in stats
+    assert np.isclose(stats["balance_loss"], 1.5)
+    assert np.allclose(stats["num_dropped_tokens"], [1.5, 3.0])
+    assert stats["gate_load"].shape == (2, 8)
+    assert np.allclose(stats["gate_load"][0], 1.5)
+
+    logs = stats_to_logs(stats)
+    assert isinstance(logs["balance_loss"], float)
+    assert len(logs["gate_load"]) == 2
+
+    # accumulators are reset after flushing, host buffers are reused
+    acc.update(balance_loss=torch.tensor(3.0))
+    acc.flush(20)
+    ((step, stats),) = acc.collect(blocking=True)
+    assert step == 20 and np.isclose(stats["balance_loss"], 3.0)
+    assert acc.num_pending == 0
+
+
+def test_domain_token_counter():
+    counter = DomainTokenCounter(["en_cc", "github", "arxiv"])
+    input_ids = torch.ones(3, 8, dtype=torch.long)
+    attention_mask = torch.ones(3, 8, dtype=torch.long)
+    attention_mask[1, 5:] = 0
+    counter.update(input_ids, attention_mask, domain_ids=torch.tensor([0, 1, 0]))
+    # packed blocks without padding
+    counter.update(input_ids[:2], domain_ids=torch.tensor([2, 2]))
+    counter.update(input_ids[:1])
+    assert counter.reduce() == {"en_cc": 16, "github": 5, "arxiv": 16, "unknown": 8}
+    # counts are reset after reducing, the reduction is applied across "ranks"
+    counter.update(input_ids, domain_ids=torch.tensor([1, 1, 1]))
+    counts = counter.reduce(lambda tensor: tensor * 2)
+    assert counts == {"en_cc": 0, "github": 48, "arxiv": 0}
+    assert counter.reduce() == {"en_cc": 0, "github": 0, "arxiv": 0}
+
+    # without domains, everything is unknown
+    counter = DomainTokenCounter()
+    counter.update(input_ids, domain_ids=torch.tensor([0, 1, 2]))
+    assert counter.reduce() == {"unknown": 24}
+
+
+def test_telemetry_event_file():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filepath = os.path.join(temp_dir, "telemetry_events.bin")
+        writer = TelemetryEventWriter(filepath)
+        writer.write(1, {"balance_loss": np.array(0.5), "gate_load": np.eye(3)})
+        writer.close()
+        # appending keeps a single file header
+        writer = TelemetryEventWriter(filepath)
+        writer.write(2, {"num_dropped_tokens": [1.0, 2.0]})
+        writer.close()
+        with open(filepath, "ab") as fout:
+            fout.write(b"\x00\x01")  # truncated tail
+
+        events = list(read_telemetry_events(filepath))
+        assert [(e["step"], e["name"]) for e in events] == [
+            (1, "balance_loss"),
+            (1, "gate_load"),
+            (2, "num_dropped_tokens"),
+        ]
+        assert events[0]["value"].shape == ()
+        assert np.array_equal(events[1]["value"], np.eye(3, dtype=np.float32))
+        assert np.array_equal(events[2]["value"], [1.0, 2.0])
+
+
+if __name__ == "__main__":
+    test_routing_stats_accumulator()
+    test_domain_token_counter()
+    test_telemetry_event_file()
@@ -0,0 +1,89 @@
+import tempfile
+
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+from smoe.utils.text_clustering import EmbeddingStore, TextClustering
+
+
+class _TopicEncoder:
+    """Texts are `"{topic} {idx}"`, encoded around one of a few fixed centers"""
+
+    def __init__(self, dim=8):
+        self.centers = np.random.default_rng(0).normal(size=(4, dim)) * 10
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False):
+        topics = np.array([int(s.split()[0]) for s in sentences])
+        noise = np.random.default_rng(len(sentences)).normal(
+            size=(len(sentences), self.centers.shape[1])
+        )
+        return (self.centers[topics] + noise).astype(np.float32)
+
+
+def test_streaming_text_clustering():
+    texts = [f"{i % 4} {i}" for i in range(1000)]
+    clustering = TextClustering(
+        num_clusters=4,
+        encoder=_TopicEncoder(),
+        encode_batch_size=64,
+        kmeans_batch_size=128,
+    )
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = clustering.encode_to_store(iter(texts), temp_dir, flush_size=300)
+        assert len(store) == 1000
+        store = EmbeddingStore.open(temp_dir)
+        assert store.array.dtype == np.float16
+        assert store.array.shape == (1000, 8)
+
+        clustering.fit_emb(store, num_epochs=2)
+        assert isinstance(clustering.kmeans, MiniBatchKMeans)
+        labels = clustering.predict_store(
+            store, chunk_size=256, output_path=f"{temp_dir}/labels.npy"
+        )
+        assert np.array_equal(np.load(f"{temp_dir}/labels.npy"), labels)
+
+        # every topic is mapped to a single cluster
+        topics = np.arange(1000) % 4
+        for topic in range(4):
+            assert len(set(labels[topics == topic].tolist())) == 1
+        assert len(set(labels.tolist())) == 4
+
+        # nearest-centroid search agrees with sklearn
+        emb = store.array[:200].astype(np.float32)
+        assert clustering.predict_emb(emb, chunk_size=64) == (
+            clustering.kmeans.predict(emb).tolist()
+        )
+
+        clustering.save_pretrained(temp_dir)
+        loaded = TextClustering.from_pretrained(temp_dir, encoder=_TopicEncoder())
+        assert loaded.num_clusters == 4
+        assert loaded.predict(texts[:8]) == labels[:8].tolist()
+
+
+def test_in_memory_text_clustering():
+    texts = [f"{i % 4} {i}" for i in range(200)]
+    clustering = TextClustering(
+        num_clusters=4, encoder=_TopicEncoder(), kmeans_batch_size=32
+    )
+    emb = clustering.encode_emb(texts)
+
+    # in-memory arrays are fitted with full-batch k-means
+    clustering.fit(texts)
+    assert isinstance(clustering.kmeans, KMeans)
+    labels = clustering.predict_emb(emb)
+    assert labels == clustering.kmeans.predict(emb).tolist()
+    assert len(set(labels)) == 4
+
+    # unless mini-batch k-means is explicitly requested
+    clustering.fit_emb(emb, num_epochs=2, minibatch=True)
+    assert isinstance(clustering.kmeans, MiniBatchKMeans)
+    assert clustering.num_clusters == 4
+    topics = np.arange(200) % 4
+    labels = np.array(clustering.predict_emb(emb))
+    for topic in range(4):
+        assert len(set(labels[topics == topic].tolist())) == 1
+
+
+if __name__ == "__main__":
+    test_streaming_text_clustering()
+    test_in_memory_text_clustering()
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+import torch
+
+from smoe.utils.visualization.tsne_torch_model import (
+    TorchTSNE,
+    _binary_search_perplexity,
+    _joint_probabilities_knn,
+    _knn_torch,
+    _pca_torch_chunked,
+    _repulsive_forces_fft,
+)
+
+
+def _clusters(num_clusters=4, num_per_cluster=100, dim=32):
+    torch.manual_seed(0)
+    centers = torch.randn(num_clusters, dim) * 5
+    X = torch.cat([center + torch.randn(num_per_cluster, dim) for center in centers])
+    labels = torch.arange(num_clusters).repeat_interleave(num_per_cluster)
+    return X, labels
+
+
+def _neighbour_purity(Y, labels, k=10):
+    D = torch.cdist(Y, Y)
+    D.fill_diagonal_(float("inf"))
+    indices = D.topk(k, largest=False).indices
+    return (labels[indices] == labels[:, None]).float().mean().item()
+
+
+def test_knn_and_p_values():
+    X = torch.randn(300, 8)
+    # a tiny memory budget, one row per chunk
+    distances, indices = _knn_torch(X, 10, max_memory_bytes=1)
+    D = torch.cdist(X, X) ** 2
+    D.fill_diagonal_(float("inf"))
+    ref_distances, ref_indices = D.topk(10, largest=False)
+    assert torch.equal(indices, ref_indices)
+    assert torch.allclose(distances, ref_distances, atol=1e-4)
+
+    P = _binary_search_perplexity(distances, perplexity=5.0)
+    entropy = -(P * torch.log(P + 1e-12)).sum(1)
+    assert torch.allclose(P.sum(1), torch.ones(300), atol=1e-5)
+    assert torch.allclose(entropy, torch.full((300,), np.log(5.0)), atol=1e-3)
+
+    rows, cols, values = _joint_probabilities_knn(P, indices)
+    assert (rows < cols).all()
+    dense = torch.zeros(300, 300)
+    dense[torch.arange(300).repeat_interleave(10), indices.reshape(-1)] = P.reshape(-1)
+    dense = (dense + dense.t()) / (2 * 300)
+    assert torch.allclose(values, dense[rows, cols], atol=1e-7)
+    assert abs(2 * values.sum().item() - 1) < 1e-5
+
+
+def test_pca_chunked():
+    X = torch.randn(200, 16) @ torch.randn(16, 16)
+    Y = _pca_torch_chunked(X.numpy(), "cpu", no_dims=4, max_memory_bytes=1024)
+    variances = Y.var(0)
+    assert (variances[:-1] >= variances[1:]).all()
+    # the projection keeps the top eigenvalues of the covariance
+    eigenvalues = torch.linalg.eigvalsh(torch.cov(X.t()))
+    assert torch.allclose(variances, eigenvalues.flip(0)[:4], rtol=1e-3)
+
+
+@pytest.mark.parametrize("scale", [1e-3, 1.0, 10.0])
+def test_repulsive_forces_fft(scale):
+    torch.manual_seed(0)
+    Y = torch.randn(500, 2) * scale
+    q = 1.0 / (1.0 + torch.cdist(Y, Y) ** 2)
+    q.fill_diagonal_(0)
+    Z = q.sum()
+    ref = (Y * (q**2).sum(1, keepdim=True) - torch.mm(q**2, Y)) / Z
+
+    forces, Z_fft = _repulsive_forces_fft(Y)
+    assert abs(Z_fft.item() / Z.item() - 1) < 1e-2
+    assert ((forces - ref).norm() / ref.norm()).item() < 5e-2
+
+
+@pytest.mark.parametrize("method", ["exact", "fft"])
+def test_torch_tsne(method):
+    X, labels = _clusters()
+    Y = TorchTSNE(
+        perplexity=10.0, n_iter=300, initial_dims=16, device="cpu", method=method
+    ).fit_transform(X)
+    assert Y.shape == (400, 2)
+    assert torch.isfinite(Y).all()
+    assert _neighbour_purity(Y, labels) > 0.95
+
+    with pytest.raises(ValueError):
+        TorchTSNE(method="barnes_hut")
+
+
+if __name__ == "__main__":
+    test_knn_and_p_values()
+    test_pca_chunked()
+    test_repulsive_forces_fft(1.0)
+    test_torch_tsne("fft")